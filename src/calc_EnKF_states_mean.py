@@ -2,7 +2,7 @@
 ''' This script calculates average of EnKF updated states across all ensemble members.
 
     Usage:
-        $ python calc_EnKF_states_mean.py <config_file (of run_data_assim)>
+        $ python calc_EnKF_states_mean.py <config_file (of run_data_assim)> [nproc]
 '''
 
 import sys
@@ -12,13 +12,18 @@ import pandas as pd
 from collections import OrderedDict
 
 from tonic.io import read_config, read_configobj
-from da_utils import calculate_ensemble_mean_states
+from da_utils import calculate_ensemble_mean_states, EnsembleWorkerPool
 
 # ============================================================ #
 # Process command line arguments
 # ============================================================ #
 # Read config file
 cfg = read_configobj(sys.argv[1])
+# Number of processors for calculating different time points in parallel
+if len(sys.argv) > 2:
+    nproc = int(sys.argv[2])
+else:
+    nproc = 1
 
 
 # ============================================================ #
@@ -67,7 +72,7 @@ EnKF_dirs['logs'] = os.path.join(EnKF_basedir, 'logs')
 # ============================================================ #
 print('Calculating ensemble-mean of the updates states...')
 
-# --- Calculate ensemble-mean for the initial time point --- #
+# --- Identify state files of the initial time point --- #
 init_time = start_time
 # Create a list of state file nc paths
 state_dir = os.path.join(EnKF_dirs['states'], 'init.{}_{:05d}'.format(
@@ -76,17 +81,11 @@ state_dir = os.path.join(EnKF_dirs['states'], 'init.{}_{:05d}'.format(
 list_state_nc = []
 for i in range(N):
     list_state_nc.append(os.path.join(state_dir, 'state.ens{}.nc'.format(i+1)))
-# Calculate ensemble-mean states
-print('\tInitial time')
-init_state_mean_nc = calculate_ensemble_mean_states(
-                            list_state_nc,
-                            out_state_nc=os.path.join(state_dir, 'state.ens_mean.nc'))
+list_args = [(list_state_nc, os.path.join(state_dir, 'state.ens_mean.nc'))]
 
-# Loop over each measurement time point of updates states
-dict_assigned_state_nc = OrderedDict()  #  An ordered dict of state times and nc files after the initial time
+# --- Identify state files of each measurement time point of updates states --- #
 for t, time in enumerate(pd.to_datetime(da_meas['time'].values)):
     state_time = pd.to_datetime(time)
-    print('\t', state_time)
     # Create a list of state file nc paths
     state_dir = os.path.join(EnKF_dirs['states'], 'updated.{}_{:05d}'.format(
                                 state_time.strftime('%Y%m%d'),
@@ -95,8 +94,16 @@ for t, time in enumerate(pd.to_datetime(da_meas['time'].values)):
     for i in range(N):
         list_state_nc.append(os.path.join(state_dir,
                                           'state.ens{}.nc'.format(i+1)))
-    # Calculate ensemble-mean states
-    dict_assigned_state_nc[time] = calculate_ensemble_mean_states(
-        list_state_nc,
-        out_state_nc=os.path.join(state_dir, 'state.ens_mean.nc'))
+    list_args.append((list_state_nc,
+                      os.path.join(state_dir, 'state.ens_mean.nc')))
+
+# --- Calculate ensemble-mean states for all time points --- #
+# (each time point streams through its member state files one at a time)
+pool = EnsembleWorkerPool(nproc)
+list_mean_nc = pool.map(calculate_ensemble_mean_states, list_args)
+pool.close()
+init_state_mean_nc = list_mean_nc[0]
+dict_assigned_state_nc = OrderedDict()  #  An ordered dict of state times and nc files after the initial time
+for time, mean_nc in zip(pd.to_datetime(da_meas['time'].values), list_mean_nc[1:]):
+    dict_assigned_state_nc[time] = mean_nc
 
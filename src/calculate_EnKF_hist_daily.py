@@ -47,6 +47,12 @@ start_year = pd.to_datetime(cfg['EnKF']['start_time']).year
 end_year = pd.to_datetime(cfg['EnKF']['end_time']).year
 hist_output_dir = os.path.join(cfg['CONTROL']['root_dir'], cfg['OUTPUT']['output_EnKF_basedir'],
                                'history', 'EnKF_ensemble_concat')
+# (If the EnKF run already aggregated history to daily, nothing to do)
+out_daily_nc = os.path.join(hist_output_dir,
+    'history.daily.ens{}.concat.{}_{}.nc'.format(i, start_year, end_year))
+if os.path.isfile(out_daily_nc):
+    print('{} already exists; skip calculating daily history'.format(out_daily_nc))
+    sys.exit()
 ds_hist = xr.open_dataset(os.path.join(hist_output_dir,
         'history.ens{}.concat.{}_{}.nc'.format(i, start_year, end_year)))
 # --- Calculate daily runoff only --- #
@@ -54,10 +60,7 @@ da_runoff_daily = ds_hist['OUT_RUNOFF'].resample('1D', dim='time', how='sum')
 da_baseflow_daily = ds_hist['OUT_BASEFLOW'].resample('1D', dim='time', how='sum')
 # --- Save daily runoff to file --- #
 ds_hist_daily = xr.Dataset({'OUT_RUNOFF': da_runoff_daily, 'OUT_BASEFLOW': da_baseflow_daily})
-to_netcdf_history_file_compress(
-    ds_hist_daily,
-    os.path.join(hist_output_dir,
-        'history.daily.ens{}.concat.{}_{}.nc'.format(i, start_year, end_year)))
+to_netcdf_history_file_compress(ds_hist_daily, out_daily_nc)
 
 
 
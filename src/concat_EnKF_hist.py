@@ -48,6 +48,13 @@ end_year = pd.to_datetime(cfg['EnKF']['end_time']).year
 hist_output_dir = os.path.join(cfg['CONTROL']['root_dir'], cfg['OUTPUT']['output_EnKF_basedir'],
                                'history', 'EnKF_ensemble_concat')
 
+# --- If the EnKF run already appended all years into one file, nothing to do --- #
+out_nc = os.path.join(hist_output_dir,
+    'history.ens{}.concat.{}_{}.nc'.format(i, start_year, end_year))
+if os.path.isfile(out_nc):
+    print('{} already exists; skip concatenating'.format(out_nc))
+    sys.exit()
+
 list_ds = []
 for y in range(start_year, end_year+1):
     ds = xr.open_dataset(os.path.join(hist_output_dir,
@@ -55,10 +62,7 @@ for y in range(start_year, end_year+1):
     list_ds.append(ds)
 ds_allyears = xr.concat(list_ds, dim='time')
 # --- Save to file --- #
-to_netcdf_history_file_compress(
-    ds_allyears,
-    os.path.join(hist_output_dir,
-        'history.ens{}.concat.{}_{}.nc'.format(i, start_year, end_year)))
+to_netcdf_history_file_compress(ds_allyears, out_nc)
 # --- Clean up --- #
 for y in range(start_year, end_year+1):
     os.remove(os.path.join(hist_output_dir, 'history.ens{}.concat.{}.nc'.format(i, y)))
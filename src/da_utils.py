@@ -3,12 +3,18 @@ import numpy as np
 import pandas as pd
 import os
 import string
+import numbers
 from collections import OrderedDict
 import xarray as xr
+import netCDF4
 import datetime as dt
 import multiprocessing as mp
 import shutil
 import scipy.linalg as la
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.signal import lfilter
+from scipy.optimize import fminbound
+from scipy.io import loadmat
 import glob
 import xesmf as xe
 import pickle
@@ -23,6 +29,97 @@ class VICReturnCodeError(Exception):
     pass
 
 
+class SoilMoistureStateView(object):
+    ''' This class is a lightweight view of VIC soil moisture states in the
+        EnKF layout. The EnKF layout is exposed as a strided view over the VIC
+        array; data are only copied when the view cannot be reshaped in place.
+
+    Atributes
+    ---------
+    sm: <np.array>
+        VIC soil moisture states
+        Dimension: [veg_class, snow_band, nlayer, lat, lon]
+    nveg, nsnow, nlayer, nlat, nlon: <int>
+        Number of veg classes, snow bands, soil layers, lat and lon
+    n: <int>
+        Number of EnKF states (nlayer * nveg * nsnow)
+
+    Methods
+    ---------
+    tiles(self)
+        Returns a [lat, lon, nlayer, veg_class, snow_band] view of sm
+    enkf(self, copy=False)
+        Returns the states in EnKF layout [lat, lon, n]
+    to_vic(self, x, out=None)
+        Converts EnKF-layout states back to VIC layout
+
+    Require
+    ---------
+    numpy
+    '''
+
+    __slots__ = ('sm', 'nveg', 'nsnow', 'nlayer', 'nlat', 'nlon', 'n')
+
+    def __init__(self, sm):
+        self.sm = sm
+        self.nveg, self.nsnow, self.nlayer, self.nlat, self.nlon = sm.shape
+        self.n = self.nlayer * self.nveg * self.nsnow
+
+    def tiles(self):
+        ''' Returns a strided (zero-copy) view of sm in dimension
+            [lat, lon, nlayer, veg_class, snow_band] '''
+        return np.transpose(self.sm, (3, 4, 2, 0, 1))
+
+    def enkf(self, copy=False):
+        ''' Returns the soil moisture states in EnKF layout
+
+        Parameters
+        ----------
+        copy: <bool>
+            If True, always return a new array that can be modified
+            without changing sm; if False, a view of sm is returned when
+            the memory layout allows (otherwise a copy).
+            Default: False
+
+        Returns
+        ----------
+        x: <np.array>
+            Soil moisture states, with n ordered as
+            [nlayer, veg_class, snow_band]
+            Dimension: [lat, lon, n]
+        '''
+        x = self.tiles()
+        if copy:
+            x = x.copy()
+        return x.reshape([self.nlat, self.nlon, self.n])
+
+    def to_vic(self, x, out=None):
+        ''' Converts soil moisture states in EnKF layout back to VIC layout
+
+        Parameters
+        ----------
+        x: <np.array>
+            Soil moisture states in EnKF layout
+            Dimension: [lat, lon, n] or [nloop, n] or [nloop, n, 1]
+        out: <np.array> or None
+            Array to write into; if None, a new array is allocated
+            Dimension: [veg_class, snow_band, nlayer, lat, lon]
+            Default: None
+
+        Returns
+        ----------
+        out: <np.array>
+            Soil moisture states in VIC layout
+            Dimension: [veg_class, snow_band, nlayer, lat, lon]
+        '''
+        if out is None:
+            out = np.empty(self.sm.shape, dtype=np.result_type(self.sm, x))
+        np.copyto(np.transpose(out, (3, 4, 2, 0, 1)),
+                  x.reshape([self.nlat, self.nlon, self.nlayer,
+                             self.nveg, self.nsnow]))
+        return out
+
+
 class States(object):
     ''' This class is a VIC states object
 
@@ -30,6 +127,11 @@ class States(object):
     ---------
     ds: <xarray.dataset>
         A dataset of VIC states
+    view: <class SoilMoistureStateView>
+        EnKF-layout view of the soil moisture states in ds
+    da_EnKF: <xarray.DataArray>
+        Soil moisture states in EnKF layout [lat, lon, n] (built on first
+        access; read-only)
     
     Methods
     ---------
@@ -43,16 +145,48 @@ class States(object):
     xarray
     '''
 
+    __slots__ = ('ds', 'view', '_da_EnKF')
     
     def __init__(self, ds):
         self.ds = ds
-        self.da_EnKF = self.convert_VICstates_to_EnKFstates_sm()
+        self.view = SoilMoistureStateView(ds['STATE_SOIL_MOISTURE'].values)
+        self._da_EnKF = None
+
+
+    @property
+    def da_EnKF(self):
+        if self._da_EnKF is None:
+            self.convert_VICstates_to_EnKFstates_sm()
+        return self._da_EnKF
+
+
+    def wrap_EnKFstates_sm(self, x):
+        ''' Wraps an array of EnKF-layout soil moisture states into a
+            DataArray with the coordinates of self.ds (without copying x)
+
+        Parameters
+        ----------
+        x: <np.array>
+            Soil moisture states in EnKF layout
+            Dimension: [lat, lon, n] or [nloop, n] or [nloop, n, 1]
+
+        Returns
+        ----------
+        da: <xr.DataArray>
+            Dimension: [lat, lon, n]
+        '''
+        return xr.DataArray(
+            x.reshape([self.view.nlat, self.view.nlon, self.view.n]),
+            coords=[self.ds['lat'], self.ds['lon'], range(self.view.n)],
+            dims=['lat', 'lon', 'n'])
     
     
     def convert_VICstates_to_EnKFstates_sm(self):
         ''' This function extracts all the soil moisture states from the original
             VIC state file ds, and converts to a da with dimension [lat, lon, n],
             where n is the total number of states in EnKF.
+            NOTE: the returned da may share memory with self.ds, and is
+            therefore read-only; copy it before modifying.
         
         Returns
         ----------
@@ -61,46 +195,28 @@ class States(object):
             Dimension: [lat, lon, n],
                 where len(n) = len(nlayer) * len(veg_class) * len(snow_band)
         '''
-             
-        # Extract coordinates
-        veg_class = self.ds['veg_class']
-        snow_band = self.ds['snow_band']
-        nlayer = self.ds['nlayer']
-        lat = self.ds['lat']
-        lon = self.ds['lon']
-        
-        # Initialize new DataArray
-        n = len(veg_class) * len(snow_band) * len(nlayer)
-        data = np.empty([len(lat), len(lon), n])
-        data[:] = np.nan
-        da_EnKF = xr.DataArray(data,
-                               coords=[lat, lon, range(n)],
-                               dims=['lat', 'lon', 'n'])
-        
-        # Extract soil moisture states and convert dimension
-        EnKF_states = np.rollaxis(self.ds['STATE_SOIL_MOISTURE'].values,
-                                  2, 0)  # [nlayer, veg_class, snow_band, lat, lon]
-        EnKF_states = EnKF_states.reshape([n, len(lat), len(lon)])
-        
-        # roll the 'n' dimension to after lat and lon, and fill in da
-        EnKF_states = np.rollaxis(EnKF_states, 0, 3) 
-        da_EnKF[:] = EnKF_states
-        
+
+        # Reshape to EnKF layout (a view of self.ds where possible)
+        x = self.view.enkf()
+        x.flags.writeable = False
+
         # Save as self.da_EnKF
-        self.da_EnKF = da_EnKF
+        self._da_EnKF = self.wrap_EnKFstates_sm(x)
         
-        return self.da_EnKF
+        return self._da_EnKF
     
     
     def convert_new_EnKFstates_sm_to_VICstates(self, da_EnKF):
         ''' This function converts an EnKF states da (soil moisture states) to the
             VIC states ds (self.ds), with all the other state variables as original in self.ds
             - as a returned ds, withouth changing self.ds.
+            NOTE: only the soil moisture variable is newly allocated; all the
+            other state variables in the returned ds share memory with self.ds
         
         Parameters
         ----------
-        da_EnKF: <xr.DataArray>
-            An DataArray of EnKF states, in dimension [lat, lon, n]
+        da_EnKF: <xr.DataArray> or <np.array>
+            An DataArray (or array) of EnKF states, in dimension [lat, lon, n]
             
         Returns
         ----------
@@ -109,25 +225,13 @@ class States(object):
             state variables = those in self.ds
         '''
         
-        # Extract coordinates
-        veg_class = self.ds['veg_class']
-        snow_band = self.ds['snow_band']
-        nlayer = self.ds['nlayer']
-        lat = self.ds['lat']
-        lon = self.ds['lon']
-        
-        # Initialize a new ds for new VIC states
-        ds = self.ds.copy(deep=True)
-        
-        # Convert da_EnKF dimension
-        EnKF_states_reshape = da_EnKF.values.reshape(len(lat), len(lon), len(nlayer),
-                                                     len(veg_class), len(snow_band))
-        EnKF_states_reshape = np.rollaxis(EnKF_states_reshape, 2, 5)  # roll nlayer to the last
-        EnKF_states_reshape = np.rollaxis(EnKF_states_reshape, 0, 5)  # put lat and lon to the last
-        EnKF_states_reshape = np.rollaxis(EnKF_states_reshape, 0, 5)
-        
-        # Fill into VIC states ds
-        ds['STATE_SOIL_MOISTURE'][:] = EnKF_states_reshape
+        # Convert da_EnKF to VIC layout
+        sm = self.view.to_vic(np.asarray(da_EnKF))
+
+        # Put into a shallow copy of self.ds
+        ds = self.ds.copy(deep=False)
+        ds['STATE_SOIL_MOISTURE'] = self.ds['STATE_SOIL_MOISTURE'].copy(
+            deep=False, data=sm)
         
         return ds
         
@@ -182,66 +286,37 @@ class States(object):
             Default: True (adjust negative to zero)
         '''
 
-        # Extract the number of EnKF states
-        n = len(self.da_EnKF['n'])
-
-        # Extract coordinates
-        lat = self.ds['lat']
-        lon = self.ds['lon']
-        veg_class = self.ds['veg_class']
-        snow_band = self.ds['snow_band']
-        nlayer = self.ds['nlayer']
-        
-        # Determine total number of loops
-        nloop = len(lat) * len(lon)
-        n = len(nlayer) * len(veg_class) * len(snow_band)
+        # Determine the number of EnKF states and total number of loops
+        n = self.view.n
+        nloop = self.view.nlat * self.view.nlon
         
         # --- If prescribed_noise = None:
         # Generate N(0, 1) random noise for whole domain and all states
+        # (drawn in one call; same sequence as drawing one scalar at a time)
         if prescribed_noise is None:
             if seed is None:
-                noise = np.array(list(map(
-                            np.random.normal,
-                            np.zeros(nloop*n),
-                            np.ones(nloop*n))))  # [nloop*n]
+                noise = np.random.normal(0, 1, size=[nloop, n])  # [nloop, n]
             else:
                 rng = np.random.RandomState(seed)
-                noise = np.array(list(map(
-                            rng.normal,
-                            np.zeros(nloop*n),
-                            np.ones(nloop*n))))  # [nloop*n]
-            noise = noise.reshape([nloop, n])  # [nloop, n]
+                noise = rng.normal(0, 1, size=[nloop, n])  # [nloop, n]
+            noise = noise[:, :, np.newaxis]  # [nloop, n, 1]
         # --- If prescribed_noise != None, directly use prescribed noise
         else:
-            noise = prescribed_noise.reshape([nloop, n])
-
-        # Apply transformation --> multivariate random noise
-        noise = np.array(list(map(
-            lambda j: np.dot(L, noise[j, :].reshape([n, 1])),
-            range(nloop))))  # [nloop, n, 1]
-        noise = noise.reshape([nloop, n])  # [nloop, n]
-        # Apply layer perturbation scale
-        noise = noise * scale_n_nloop  # [nloop, n]
-        noise = noise.reshape([len(lat), len(lon), n])  # [lat, lon, n]
-
-        # Add noise to soil moisture field
-        da_perturbed = self.da_EnKF.copy(deep=True)
-        da_perturbed[:] += noise
-
-        # Reset negative perturbed soil moistures to zero
-        sm_new = da_perturbed.values
-        if adjust_negative:
-            sm_new[sm_new<0] = 0
+            noise = prescribed_noise.reshape([nloop, n, 1])
 
-        # Reset perturbed soil moistures above maximum to maximum
-        max_moist = da_max_moist_n.values
-        sm_new[(sm_new>max_moist)] = max_moist[(sm_new>max_moist)]
+        # Apply transformation --> multivariate random noise; apply layer
+        # perturbation scale
+        noise = generate_sm_perturbation_ensemble(
+                    L, scale_n_nloop, 1,
+                    prescribed_noise_ensemble=noise)  # [nloop, n, 1]
 
-        # Put into da
-        da_perturbed[:] = sm_new
+        # Add noise to soil moisture field and reset to within [0, max]
+        sm_new = self.view.enkf().reshape([nloop, n, 1]) + noise
+        clip_soil_moisture_states(sm_new, da_max_moist_n.values.reshape([nloop, n]),
+                                  adjust_negative)
 
         # Put the perturbed soil moisture states back to VIC states ds
-        ds = self.convert_new_EnKFstates_sm_to_VICstates(da_perturbed)
+        ds = self.convert_new_EnKFstates_sm_to_VICstates(sm_new)
         
         return ds
 
@@ -292,52 +367,27 @@ class States(object):
 
         # --- Extract dimensions --- #
         m = len(da_y_est['m'])
-        n = len(self.da_EnKF['n'])
-        lat_coord = self.da_EnKF['lat']
-        lon_coord = self.da_EnKF['lon']
-
-        # --- Initiate updated DataArray for states --- #
-        da_x_updated = self.da_EnKF.copy(deep=True)  # [lat, lon, n]
+        n = self.view.n
+        lat_coord = self.ds['lat']
+        lon_coord = self.ds['lon']
 
         # --- Update states --- #
         # Determine the total number of loops
         nloop = len(lat_coord) * len(lon_coord)
         # Generate random measurement perturbation
-        R_flat = R.reshape([nloop])
-        if seed is None:
-            v = np.random.normal(
-                    0, np.sqrt(R_flat), size=nloop).reshape([nloop, m, 1])  # [nloop, m, 1]
-        else:
-            rng = np.random.RandomState(seed)
-            v = rng.normal(
-                    0, np.sqrt(R_flat), size=nloop).reshape([nloop, m, 1])  # [nloop, m, 1]
+        v = generate_meas_perturbation_ensemble(R, [seed])  # [nloop, m, 1]
         # Convert xr.DataArray's to np.array's and straighten lat and lon into nloop
+        x = self.view.enkf(copy=True).reshape([nloop, n, 1])  # [nloop, n, 1]
         K = da_K.values.reshape([nloop, n, m])  # [nloop, n, m]
-        y_meas = da_y_meas.values.reshape([nloop, m, 1])  # [nloop, m, 1]
-        y_est = da_y_est.values.\
-                    reshape([nloop, m, 1])  # [nloop, m, 1]
-        # Calculate delta = K * (y_meas + v - y_est)
-        delta = np.array(list(map(
-                    lambda j: np.dot(K[j, :, :],
-                                     y_meas[j, :, :] + v[j, :, :] - y_est[j, :, :]),
-                    range(nloop))))  # [nloop, n, 1]
-        delta[np.isnan(delta)] = 0
-        # Reshape delta
-        delta = delta.reshape([len(lat_coord), len(lon_coord), n])  # [lat, lon, n]
-        # Update states - add delta to orig. states
-        da_x_updated[:] += delta
-
-        # --- Reset negative updated soil moistures to zero --- #
-        x_new = da_x_updated[:].values
-        if adjust_negative:
-            x_new[x_new<0] = 0
-
-        # --- Reset updated soil moistures above maximum to maximum --- #
-        max_moist = da_max_moist_n.values
-        x_new[(x_new>max_moist)] = max_moist[(x_new>max_moist)]
-
+        y_meas = da_y_meas.values.reshape([nloop, m])  # [nloop, m]
+        y_est = da_y_est.values.reshape([nloop, m, 1])  # [nloop, m, 1]
+        max_moist = da_max_moist_n.values.reshape([nloop, n])  # [nloop, n]
+        # Update states (x + K * (y_meas + v - y_est)) and reset
+        # negative/above-maximum soil moistures
+        x = update_soil_moisture_states_ensemble(
+                x, K, y_meas, y_est, v, max_moist, adjust_negative)
         # --- Put into da --- #
-        da_x_updated[:] = x_new
+        da_x_updated = self.wrap_EnKFstates_sm(x)  # [lat, lon, n]
 
         # --- Save measurement perturbation v to da --- #
         v = v.reshape([len(lat_coord), len(lon_coord), m])  # [lat, lon, m]
@@ -575,14 +625,7 @@ class Forcings(object):
                             size=(self.time_len, self.lat_len, self.lon_len))
 
         # --- AR(1) process --- #
-        # Initialize
-        ar1 = np.empty([self.time_len, self.lat_len, self.lon_len])
-        # Generate data for the first time point (need to double check how to do this!!!!!)
-        ar1[0, :, :] = white_noise[0, :, :]
-        # Loop over each time point
-        for t in range(1, self.time_len):
-            ar1[t, :, :] = mu + phi * (ar1[t-1, :, :] - mu) +\
-                              white_noise[t, :, :]
+        ar1 = generate_ar1_process(white_noise, phi, mu)  # [time, lat, lon]
 
         # --- Calculate final noise by taking exp --- #
         noise = np.exp(ar1)
@@ -672,56 +715,812 @@ class VarToPerturb(object):
         mu = 0
         
         # Generate random noise for the whole field
-        da_noise = self.da.copy(deep=True)
-        da_noise[:] = np.nan
-        for lt in self.lat:
-            for lg in self.lon:
-                sigma = da_sigma.loc[lt, lg].values
-                if np.isnan(sigma) is True or sigma <= 0:  # if inactive cell, skip
-                    continue
-                # Calculate std of white noise and generate random white noise
-                scale = sigma * np.sqrt(1 - phi * phi)
-                if seed is None:
-                    white_noise = np.random.normal(
-                            loc=0, scale=scale,
-                            size=(len(self.time)))
-                    # da_noise.loc[:, lt, lg] = np.random.normal(
-                    #        loc=0, scale=sigma, size=len(self.time))
-                else:
-                    rng = np.random.RandomState(seed)
-                    white_noise = rng.normal(
-                            loc=0, scale=scale,
-                            size=(len(self.time)))
-                # --- AR(1) process --- #
-                # Initialize
-                ar1 = np.empty(len(self.time))
-                # Generate data for the first time point (need to double check how to do this!!!!!)
-                ar1[0] = white_noise[0]
-                # Loop over each time point
-                for t in range(1, len(self.time)):
-                    ar1[t] = mu + phi * (ar1[t-1] - mu) + white_noise[t]
-                # --- Put final noise into da --- #
-                da_noise.loc[:, lt, lg] = ar1
+        # (cells with sigma <= 0 are not perturbed and get NaN noise)
+        sigma = da_sigma.values  # [lat, lon]
+        active = ~(sigma <= 0)  # [lat, lon]
+        nt = len(self.time)
+        # Calculate std of white noise and generate random white noise
+        # for all active cells [time, n_active]; without a seed, the
+        # global seed draws one time series for each cell in turn
+        scale = sigma[active] * np.sqrt(1 - phi * phi)  # [n_active]
+        if seed is None:
+            white_noise = np.random.standard_normal(
+                            size=(len(scale), nt)).T * scale
+        else:
+            rng = np.random.RandomState(seed)
+            white_noise = rng.standard_normal(size=(nt, 1)) * scale
+        # --- AR(1) process --- #
+        noise = np.full([nt, len(self.lat), len(self.lon)], np.nan)
+        noise[:, active] = generate_ar1_process(white_noise, phi, mu)
                 
         # Add noise to the original da
-        da_perturbed = self.da + da_noise
+        da_perturbed = self.da + noise
         # Set negative to zero
         tmp = da_perturbed.values
         if adjust_negative:
             tmp[tmp<0] = 0
         # Set perturbed values above maximum to maximum values
         max_values = da_max_values.values  # [lat, lon]
-        for i in range(len(self.lat)):
-            for j in range(len(self.lon)):
-                tmp[(tmp[:, i, j]>max_values[i, j]), i, j] = max_values[i, j]
+        tmp = np.where(tmp > max_values, max_values, tmp)
         # Put into da
         da_perturbed[:] = tmp
         # Add attrs back
         da_perturbed.attrs = self.da.attrs
-        
+
         return da_perturbed
 
 
+class MismatchedGridWeights(object):
+    ''' This class holds sparse remapping weights from a source (e.g., VIC)
+        grid to a target (e.g., measurement) grid, together with a compact
+        per-target index table of contributing source cells. Weights are
+        loaded and normalized once.
+
+    Atributes
+    ---------
+    A: <scipy.sparse.csr_matrix>
+        Weights as in the weight file. Dimension: [n_target, n_source]
+        (a target cell not overlapping any active source cell has all its
+        weights = -1; see process_weight_file)
+    n_target: <int>
+        Number of target grid cells
+    n_source: <int>
+        Number of source grid cells
+    len_x_source: <int>
+        Length of x (lon) in the 2D domain of source
+    offsets: <np.array>
+        Contributing source cells of target cell i are entries
+        offsets[i]:offsets[i+1] of the arrays below
+        Dimension: [n_target+1]
+    source_ind1D: <np.array>
+        1D index of each contributing source cell. Dimension: [n_entries]
+    target_ind1D: <np.array>
+        1D index of the target cell of each entry. Dimension: [n_entries]
+    weight_target: <np.array>
+        Original weights, adding up to 1 for each target cell.
+        Dimension: [n_entries]
+    weight_source: <np.array>
+        Weights normalized for each source cell (adding up to 1 for each
+        source cell). Dimension: [n_entries]
+    nan_target: <np.array>
+        Whether a target cell does not overlap with any active source cell.
+        Dimension: [n_target]
+
+    Require
+    ---------
+    numpy
+    scipy.sparse
+    '''
+
+    def __init__(self, A, len_x_source):
+        self.A = csr_matrix(A)
+        self.A.sum_duplicates()
+        self.n_target, self.n_source = self.A.shape
+        self.len_x_source = len_x_source
+        # Keep only positive (i.e., contributing) weights
+        A_pos = self.A.multiply(self.A > 0).tocsr()
+        A_pos.eliminate_zeros()
+        A_pos.sort_indices()
+        self.offsets = A_pos.indptr.astype(np.int64)
+        self.source_ind1D = A_pos.indices.astype(np.int64)
+        self.target_ind1D = np.repeat(np.arange(self.n_target, dtype=np.int64),
+                                      np.diff(self.offsets))
+        self.weight_target = A_pos.data
+        # Calculate weights normalized for each SOURCE grid cell
+        source_sum = np.asarray(A_pos.sum(axis=0)).ravel()  # [n_source]
+        self.weight_source = A_pos.data / source_sum[self.source_ind1D]
+        # Target cells with negative weights do not overlap with any
+        # valid source cell
+        self.nan_target = np.asarray(self.A.sum(axis=1)).ravel() < 0
+        # Sparse operator for distributing entry values back to source cells
+        n_entries = len(self.source_ind1D)
+        self._scatter_matrix = csr_matrix(
+            (self.weight_source, (self.source_ind1D, np.arange(n_entries))),
+            shape=[self.n_source, n_entries])
+
+
+    @property
+    def n_contrib(self):
+        ''' Number of contributing source cells for each target cell '''
+        return np.diff(self.offsets)
+
+
+    def source_ind2D(self):
+        ''' Return 2D index (lat_ind, lon_ind) of each contributing source
+            cell; each is of dimension [n_entries] '''
+        return (self.source_ind1D // self.len_x_source,
+                self.source_ind1D % self.len_x_source)
+
+
+    def remap(self, data):
+        ''' Remap source-grid data to the target grid
+
+        Parameters
+        ----------
+        data: <np.array>
+            Source data. Dimension: [..., n_source]
+
+        Returns
+        ----------
+        remapped: <np.array>
+            Remapped data; NAN for target cells that do not overlap with
+            any valid source cell. Dimension: [..., n_target]
+        '''
+
+        extra_shape = data.shape[:-1]
+        remapped = (self.A @ data.reshape([-1, self.n_source]).T).T
+        remapped = np.asarray(remapped).reshape(
+            list(extra_shape) + [self.n_target])
+        remapped[..., self.nan_target] = np.nan
+
+        return remapped
+
+
+    def gather(self, data):
+        ''' Gather source-grid data for all contributing source cells of
+            all target cells (in the order of the index table)
+
+        Parameters
+        ----------
+        data: <np.array>
+            Source data. Dimension: [n_source, ...]
+
+        Returns
+        ----------
+        <np.array>
+            Dimension: [n_entries, ...]
+        '''
+
+        return data[self.source_ind1D]
+
+
+    def scatter(self, values):
+        ''' Distribute values of all entries in the index table back to
+            source cells, weighted by weight_source (i.e., the inverse of
+            gather() for quantities such as update increments)
+
+        Parameters
+        ----------
+        values: <np.array>
+            Dimension: [n_entries, ...]
+
+        Returns
+        ----------
+        <np.array>
+            Weighted sum for each source cell. Dimension: [n_source, ...]
+        '''
+
+        extra_shape = values.shape[1:]
+        out = self._scatter_matrix @ values.reshape([len(values), -1])
+
+        return np.asarray(out).reshape([self.n_source] + list(extra_shape))
+
+
+class ObservationOperator(object):
+    ''' This class is the observation operator H of the EnKF, built once from
+        the tile fractions: the estimated measurement of a grid cell,
+        y_est = Hx, is the tile-fraction-weighted sum of top-layer soil
+        moisture over all veg/snowband tiles (tiles with NaN are skipped).
+
+    Atributes
+    ---------
+    da_tile_frac: <xr.DataArray>
+        Fraction of each veg/snowband in each grid cell for the whole domain
+        Dimension: [veg_class, snow_band, lat, lon]
+    H: <np.array>
+        Weights of the top-layer tiles of each grid cell (NaN set to zero).
+        In the EnKF state vector of a grid cell, the top-layer states are the
+        first n_tile = nveg * nsnow states.
+        Dimension: [nloop, n_tile] (where nloop = lat * lon)
+    nveg, nsnow, nlat, nlon: <int>
+        Number of veg classes, snow bands, lat and lon
+
+    Require
+    ---------
+    numpy
+    xarray
+    determine_tile_frac
+    '''
+
+    def __init__(self, da_tile_frac):
+        self.da_tile_frac = da_tile_frac
+        self.nveg, self.nsnow, self.nlat, self.nlon = da_tile_frac.shape
+        tile_frac = da_tile_frac.values.reshape(
+            [self.nveg * self.nsnow, self.nlat * self.nlon])
+        self.H = np.ascontiguousarray(np.nan_to_num(tile_frac).T)
+
+
+    @classmethod
+    def from_global(cls, global_path):
+        ''' Build the operator from a VIC global parameter file '''
+        return cls(determine_tile_frac(global_path))
+
+
+    @property
+    def n_tile(self):
+        ''' Number of veg/snowband tiles in each grid cell '''
+        return self.nveg * self.nsnow
+
+
+    def y_est(self, x):
+        ''' Estimated measurement of all grid cells and ensemble members,
+            in one contraction
+
+        Parameters
+        ----------
+        x: <np.array>
+            EnKF states of all ensemble members
+            Dimension: [nloop, n, N]
+
+        Returns
+        ----------
+        y_est: <np.array>
+            Dimension: [nloop, N]
+        '''
+        x_top = np.nan_to_num(x[:, :self.n_tile, :])  # [nloop, n_tile, N]
+        return np.einsum('kt,ktN->kN', self.H, x_top)
+
+
+    def cell_average(self, da_tiles):
+        ''' Tile-fraction-weighted sum of any variable over all
+            veg/snowband tiles (e.g., for cell-average diagnostics)
+
+        Parameters
+        ----------
+        da_tiles: <xr.DataArray>
+            Dimension: [..., veg_class, snow_band, ..., lat, lon] (any order)
+
+        Returns
+        ----------
+        da_cellAvg: <xr.DataArray>
+            Dimension: the same as da_tiles without veg_class and snow_band
+        '''
+        return (da_tiles * self.da_tile_frac).sum(dim='veg_class').sum(dim='snow_band')
+
+
+class EnsembleStateStore(object):
+    ''' This class keeps the soil moisture states of all ensemble members in
+        one (optionally memory-mapped) array, so that states are passed between
+        EnKF steps in memory. VIC-format state files are only materialized
+        when VIC needs them; all state variables other than soil moisture are
+        taken from a template state file of each member.
+
+    Atributes
+    ---------
+    sm: <np.array> or <np.memmap>
+        Soil moisture states of all ensemble members
+        Dimension: [n_member, veg_class, snow_band, nlayer, lat, lon]
+    dims: <tuple>
+        Dimension names of VIC state "STATE_SOIL_MOISTURE" variable
+    coords: <OrderedDict>
+        Coordinates of VIC state "STATE_SOIL_MOISTURE" variable
+    attrs: <dict>
+        Attributes of VIC state "STATE_SOIL_MOISTURE" variable
+    list_template_nc: <list>
+        For each member, path of a VIC state file providing state variables
+        other than soil moisture
+    filename: <str> or None
+        Path of the backing .npy file if memory-mapped; None if in memory
+
+    Require
+    ---------
+    numpy
+    save_updated_states
+    '''
+
+    def __init__(self, da_sm, n_member, filename=None):
+        shape = (n_member,) + da_sm.shape
+        if filename is None:
+            self.sm = np.empty(shape)
+        else:
+            self.sm = np.lib.format.open_memmap(filename, mode='w+',
+                                                dtype=np.float64, shape=shape)
+        self.dims = da_sm.dims
+        self.coords = OrderedDict((dim, da_sm[dim].values) for dim in da_sm.dims)
+        self.attrs = dict(da_sm.attrs)
+        self.list_template_nc = [None] * n_member
+        self.filename = filename
+
+
+    @property
+    def n_member(self):
+        ''' Number of ensemble members (including the reference member for
+            bias correction, if any) '''
+        return self.sm.shape[0]
+
+
+    @classmethod
+    def from_nc(cls, list_state_nc, filename=None):
+        ''' Initialize a store from VIC state files of all members '''
+        with xr.open_dataset(list_state_nc[0]) as ds:
+            da_sm = ds['STATE_SOIL_MOISTURE'].load()
+        store = cls(da_sm, len(list_state_nc), filename)
+        store.load_nc(list_state_nc)
+        return store
+
+
+    @classmethod
+    def from_array(cls, sm, da_sm, list_template_nc):
+        ''' Initialize an in-memory store on an existing soil moisture array
+            of all members (not copied); da_sm (one member) provides the
+            dims, coords and attrs '''
+        store = cls(da_sm, 0)
+        store.sm = sm
+        store.list_template_nc = list(list_template_nc)
+        return store
+
+
+    def load_nc(self, list_state_nc):
+        ''' Load soil moisture states from VIC state files (in the order of
+            members); these files also become the template files '''
+        for i, state_nc in enumerate(list_state_nc):
+            self.load_member_nc(i, state_nc)
+
+
+    def load_member_nc(self, i, state_nc):
+        ''' Load soil moisture states of member i (index starting from 0)
+            from a VIC state file; the file also becomes its template file '''
+        with xr.open_dataset(state_nc) as ds:
+            self.sm[i] = ds['STATE_SOIL_MOISTURE'].values
+        self.list_template_nc[i] = state_nc
+
+
+    def set_sm(self, list_da_sm, list_template_nc=None):
+        ''' Replace soil moisture states (in the order of members, starting
+            from the first member); optionally replace the template files '''
+        for i, da_sm in enumerate(list_da_sm):
+            self.sm[i] = np.asarray(da_sm)
+        if list_template_nc is not None:
+            self.list_template_nc[:len(list_template_nc)] = list_template_nc
+
+
+    def get_da(self, i):
+        ''' Return soil moisture states of member i (index starting from 0) as
+            an xr.DataArray in the structure of VIC state file
+            "STATE_SOIL_MOISTURE" variable (a view on the store) '''
+        return xr.DataArray(np.asarray(self.sm[i]),
+                            coords=list(self.coords.values()),
+                            dims=self.dims, attrs=self.attrs)
+
+
+    def list_da(self, n=None):
+        ''' Return a list of soil moisture states of the first n members
+            (all members if n is None) '''
+        if n is None:
+            n = self.n_member
+        return [self.get_da(i) for i in range(n)]
+
+
+    def to_nc(self, list_out_nc, compress=True, nproc=1, pool=None,
+              wait=True):
+        ''' Materialize VIC state files for the first len(list_out_nc)
+            members
+
+        Parameters
+        ----------
+        list_out_nc: <list>
+            Output VIC state file paths, in the order of members
+        compress: <bool>
+            Whether to compress the output files; set False for temporary
+            files only read by VIC
+        nproc: <int>
+            Number of processors to use for writing files
+        pool: <class EnsembleWorkerPool> or None
+            Worker pool to use; if None, a pool of nproc processors is
+            created for this call only. If the store is memory-mapped,
+            workers read soil moisture from the store file.
+        wait: <bool>
+            If False, only submit the writes to pool and return the pending
+            results (see EnsembleWorkerPool.wait); soil moisture is then
+            passed by value, so the store may be modified while the files
+            are written. Requires pool.
+
+        Returns
+        ----------
+        list_pending: <list> (only if wait is False)
+            Pending results of the writes
+        '''
+
+        if not wait:
+            if pool is None:
+                raise ValueError('A worker pool is required for wait=False')
+            return pool.submit(
+                save_updated_states,
+                [(self.list_template_nc[i], self.get_da(i).copy(), out_nc, compress)
+                 for i, out_nc in enumerate(list_out_nc)])
+        if pool is not None and self.filename is not None:
+            self.sm.flush()
+            pool.map(save_store_member_states,
+                     [(self.list_template_nc[i], self.filename, i, out_nc, compress)
+                      for i, out_nc in enumerate(list_out_nc)])
+        else:
+            if pool is None:
+                worker_pool = EnsembleWorkerPool(nproc)
+            else:
+                worker_pool = pool
+            worker_pool.map(save_updated_states,
+                            [(self.list_template_nc[i], self.get_da(i), out_nc, compress)
+                             for i, out_nc in enumerate(list_out_nc)])
+            if pool is None:
+                worker_pool.close()
+
+
+    def snapshot(self, filename, list_template_nc=None):
+        ''' Atomically save the store to a pickle file, for restarting; if
+            list_template_nc is not None, it is saved as the template files
+            instead of the current ones. Only the template file paths and
+            metadata are saved (not soil moisture), so the template files
+            must hold the current soil moisture states of the store (e.g.,
+            the updated state files) '''
+        if list_template_nc is None:
+            list_template_nc = self.list_template_nc
+        tmp_filename = '{}.tmp'.format(filename)
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump({'dims': self.dims, 'coords': self.coords,
+                         'attrs': self.attrs,
+                         'list_template_nc': list(list_template_nc)}, f)
+        os.replace(tmp_filename, filename)
+
+
+    @classmethod
+    def restore(cls, filename, memmap_filename=None):
+        ''' Restore a store saved by snapshot(); soil moisture states are
+            reloaded from the saved template files '''
+        with open(filename, 'rb') as f:
+            dict_store = pickle.load(f)
+        store = cls.from_nc(dict_store['list_template_nc'], memmap_filename)
+        store.attrs = dict_store['attrs']
+        return store
+
+
+class EnsembleStateReducer(object):
+    ''' This class calculates the ensemble-mean (or median) VIC states by
+        streaming through ensemble members one at a time. Running sums are
+        kept for the variables averaged by mean; only the (snow) variables
+        reduced by median are buffered for all members.
+
+    Atributes
+    ---------
+    N: <int>
+        Ensemble size
+    n_added: <int>
+        Number of members added so far
+    ds_template: <xr.Dataset>
+        State dataset of the first member; variables not reduced are taken
+        from it
+    dict_sum: <OrderedDict>
+        Running sum of each mean variable
+    dict_stack: <OrderedDict>
+        Values of all members of each median variable
+        Dimension of each: [N, <variable dims>]
+
+    Methods
+    ---------
+    add(self, ds)
+        Add the states of one ensemble member
+    result(self)
+        Return the ensemble-mean states as a VIC state dataset
+
+    Require
+    ---------
+    numpy
+    xarray
+    '''
+
+    # State variables averaged by mean
+    list_mean_var = ['STATE_SOIL_MOISTURE', 'STATE_SOIL_ICE',
+                     'STATE_CANOPY_WATER', 'STATE_SOIL_NODE_TEMP',
+                     'STATE_FOLIAGE_TEMPERATURE', 'STATE_ENERGY_LONGUNDEROUT']
+    # State variables reduced by median
+    list_median_var = ['STATE_SNOW_AGE', 'STATE_SNOW_MELT_STATE',
+                       'STATE_SNOW_COVERAGE', 'STATE_SNOW_WATER_EQUIVALENT',
+                       'STATE_SNOW_SURF_TEMP', 'STATE_SNOW_SURF_WATER',
+                       'STATE_SNOW_PACK_TEMP', 'STATE_SNOW_PACK_WATER',
+                       'STATE_SNOW_DENSITY', 'STATE_SNOW_COLD_CONTENT',
+                       'STATE_SNOW_CANOPY', 'STATE_ENERGY_SNOW_FLUX']
+    # Median variables that are integers (median is rounded)
+    list_integer_var = ['STATE_SNOW_AGE', 'STATE_SNOW_MELT_STATE']
+
+    def __init__(self, N):
+        self.N = N
+        self.n_added = 0
+        self.ds_template = None
+        self.dict_sum = OrderedDict()
+        self.dict_stack = OrderedDict()
+
+
+    def add(self, ds):
+        ''' Add the states of one ensemble member (an xr.Dataset of VIC
+            states) '''
+        if self.n_added == self.N:
+            raise ValueError('All {} ensemble members have already been '
+                             'added'.format(self.N))
+        # Keep the first member as template and allocate running results
+        if self.ds_template is None:
+            self.ds_template = ds.copy(deep=True).load()
+            for var in self.list_mean_var:
+                self.dict_sum[var] = np.zeros(ds[var].shape)
+            for var in self.list_median_var:
+                self.dict_stack[var] = np.empty((self.N,) + ds[var].shape,
+                                                dtype=ds[var].dtype)
+        # Accumulate
+        for var in self.list_mean_var:
+            self.dict_sum[var] += ds[var].values
+        for var in self.list_median_var:
+            self.dict_stack[var][self.n_added] = ds[var].values
+        self.n_added += 1
+
+
+    def result(self):
+        ''' Return the ensemble-mean (or median) states as a VIC state
+            dataset '''
+        if self.n_added != self.N:
+            raise ValueError('Only {} of {} ensemble members have been '
+                             'added'.format(self.n_added, self.N))
+        ds_mean = self.ds_template.copy(deep=False)
+        for var in self.list_mean_var:
+            ds_mean[var] = ds_mean[var].copy(data=self.dict_sum[var] / self.N)
+        for var in self.list_median_var:
+            median = np.nanmedian(self.dict_stack[var], axis=0)
+            if var in self.list_integer_var:
+                median = median.round()
+            ds_mean[var] = ds_mean[var].copy(
+                data=median.astype(ds_mean[var].dtype))
+        return ds_mean
+
+
+class HistoryAppender(object):
+    ''' This class is an append-only history sink of one ensemble member.
+        The history records of each VIC run period are appended to one
+        netCDF file with an unlimited time dimension as soon as the run
+        finishes; if the time period of the new records overlaps that of
+        the existing records, the new values are used (the same as
+        concat_vic_history_files). Daily aggregates (sum) of selected
+        variables can be maintained on the fly in a separate file.
+
+    Atributes
+    ---------
+    out_nc: <str>
+        Path of the output history netCDF file
+    out_daily_nc: <str> or None
+        Path of the output daily history netCDF file; None for no daily
+        aggregates
+    list_daily_var: <list>
+        Variables to aggregate to daily (sum)
+
+    Methods
+    ---------
+    append(self, history_nc, delete=True)
+        Append the records of a VIC history file
+
+    Require
+    ---------
+    netCDF4
+    numpy
+    xarray
+    to_netcdf_history_file_compress
+    '''
+
+    def __init__(self, out_nc, out_daily_nc=None, list_daily_var=None):
+        self.out_nc = out_nc
+        self.out_daily_nc = out_daily_nc
+        if list_daily_var is None:
+            list_daily_var = []
+        self.list_daily_var = list_daily_var
+
+
+    def append(self, history_nc, delete=True):
+        ''' Append the records of a VIC history file (and update the daily
+            aggregates of the days it covers); the history file is deleted
+            afterwards if delete is True '''
+        with xr.open_dataset(history_nc) as ds:
+            ds = ds.load()
+        times = pd.to_datetime(ds['time'].values)
+        # --- Append to history file --- #
+        if not os.path.isfile(self.out_nc):
+            to_netcdf_history_file_compress(ds, self.out_nc,
+                                            unlimited_dims=['time'])
+        else:
+            with netCDF4.Dataset(self.out_nc, 'a') as nc:
+                istart = self._find_time_index(nc, times)
+                self._write_records(nc, ds, istart)
+        # --- Update daily aggregates --- #
+        if self.out_daily_nc is not None:
+            self._update_daily(times.floor('D').unique())
+        # --- Clean up --- #
+        if delete:
+            os.remove(history_nc)
+
+
+    def _time_to_num(self, nc, times):
+        ''' Converts times to the numeric time values of nc; also returns
+            the numeric length of one second '''
+        units = nc.variables['time'].units
+        calendar = getattr(nc.variables['time'], 'calendar', 'standard')
+        t = netCDF4.date2num(list(times.to_pydatetime()), units, calendar)
+        one_sec = netCDF4.date2num(
+            times[0].to_pydatetime() + dt.timedelta(seconds=1),
+            units, calendar) - t[0]
+        return np.asarray(t), one_sec
+
+
+    def _find_time_index(self, nc, times):
+        ''' Returns the time index in nc of the first of the new times (the
+            end of the existing records if no overlap). Existing records
+            after the new ones (e.g., when re-running from a restart time)
+            are kept until they are overwritten by later appends. '''
+        t, one_sec = self._time_to_num(nc, times)
+        t_exist = np.asarray(nc.variables['time'][:])
+        # Minus 1 second to avoid resolution issue
+        return int(np.searchsorted(t_exist, t[0] - one_sec))
+
+
+    def _write_records(self, nc, ds, istart):
+        ''' Writes all time-dependent variables of ds to nc from time index
+            istart '''
+        nt = len(ds['time'])
+        t, _ = self._time_to_num(nc, pd.to_datetime(ds['time'].values))
+        nc.variables['time'][istart:istart+nt] = t
+        for var in ds.data_vars:
+            if 'time' not in ds[var].dims or var not in nc.variables:
+                continue
+            ind = [slice(None)] * len(ds[var].dims)
+            ind[ds[var].dims.index('time')] = slice(istart, istart+nt)
+            nc.variables[var][tuple(ind)] = ds[var].values
+
+
+    def _update_daily(self, days):
+        ''' Recalculates the daily aggregates of days from the history file '''
+        # --- Sum up the records of each day --- #
+        with xr.open_dataset(self.out_nc) as ds_hist:
+            times = pd.to_datetime(ds_hist['time'].values)
+            istart = np.searchsorted(times, days[0])
+            iend = np.searchsorted(times, days[-1] + pd.DateOffset(days=1))
+            ds_daily = ds_hist[self.list_daily_var].isel(
+                time=slice(istart, iend)).load()
+            time_encoding = {key: ds_hist['time'].encoding[key]
+                             for key in ['units', 'calendar', 'dtype']
+                             if key in ds_hist['time'].encoding}
+        ds_daily.coords['day'] = ('time', times[istart:iend].floor('D'))
+        ds_daily = ds_daily.groupby('day').sum(dim='time')
+        ds_daily = ds_daily.rename({'day': 'time'})
+        ds_daily['time'].encoding = time_encoding
+        # --- Write to daily file --- #
+        if not os.path.isfile(self.out_daily_nc):
+            to_netcdf_history_file_compress(ds_daily, self.out_daily_nc,
+                                            unlimited_dims=['time'])
+        else:
+            with netCDF4.Dataset(self.out_daily_nc, 'a') as nc:
+                istart = self._find_time_index(
+                    nc, pd.to_datetime(ds_daily['time'].values))
+                self._write_records(nc, ds_daily, istart)
+
+
+class EnsembleWorkerPool(object):
+    ''' This class is a long-lived pool of worker processes, reused for all
+        ensemble tasks of a run (e.g., all measurement time points of the
+        EnKF driver). Large read-only inputs can be broadcast once to the
+        workers as memory-mapped .npy files (e.g., the original prec in
+        SMART post-processing), so that each task only needs to carry the
+        ensemble member index (and file paths).
+
+    Atributes
+    ---------
+    nproc: <int>
+        Number of worker processes; if 1, tasks are run in the current
+        process
+    pool: <mp.Pool> or None
+        Worker processes; None if nproc == 1
+    broadcast_dir: <str> or None
+        Directory of broadcast .npy files
+    dict_broadcast: <dict>
+        Broadcast .npy file path of each broadcast name
+
+    Require
+    ---------
+    multiprocessing
+    numpy
+    load_broadcast
+    '''
+
+    def __init__(self, nproc=1, broadcast_dir=None):
+        self.nproc = nproc
+        if nproc > 1:
+            self.pool = mp.Pool(processes=nproc)
+        else:
+            self.pool = None
+        self.broadcast_dir = broadcast_dir
+        self.dict_broadcast = {}
+
+
+    def broadcast(self, name, array):
+        ''' Save a read-only array for the workers (once for each name);
+            return the broadcast file path '''
+        if name not in self.dict_broadcast:
+            path = os.path.join(self.broadcast_dir, '{}.npy'.format(name))
+            np.save(path, np.asarray(array))
+            self.dict_broadcast[name] = path
+        return self.dict_broadcast[name]
+
+
+    def map(self, func, list_args):
+        ''' Run func for each tuple of arguments in list_args; return a list
+            of return values in the order of list_args. Errors raised in the
+            workers are raised here. '''
+        # --- If nproc == 1, run in the current process --- #
+        if self.pool is None:
+            return [func(*args) for args in list_args]
+        # --- If nproc > 1, submit all tasks before waiting for any --- #
+        results = [self.pool.apply_async(func, args) for args in list_args]
+        return [result.get() for result in results]
+
+
+    def imap_unordered(self, func, list_args):
+        ''' Run func for each tuple of arguments in list_args; yield
+            (index in list_args, return value) as soon as each task completes,
+            so that the results of finished tasks can be processed while the
+            other tasks are still running. Errors raised in the workers are
+            raised here. '''
+        # --- If nproc == 1, run in the current process --- #
+        if self.pool is None:
+            for i, args in enumerate(list_args):
+                yield i, func(*args)
+            return
+        # --- If nproc > 1, yield in the order of completion --- #
+        for i, value in self.pool.imap_unordered(
+                call_indexed_task,
+                [(i, func, args) for i, args in enumerate(list_args)]):
+            yield i, value
+
+
+    def submit(self, func, list_args):
+        ''' Submit func for each tuple of arguments in list_args without
+            waiting; return a list of pending results to pass to wait().
+            If nproc == 1, the tasks are run immediately and an empty list is
+            returned. '''
+        if self.pool is None:
+            for args in list_args:
+                func(*args)
+            return []
+        return [self.pool.apply_async(func, args) for args in list_args]
+
+
+    def wait(self, list_results):
+        ''' Wait for pending results returned by submit(); return a list of
+            return values. Errors raised in the workers are raised here. '''
+        return [result.get() for result in list_results]
+
+
+    def close(self):
+        ''' Shut down the worker processes and remove broadcast files '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for path in self.dict_broadcast.values():
+            if os.path.isfile(path):
+                os.remove(path)
+        self.dict_broadcast = {}
+
+
+_dict_broadcast_cache = {}
+
+
+def call_indexed_task(task):
+    ''' Call func(*args) for task = (i, func, args); return (i, return value)
+        (for EnsembleWorkerPool.imap_unordered) '''
+    i, func, args = task
+    return i, func(*args)
+
+
+def load_broadcast(path):
+    ''' Load an array broadcast by EnsembleWorkerPool (memory-mapped; loaded
+        once in each worker process) '''
+    if path not in _dict_broadcast_cache:
+        _dict_broadcast_cache[path] = np.load(path, mmap_mode='r')
+    return _dict_broadcast_cache[path]
+
+
 def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_moist_n,
              R, da_meas,
              da_meas_time_var, vic_exe, vic_global_template,
@@ -737,12 +1536,14 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
              nproc=1,
              nproc_vic=None,
              mpi_proc=None, mpi_exe='mpiexec', debug=False, save_cellAvg_state_only=False,
-             output_temp_dir=None,
+             output_temp_dir=None, output_vic_scratch_dir=None,
              restart=None, dict_diagnose=None,
              state_perturb_spatial_corr=False,
              state_perturb_random_field_dir=None,
+             state_perturb_random_field_phi=None,
              linear_model=False, linear_model_prec_varname=None,
-             dict_linear_model_param=None):
+             dict_linear_model_param=None,
+             list_history_daily_var=['OUT_RUNOFF', 'OUT_BASEFLOW']):
     ''' This function runs ensemble kalman filter (EnKF) on VIC (image driver)
 
     Parameters
@@ -827,6 +1628,12 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
     output_temp_dir: <str>
         Directory for temp files (for dignostic purpose); only used when
         debug = True
+    output_vic_scratch_dir: <str> or None
+        Directory (typically on local scratch disk) for files that are only
+        read by VIC or only used within the run: the memory-mapped ensemble
+        state store, perturbed states and propagated states. None for
+        output_vic_state_root_dir.
+        Default: None
     restart: None or <str>
         Restart time; None for starting from scratch (i.e., not restarting)
         Default: None
@@ -843,6 +1650,14 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
         One file is a zero-mean unit-variance field for each tile/layer/ensemble/timestep;
         all input 2D fields are uncorrelated - correlation will be added when running da
         Optional: only needed when state_perturb_spatial_corr = True
+        and state_perturb_random_field_phi = None
+    state_perturb_random_field_phi: <float>
+        Range parameter of the exponential spatial correlation [number of VIC
+        grid cells]. If not None, the random fields (same format as the
+        pre-generated files) are generated at each perturbation time from the
+        timestep seed, instead of loaded from state_perturb_random_field_dir
+        Optional: only used when state_perturb_spatial_corr = True
+        Default: None
     linear_model: <bool>
         Whether to run a linear model instead of VIC for propagation.
         Default is 'False', which is to run VIC
@@ -854,6 +1669,11 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
         NOTE: this parameter is only needed if linear_model = True.
         A dict of linear model parameters.
         Keys: 'r1', 'r2', 'r3', 'r12', 'r23
+    list_history_daily_var: <list> or None
+        History variables to aggregate to daily (sum) on the fly, saved to
+        "history.daily.ens<i>.concat.<start_year>_<end_year>.nc"; None for
+        no daily history
+        Default: ['OUT_RUNOFF', 'OUT_BASEFLOW']
         
     Required
     ----------
@@ -876,6 +1696,8 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                 coords=[[1], [0], da_meas['lat'], da_meas['lon']],
                 dims=['veg_class', 'snow_band', 'lat', 'lon'])
         adjust_negative = False
+    # Observation operator (built once for the whole run)
+    obs_operator = ObservationOperator(da_tile_frac)
         
     # If mismatched grids, extract weight info
     if mismatched_grid:
@@ -885,10 +1707,10 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
         vic_domain_nc = find_global_param_value(vic_global_param, 'DOMAIN')
         da_vic_domain = xr.open_dataset(vic_domain_nc)['mask']
         # Extract weight info
-        list_source_ind2D_weight_all = extract_mismatched_grid_weight_info(
+        grid_weights = extract_mismatched_grid_weight_info(
             da_vic_domain, da_meas, weight_nc)
     else:
-        list_source_ind2D_weight_all = None
+        grid_weights = None
 
     # Check whether to exclude SM3 from state vector
     if dict_diagnose is not None and 'no_sm3' in dict_diagnose and \
@@ -917,6 +1739,64 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                 output_vic_history_root_dir,
                 mkdirs=['EnKF_ensemble_concat'])['EnKF_ensemble_concat']
 
+    # --- Set up history sinks --- #
+    # The history records of each member are appended to one file for the
+    # whole run (and aggregated to daily) as soon as each VIC run completes
+    ens_list = list(range(1, N+1))
+    if bias_correct:
+        ens_list.append('ref')
+    list_history_appender = []
+    for ens in ens_list:
+        if list_history_daily_var:
+            out_daily_nc = os.path.join(
+                out_hist_concat_dir, 'history.daily.ens{}.concat.{}_{}.nc'.format(
+                    ens, start_time.year, end_time.year))
+        else:
+            out_daily_nc = None
+        list_history_appender.append(HistoryAppender(
+            os.path.join(out_hist_concat_dir, 'history.ens{}.concat.{}_{}.nc'.format(
+                ens, start_time.year, end_time.year)),
+            out_daily_nc, list_history_daily_var))
+
+    # --- Set up ensemble state store --- #
+    # Soil moisture states of all ensemble members are passed between steps
+    # in this memory-mapped store; state files are only written for VIC
+    if output_vic_scratch_dir is None:
+        output_vic_scratch_dir = output_vic_state_root_dir
+    store_filename = os.path.join(output_vic_scratch_dir, 'ensemble_sm_store.npy')
+    store = None
+
+    # --- Set up worker pools --- #
+    # One long-lived pool is used for all ensemble tasks of the whole run;
+    # VIC runs use a separate pool only if nproc_vic limits parallel VIC runs
+    worker_pool = EnsembleWorkerPool(nproc)
+    if nproc_vic is not None and nproc_vic < nproc:
+        vic_pool = EnsembleWorkerPool(nproc_vic)
+    else:
+        vic_pool = worker_pool
+
+    # --- Set up on-demand spatially-correlated state perturbation noise --- #
+    # The circulant embedding is the same for all timesteps
+    if state_perturb_spatial_corr is True and \
+            state_perturb_random_field_phi is not None:
+        random_field_eigenvalues = calculate_exponential_circulant_eigenvalues(
+            len(da_max_moist_n['lat']), len(da_max_moist_n['lon']),
+            state_perturb_random_field_phi)
+
+    # --- Pipeline propagation and state loading --- #
+    # As soon as a member's run completes, its propagated soil moisture
+    # states are loaded into the store and its history records are appended
+    # to its history sink while the other runs continue
+    list_load_time = []
+    def load_propagated_member_states(i):
+        time1 = timeit.default_timer()
+        store.load_member_nc(i, list_prop_state_nc[i])
+        list_history_appender[i].append(list_prop_history_nc[i])
+        list_load_time.append(timeit.default_timer() - time1)
+    member_done_callback = load_propagated_member_states
+    # Pending writes of updated state files
+    list_pending_writes = []
+
     # --- Step 1. Initialize ---#
     if restart is None:
         init_state_time = start_time
@@ -932,7 +1812,7 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                                         init_state_time.strftime('%Y%m%d'),
                                         init_state_time.hour*3600+init_state_time.second)
         init_state_dir = setup_output_dirs(
-                                output_vic_state_root_dir,
+                                output_vic_scratch_dir,
                                 mkdirs=[init_state_dir_name])[init_state_dir_name]
         # For each ensemble member, add Gaussian noise to sm states with covariance P,
         # and save each ensemble member states
@@ -940,70 +1820,49 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
             debug_dir = setup_output_dirs(
                             output_temp_dir,
                             mkdirs=[init_state_dir_name])[init_state_dir_name]
-        # Load prescribed state noise, if specified
-        if state_perturb_spatial_corr is True:
+        # Perturb all ensemble members at once; one seed for this timestep
+        seed = np.random.randint(low=100000)
+        # Generate or load prescribed state noise, if specified
+        if state_perturb_spatial_corr is True and \
+                state_perturb_random_field_phi is not None:
+            prescribed_noise_ensemble = generate_state_perturb_random_fields(
+                da_max_moist_n['lat'].values, da_max_moist_n['lon'].values,
+                n, N, state_perturb_random_field_phi, seed,
+                random_field_eigenvalues)
+        elif state_perturb_spatial_corr is True:
             prescribed_noise_ensemble = xr.open_dataset(os.path.join(
                 state_perturb_random_field_dir,
                 'vert_uncorr.{}.nc'.format(init_state_time.strftime("%Y%m%d-%H-%M-%S"))))['noise']
+        else:
+            prescribed_noise_ensemble = None
+        list_da_perturbation = perturb_soil_moisture_states_list(
+                list_states_to_perturb_nc=[init_state_nc] * N,
+                list_out_states_nc=[
+                    os.path.join(init_state_dir, 'state.ens{}.nc'.format(i+1))
+                    for i in range(N)],
+                L=L,
+                scale_n_nloop=scale_n_nloop,
+                da_max_moist_n=da_max_moist_n,
+                adjust_negative=adjust_negative,
+                seed=seed,
+                nproc=nproc,
+                no_sm3=no_sm3_perturb,
+                pool=worker_pool,
+                prescribed_noise_ensemble=prescribed_noise_ensemble)
+        # Save soil moisture perturbation
+        if debug:
+            for i, da_perturbation in enumerate(list_da_perturbation):
+                ds_perturbation = xr.Dataset({'STATE_SOIL_MOISTURE':
+                                              da_perturbation})
+                ds_perturbation.to_netcdf(os.path.join(
+                        debug_dir,
+                        'perturbation.ens{}.nc').format(i+1))
 
-        # --- If nproc == 1, do a regular ensemble loop --- #
-        if nproc == 1:
-            for i in range(N):
-                seed = np.random.randint(low=100000)
-                if state_perturb_spatial_corr is True:
-                    prescribed_noise = prescribed_noise_ensemble.values[:, :, :, i]
-                else:
-                    prescribed_noise = None
-                da_perturbation = perturb_soil_moisture_states_class_input(
-                        class_states=class_states,
-                        L=L,
-                        scale_n_nloop=scale_n_nloop,
-                        out_states_nc=os.path.join(init_state_dir,
-                                                   'state.ens{}.nc'.format(i+1)),
-                        da_max_moist_n=da_max_moist_n,
-                        adjust_negative=adjust_negative,
-                        seed=seed,
-                        no_sm3=no_sm3_perturb,
-                        prescribed_noise=prescribed_noise)
-                # Save soil moisture perturbation
-                if debug:
-                    ds_perturbation = xr.Dataset({'STATE_SOIL_MOISTURE':
-                                                  da_perturbation})
-                    ds_perturbation.to_netcdf(os.path.join(
-                            debug_dir,
-                            'perturbation.ens{}.nc').format(i+1))
-        # --- If nproc > 1, use multiprocessing --- #
-        elif nproc > 1:
-            # --- Set up multiprocessing --- #
-            pool = mp.Pool(processes=nproc)
-            # --- Loop over each ensemble member --- #
-            for i in range(N):
-                seed = np.random.randint(low=100000)
-                if state_perturb_spatial_corr is True:
-                    prescribed_noise = prescribed_noise_ensemble.values[:, :, :, i]
-                else:
-                    prescribed_noise = None
-                pool.apply_async(
-                    perturb_soil_moisture_states_class_input,
-                    (class_states, L, scale_n_nloop,
-                     os.path.join(init_state_dir, 'state.ens{}.nc'.format(i+1)),
-                     da_max_moist_n, adjust_negative, seed, no_sm3_perturb,
-                     prescribed_noise))
-            # --- Finish multiprocessing --- #
-            pool.close()
-            pool.join()
-    
         time2 = timeit.default_timer()
         print('\t\tTime of perturbing init state: {}'.format(time2-time1))
 
     # --- Step 2.1. Propagate (run VIC) until the first measurement time point ---#
     if restart is None:
-        # Initialize dictionary of history file paths for each ensemble member
-        dict_ens_list_history_files = {}
-        for i in range(N):
-            dict_ens_list_history_files['ens{}'.format(i+1)] = []
-        if bias_correct:
-            dict_ens_list_history_files['ensref'] = []
         # Determine VIC run period
         vic_run_start_time = start_time
         vic_run_end_time = pd.to_datetime(da_meas[da_meas_time_var].values[0]) - \
@@ -1017,7 +1876,7 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                             vic_run_start_time.hour*3600+vic_run_start_time.second,
                             vic_run_end_time.strftime('%Y%m%d'))
         out_state_dir = setup_output_dirs(
-                                output_vic_state_root_dir,
+                                output_vic_scratch_dir,
                                 mkdirs=[propagate_output_dir_name])[propagate_output_dir_name]
         out_history_dir = setup_output_dirs(
                                 output_vic_history_root_dir,
@@ -1028,6 +1887,19 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
         out_log_dir = setup_output_dirs(
                                 output_vic_log_root_dir,
                                 mkdirs=[propagate_output_dir_name])[propagate_output_dir_name]
+        # Set up the state store for propagated states
+        if bias_correct:
+            n_ens = N + 1
+        else:
+            n_ens = N
+        store = EnsembleStateStore(class_states.ds['STATE_SOIL_MOISTURE'],
+                                   n_ens, store_filename)
+        state_time = vic_run_end_time + pd.DateOffset(hours=24/vic_model_steps_per_day)
+        list_prop_state_nc = list_ensemble_state_nc(
+            out_state_dir, N, bias_correct, state_time)
+        list_prop_history_nc = list_ensemble_history_nc(
+            out_history_dir, N, bias_correct, vic_run_start_time)
+        list_load_time = []
         # Propagate all ensemble members
         if not linear_model:
             propagate_ensemble(
@@ -1044,12 +1916,13 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                     out_log_dir=out_log_dir,
                     ens_forcing_basedir=ens_forcing_basedir,
                     ens_forcing_prefix=ens_forcing_prefix,
-                    nproc=min(nproc, nproc_vic) if nproc_vic is not None else nproc,
+                    pool=vic_pool,
                     mpi_proc=mpi_proc,
                     mpi_exe=mpi_exe,
                     bias_correct=bias_correct,
                     ref_init_state_nc=init_state_nc,
-                    ref_forcing_basepath=orig_forcing_basepath)
+                    ref_forcing_basepath=orig_forcing_basepath,
+                    member_done_callback=member_done_callback)
         else:
             propagate_ensemble_linear_model(
                     N,
@@ -1065,30 +1938,22 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                     ens_forcing_prefix=ens_forcing_prefix,
                     prec_varname=linear_model_prec_varname,
                     dict_linear_model_param=dict_linear_model_param,
-                    nproc=nproc)
+                    pool=worker_pool,
+                    member_done_callback=member_done_callback)
         # Clean up log dir
 #        shutil.rmtree(out_log_dir)
-        # Put output history file paths into dictionary
-        for i in range(N):
-            dict_ens_list_history_files['ens{}'.format(i+1)].append(os.path.join(
-                        out_history_dir, 'history.ens{}.{}-{:05d}.nc'.format(
-                                i+1,
-                                vic_run_start_time.strftime('%Y-%m-%d'),
-                                vic_run_start_time.hour*3600+vic_run_start_time.second)))
-        if bias_correct:
-            dict_ens_list_history_files['ensref'].append(os.path.join(
-                        out_history_dir, 'history.ensref.{}-{:05d}.nc'.format(
-                                vic_run_start_time.strftime('%Y-%m-%d'),
-                                vic_run_start_time.hour*3600+vic_run_start_time.second)))
+        # Clean up history dir (history records are already appended)
+        shutil.rmtree(out_history_dir)
         time2 = timeit.default_timer()
         print('\t\tTime of propagation: {}'.format(time2-time1))
+        print('\t\t\tTime of loading propagated states (overlapped): {}'.format(
+            sum(list_load_time)))
 
         # --- Step 2.2. Bias correction of propagated ensemble states, if specified --- #
         time1 = timeit.default_timer()
-        state_time = vic_run_end_time + pd.DateOffset(hours=24/vic_model_steps_per_day)
         if bias_correct:
-            list_da_sm_prop, da_delta = bias_correct_propagated_states(
-                N, state_time, out_state_dir, no_sm3_bc)  # Length of list: N+1
+            # (bias-corrected in place in the state store)
+            _, delta = bias_correct_propagated_states(store.sm, no_sm3_bc)
             if debug:
                 debug_bc_dir = setup_output_dirs(
                             output_temp_dir,
@@ -1097,27 +1962,22 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                 veg_class = da_tile_frac['veg_class']
                 snow_band = da_tile_frac['snow_band']
                 nlayer = range(0, 3)  ############# THIS IS NOT GENERAL ###############
-                array_data_tiles = da_delta.values.reshape(
-                    [len(veg_class), len(snow_band),
-                     len(nlayer), len(da_tile_frac['lat']),
-                     len(da_tile_frac['lon'])])
                 da_data_tiles = xr.DataArray(
-                    array_data_tiles,
+                    delta,
                     dims=['veg_class', 'snow_band', 'nlayer', 'lat', 'lon'],
                     coords=[veg_class, snow_band,
                         nlayer, da_tile_frac['lat'],
                         da_tile_frac['lon']])
-                da_data_cellAvg = (da_data_tiles * da_tile_frac).sum(dim='veg_class').sum(dim='snow_band')
-                # Save da_delta to file
+                da_data_cellAvg = obs_operator.cell_average(da_data_tiles)
+                # Save delta to file
                 ds_delta = xr.Dataset({'delta_soil_moisture': da_data_cellAvg})
                 ds_delta.to_netcdf(os.path.join(
                         debug_bc_dir,
                         'delta.{}_{:05d}.nc'.format(
                                 state_time.strftime('%Y%m%d'),
                                 state_time.hour*3600+state_time.second)))
-        else:
-            list_da_sm_prop = load_propagated_states_sm(
-                    N, state_time, out_state_dir)
+        # (Propagated states were loaded into the store as each run completed)
+        list_da_sm_prop = store.list_da()
         time2 = timeit.default_timer()
         print('\t\tTime of bias correction: {}'.format(time2-time1))
  
@@ -1172,7 +2032,7 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                                     n_ens,
                                     list_da_sm=list_da_sm_prop,
                                     da_tile_frac=da_tile_frac,
-                                    nproc=nproc)
+                                    obs_operator=obs_operator)
             if mismatched_grid is False:  # if no mismatch
                 da_K = calculate_gain_K_whole_field(da_x, da_y_est, R)
                 # if zero_update
@@ -1180,15 +2040,12 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                 dict_diagnose['zero_update'] is True:
                     da_K[:] = 0
             else:  # if mismatched grid
-                list_K, y_est_remapped = calculate_gain_K_whole_field_mismatched_grid(
-                    da_x, da_y_est, R,
-                    list_source_ind2D_weight_all,
-                    weight_nc, da_meas)
+                K_stacked, y_est_remapped = calculate_gain_K_whole_field_mismatched_grid(
+                    da_x, da_y_est, R, grid_weights)
                 # if zero_update
                 if dict_diagnose is not None and 'zero_update' in dict_diagnose and \
                 dict_diagnose['zero_update'] is True:
-                    for i in range(len(list_K)):
-                        list_K[i][:] = 0
+                    K_stacked[:] = 0
             if debug:
                 if mismatched_grid is False:  # if no mismatch
                     ds_K = xr.Dataset({'K': da_K})
@@ -1202,7 +2059,7 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                                                     current_time.strftime('%Y%m%d'),
                                                     current_time.hour*3600+current_time.second))
                     with open(K_name, 'wb') as f:
-                        pickle.dump(list_K, f)
+                        pickle.dump(K_stacked, f)
             time2 = timeit.default_timer()
             print('\t\tTime of calculating gain K: {}'.format(time2-time1))
     
@@ -1259,7 +2116,7 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                 K = da_K
             else:
                 y_est = y_est_remapped
-                K = list_K
+                K = K_stacked
             list_da_updated, da_update_increm = update_states_ensemble(
                     y_est, K,
                     da_meas.loc[time, :, :, :],
@@ -1267,7 +2124,7 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                     list_da_sm_to_update=list_da_sm_prop,
                     da_max_moist_n=da_max_moist_n,
                     mismatched_grid=mismatched_grid,
-                    list_source_ind2D_weight_all=list_source_ind2D_weight_all,
+                    grid_weights=grid_weights,
                     adjust_negative=adjust_negative,
                     nproc=nproc,
                     no_sm3=no_sm3_update)
@@ -1286,7 +2143,7 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                     dims=['N', 'lat', 'lon', 'nlayer', 'veg_class', 'snow_band'],
                     coords=[da_update_increm['N'], da_update_increm['lat'],
                             da_update_increm['lon'], nlayer, veg_class, snow_band])
-                da_data_cellAvg = (da_data_tiles * da_tile_frac).sum(dim='veg_class').sum(dim='snow_band')
+                da_data_cellAvg = obs_operator.cell_average(da_data_tiles)
                 # Save
                 ds_update_increm = xr.Dataset({'update_increment': da_data_cellAvg})
                 ds_update_increm.to_netcdf(os.path.join(
@@ -1298,23 +2155,24 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
             print('\t\tTime of updating states: {}'.format(time2-time1))
 
             # (1.4) Save updated states to nc files
+            # (state variables other than soil moisture are from the
+            # propagated states in the store)
+            # The writes are only submitted here; they overlap with the
+            # perturbation step and are waited for at the end of it (the
+            # perturbed states are written from the same template files)
             time1 = timeit.default_timer()
-            save_updated_states_ensemble(
-                    N=N,
-                    state_dir_before_update=state_dir_after_prop,
-                    state_time=current_time,
-                    out_vic_state_dir=out_updated_state_dir,
-                    list_da_updated=list_da_updated,
-                    bias_correct=bias_correct,
-                    nproc=nproc)
+            store.set_sm(list_da_updated)
+            list_updated_state_nc = list_ensemble_state_nc(
+                out_updated_state_dir, N, bias_correct)
+            list_pending_writes = store.to_nc(
+                list_updated_state_nc, compress=True, pool=worker_pool,
+                wait=False)
             if bias_correct:
                 updated_states_avg_nc = os.path.join(out_updated_state_dir, 'state.ensref.nc')
             else:
                 updated_states_avg_nc = None
             time2 = timeit.default_timer()
-            print('\t\t\tTime of saving updated states: {}'.format(time2-time1))
-            # Delete propagated states
-            shutil.rmtree(state_dir_after_prop)
+            print('\t\t\tTime of submitting saving updated states: {}'.format(time2-time1))
  
             # (1.5) Save the following current DA states to file for restarting:
             # - random state
@@ -1325,13 +2183,15 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
             random_state = np.random.get_state()
             with open(filename, 'wb') as f:
                 pickle.dump(random_state, f)
-            # - dict_ens_list_history_files
-            filename = os.path.join(
+            # - state store (only the paths of the updated state files to
+            # reload soil moisture from; saved as pending, and it only
+            # replaces the restart file once these files are written)
+            store_snapshot = os.path.join(
                 output_restart_log_dir,
-                '{}.after_update.dict_ens_list_history_files.pickle'.format(
+                '{}.after_update.state_store.pickle'.format(
                     current_time.strftime("%Y%m%d-%H-%M-%S")))
-            with open(filename, 'wb') as f:
-                pickle.dump(dict_ens_list_history_files, f)
+            store.snapshot('{}.pending'.format(store_snapshot),
+                           list_updated_state_nc)
             
             # (1.6) If save cell-avg updated states only, then calculate cell-avg updated states
             # of the LAST update and delete the full update states
@@ -1343,7 +2203,7 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                     mkdirs=[updated_states_to_cleanup_dirname])[updated_states_to_cleanup_dirname]
                 cleanup_updated_states_ensemble(
                     N, updated_states_to_cleanup_dir, da_tile_frac,
-                    bias_correct=bias_correct, nproc=nproc)
+                    bias_correct=bias_correct, pool=worker_pool)
 
         # (2) Perturb states
         time1 = timeit.default_timer()
@@ -1362,39 +2222,66 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                 updated_states_avg_nc = None
             # If debug and bias correction, identify output dir
             debug_bc_dir = os.path.join(output_temp_dir, 'bias_correct')
-        # - Load dict_ens_list_history_files
-        filename = os.path.join(
-            output_restart_log_dir,
-            '{}.after_update.dict_ens_list_history_files.pickle'.format(
-                current_time.strftime("%Y%m%d-%H-%M-%S")))
-        with open(filename, 'rb') as f:
-            dict_ens_list_history_files = pickle.load(f)
+            # Restore the state store (or load the updated states if the
+            # store was not saved)
+            store_snapshot = os.path.join(
+                output_restart_log_dir,
+                '{}.after_update.state_store.pickle'.format(
+                    current_time.strftime("%Y%m%d-%H-%M-%S")))
+            if os.path.isfile(store_snapshot):
+                store = EnsembleStateStore.restore(store_snapshot, store_filename)
+            else:
+                store = EnsembleStateStore.from_nc(
+                    list_ensemble_state_nc(out_updated_state_dir, N, bias_correct),
+                    store_filename)
         # Set up perturbed state subdirectories
         pert_state_dir_name = 'perturbed.{}_{:05d}'.format(
                                         current_time.strftime('%Y%m%d'),
                                         current_time.hour*3600+current_time.second)
         pert_state_dir = setup_output_dirs(
-                            output_vic_state_root_dir,
+                            output_vic_scratch_dir,
                             mkdirs=[pert_state_dir_name])[pert_state_dir_name]
         # Perturb states for each ensemble member
-        # Load prescribed state noise, if specified
-        if state_perturb_spatial_corr is True:
+        seed = np.random.randint(low=100000)
+        # Generate or load prescribed state noise, if specified
+        if state_perturb_spatial_corr is True and \
+                state_perturb_random_field_phi is not None:
+            prescribed_noise_ensemble = generate_state_perturb_random_fields(
+                da_max_moist_n['lat'].values, da_max_moist_n['lon'].values,
+                len(da_max_moist_n['n']), N, state_perturb_random_field_phi,
+                seed, random_field_eigenvalues)
+        elif state_perturb_spatial_corr is True:
             prescribed_noise_ensemble = xr.open_dataset(os.path.join(
                 state_perturb_random_field_dir,
                 'vert_uncorr.{}.nc'.format(current_time.strftime("%Y%m%d-%H-%M-%S"))))['noise']
         else:
             prescribed_noise_ensemble = None
-        list_da_perturbation = perturb_soil_moisture_states_ensemble(
-                    N,
-                    states_to_perturb_dir=out_updated_state_dir,
+        list_da_perturbation = perturb_soil_moisture_states_store(
+                    store,
                     L=L,
                     scale_n_nloop=scale_n_nloop,
-                    out_states_dir=pert_state_dir,
                     da_max_moist_n=da_max_moist_n,
                     adjust_negative=adjust_negative,
-                    nproc=nproc,
+                    seed=seed,
                     no_sm3=no_sm3_perturb,
-                    prescribed_noise_ensemble=prescribed_noise_ensemble)
+                    prescribed_noise_ensemble=prescribed_noise_ensemble,
+                    N=N)
+        # Write perturbed states for VIC (temporary files; not compressed)
+        store.to_nc(list_ensemble_state_nc(pert_state_dir, N),
+                    compress=False, pool=worker_pool)
+        # If states were updated at this time point, wait for the updated
+        # state files; then they replace the propagated states as template
+        # files
+        if restart is None or current_time > restart_time:
+            time_wait1 = timeit.default_timer()
+            worker_pool.wait(list_pending_writes)
+            list_pending_writes = []
+            store.set_sm([], list_updated_state_nc)
+            os.replace('{}.pending'.format(store_snapshot), store_snapshot)
+            shutil.rmtree(state_dir_after_prop)
+            time_wait2 = timeit.default_timer()
+            print('\t\t\tTime of waiting for saving updated states: {}'.format(
+                time_wait2-time_wait1))
         if debug:
             # Aggregate to cellAvg
             da_perturbation = xr.concat(list_da_perturbation, dim='N')
@@ -1412,7 +2299,7 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                 coords=[range(N), veg_class, snow_band,
                         nlayer, da_perturbation['lat'],
                         da_perturbation['lon']])
-            da_data_cellAvg = (da_data_tiles * da_tile_frac).sum(dim='veg_class').sum(dim='snow_band')
+            da_data_cellAvg = obs_operator.cell_average(da_data_tiles)
             # Save to file
             ds_perturbation = xr.Dataset({'soil_moisture_perturbation':
                                           da_data_cellAvg})
@@ -1435,7 +2322,7 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                                             current_time.hour*3600+current_time.second,
                                             next_time.strftime('%Y%m%d'))
         out_state_dir = setup_output_dirs(
-                                output_vic_state_root_dir,
+                                output_vic_scratch_dir,
                                 mkdirs=[propagate_output_dir_name])[propagate_output_dir_name]
         out_history_dir = setup_output_dirs(
                                 output_vic_history_root_dir,
@@ -1446,6 +2333,12 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
         out_log_dir = setup_output_dirs(
                                 output_vic_log_root_dir,
                                 mkdirs=[propagate_output_dir_name])[propagate_output_dir_name]
+        state_time = next_time + pd.DateOffset(hours=24/vic_model_steps_per_day)
+        list_prop_state_nc = list_ensemble_state_nc(
+            out_state_dir, N, bias_correct, state_time)
+        list_prop_history_nc = list_ensemble_history_nc(
+            out_history_dir, N, bias_correct, current_time)
+        list_load_time = []
         if not linear_model:
             propagate_ensemble(
                     N, start_time=current_time, end_time=next_time,
@@ -1459,12 +2352,13 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                     out_log_dir=out_log_dir,
                     ens_forcing_basedir=ens_forcing_basedir,
                     ens_forcing_prefix=ens_forcing_prefix,
-                    nproc=min(nproc, nproc_vic) if nproc_vic is not None else nproc,
+                    pool=vic_pool,
                     mpi_proc=mpi_proc,
                     mpi_exe=mpi_exe,
                     bias_correct=bias_correct,
                     ref_init_state_nc=updated_states_avg_nc,
-                    ref_forcing_basepath=orig_forcing_basepath)
+                    ref_forcing_basepath=orig_forcing_basepath,
+                    member_done_callback=member_done_callback)
         else:
             propagate_ensemble_linear_model(
                     N,
@@ -1480,133 +2374,50 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
                     ens_forcing_prefix=ens_forcing_prefix,
                     prec_varname=linear_model_prec_varname,
                     dict_linear_model_param=dict_linear_model_param,
-                    nproc=nproc)
+                    pool=worker_pool,
+                    member_done_callback=member_done_callback)
         # Clean up log dir
         shutil.rmtree(out_log_dir)
-        # Put output history file paths into dictionary
-        for i in range(N):
-            dict_ens_list_history_files['ens{}'.format(i+1)].append(os.path.join(
-                    out_history_dir, 'history.ens{}.{}-{:05d}.nc'.format(
-                            i+1,
-                            current_time.strftime('%Y-%m-%d'),
-                            current_time.hour*3600+current_time.second)))
-        if bias_correct:
-            dict_ens_list_history_files['ensref'].append(os.path.join(
-                    out_history_dir, 'history.ensref.{}-{:05d}.nc'.format(
-                            current_time.strftime('%Y-%m-%d'),
-                            current_time.hour*3600+current_time.second)))
+        # Clean up history dir (history records are already appended)
+        shutil.rmtree(out_history_dir)
         # Delete perturbed states
         shutil.rmtree(pert_state_dir)
         time2 = timeit.default_timer()
         print('\t\tTime of propagation: {}'.format(time2-time1))
+        print('\t\t\tTime of loading propagated states (overlapped): {}'.format(
+            sum(list_load_time)))
 
         # (4) Bias-correct states, if specified
         time1 = timeit.default_timer()
-        state_time = next_time + pd.DateOffset(hours=24/vic_model_steps_per_day)
         if bias_correct:
-            list_da_sm_prop, da_delta = bias_correct_propagated_states(
-                N, state_time, out_state_dir, no_sm3_bc)
+            # (bias-corrected in place in the state store)
+            _, delta = bias_correct_propagated_states(store.sm, no_sm3_bc)
             if debug:
                 # Aggregate to cellAvg
                 veg_class = da_tile_frac['veg_class']
                 snow_band = da_tile_frac['snow_band']
                 nlayer = range(0, 3)  ############# THIS IS NOT GENERAL ###############
-                array_data_tiles = da_delta.values.reshape(
-                    [len(veg_class), len(snow_band),
-                     len(nlayer), len(da_tile_frac['lat']),
-                     len(da_tile_frac['lon'])])
                 da_data_tiles = xr.DataArray(
-                    array_data_tiles,
+                    delta,
                     dims=['veg_class', 'snow_band', 'nlayer', 'lat', 'lon'],
                     coords=[veg_class, snow_band,
-                        nlayer, da_data_tiles['lat'],
-                        da_data_tiles['lon']])
-                da_data_cellAvg = (da_data_tiles * da_tile_frac).sum(dim='veg_class').sum(dim='snow_band')
-                # Save da_delta to file
+                        nlayer, da_tile_frac['lat'],
+                        da_tile_frac['lon']])
+                da_data_cellAvg = obs_operator.cell_average(da_data_tiles)
+                # Save delta to file
                 ds_delta = xr.Dataset({'delta_soil_moisture': da_data_cellAvg})
                 ds_delta.to_netcdf(os.path.join(
                         debug_bc_dir,
                         'delta.{}_{:05d}.nc'.format(
                                 state_time.strftime('%Y%m%d'),
                                 state_time.hour*3600+state_time.second)))
-        else:
-            list_da_sm_prop = load_propagated_states_sm(
-                    N, state_time, out_state_dir)
+        # (Propagated states were loaded into the store as each run completed)
+        list_da_sm_prop = store.list_da()
         time2 = timeit.default_timer()
         # Point state directory to be updated to the propagated one
         state_dir_after_prop = out_state_dir
         print('\t\tTime of bias correction: {}'.format(time2-time1))
 
-        # (5) Concat and delete individual history files for each year
-        # (If the end of EnKF run, or the end of a calendar year)
-        if (t == (len(da_meas[da_meas_time_var]) - 1)) or \
-           (t < (len(da_meas[da_meas_time_var]) - 1) and \
-           current_time.year != (next_time + \
-           pd.DateOffset(hours=24/vic_model_steps_per_day)).year):
-            print('\tConcatenating history files...')
-            time1 = timeit.default_timer()
-            # Determine history file year
-            year = current_time.year
-            # Identify history dirs to delete later
-            list_dir_to_delete = []
-            for f in dict_ens_list_history_files['ens1']:
-                list_dir_to_delete.append(os.path.dirname(f))
-            set_dir_to_delete = set(list_dir_to_delete)  # remove duplicated dirs
-            # --- If nproc == 1, do a regular ensemble loop --- #
-            if nproc == 1:
-                # Concat for each ensemble member and delete individual files
-                n_ens = N
-                ens_list = list(range(1, N+1))
-                if bias_correct:
-                    n_ens = N + 1
-                    ens_list.append(ref)
-                for i in range(n_ens):
-                    # Concat and clean up
-                    list_history_files=dict_ens_list_history_files\
-                                       ['ens{}'.format(ens_list[i])]
-                    output_file=os.path.join(
-                                    out_hist_concat_dir,
-                                    'history.ens{}.concat.{}.nc'.format(
-                                        ens_list[i], year))
-                    concat_clean_up_history_file(list_history_files,
-                                                 output_file)
-                    # Reset history file list
-                    dict_ens_list_history_files['ens{}'.format(ens_list[i])] = []
-            # --- If nproc > 1, use multiprocessing --- #
-            elif nproc > 1:
-                # Set up multiprocessing
-                pool = mp.Pool(processes=nproc)
-                # Concat for each ensemble member and delete individual files
-                n_ens = N
-                ens_list = list(range(1, N+1))
-                if bias_correct:
-                    n_ens = N + 1
-                    ens_list.append('ref')
-                # Loop over each ensemble member
-                for i in range(n_ens):
-                    # Concat and clean up
-                    list_history_files=dict_ens_list_history_files\
-                                       ['ens{}'.format(ens_list[i])]
-                    output_file=os.path.join(
-                                    out_hist_concat_dir,
-                                    'history.ens{}.concat.{}.nc'.format(
-                                        ens_list[i], year))
-                    pool.apply_async(concat_clean_up_history_file,
-                                     (list_history_files, output_file))
-                    # Reset history file list
-                    dict_ens_list_history_files['ens{}'.format(ens_list[i])] = []
-                # --- Finish multiprocessing --- #
-                pool.close()
-                pool.join()
-            time2 = timeit.default_timer()
-            print('\t\tTime of propagation: {}'.format(time2-time1))
-            # Delete history dirs containing individual files
-            time1 = timeit.default_timer()
-            for d in set_dir_to_delete:
-                shutil.rmtree(d)
-            time2 = timeit.default_timer()
-            print('\t\tTime of deleting history directories: {}'.format(time2-time1))
-
     # --- If save_cellAvg_state_only, clean up updated states for the last updating time point --- #
     if save_cellAvg_state_only:
         last_time = pd.to_datetime(da_meas[da_meas_time_var].values[-1])
@@ -1617,7 +2428,17 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
             mkdirs=[updated_states_to_cleanup_dirname])[updated_states_to_cleanup_dirname]
         cleanup_updated_states_ensemble(
             N, updated_states_to_cleanup_dir, da_tile_frac,
-            bias_correct=bias_correct, nproc=nproc)
+            bias_correct=bias_correct, pool=worker_pool)
+
+    # --- Shut down worker pools --- #
+    if vic_pool is not worker_pool:
+        vic_pool.close()
+    worker_pool.close()
+
+    # --- Remove the ensemble state store file --- #
+    # (Restart snapshots are rebuilt from the updated state files)
+    del store
+    os.remove(store_filename)
 
     # --- Concat and clean up normalized innovation results --- #
     debug_innov_dir
@@ -1800,7 +2621,195 @@ def EnKF_VIC(N, start_time, end_time, init_state_nc, L, scale_n_nloop, da_max_mo
             print('Time of concatenating gain K: {}'.format(time2-time1))
 
 
-def to_netcdf_history_file_compress(ds_hist, out_nc):
+def determine_chunksizes(da, layout='map', time_dim='time'):
+    ''' Determines the chunk sizes of a variable for a chunk layout preset
+
+    Parameters
+    ----------
+    da: <xr.DataArray>
+        Variable to save
+    layout: <str>
+        Chunk layout preset. Options:
+            "map": one time step and the full spatial domain per chunk (fast
+                   reading of maps, e.g., by VIC)
+            "timeseries": the full time series of one grid cell per chunk
+                   (fast reading of per-pixel time series)
+            "balanced": blocks of time steps and grid cells of about
+                   2**20 values per chunk
+    time_dim: <str>
+        Time dimension name
+        Default: 'time'
+
+    Returns
+    ----------
+    chunksizes: <list>
+        Chunk size of each dimension of da (dimensions other than time, lat
+        and lon are never split)
+    '''
+
+    space_dims = ['lat', 'lon']
+    chunksizes = list(da.shape)
+    if layout == 'map':
+        for i, dim in enumerate(da.dims):
+            if dim == time_dim:
+                chunksizes[i] = 1
+    elif layout == 'timeseries':
+        for i, dim in enumerate(da.dims):
+            if dim in space_dims:
+                chunksizes[i] = 1
+    elif layout == 'balanced':
+        # Spatial blocks of up to 32 * 32 grid cells; fill the rest of the
+        # chunk with time steps
+        n_other = 1
+        for i, dim in enumerate(da.dims):
+            if dim in space_dims:
+                chunksizes[i] = min(chunksizes[i], 32)
+            if dim != time_dim:
+                n_other *= chunksizes[i]
+        for i, dim in enumerate(da.dims):
+            if dim == time_dim:
+                chunksizes[i] = min(chunksizes[i], max(1, 2**20 // n_other))
+    else:
+        raise ValueError('Unsupported chunk layout {}'.format(layout))
+    # A chunk size cannot be zero (e.g., for an empty time dimension)
+    chunksizes = [max(1, c) for c in chunksizes]
+
+    return chunksizes
+
+
+def save_dataset_chunked(ds, out_path, list_var, layout='map',
+                         backend='netcdf', compressor='zlib', complevel=1,
+                         time_dim='time', unlimited_dims=None):
+    ''' Saves a dataset to netCDF4 or Zarr, with compression and chunk
+        layout of selected variables
+
+    Parameters
+    ----------
+    ds: <xr.Dataset>
+        Dataset to save
+    out_path: <str>
+        Path of output netCDF file (or Zarr directory)
+    list_var: <list>
+        Variables to compress and chunk; the other variables are saved
+        with default settings
+    layout: <str> or None
+        Chunk layout preset (see determine_chunksizes); None for default
+        chunking of the backend
+        Default: 'map'
+    backend: <str>
+        Options: "netcdf" (NETCDF4 format) or "zarr"
+        Default: 'netcdf'
+    compressor: <str> or None
+        Options: "zlib"; "zstd" (zarr only; Blosc); None for no compression
+        Default: 'zlib'
+    complevel: <int>
+        Compression level
+        Default: 1
+    time_dim: <str>
+        Time dimension name
+        Default: 'time'
+    unlimited_dims: <list> or None
+        Dimensions to save as unlimited (netCDF only)
+        Default: None
+
+    Require
+    ----------
+    zarr and numcodecs (only for backend = "zarr")
+    '''
+
+    dict_encode = {}
+    if backend == 'netcdf':
+        if compressor not in ['zlib', None]:
+            raise ValueError('Unsupported compressor {} for netCDF'.format(
+                compressor))
+        for var in list_var:
+            dict_encode[var] = {}
+            if compressor is not None:
+                dict_encode[var]['zlib'] = True
+                dict_encode[var]['complevel'] = complevel
+            if layout is not None:
+                dict_encode[var]['chunksizes'] = determine_chunksizes(
+                    ds[var], layout, time_dim)
+        ds.to_netcdf(out_path,
+                     format='NETCDF4',
+                     encoding=dict_encode,
+                     unlimited_dims=unlimited_dims)
+    elif backend == 'zarr':
+        import numcodecs
+        if compressor == 'zlib':
+            codec = numcodecs.Zlib(level=complevel)
+        elif compressor == 'zstd':
+            codec = numcodecs.Blosc(cname='zstd', clevel=complevel)
+        elif compressor is None:
+            codec = None
+        else:
+            raise ValueError('Unsupported compressor {} for Zarr'.format(
+                compressor))
+        for var in list_var:
+            dict_encode[var] = {'compressor': codec}
+            if layout is not None:
+                dict_encode[var]['chunks'] = tuple(determine_chunksizes(
+                    ds[var], layout, time_dim))
+        ds.to_zarr(out_path, mode='w', encoding=dict_encode)
+    else:
+        raise ValueError('Unsupported backend {}'.format(backend))
+
+
+def open_dataset_chunked(path):
+    ''' Opens a dataset saved by save_dataset_chunked (a Zarr store if path
+        ends with ".zarr"; otherwise a netCDF file) '''
+    if path.rstrip('/').endswith('.zarr'):
+        return xr.open_zarr(path)
+    else:
+        return xr.open_dataset(path)
+
+
+def rechunk_dataset(in_path, out_path, layout, backend=None,
+                    compressor='zlib', complevel=1, time_dim='time'):
+    ''' Converts an existing output file to another chunk layout (and/or
+        backend); all data variables are rechunked
+
+    Parameters
+    ----------
+    in_path: <str>
+        Path of input netCDF file or Zarr store
+    out_path: <str>
+        Path of output netCDF file or Zarr store
+    layout: <str>
+        Chunk layout preset of the output (see determine_chunksizes)
+    backend: <str> or None
+        Backend of the output ("netcdf" or "zarr"); if None, determined
+        from out_path (Zarr if it ends with ".zarr")
+        Default: None
+    compressor, complevel, time_dim:
+        See save_dataset_chunked
+
+    Require
+    ----------
+    open_dataset_chunked
+    save_dataset_chunked
+    '''
+
+    if backend is None:
+        if out_path.rstrip('/').endswith('.zarr'):
+            backend = 'zarr'
+        else:
+            backend = 'netcdf'
+    with open_dataset_chunked(in_path) as ds:
+        ds = ds.load()
+    # Drop the on-disk encoding of the input, which would otherwise
+    # override the new chunk layout
+    for var in ds.variables:
+        for key in ['chunksizes', 'chunks', 'preferred_chunks', 'zlib',
+                    'complevel', 'compressor', 'contiguous', 'shuffle']:
+            ds[var].encoding.pop(key, None)
+    save_dataset_chunked(ds, out_path, list(ds.data_vars), layout, backend,
+                         compressor, complevel, time_dim)
+
+
+def to_netcdf_history_file_compress(ds_hist, out_nc, unlimited_dims=None,
+                                    layout='map', backend='netcdf',
+                                    compressor='zlib'):
     ''' This function saves a VIC-history-file-format ds to netCDF, with
         compression.
 
@@ -1810,30 +2819,25 @@ def to_netcdf_history_file_compress(ds_hist, out_nc):
         History dataset to save
     out_nc: <str>
         Path of output netCDF file
+    unlimited_dims: <list> or None
+        Dimensions to save as unlimited (e.g., ['time'] for files to be
+        appended to)
+        Default: None
+    layout, backend, compressor:
+        Chunk layout preset, output backend and compressor; see
+        save_dataset_chunked
+        Default: 'map', 'netcdf', 'zlib'
     '''
 
-    dict_encode = {}
-    for var in ds_hist.data_vars:
-        # skip variables not starting with "OUT_"
-        if var.split('_')[0] != 'OUT':
-            continue
-        # determine chunksizes
-        chunksizes = []
-        for i, dim in enumerate(ds_hist[var].dims):
-            if dim == 'time':  # for time dimension, chunksize = 1
-                chunksizes.append(1)
-            else:
-                chunksizes.append(len(ds_hist[dim]))
-        # create encoding dict
-        dict_encode[var] = {'zlib': True,
-                            'complevel': 1,
-                            'chunksizes': chunksizes}
-    ds_hist.to_netcdf(out_nc,
-                      format='NETCDF4',
-                      encoding=dict_encode)
+    # Only compress variables starting with "OUT_"
+    list_var = [var for var in ds_hist.data_vars if var.split('_')[0] == 'OUT']
+    save_dataset_chunked(ds_hist, out_nc, list_var, layout=layout,
+                         backend=backend, compressor=compressor,
+                         unlimited_dims=unlimited_dims)
 
 
-def to_netcdf_state_file_compress(ds_state, out_nc):
+def to_netcdf_state_file_compress(ds_state, out_nc, backend='netcdf',
+                                  compressor='zlib'):
     ''' This function saves a VIC-state-file-format ds to netCDF, with
         compression.
 
@@ -1843,21 +2847,19 @@ def to_netcdf_state_file_compress(ds_state, out_nc):
         State dataset to save
     out_nc: <str>
         Path of output netCDF file
+    backend, compressor:
+        Output backend and compressor; see save_dataset_chunked. NOTE: VIC
+        can only read netCDF state files
+        Default: 'netcdf', 'zlib'
     '''
 
-    dict_encode = {}
-    for var in ds_state.data_vars:
-        if var.split('_')[0] != 'STATE':
-            continue
-        # create encoding dict
-        dict_encode[var] = {'zlib': True,
-                            'complevel': 1}
-    ds_state.to_netcdf(out_nc,
-                       format='NETCDF4',
-                       encoding=dict_encode)
+    list_var = [var for var in ds_state.data_vars if var.split('_')[0] == 'STATE']
+    save_dataset_chunked(ds_state, out_nc, list_var, layout=None,
+                         backend=backend, compressor=compressor)
 
 
-def to_netcdf_cellAvg_state_file_compress(ds_state, out_nc):
+def to_netcdf_cellAvg_state_file_compress(ds_state, out_nc, layout=None,
+                                          backend='netcdf', compressor='zlib'):
     ''' This function saves a celAvg state ds to netCDF, with
         compression.
 
@@ -1867,19 +2869,21 @@ def to_netcdf_cellAvg_state_file_compress(ds_state, out_nc):
         State dataset to save
     out_nc: <str>
         Path of output netCDF file
+    layout, backend, compressor:
+        Chunk layout preset (None for default chunking), output backend and
+        compressor; see save_dataset_chunked
+        Default: None, 'netcdf', 'zlib'
     '''
 
-    dict_encode = {}
-    for var in ds_state.data_vars:
-        if var == 'SOIL_MOISTURE' or var == 'SWE':
-            dict_encode[var] = {'zlib': True,
-                                'complevel': 1}
-    ds_state.to_netcdf(out_nc,
-                       format='NETCDF4',
-                       encoding=dict_encode)
+    list_var = [var for var in ds_state.data_vars
+                if var == 'SOIL_MOISTURE' or var == 'SWE']
+    save_dataset_chunked(ds_state, out_nc, list_var, layout=layout,
+                         backend=backend, compressor=compressor)
 
 
-def to_netcdf_forcing_file_compress(ds_force, out_nc, time_dim='time'):
+def to_netcdf_forcing_file_compress(ds_force, out_nc, time_dim='time',
+                                    layout='map', backend='netcdf',
+                                    compressor='zlib'):
     ''' This function saves a VIC-forcing-file-format ds to netCDF, with
         compression.
 
@@ -1891,24 +2895,16 @@ def to_netcdf_forcing_file_compress(ds_force, out_nc, time_dim='time'):
         Path of output netCDF file
     time_dim: <str>
         Time dimension name in ds_force. Default: 'time'
+    layout, backend, compressor:
+        Chunk layout preset, output backend and compressor; see
+        save_dataset_chunked. NOTE: VIC can only read netCDF forcing files
+        and reads them one time step at a time ("map" layout)
+        Default: 'map', 'netcdf', 'zlib'
     '''
 
-    dict_encode = {}
-    for var in ds_force.data_vars:
-        # determine chunksizes
-        chunksizes = []
-        for i, dim in enumerate(ds_force[var].dims):
-            if dim == time_dim:  # for time dimension, chunksize = 1
-                chunksizes.append(1)
-            else:
-                chunksizes.append(len(ds_force[dim]))
-        # create encoding dict
-        dict_encode[var] = {'zlib': True,
-                            'complevel': 1,
-                            'chunksizes': chunksizes}
-    ds_force.to_netcdf(out_nc,
-                      format='NETCDF4',
-                      encoding=dict_encode)
+    save_dataset_chunked(ds_force, out_nc, list(ds_force.data_vars),
+                         layout=layout, backend=backend,
+                         compressor=compressor, time_dim=time_dim)
 
 
 def concat_clean_up_history_file(list_history_files, output_file):
@@ -2120,7 +3116,8 @@ def propagate_ensemble(N, start_time, end_time, vic_exe, vic_global_template_fil
                        ens_forcing_basedir, ens_forcing_prefix, nproc=1,
                        mpi_proc=None, mpi_exe='mpiexec',
                        bias_correct=False, ref_init_state_nc=None,
-                       ref_forcing_basepath=None):
+                       ref_forcing_basepath=None, pool=None,
+                       member_done_callback=None):
     ''' This function propagates (via VIC) an ensemble of states to a certain time point.
     
     Parameters
@@ -2175,12 +3172,22 @@ def propagate_ensemble(N, start_time, end_time, vic_exe, vic_global_template_fil
     ref_forcing_basepath: <str> (only needed if bias_correct = True)
         Basepath of original forcing. "YYYY.nc" will be appended.
         Only required if bias_correct = True
+    pool: <class EnsembleWorkerPool> or None
+        Worker pool to run VIC with; if None, a pool of nproc processors is
+        created for this propagation only. If not None, nproc is ignored.
+        Default: None
+    member_done_callback: <function> or None
+        If not None, called (in this process) with the run index (0, ...,
+        N-1, and N for the reference run) as soon as each VIC run completes,
+        while the other runs continue
+        Default: None
         
     Require
     ----------
     OrderedDict
-    multiprocessing
+    EnsembleWorkerPool
     generate_VIC_global_file
+    run_vic_for_multiprocess
     '''
 
     # --- Prepare for bias correction, if specified --- #
@@ -2208,63 +3215,47 @@ def propagate_ensemble(N, start_time, end_time, vic_exe, vic_global_template_fil
         init_state_list.append(ref_init_state_nc)
         force_list.append(ref_forcing_basepath)
 
-    # --- If nproc == 1, do a regular ensemble loop --- #
-    if nproc == 1:
-        for i in range(n_vic_runs):
-            # Generate VIC global param file
-            replace = OrderedDict([('FORCING1', force_list[i]),
-                                   ('OUTFILE', 'history.ens{}'.format(ens_list[i]))])
-            global_file = generate_VIC_global_file(
-                                global_template_path=vic_global_template_file,
-                                model_steps_per_day=vic_model_steps_per_day,
-                                start_time=start_time,
-                                end_time=end_time,
-                                init_state="INIT_STATE {}".format(init_state_list[i]),
-                                vic_state_basepath=os.path.join(
-                                            out_state_dir,
-                                            'state.ens{}'.format(ens_list[i])),
-                                vic_history_file_dir=out_history_dir,
-                                replace=replace,
-                                output_global_basepath=os.path.join(
-                                            out_global_dir,
-                                            'global.ens{}'.format(ens_list[i])))
-            # Run VIC
-            run_vic_for_multiprocess(vic_exe, global_file, out_log_dir,
-                                     mpi_proc, mpi_exe)
-    # --- If nproc > 1, use multiprocessing --- #
-    elif nproc > 1:
-        # --- Set up multiprocessing --- #
-        pool = mp.Pool(processes=nproc)
-        # --- Loop over each ensemble member --- #
-        for i in range(n_vic_runs):
-            # Generate VIC global param file
-            replace = OrderedDict([('FORCING1', force_list[i]),
-                                   ('OUTFILE', 'history.ens{}'.format(ens_list[i]))])
-            global_file = generate_VIC_global_file(
-                                global_template_path=vic_global_template_file,
-                                model_steps_per_day=vic_model_steps_per_day,
-                                start_time=start_time,
-                                end_time=end_time,
-                                init_state="INIT_STATE {}".format(init_state_list[i]),
-                                vic_state_basepath=os.path.join(
-                                            out_state_dir,
-                                            'state.ens{}'.format(ens_list[i])),
-                                vic_history_file_dir=out_history_dir,
-                                replace=replace,
-                                output_global_basepath=os.path.join(
-                                            out_global_dir,
-                                            'global.ens{}'.format(ens_list[i])))
+    # --- Generate VIC global param file for each run --- #
+    if pool is not None:
+        nproc = pool.nproc
+    list_args = []
+    for i in range(n_vic_runs):
+        replace = OrderedDict([('FORCING1', force_list[i]),
+                               ('OUTFILE', 'history.ens{}'.format(ens_list[i]))])
+        global_file = generate_VIC_global_file(
+                            global_template_path=vic_global_template_file,
+                            model_steps_per_day=vic_model_steps_per_day,
+                            start_time=start_time,
+                            end_time=end_time,
+                            init_state="INIT_STATE {}".format(init_state_list[i]),
+                            vic_state_basepath=os.path.join(
+                                        out_state_dir,
+                                        'state.ens{}'.format(ens_list[i])),
+                            vic_history_file_dir=out_history_dir,
+                            replace=replace,
+                            output_global_basepath=os.path.join(
+                                        out_global_dir,
+                                        'global.ens{}'.format(ens_list[i])))
+        # Parallel runs each write logs to a separate subdir
+        if nproc > 1:
             out_log_dir_ens = setup_output_dirs(
                 out_log_dir,
                 mkdirs=['ens{}'.format(ens_list[i])])['ens{}'.format(ens_list[i])]
-            # Run VIC
-            pool.apply_async(run_vic_for_multiprocess,
-                             (vic_exe, global_file, out_log_dir_ens,
-                              mpi_proc, mpi_exe))
-        
-        # --- Finish multiprocessing --- #
-        pool.close()
-        pool.join()
+        else:
+            out_log_dir_ens = out_log_dir
+        list_args.append((vic_exe, global_file, out_log_dir_ens,
+                          mpi_proc, mpi_exe))
+
+    # --- Run VIC (errors of any run are raised here) --- #
+    if pool is None:
+        worker_pool = EnsembleWorkerPool(nproc)
+    else:
+        worker_pool = pool
+    for i, _ in worker_pool.imap_unordered(run_vic_for_multiprocess, list_args):
+        if member_done_callback is not None:
+            member_done_callback(i)
+    if pool is None:
+        worker_pool.close()
 
 
 def determine_tile_frac(global_path):
@@ -2314,41 +3305,21 @@ def determine_tile_frac(global_path):
     else:  # if more than one snowband
         da_AreaFract = ds_param['AreaFract']
 
-    # --- Initialize the final DataArray --- #
+    # --- Calculate fraction of each veg/snowband tile for each grid cell --- #
+    # (Cv * AreaFract for each tile)
     veg_class = da_Cv['veg_class']
     snow_band = da_AreaFract['snow_band']
-    data = np.empty([len(veg_class), len(snow_band), len(lat), len(lon)])
-    data[:] = np.nan
-    da_tile_frac = xr.DataArray(data, coords=[veg_class, snow_band, lat, lon],
+    tile_frac = da_Cv.values[:, np.newaxis, :, :] * \
+                da_AreaFract.values[np.newaxis, :, :, :]  # [nveg, nsnow, lat, lon]
+    da_tile_frac = xr.DataArray(tile_frac, coords=[veg_class, snow_band, lat, lon],
                                 dims=['veg_class', 'snow_band', 'lat', 'lon'])
     
-    # --- Calculate fraction of each veg/snowband tile for each grid cell,
-    # and fill in da_file_frac --- #
-    # Determine the total number of loops
-    nloop = len(lat) * len(lon)
-    # Convert Cv and AreaFract to np.array and straighten lat and lon into nloop
-    Cv = da_Cv.values.reshape([len(veg_class), nloop])  # [nveg, nloop]
-    AreaFract = da_AreaFract.values.reshape([len(snow_band), nloop])  # [nsnow, nloop]
-
-    # Multiply Cv and AreaFract for each tile and grid cell
-    tile_frac = np.array(list(map(
-                    lambda i: np.dot(
-                        Cv[:, i].reshape([len(veg_class), 1]),
-                        AreaFract[:, i].reshape([1, len(snow_band)])),
-                    range(nloop))))  # [nloop, nveg, nsnow]
-
-    # Reshape tile_frac
-    tile_frac = np.rollaxis(tile_frac, 0, 3)  # [nveg, nsow, nloop]
-    tile_frac = tile_frac.reshape([len(veg_class), len(snow_band), len(lat), len(lon)])
-
-    # Put in da_tile_frac
-    da_tile_frac[:] = tile_frac
-    
     return da_tile_frac
 
 
 def get_soil_moisture_and_estimated_meas_all_ensemble(N, list_da_sm,
-                                                      da_tile_frac, nproc):
+                                                      da_tile_frac, nproc=1,
+                                                      obs_operator=None):
     ''' This function extracts soil moisture states from netCDF state files for all ensemble
         members, for all grid cells, veg and snow band tiles.
     
@@ -2364,9 +3335,15 @@ def get_soil_moisture_and_estimated_meas_all_ensemble(N, list_da_sm,
     da_tile_frac: <xr.DataArray>
         Fraction of each veg/snowband in each grid cell for the whole domain
         Dimension: [veg_class, snow_band, lat, lon]
+        Only used if obs_operator is None.
     nproc: <int>
-        Number of processors to use for parallel ensemble
+        Not used; all members are processed in one vectorized pass
+        (kept for compatibility)
         Default: 1
+    obs_operator: <class ObservationOperator> or None
+        Pre-built observation operator; if None, it is built from
+        da_tile_frac.
+        Default: None
 
     Returns
     ----------
@@ -2380,8 +3357,8 @@ def get_soil_moisture_and_estimated_meas_all_ensemble(N, list_da_sm,
     Require
     ----------
     xarray
-    os
-    States
+    ObservationOperator
+    convert_VICstates_to_EnKFstates_sm_ensemble
     '''
     
     # --- Extract dimensions from the first ensemble member --- #
@@ -2398,61 +3375,20 @@ def get_soil_moisture_and_estimated_meas_all_ensemble(N, list_da_sm,
     # number of total states n = len(veg_class) * len(snow_band) * len(nlayer)
     n = len(veg_class) * len(snow_band) * len(nlayer)
     
-    # --- Initialize da for states and measurement estimates --- #
-    # Initialize states x [lat, lon, n, N]
-    data = np.empty([len(lat), len(lon), n, N])
-    data[:] = np.nan
-    da_x = xr.DataArray(data,
+    # --- States x of all ensemble members [nloop, n, N] --- #
+    x = convert_VICstates_to_EnKFstates_sm_ensemble(
+        np.stack([np.asarray(da) for da in list_da_sm[:N]]))
+    da_x = xr.DataArray(x.reshape([len(lat), len(lon), n, N]),
                         coords=[lat, lon, range(n), range(N)],
                         dims=['lat', 'lon', 'n', 'N'])
-    # Initialize measurement estimates y_est [lat, lon, m, N]
-    data = np.empty([len(lat), len(lon), 1, N])
-    data[:] = np.nan
-    da_y_est = xr.DataArray(data,
+
+    # --- Measurement estimates y_est [lat, lon, m, N] --- #
+    if obs_operator is None:
+        obs_operator = ObservationOperator(da_tile_frac)
+    y_est = obs_operator.y_est(x)  # [nloop, N]
+    da_y_est = xr.DataArray(y_est.reshape([len(lat), len(lon), 1, N]),
                         coords=[lat, lon, [1], range(N)],
                         dims=['lat', 'lon', 'm', 'N'])
-    
-    # --- Loop over each ensemble member --- #
-    # --- If nproc == 1, do a regular ensemble loop --- #
-    if nproc == 1:
-        for i in range(N):
-            # Load state file
-            da = list_da_sm[i]
-            class_states = States(xr.Dataset({'STATE_SOIL_MOISTURE': da}))
-            
-            # Fill x and y_est data in
-            # Fill in states x
-            da_x.loc[:, :, :, i] = class_states.da_EnKF
-            # Fill in measurement estimates y
-            da_y_est[:, :, :, i] = calculate_y_est_whole_field(
-                                            class_states.ds['STATE_SOIL_MOISTURE'],
-                                            da_tile_frac)
-    # --- If nproc > 1, use multiprocessing --- #
-    elif nproc > 1:
-        results = {}
-        # --- Set up multiprocessing --- #
-        pool = mp.Pool(processes=nproc)
-        # --- Loop over each ensemble member --- #
-        for i in range(N):
-            # Load state file
-            da = list_da_sm[i]
-            class_states = States(xr.Dataset({'STATE_SOIL_MOISTURE': da}))
- 
-            # Fill x and y_est data in
-            # Fill in states x
-            da_x.loc[:, :, :, i] = class_states.da_EnKF
-            # Fill in measurement estimates y
-            results[i] = pool.apply_async(
-                            calculate_y_est_whole_field,
-                            (class_states.ds['STATE_SOIL_MOISTURE'],
-                             da_tile_frac))
-        # --- Finish multiprocessing --- #
-        pool.close()
-        pool.join()
-        # --- Get return values --- #
-        list_da_perturbation = []
-        for i, result in results.items():
-            da_y_est[:, :, :, i] = result.get()
 
     return da_x, da_y_est
 
@@ -2531,10 +3467,8 @@ def calculate_y_est_whole_field(da_x, da_tile_frac):
     tile_frac = da_tile_frac.values.reshape([len(veg_class), len(snow_band),
                                              nloop])  # [nveg, nsnow, nloop]
     # Calculate y_est for all grid cells
-    y_est = np.array(list(map(
-                lambda i: calculate_y_est(x[:, :, :, i],
-                                          tile_frac[:, :, i]),
-                range(nloop)))).reshape([nloop, 1])  # [nloop, m=1]
+    y_est = np.nansum(x[:, :, 0, :] * tile_frac,
+                      axis=(0, 1)).reshape([nloop, 1])  # [nloop, m=1]
     # Reshape y_est
     y_est = y_est.reshape([len(lat), len(lon), 1])  # [lat, lon, m=1]
     # Put in da_y_est
@@ -2610,7 +3544,63 @@ def calculate_gain_K(x, y_est, R):
     if m == 1:  # if m = 1
         K = Pxy / (Pyy + R)
     else:  # if m > 1
-        K = np.dot(Pxx, np.linalg.inv(Pyy+R))
+        K = np.dot(Pxy, np.linalg.inv(Pyy+R))
+
+    return K
+
+
+def calculate_gain_K_batch(x, y_est, R):
+    ''' This function calculates Kalman gain K from ensemble for a batch of
+        grid cells at once (same as calculate_gain_K but vectorized over the
+        first dimension).
+
+    Parameters
+    ----------
+    x: <np.array> [nloop, n, N]
+        Forecasted ensemble states (before updated) of all grid cells
+    y_est: <np.array> [nloop, m, N]
+        Forecasted ensemble measurement estimates (before updated) of all grid
+        cells (y_est = Hx)
+    R: <np.array> [nloop, m, m]
+        Measurement error covariance matrix of all grid cells
+
+    Returns
+    ----------
+    K: <np.array> [nloop, n, m]
+        Gain K of all grid cells. Cells with non-finite Pyy + R (e.g., inactive
+        cells) are NAN
+
+    Require
+    ----------
+    numpy
+    '''
+
+    # Extract dimensions
+    nloop, n, N = x.shape
+    m = y_est.shape[1]
+
+    # Ensemble anomalies
+    x_anom = x - x.mean(axis=2, keepdims=True)  # [nloop, n, N]
+    y_anom = y_est - y_est.mean(axis=2, keepdims=True)  # [nloop, m, N]
+
+    # Pxy = cov(x, y.transpose); size = [nloop, n, m]; divided by (N-1)
+    Pxy = np.einsum('ijk,ilk->ijl', x_anom, y_anom) / (N - 1)
+    # Pyy = cov(y, y.transpose); size = [nloop, m, m]; divided by (N-1)
+    Pyy = np.einsum('ijk,ilk->ijl', y_anom, y_anom) / (N - 1)
+    Pyy_R = Pyy + R  # [nloop, m, m]
+
+    # Only solve for cells with finite Pyy + R; the rest stays NAN
+    K = np.empty([nloop, n, m])
+    K[:] = np.nan
+    active = np.isfinite(Pyy_R).all(axis=(1, 2))  # [nloop]
+    # K = Pxy * (Pyy)-1
+    if m == 1:  # if m = 1
+        K[active] = Pxy[active] / Pyy_R[active]
+    else:  # if m > 1; (Pyy+R) is symmetric, so K.T = (Pyy+R)-1 * Pxy.T
+        K[active] = np.transpose(
+            np.linalg.solve(Pyy_R[active],
+                            np.transpose(Pxy[active], (0, 2, 1))),
+            (0, 2, 1))
 
     return K
 
@@ -2640,7 +3630,7 @@ def calculate_gain_K_whole_field(da_x, da_y_est, R):
     Require
     ----------
     xarray
-    calculate_gain_K
+    calculate_gain_K_batch
     numpy
     '''
 
@@ -2650,30 +3640,24 @@ def calculate_gain_K_whole_field(da_x, da_y_est, R):
     n_coord = da_x['n']
     N_coord = da_x['N']
     m_coord = da_y_est['m']
-    
-    # --- Initialize da_K --- #
-    K = np.empty([len(lat_coord), len(lon_coord), len(n_coord), len(m_coord)])
-    K[:] = np.nan
-    da_K = xr.DataArray(K,
-                        coords=[lat_coord, lon_coord, n_coord, m_coord],
-                        dims=['lat', 'lon', 'n', 'm'])
+    m = len(m_coord)
     
     # --- Calculate gain K for the whole field --- #
-    # Determine the total number of loops
+    # Determine the total number of grid cells
     nloop = len(lat_coord) * len(lon_coord)
     # Convert da_x and da_y_est to np.array and straighten lat and lon into nloop
     x = da_x.values.reshape([nloop, len(n_coord), len(N_coord)])  # [nloop, n, N]
-    y_est = da_y_est.values.reshape([nloop, len(m_coord), len(N_coord)])  # [nloop, m, N]
-    R_flat = R.reshape([nloop, 1, 1])
-    # Calculate gain K for the whole field
-    K = np.array(list(map(
-                lambda i: calculate_gain_K(x[i, :, :], y_est[i, :, :], R_flat[i, :, :]),
-                range(nloop))))  # [nloop, n, m]
+    y_est = da_y_est.values.reshape([nloop, m, len(N_coord)])  # [nloop, m, N]
+    R_flat = R.reshape([nloop, m, m])
+    # Calculate gain K for all grid cells at once
+    K = calculate_gain_K_batch(x, y_est, R_flat)  # [nloop, n, m]
     # Reshape K
     K = K.reshape([len(lat_coord), len(lon_coord), len(n_coord),
-                   len(m_coord)])  # [lat, lon, n, m]
+                   m])  # [lat, lon, n, m]
     # Put in da_K
-    da_K[:] = K
+    da_K = xr.DataArray(K,
+                        coords=[lat_coord, lon_coord, n_coord, m_coord],
+                        dims=['lat', 'lon', 'n', 'm'])
 
     return da_K
 
@@ -2752,249 +3736,448 @@ def update_states(da_y_est, da_K, da_meas, R, da_sm_to_update,
     return da_updated, da_update_increm
 
 
-def update_states_ensemble(y_est, K, da_meas, R, list_da_sm_to_update,
-                           da_max_moist_n,
-                           mismatched_grid=False, list_source_ind2D_weight_all=None,
-                           adjust_negative=True, nproc=1, no_sm3=False):
-    ''' Update the EnKF states for the whole field for each ensemble member.
+def generate_meas_perturbation_ensemble(R, list_seed):
+    ''' Generates random measurement perturbation v ~ N(0, R) for all grid
+        cells and all ensemble members. Each ensemble member has its own
+        random stream seeded by its seed in list_seed.
+        NOTE: this function assumes m = 1
 
     Parameters
     ----------
-    y_est: <xr.DataArray> for mismatched_grid=False; <np.array> for mismatched_grid=True
-        Estimated measurement from pre-updated states of all ensemble members (y = Hx);
-        If mismatched_grid=False:
-            xr.DataArray with Dimension: [lat, lon, m, N]
-        If mismatched_grid=True:
-            Is actually y_est_remapped; y_est remapped to the meas grid.
-            Dim: [n_target, m, N]
-    K: <xr.DataArray> for mismatched_grid=False; <list> for mismatched_grid=True
-        Gain K for the whole field
-        If mismatched_grid=False:
-            xr.DataArray with dimension: [lat, lon, n, m],
-            where [n, m] is the Kalman gain K
-        If mismatched_grid=True:
-            Is actually list_K;
-            A list of K for each meas grid cell (length n_target)
-            Each element of the list is a K matrix of dim [n_stacked, m]
-            (n_stacked can be different for each meas cell)
-    da_meas: <xr.DataArray> [lat, lon, m]
-        Measurements at current time
     R: <np.array> [lat, lon, m, m]
         Measurement error covariance matrix (measurement error ~ N(0, R))
-    list_da_sm_to_update:
-        A list of soil moisture states to update, in the order of
-        ensemble members. Each member of the list is an xarray.DataArray for
-        an ensemble member, in the structure of VIC state file
-        "STATE_SOIL_MOISTURE" variable.
-    da_max_moist_n: <xarray.DataArray>
-        Maximum soil moisture for the whole domain and each tile
-        [unit: mm]. Soil moistures above maximum after perturbation will
-        be reset to maximum value.
-        Dimension: [lat, lon, n]
-    mismatched_grid: <bool>
-        Whether mismatched measurement and VIC grids. Default: False
-    list_source_ind2D_weight_all: <list> (Only needed if mismatched_grid = True)
-        Typically returned by extract_mismatched_grid_weight_info().
-        list_source_ind2D_weight_all: <list>
-        Length of the list: number of meas cells (n_target)
-        Each element: a list of ((2D-index), weight) of source cells
-        that overlap with ONE target cell
+    list_seed: <list>
+        A list of seeds for each ensemble member (length N); None for an
+        ensemble member means using the global seed for that member
+
+    Returns
+    ----------
+    v: <np.array>
+        Measurement perturbation
+        Dimension: [nloop, m, N] (where nloop = lat * lon)
+
+    Require
+    ----------
+    numpy
+    '''
+
+    # Extract dimensions
+    m = R.shape[-1]
+    N = len(list_seed)
+    R_flat = R.reshape([-1, m, m])
+    nloop = R_flat.shape[0]
+    # Standard deviation of measurement error
+    std = np.sqrt(np.diagonal(R_flat, axis1=1, axis2=2))  # [nloop, m]
+
+    # Generate perturbation for each ensemble member from its own stream
+    v = np.empty([nloop, m, N])
+    for i, seed in enumerate(list_seed):
+        if seed is None:
+            v[:, :, i] = np.random.normal(0, std, size=[nloop, m])
+        else:
+            rng = np.random.RandomState(seed)
+            v[:, :, i] = rng.normal(0, std, size=[nloop, m])
+
+    return v
+
+
+def update_soil_moisture_states_ensemble(x, K, y_meas, y_est, v, max_moist,
+                                         adjust_negative=True, n_update=None):
+    ''' Updates soil moisture states of all grid cells and all ensemble
+        members in one vectorized pass:
+                x = x + K * (y_meas + v - y_est)
+        NOTE: x is updated in place
+
+    Parameters
+    ----------
+    x: <np.array>
+        Soil moisture states to update (in EnKF layout)
+        Dimension: [nloop, n, N] (where nloop = lat * lon)
+    K: <np.array>
+        Gain K for the whole field
+        Dimension: [nloop, n, m]
+    y_meas: <np.array>
+        Measurements at current time
+        Dimension: [nloop, m]
+    y_est: <np.array>
+        Estimated measurement from before-updated states (y = Hx)
+        Dimension: [nloop, m, N]
+    v: <np.array>
+        Measurement perturbation
+        Dimension: [nloop, m, N]
+    max_moist: <np.array>
+        Maximum soil moisture for each tile [unit: mm]. Soil moistures above
+        maximum after update will be reset to maximum value.
+        Dimension: [nloop, n]
     adjust_negative: <bool>
         Whether or not to adjust negative soil moistures after update
         to zero.
         Default: True (adjust negative to zero)
-    nproc: <int>
-        Number of processors to use for parallel ensemble
-        Default: 1
-    no_sm3: <bool>
-        Whether to EXCLUDE SM3 from kalman filter state vector (i.e., no perturbation or update)
-        Default: False (i.e., default is to include SM3)
+    n_update: <int or None>
+        If not None, only update the first n_update states (e.g., to exclude
+        SM3 from update); the rest of the states are kept unchanged.
+        Default: None (update all states)
 
     Returns
     ----------
-    list_da_updated: <xr.Dataset>
-        A list of VIC-format updated soil moisture states for all ensemble
-    da_update_increm: <xr.DataArray>
-        Update increment of soil moisture states
+    x: <np.array>
+        Updated soil moisture states (the same array as input x)
+        Dimension: [nloop, n, N]
 
     Require
     ----------
     numpy
     '''
-    
-    # Extract N
-    if mismatched_grid is False:
-        N = len(y_est['N'])
-    else:
-        N = y_est.shape[2]
-
-    list_da_update_increm = []  # update increment
-    list_da_updated = []  # updated states
-
-    # --- If nproc == 1, do a regular ensemble loop --- #
-    if nproc == 1:
-        for i in range(N):
-            # Set up parameters
-            da_sm_to_update = list_da_sm_to_update[i]
-            # Update states
-            seed = np.random.randint(low=100000)
-            if mismatched_grid is False:  # if no mismatch
-                da_updated, da_update_increm = update_states(
-                            y_est.loc[:, :, :, i], K, da_meas, R,
-                            da_sm_to_update,
-                            da_max_moist_n,
-                            adjust_negative, seed,
-                            no_sm3)
-            else:  # if there is mismatch
-                da_updated, da_update_increm = update_states_mismatched_grid(
-                    y_est[:, :, i], K, da_meas, R, da_sm_to_update,
-                    da_max_moist_n, list_source_ind2D_weight_all,
-                    adjust_negative, seed, no_sm3)
-            # Put results to list
-            list_da_updated.append(da_updated)
-            list_da_update_increm.append(da_update_increm)
-    # --- If nproc > 1, use multiprocessing --- #
-    elif nproc > 1:
-        results = {}
-        # --- Set up multiprocessing --- #
-        pool = mp.Pool(processes=nproc)
-        # --- Loop over each ensemble member --- #
-        for i in range(N):
-            # Set up parameters
-            da_sm_to_update = list_da_sm_to_update[i]
-            # Update states
-            seed = np.random.randint(low=100000)
-            if mismatched_grid is False:  # if no mismatch
-                results[i] = pool.apply_async(
-                                update_states,
-                                (y_est.loc[:, :, :, i], K, da_meas, R,
-                                da_sm_to_update, da_max_moist_n,
-                                adjust_negative, seed, no_sm3))
-            else:  # if there is mismatch
-                results[i] = pool.apply_async(
-                    update_states_mismatched_grid,
-                        (y_est[:, :, i], K, da_meas, R, da_sm_to_update,
-                         da_max_moist_n, list_source_ind2D_weight_all,
-                         adjust_negative, seed, no_sm3))
-        # --- Finish multiprocessing --- #
-        pool.close()
-        pool.join()
-        # --- Get return values --- #
-        for i, result in results.items():
-            da_updated, da_update_increm = result.get()
-            # Put results to list
-            list_da_updated.append(da_updated)
-            list_da_update_increm.append(da_update_increm)
-
-    # --- Put update increment and measurement perturbation of all ensemble
-    # members into one da --- #
-    da_update_increm = xr.concat(list_da_update_increm, dim='N')
-    da_update_increm['N'] = range(1, N+1)
 
-    return list_da_updated, da_update_increm
+    # Calculate delta = K * (y_meas + v - y_est)
+    innov = y_meas[:, :, np.newaxis] + v - y_est  # [nloop, m, N]
+    delta = np.einsum('ijl,ilk->ijk', K[:, :n_update, :], innov)  # [nloop, n_update, N]
+    delta[np.isnan(delta)] = 0
 
+    # Update states - add delta to orig. states
+    x_update = x[:, :n_update, :]  # view of x
+    x_update += delta
+
+    # Reset updated soil moistures to within [0, max]
+    clip_soil_moisture_states(x_update, max_moist[:, :n_update],
+                              adjust_negative)
+
+    return x
 
-def perturb_forcings(ens, orig_forcing, dict_varnames, prec_std,
-                     prec_phi, out_forcing_basedir):
-    ''' Perturb forcings for a single ensemble member
+
+def clip_soil_moisture_states(x, max_moist, adjust_negative=True):
+    ''' Resets soil moisture states of all ensemble members to within
+        physical range, in place. NaN (inactive) cells are left unchanged.
 
     Parameters
     ----------
-    ens: <int>
-        Ensemble index; will be used in output directory name
-    orig_forcing: <class 'Forcings'>
-        Original (unperturbed) VIC forcings
-    dict_varnames: <dict>
-        A dictionary of forcing names in nc file;
-        e.g., {'PREC': 'prcp'; 'AIR_TEMP': 'tas'}
-    prec_std: <float>
-        Standard deviation of the precipitation perturbing multiplier
-    prec_phi: <float>
-        Parameter in AR(1) process for precipitation noise.
-    out_forcing_basedir: <str>
-        Base directory for output perturbed forcings;
-        Subdirs "ens_<i>" will be created, where <i> is ensemble index, 1, ..., N
-        File names will be: forc.YYYY.nc 
+    x: <np.array>
+        Soil moisture states (in EnKF layout)
+        Dimension: [nloop, n, N]
+    max_moist: <np.array>
+        Maximum soil moisture for each tile [unit: mm]. Soil moistures above
+        maximum will be reset to maximum value.
+        Dimension: [nloop, n]
+    adjust_negative: <bool>
+        Whether or not to adjust negative soil moistures to zero.
+        Default: True (adjust negative to zero)
+
+    Returns
+    ----------
+    x: <np.array>
+        Clipped soil moisture states (the same array as input x)
 
     Require
     ----------
-    os
+    numpy
     '''
-    
-    # Setup subdir
-    subdir = setup_output_dirs(
-                out_forcing_basedir,
-                mkdirs=['ens_{}'.format(ens)])['ens_{}'.format(ens)]
 
-    # Perturb PREC
-    ds_perturbed = orig_forcing.perturb_prec_lognormal(
-                                        varname=dict_varnames['PREC'],
-                                        std=prec_std,
-                                        phi=prec_phi)
-    # Save to nc file
-    for year, ds in ds_perturbed.groupby('time.year'):
-        to_netcdf_forcing_file_compress(
-                ds, os.path.join(subdir,
-                'force.{}.nc'.format(year)))
+    # Reset negative soil moistures to zero
+    if adjust_negative:
+        np.copyto(x, 0, where=(x<0))
 
+    # Reset soil moistures above maximum to maximum
+    max_moist = np.broadcast_to(max_moist[:, :, np.newaxis], x.shape)
+    np.copyto(x, max_moist, where=(x>max_moist))
 
-def replace_global_values(gp, replace):
-    '''given a multiline string that represents a VIC global parameter file,
-       loop through the string, replacing values with those found in the
-       replace dictionary'''
-    
-    gpl = []
-    for line in iter(gp.splitlines()):
-        line_list = line.split()
-        if line_list:
-            key = line_list[0]
-            if key in replace:
-                value = replace.pop(key)
-                val = list([str(value)])
-            else:
-                val = line_list[1:]
-            gpl.append('{0: <20} {1}\n'.format(key, ' '.join(val)))
+    return x
 
-    if replace:
-        for key, val in replace.items():
-            try:
-                value = ' '.join(val)
-            except:
-                value = val
-            gpl.append('{0: <20} {1}\n'.format(key, value))
 
-    return gpl
+def convert_VICstates_to_EnKFstates_sm_ensemble(sm):
+    ''' Converts stacked VIC-format soil moisture states of all ensemble
+        members to EnKF layout
 
+    Parameters
+    ----------
+    sm: <np.array>
+        Soil moisture states of all ensemble members
+        Dimension: [N, veg_class, snow_band, nlayer, lat, lon]
+
+    Returns
+    ----------
+    x: <np.array>
+        Soil moisture states in EnKF layout, with n ordered as
+        [nlayer, veg_class, snow_band] (the same as States.da_EnKF)
+        Dimension: [nloop, n, N] (where nloop = lat * lon)
+    '''
+
+    N, nveg, nsnow, nlayer, nlat, nlon = sm.shape
+    # [N, veg, snow, nlayer, lat, lon] -> [lat, lon, nlayer, veg, snow, N]
+    x = np.transpose(sm, (4, 5, 3, 1, 2, 0)).reshape(
+            [nlat*nlon, nlayer*nveg*nsnow, N])
+
+    return x
+
+
+def convert_EnKFstates_sm_to_VICstates_ensemble(x, nveg, nsnow, nlayer,
+                                                nlat, nlon):
+    ''' Converts soil moisture states of all ensemble members in EnKF layout
+        back to stacked VIC-format (the inverse of
+        convert_VICstates_to_EnKFstates_sm_ensemble)
+
+    Parameters
+    ----------
+    x: <np.array>
+        Soil moisture states in EnKF layout
+        Dimension: [nloop, n, N]
+    nveg, nsnow, nlayer, nlat, nlon: <int>
+        Number of veg classes, snow bands, soil layers, lat and lon
+
+    Returns
+    ----------
+    sm: <np.array>
+        Soil moisture states of all ensemble members
+        Dimension: [N, veg_class, snow_band, nlayer, lat, lon]
+    '''
+
+    N = x.shape[2]
+    # [lat, lon, nlayer, veg, snow, N] -> [N, veg, snow, nlayer, lat, lon]
+    sm = np.transpose(
+            x.reshape([nlat, nlon, nlayer, nveg, nsnow, N]),
+            (5, 3, 4, 2, 0, 1))
+
+    return sm
+
+
+def calculate_exponential_circulant_eigenvalues(nlat, nlon, phi, max_pad=8):
+    ''' Calculates the eigenvalues of the circulant embedding of an exponential,
+        unit-variance spatial covariance on a regular [lat, lon] grid, for
+        generating spatially correlated random fields by FFT.
+
+    Parameters
+    ----------
+    nlat: <int>
+        Number of grid cells in lat
+    nlon: <int>
+        Number of grid cells in lon
+    phi: <float>
+        Range parameter of the exponential covariance, cov(h) = exp(-h/phi),
+        where h is the distance in number of grid cells (same as phi in
+        geoR::grf with unit grid spacing)
+    max_pad: <int>
+        Maximum size of the embedding grid, in multiples of the domain size.
+        The embedding grid is enlarged (from 2x) until the embedding is
+        non-negative definite; if still not at max_pad (large phi relative to
+        the domain), the remaining (small) negative eigenvalues are set to
+        zero, which slightly approximates the covariance.
+        Default: 8
+
+    Returns
+    ----------
+    eigenvalues: <np.array>
+        Eigenvalues of the embedding covariance
+        Dim: [nlat_embed, nlon_embed]
+
+    Require
+    ----------
+    numpy
+    '''
+
+    pad = 2
+    while True:
+        # --- Wrapped distances on the embedding torus --- #
+        nlat_embed = pad * nlat
+        nlon_embed = pad * nlon
+        dlat = np.minimum(np.arange(nlat_embed), nlat_embed - np.arange(nlat_embed))
+        dlon = np.minimum(np.arange(nlon_embed), nlon_embed - np.arange(nlon_embed))
+        h = np.sqrt(dlat[:, np.newaxis]**2 + dlon[np.newaxis, :]**2)
+        # --- Eigenvalues of the circulant covariance --- #
+        eigenvalues = np.real(np.fft.fft2(np.exp(-h / phi)))
+        if eigenvalues.min() >= -1e-8 * eigenvalues.max() or pad * 2 > max_pad:
+            break
+        pad *= 2
+
+    return np.maximum(eigenvalues, 0)
+
+
+def generate_spatial_random_fields(nlat, nlon, phi, nfield, seed=None,
+                                   eigenvalues=None, nfield_batch=16):
+    ''' Generates independent, zero-mean, unit-variance 2D random fields with
+        exponential spatial correlation (circulant embedding). Each FFT gives
+        two independent fields (real and imaginary parts).
+
+    Parameters
+    ----------
+    nlat: <int>
+        Number of grid cells in lat
+    nlon: <int>
+        Number of grid cells in lon
+    phi: <float>
+        Range parameter of the exponential covariance [number of grid cells]
+    nfield: <int>
+        Number of fields to generate
+    seed: <int or None>
+        Seed for the random number generator; None for drawing a fresh seed
+        from OS entropy.
+        Default: None
+    eigenvalues: <np.array> or None
+        Pre-calculated output of calculate_exponential_circulant_eigenvalues
+        for the same nlat, nlon and phi; None for calculating here.
+        Default: None
+    nfield_batch: <int>
+        Number of fields generated in each FFT batch (limits memory use)
+        Default: 16
+
+    Returns
+    ----------
+    fields: <np.array>
+        Dim: [nfield, lat, lon]
+
+    Require
+    ----------
+    numpy
+    calculate_exponential_circulant_eigenvalues
+    '''
+
+    if eigenvalues is None:
+        eigenvalues = calculate_exponential_circulant_eigenvalues(nlat, nlon, phi)
+    sqrt_eigenvalues = np.sqrt(eigenvalues / eigenvalues.size)
+
+    rng = np.random.default_rng(seed)
+    fields = np.empty([nfield, nlat, nlon])
+    for i in range(0, nfield, nfield_batch):
+        nfield_this = min(nfield_batch, nfield - i)
+        nfft = (nfield_this + 1) // 2
+        # --- Complex white noise on the embedding grid --- #
+        w = rng.standard_normal((2, nfft) + eigenvalues.shape)
+        y = np.fft.fft2(sqrt_eigenvalues * (w[0] + 1j * w[1]))
+        # --- Real and imaginary parts are independent fields --- #
+        y = np.concatenate([y.real[:, :nlat, :nlon], y.imag[:, :nlat, :nlon]])
+        fields[i:i+nfield_this] = y[:nfield_this]
+
+    return fields
+
+
+def generate_state_perturb_random_fields(lat, lon, n, N, phi, seed=None,
+                                         eigenvalues=None):
+    ''' Generates zero-mean, unit-variance, spatially correlated (but
+        tile/layer-uncorrelated) random fields for state perturbation of one
+        timestep. Same format as the pre-generated "vert_uncorr.<time>.nc"
+        files, and can be used as prescribed_noise_ensemble in
+        perturb_soil_moisture_states_store and perturb_soil_moisture_states_list.
 
-def perturb_soil_moisture_states_ensemble(N, states_to_perturb_dir,
-                                          L, scale_n_nloop,
-                                          out_states_dir,
-                                          da_max_moist_n,
-                                          adjust_negative=True,
-                                          nproc=1, no_sm3=False,
-                                          prescribed_noise_ensemble=None):
-    ''' Perturb all soil_moisture states for each ensemble member
-    
     Parameters
     ----------
+    lat: <np.array>
+        Lat coordinates of the VIC domain
+    lon: <np.array>
+        Lon coordinates of the VIC domain
+    n: <int>
+        Number of states in each grid cell (nlayer * nveg * nsnow)
     N: <int>
         Number of ensemble members
-    states_to_perturb_dir: <str>
-        Directory for VIC state files to perturb.
-        File names: state.ens<i>.nc, where <i> is ensemble index 1, ..., N
+    phi: <float>
+        Range parameter of the exponential covariance [number of grid cells]
+    seed: <int or None>
+        Seed for the random number generator of this timestep
+        Default: None
+    eigenvalues: <np.array> or None
+        Pre-calculated output of calculate_exponential_circulant_eigenvalues
+        Default: None
+
+    Returns
+    ----------
+    da_noise: <xr.DataArray>
+        Dim: [lat, lon, n, N]
+
+    Require
+    ----------
+    generate_spatial_random_fields
+    '''
+
+    fields = generate_spatial_random_fields(
+        len(lat), len(lon), phi, n*N, seed, eigenvalues)  # [n*N, lat, lon]
+    noise = np.moveaxis(fields.reshape([n, N, len(lat), len(lon)]),
+                        [0, 1], [2, 3])  # [lat, lon, n, N]
+    da_noise = xr.DataArray(noise, coords=[lat, lon, range(n), range(N)],
+                            dims=['lat', 'lon', 'n', 'N'], name='noise')
+
+    return da_noise
+
+
+def generate_sm_perturbation_ensemble(L, scale_n_nloop, N, seed=None,
+                                      prescribed_noise_ensemble=None):
+    ''' Generates vertically/tile-correlated soil moisture perturbation for
+        all grid cells and all ensemble members at once.
+
+    Parameters
+    ----------
     L: <np.array>
         Cholesky decomposed matrix of covariance matrix P of all states:
                         P = L * L.T
-        Thus, L * Z (where Z is i.i.d. standard normal random variables of
-        dimension [n, n]) is multivariate normal random variables with
-        mean zero and covariance matrix P.
         Dimension: [n, n]
     scale_n_nloop: <np.array>
         Standard deviation of noise to add for the whole field.
         Dimension: [nloop, n] (where nloop = lat * lon)
-    out_states_dir: <str>
-        Directory for output perturbed VIC state files;
-        File names: state.ens<i>.nc, where <i> is ensemble index 1, ..., N
+    N: <int>
+        Number of ensemble members
+    seed: <int or None>
+        Seed for the random number generator of this timestep. All members'
+        N(0, 1) noise is drawn in one call, member-major, so the noise of
+        member i only depends on seed and i (not on N or nproc).
+        None for drawing a fresh seed from OS entropy.
+        Default: None
+    prescribed_noise_ensemble: <np.array> or None
+        If not None, use pre-generated random noises as Z (before transforming
+        to be vertically/tile correlated) instead of regenerating here
+        Dim: [lat, lon, n, N]
+        Default: None
+
+    Returns
+    ----------
+    noise: <np.array>
+        Soil moisture perturbation
+        Dimension: [nloop, n, N]
+
+    Require
+    ----------
+    numpy
+    '''
+
+    nloop, n = scale_n_nloop.shape
+
+    # --- Generate (or load) N(0, 1) noise --- #
+    if prescribed_noise_ensemble is None:
+        rng = np.random.default_rng(seed)
+        z = rng.standard_normal([N, nloop, n])  # [N, nloop, n]
+    else:
+        z = np.moveaxis(
+            np.asarray(prescribed_noise_ensemble).reshape([nloop, n, N]),
+            2, 0)  # [N, nloop, n]
+
+    # --- Apply transformation L * z for each cell and scale --- #
+    noise = np.matmul(z, L.T) * scale_n_nloop  # [N, nloop, n]
+
+    return np.moveaxis(noise, 0, 2)  # [nloop, n, N]
+
+
+def perturb_soil_moisture_states_list(list_states_to_perturb_nc,
+                                      list_out_states_nc,
+                                      L, scale_n_nloop,
+                                      da_max_moist_n,
+                                      adjust_negative=True, seed=None,
+                                      nproc=1, no_sm3=False,
+                                      prescribed_noise_ensemble=None,
+                                      pool=None):
+    ''' Perturb soil_moisture states of a list of VIC state files (one file
+        for each ensemble member); the noise for all members is generated and
+        added in one vectorized pass, and then each member is written out.
+
+    Parameters
+    ----------
+    list_states_to_perturb_nc: <list>
+        A list of paths of VIC state netCDF files to perturb, in the order of
+        ensemble members (the same file may appear multiple times, e.g., to
+        generate an initial ensemble from a single state)
+    list_out_states_nc: <list>
+        A list of paths of output perturbed VIC state files, in the order of
+        ensemble members
+    L: <np.array>
+        Cholesky decomposed matrix of covariance matrix P of all states
+        Dimension: [n, n]
+    scale_n_nloop: <np.array>
+        Standard deviation of noise to add for the whole field.
+        Dimension: [nloop, n] (where nloop = lat * lon)
     da_max_moist_n: <xarray.DataArray>
         Maximum soil moisture for the whole domain and each tile
         [unit: mm]. Soil moistures above maximum after perturbation will
@@ -3004,8 +4187,13 @@ def perturb_soil_moisture_states_ensemble(N, states_to_perturb_dir,
         Whether or not to adjust negative soil moistures after
         perturbation to zero.
         Default: True (adjust negative to zero)
+    seed: <int or None>
+        Seed for random number generator of this timestep; see
+        generate_sm_perturbation_ensemble
+        Default: None
     nproc: <int>
-        Number of processors to use for parallel ensemble
+        Number of processors to use for writing the perturbed state files.
+        The perturbation itself does not depend on nproc.
         Default: 1
     no_sm3: <bool>
         Whether to EXCLUDE SM3 from kalman filter state vector
@@ -3016,1284 +4204,3184 @@ def perturb_soil_moisture_states_ensemble(N, states_to_perturb_dir,
         to be vertically/tile correlated) instead of regenerating here
         Dim: [lat, lon, n, N]
         Default: None
+    pool: <class EnsembleWorkerPool> or None
+        Worker pool for writing the perturbed state files; if None, a pool
+        of nproc processors is created for this call only.
+        Default: None
 
     Return
     ----------
     list_da_perturbation: <list>
         A list of amount of perturbation added (a list of each ensemble member)
         Dimension of each da: [veg_class, snow_band, nlayer, lat, lon]
-    
+
     Require
     ----------
-    os
-    class States
+    class EnsembleStateStore
+    perturb_soil_moisture_states_store
     '''
 
-    # --- If nproc == 1, do a regular ensemble loop --- #
-    if nproc == 1:
-        list_da_perturbation = [] 
-        for i in range(N):
-            states_to_perturb_nc = os.path.join(
-                    states_to_perturb_dir,
-                    'state.ens{}.nc'.format(i+1))
-            out_states_nc = os.path.join(out_states_dir,
-                                         'state.ens{}.nc'.format(i+1))
-            seed = np.random.randint(low=100000)
-            if prescribed_noise_ensemble is not None:
-                prescribed_noise = prescribed_noise_ensemble.values[:, :, :, i]
-            else:
-                prescribed_noise = None
-            da_perturbation = perturb_soil_moisture_states(
-                                         states_to_perturb_nc, L, scale_n_nloop,
-                                         out_states_nc, da_max_moist_n,
-                                         adjust_negative, seed, no_sm3, prescribed_noise)
-            list_da_perturbation.append(da_perturbation)
-    # --- If nproc > 1, use multiprocessing --- #
-    elif nproc > 1:
-        results = {}
-        # --- Set up multiprocessing --- #
-        pool = mp.Pool(processes=nproc)
-        # --- Loop over each ensemble member --- #
-        for i in range(N):
-            states_to_perturb_nc = os.path.join(
-                    states_to_perturb_dir,
-                    'state.ens{}.nc'.format(i+1))
-            out_states_nc = os.path.join(out_states_dir,
-                                         'state.ens{}.nc'.format(i+1))
-            seed = np.random.randint(low=100000)
-            if prescribed_noise_ensemble is not None:
-                prescribed_noise = prescribed_noise_ensemble.values[:, :, :, i]
-            else:
-                prescribed_noise = None
-            results[i] = pool.apply_async(
-                    perturb_soil_moisture_states,
-                    (states_to_perturb_nc, L, scale_n_nloop,
-                     out_states_nc, da_max_moist_n,
-                     adjust_negative, seed, no_sm3, prescribed_noise))
-        # --- Finish multiprocessing --- #
-        pool.close()
-        pool.join()
-
-        # --- Get return values --- #
-        list_da_perturbation = [] 
-        for i, result in results.items():
-            list_da_perturbation.append(result.get())
+    # --- Load soil moisture states of all members --- #
+    store = EnsembleStateStore.from_nc(list_states_to_perturb_nc)
+
+    # --- Perturb all members --- #
+    list_da_perturbation = perturb_soil_moisture_states_store(
+        store, L, scale_n_nloop, da_max_moist_n,
+        adjust_negative, seed, no_sm3, prescribed_noise_ensemble)
+
+    # --- Save perturbed state files --- #
+    store.to_nc(list_out_states_nc, compress=True, nproc=nproc, pool=pool)
 
     return list_da_perturbation
 
 
-def propagate(start_time, end_time, vic_exe, vic_global_template_file,
-                       vic_model_steps_per_day, init_state_nc, out_state_basepath,
-                       out_history_dir, out_history_fileprefix,
-                       out_global_basepath, out_log_dir,
-                       forcing_basepath, mpi_proc=None, mpi_exe='mpiexec', delete_log=True):
-    ''' This function propagates (via VIC) from an initial state (or no initial state)
-        to a certain time point.
+def perturb_soil_moisture_states_store(store, L, scale_n_nloop,
+                                       da_max_moist_n,
+                                       adjust_negative=True, seed=None,
+                                       no_sm3=False,
+                                       prescribed_noise_ensemble=None,
+                                       N=None):
+    ''' Perturb soil_moisture states of all ensemble members held in an
+        EnsembleStateStore, in one vectorized pass. The store is updated in
+        place.
 
     Parameters
     ----------
-    start_time: <pandas.tslib.Timestamp>
-        Start time of this propagation run
-    end_time: <pandas.tslib.Timestamp>
-        End time of this propagation
-    vic_exe: <class 'VIC'>
-        Tonic VIC class
-    vic_global_template_file: <str>
-        Path of VIC global file template
-    vic_model_steps_per_day: <str>
-        VIC option - model steps per day
-    init_state_nc: <str>
-        Initial state netCDF file; None for no initial state
-    out_state_basepath: <str>
-        Basepath of output states; ".YYYYMMDD_SSSSS.nc" will be appended.
-        None if do not want to output state file
-    out_history_dir: <str>
-        Directory of output history files
-    out_history_fileprefix: <str>
-        History file prefix
-    out_global_basepath: <str>
-        Basepath of output global files; "YYYYMMDD-HHS_YYYYMMDD.txt" will be appended
-    out_log_dir: <str>
-        Directory for output log files
-    forcing_basepath: <str>
-        Forcing basepath. <YYYY.nc> will be appended
-    mpi_proc: <int or None>
-        Number of processors to use for VIC MPI run. None for not using MPI
+    store: <class EnsembleStateStore>
+        Soil moisture states to perturb
+    L: <np.array>
+        Cholesky decomposed matrix of covariance matrix P of all states
+        Dimension: [n, n]
+    scale_n_nloop: <np.array>
+        Standard deviation of noise to add for the whole field.
+        Dimension: [nloop, n] (where nloop = lat * lon)
+    da_max_moist_n: <xarray.DataArray>
+        Maximum soil moisture for the whole domain and each tile
+        [unit: mm]. Soil moistures above maximum after perturbation will
+        be reset to maximum value.
+        Dimension: [lat, lon, n]
+    adjust_negative: <bool>
+        Whether or not to adjust negative soil moistures after
+        perturbation to zero.
+        Default: True (adjust negative to zero)
+    seed: <int or None>
+        Seed for random number generator of this timestep; see
+        generate_sm_perturbation_ensemble
+        Default: None
+    no_sm3: <bool>
+        Whether to EXCLUDE SM3 from kalman filter state vector
+        (i.e., no perturbation or update)
+        Default: False (i.e., default is to include SM3)
+    prescribed_noise_ensemble: <xr.DataArray>
+        If not None, use pre-generated random noises as Z (before transforming
+        to be vertically/tile correlated) instead of regenerating here
+        Dim: [lat, lon, n, N]
+        Default: None
+    N: <int> or None
+        Only perturb the first N members of the store (e.g., to exclude the
+        reference member for bias correction). None for all members.
         Default: None
-    mpi_exe: <str>
-        Path for MPI exe. Only used if mpi_proc is not None
-    delete_log: <bool>
-        Whether to delete all log files in the log directory after running.
-        Default: True
 
-    Require
+    Return
     ----------
-    OrderedDict
-    generate_VIC_global_file
-    check_returncode
+    list_da_perturbation: <list>
+        A list of amount of perturbation added (a list of each ensemble member)
+        Dimension of each da: [veg_class, snow_band, nlayer, lat, lon]
     '''
 
-    # Generate VIC global param file
-    replace = OrderedDict([('FORCING1', forcing_basepath),
-                           ('OUTFILE', out_history_fileprefix)])
-    global_file = generate_VIC_global_file(
-                        global_template_path=vic_global_template_file,
-                        model_steps_per_day=vic_model_steps_per_day,
-                        start_time=start_time,
-                        end_time=end_time,
-                        init_state='#INIT_STATE' if init_state_nc is None
-                                   else 'INIT_STATE {}'.format(init_state_nc),
-                        vic_state_basepath=out_state_basepath,
-                        vic_history_file_dir=out_history_dir,
-                        replace=replace,
-                        output_global_basepath=out_global_basepath)
-    
-    # Run VIC
-    returncode = vic_exe.run(global_file, logdir=out_log_dir,
-                             **{'mpi_proc': mpi_proc, 'mpi_exe': mpi_exe})
-    check_returncode(returncode, expected=0)
+    # --- Extract dimensions --- #
+    if N is None:
+        N = store.n_member
+    nveg, nsnow, nlayer, nlat, nlon = store.sm.shape[1:]
+    nloop = nlat * nlon
+    n = nlayer * nveg * nsnow
+    x_orig = convert_VICstates_to_EnKFstates_sm_ensemble(
+        np.asarray(store.sm[:N]))  # [nloop, n, N]
+
+    # --- Perturb all members --- #
+    if prescribed_noise_ensemble is not None:
+        prescribed_noise_ensemble = prescribed_noise_ensemble.values
+    noise = generate_sm_perturbation_ensemble(
+        L, scale_n_nloop, N, seed, prescribed_noise_ensemble)  # [nloop, n, N]
+    # If exclude SM3 from state vector, only perturb SM1 and SM2
+    n_perturb = int(n/3*2) if no_sm3 is True else n
+    x = x_orig.copy()
+    x[:, :n_perturb, :] += noise[:, :n_perturb, :]
+    clip_soil_moisture_states(
+        x[:, :n_perturb, :],
+        da_max_moist_n.values.reshape([nloop, n])[:, :n_perturb],
+        adjust_negative)
+
+    # --- Put back to the store in VIC-format --- #
+    store.sm[:N] = convert_EnKFstates_sm_to_VICstates_ensemble(
+        x, nveg, nsnow, nlayer, nlat, nlon)
+    sm_perturbation = convert_EnKFstates_sm_to_VICstates_ensemble(
+        x - x_orig, nveg, nsnow, nlayer, nlat, nlon)
+    list_da_perturbation = [
+        xr.DataArray(sm_perturbation[i], coords=list(store.coords.values()),
+                     dims=store.dims)
+        for i in range(N)]
 
-    # Delete log files (to save space)
-    if delete_log:
-        for f in glob.glob(os.path.join(out_log_dir, "*")):
-            os.remove(f)
+    return list_da_perturbation
 
 
-def propagate_linear_model(start_time, end_time, lat_coord, lon_coord,
-                       model_steps_per_day, init_state_nc, out_state_basepath,
-                       out_history_dir, out_history_fileprefix,
-                       forcing_basepath, prec_varname, dict_linear_model_param):
-    ''' This function propagates (via VIC) from an initial state (or no
-        initial state) to a certain time point for the whole domain.
-        The linear model assumes 3 soil layers and only allows 1 tile per
-        grid cell (i.e., nveg=1 and nsnow=1). Specifically, for each grid cell,
-        the model takes the following form:
-                    sm(t+1) = r * sm(t) + P(t)
-        where sm(t) is an array of dim [3, 1], r is a constant matrix of
-        dim [3, 3], and P(t) is input precipitation and is an array of dim
-        [3, 1].
+def update_states_ensemble(y_est, K, da_meas, R, list_da_sm_to_update,
+                           da_max_moist_n,
+                           mismatched_grid=False, grid_weights=None,
+                           adjust_negative=True, nproc=1, no_sm3=False):
+    ''' Update the EnKF states for the whole field for each ensemble member.
 
     Parameters
     ----------
-    start_time: <pandas.tslib.Timestamp>
-        Start time of this propagation run
-    end_time: <pandas.tslib.Timestamp>
-        End time of this propagation
-    lat_coord: <list/xr.coord>
-        Latitude coordinates
-    lon_coord: <list/xr.coord>
-        Longitude coordinates
-    model_steps_per_day: <str>
-        VIC option - model steps per day
-    init_state_nc: <str>
-        Initial state netCDF file; None for no initial state
-    out_state_basepath: <str>
-        Basepath of output states; ".YYYYMMDD_SSSSS.nc" will be appended
-    out_history_dir: <str>
-        Directory of output history files
-    out_history_fileprefix: <str>
-        History file prefix
-    forcing_basepath: <str>
-        Forcing basepath. <YYYY.nc> will be appended
-    prec_varname: <str>
-        Precip varname in the forcing netCDF files
-    dict_linear_model_param: <dict>
-        A dict of linear model parameters.
-        Keys: 'r1', 'r2', 'r3', 'r12', 'r23'
+    y_est: <xr.DataArray> for mismatched_grid=False; <np.array> for mismatched_grid=True
+        Estimated measurement from pre-updated states of all ensemble members (y = Hx);
+        If mismatched_grid=False:
+            xr.DataArray with Dimension: [lat, lon, m, N]
+        If mismatched_grid=True:
+            Is actually y_est_remapped; y_est remapped to the meas grid.
+            Dim: [n_target, m, N]
+    K: <xr.DataArray> for mismatched_grid=False; <np.array> for mismatched_grid=True
+        Gain K for the whole field
+        If mismatched_grid=False:
+            xr.DataArray with dimension: [lat, lon, n, m],
+            where [n, m] is the Kalman gain K
+        If mismatched_grid=True:
+            Is actually K_stacked, as returned by
+            calculate_gain_K_whole_field_mismatched_grid();
+            Dim: [n_entries, n, m]
+    da_meas: <xr.DataArray> [lat, lon, m]
+        Measurements at current time
+    R: <np.array> [lat, lon, m, m]
+        Measurement error covariance matrix (measurement error ~ N(0, R))
+    list_da_sm_to_update:
+        A list of soil moisture states to update, in the order of
+        ensemble members. Each member of the list is an xarray.DataArray for
+        an ensemble member, in the structure of VIC state file
+        "STATE_SOIL_MOISTURE" variable.
+    da_max_moist_n: <xarray.DataArray>
+        Maximum soil moisture for the whole domain and each tile
+        [unit: mm]. Soil moistures above maximum after perturbation will
+        be reset to maximum value.
+        Dimension: [lat, lon, n]
+    mismatched_grid: <bool>
+        Whether mismatched measurement and VIC grids. Default: False
+    grid_weights: <class MismatchedGridWeights> (Only needed if mismatched_grid = True)
+        Typically returned by extract_mismatched_grid_weight_info().
+    adjust_negative: <bool>
+        Whether or not to adjust negative soil moistures after update
+        to zero.
+        Default: True (adjust negative to zero)
+    nproc: <int>
+        Not used; all ensemble members are updated together in one
+        vectorized pass
+        Default: 1
+    no_sm3: <bool>
+        Whether to EXCLUDE SM3 from kalman filter state vector (i.e., no perturbation or update)
+        Default: False (i.e., default is to include SM3)
+
+    Returns
+    ----------
+    list_da_updated: <xr.Dataset>
+        A list of VIC-format updated soil moisture states for all ensemble
+    da_update_increm: <xr.DataArray>
+        Update increment of soil moisture states
+
+    Require
+    ----------
+    numpy
     '''
     
-    # --- Establish linear propagation matrix r[3, 3] --- #
-    r1 = dict_linear_model_param['r1']
-    r2 = dict_linear_model_param['r2']
-    r3 = dict_linear_model_param['r3']
-    r12 = dict_linear_model_param['r12']
-    r23 = dict_linear_model_param['r23']
-    r = np.array([[r1-r12, 0, 0],
-                  [r12, r2-r23, 0],
-                  [0, r23, r3]])
+    # --- Extract dimensions --- #
+    da_sm = list_da_sm_to_update[0]
+    nveg = len(da_sm['veg_class'])
+    nsnow = len(da_sm['snow_band'])
+    nlayer = len(da_sm['nlayer'])
+    lat_coord = da_max_moist_n['lat']
+    lon_coord = da_max_moist_n['lon']
+    nloop = len(lat_coord) * len(lon_coord)
+    n = nlayer * nveg * nsnow
+    m = len(da_meas['m'])
+    N = len(list_da_sm_to_update)
+    n_update = int(n/3*2) if no_sm3 is True else None
 
-    # --- Establish a list of time steps --- #
-    dt_hour = int(24 / model_steps_per_day)  # delta t in hour
-    times = pd.date_range(start_time, end_time, freq='{}H'.format(dt_hour))
+    # --- Stack VIC-format states of all members and convert to EnKF layout --- #
+    x_orig = convert_VICstates_to_EnKFstates_sm_ensemble(
+        np.stack([da.values for da in list_da_sm_to_update]))  # [nloop, n, N]
 
-    # --- Set initial states [3, lat, lon] --- #
-    # If not initial states, set all initial soil moistures to zero
-    if init_state_nc is None:
-        sm0 = np.zeros([3, len(lat_coord), len(lon_coord)])
-    # Otherwise, read from an initial state netCDF file
+    # --- Generate measurement perturbation for all members; each member has
+    # its own seed drawn from the global random state --- #
+    list_seed = [np.random.randint(low=100000) for i in range(N)]
+    v = generate_meas_perturbation_ensemble(R, list_seed)  # [n_meas, m, N]
+
+    # --- Update all ensemble members at once --- #
+    # If no mismatch
+    if mismatched_grid is False:
+        x = update_soil_moisture_states_ensemble(
+                x_orig.copy(), K.values.reshape([nloop, n, m]),
+                da_meas.values.reshape([nloop, m]),
+                y_est.values.reshape([nloop, m, N]), v,
+                da_max_moist_n.values.reshape([nloop, n]),
+                adjust_negative, n_update)  # [nloop, n, N]
+    # If mismatched grid
     else:
-        sm0 = xr.open_dataset(init_state_nc)['STATE_SOIL_MOISTURE']\
-              [0, 0, :, :, :].values
+        x = update_soil_moisture_states_mismatched_grid_ensemble(
+                x_orig.copy(), K,
+                da_meas.values.reshape([-1, m]),
+                y_est, v,
+                da_max_moist_n.values.reshape([nloop, n]),
+                grid_weights, adjust_negative, n_update)  # [nloop, n, N]
+
+    # --- Update increment --- #
+    increm = np.rollaxis(x - x_orig, 2, 0).reshape(
+        [N, len(lat_coord), len(lon_coord), n])  # [N, lat, lon, n]
+    if no_sm3 is True:
+        increm[:, :, :, int(n/3*2):] = 0
+    da_update_increm = xr.DataArray(
+        increm, coords=[range(1, N+1), lat_coord, lon_coord, range(n)],
+        dims=['N', 'lat', 'lon', 'n'])
+
+    # --- Convert back to VIC-format states --- #
+    sm_updated = convert_EnKFstates_sm_to_VICstates_ensemble(
+        x, nveg, nsnow, nlayer, len(lat_coord), len(lon_coord))
+    list_da_updated = []
+    for i, da in enumerate(list_da_sm_to_update):
+        list_da_updated.append(xr.DataArray(
+            sm_updated[i], coords=da.coords, dims=da.dims, attrs=da.attrs))
 
-    # --- Load forcing data --- #
-    start_year = start_time.year
-    end_year = end_time.year
-    list_ds = []
-    for year in range(start_year, end_year+1):
-        ds = xr.open_dataset(forcing_basepath + str(year) + '.nc')
-        list_ds.append(ds)
-    ds_force = xr.concat(list_ds, dim='time')
-    
-    # --- Run the linear model --- #
-    sm = np.empty([len(times), 3, len(lat_coord), len(lon_coord)])  # [time, 3, lat, lon]
-    for i, t in enumerate(times):
-        # Extract prec forcing
-        da_prec = ds_force[prec_varname].sel(time=t)  # [lat, lon]
-        # Determine the total number of loops
-        nloop = len(lat_coord) * len(lon_coord)
-        # Convert sm into nloop
-        if i == 0:
-            sm_init = sm0.reshape([3, nloop])  # [3, nloop]
-        else:
-            sm_init = sm[i-1, :, :, :].reshape([3, nloop])
-        # Convert prec into nloop
-        prec = da_prec.values.reshape([nloop])
-        prec2 = np.zeros(nloop)
-        prec3 = np.zeros(nloop)
-        prec = np.array([prec, prec2, prec3])  # [3, nloop]
-        # Use linear model operate to calculate sm(t)
-        sm_new = np.array(list(map(
-                    lambda j: np.dot(r, sm_init[:, j]) + prec[:, j],
-                    range(nloop))))  # [nloop, 3]
-        # Reshape and roll lat and lon to last # [3, lat, lon]
-        sm_new = sm_new.reshape([len(lat_coord), len(lon_coord), 3])
-        sm_new = np.rollaxis(sm_new, 0, 3)
-        sm_new = np.rollaxis(sm_new, 0, 3)
-        sm_new = sm_new.reshape([3, len(lat_coord), len(lon_coord)])
-        # Put sm_new into the final sm matrix
-        sm[i, :, :, :] = sm_new
-    
-    # --- Put simulated sm into history da and save to history file --- #
-    da_sm = xr.DataArray(sm,
-                         coords=[times, [0, 1, 2], lat_coord, lon_coord],
-                         dims=['time', 'nlayer', 'lat', 'lon'])
-    ds_hist = xr.Dataset({'OUT_SOIL_MOIST': da_sm})
-    ds_hist.to_netcdf(os.path.join(
-            out_history_dir,
-            out_history_fileprefix + \
-            '.{}-{:05d}.nc'.format(start_time.strftime('%Y-%m-%d'),
-                               start_time.hour*3600+start_time.second)))
-    
-    # --- Save state file at the end of the last time step --- #
-    state_time = end_time + pd.DateOffset(hours=dt_hour)
-    sm_state = sm[-1, :, :, :].reshape([1, 1, 3, len(lat_coord),
-                                        len(lon_coord)])  # [1, 1, 3, lat, lon]
-    da_sm_state = xr.DataArray(
-            sm_state,
-            coords=[[1], [0], [0, 1, 2], lat_coord, lon_coord],
-            dims=['veg_class', 'snow_band', 'nlayer', 'lat', 'lon'])
-    ds_state = xr.Dataset({'STATE_SOIL_MOISTURE': da_sm_state})
-    ds_state.to_netcdf(
-            out_state_basepath + \
-            '.{}_{:05d}.nc'.format(state_time.strftime('%Y%m%d'),
-                                  state_time.hour*3600+state_time.second))
+    return list_da_updated, da_update_increm
 
 
-def propagate_ensemble_linear_model(N, start_time, end_time, lat_coord,
-                                   lon_coord, model_steps_per_day,
-                                   init_state_dir, out_state_dir,
-                                   out_history_dir,
-                                   ens_forcing_basedir, ens_forcing_prefix,
-                                   prec_varname, dict_linear_model_param,
-                                   nproc=1):
-    ''' This function propagates (via VIC) an ensemble of states to a certain time point.
-    
+def generate_ar1_process(white_noise, phi, mu=0, ar1_prev=None):
+    ''' Generate an AR(1) process along the first (time) dimension with a
+        recursive filter, for all other dimensions at once:
+                ar1[t] = mu + phi * (ar1[t-1] - mu) + white_noise[t]
+
     Parameters
     ----------
-    N: <int>
-        Number of ensemble members
-    start_time: <pandas.tslib.Timestamp>
-        Start time of this propagation run
-    end_time: <pandas.tslib.Timestamp>
-        End time of this propagation
-    lat_coord: <list/xr.coord>
-        Latitude coordinates
-    lon_coord: <list/xr.coord>
-        Longitude coordinates
-    model_steps_per_day: <str>
-        VIC option - model steps per day
-    init_state_dir: <str>
-        Directory of initial states for each ensemble member
-        State file names are "state.ens<i>", where <i> is 1, 2, ..., N
-    out_state_dir: <str>
-        Directory of output states for each ensemble member
-        State file names will be "state.ens<i>.xxx.nc", where <i> is 1, 2, ..., N
-    out_history_dir: <str>
-        Directory of output history files for each ensemble member
-        History file names will be "history.ens<i>.nc", where <i> is 1, 2, ..., N
-    ens_forcing_basedir: <str>
-        Ensemble forcing basedir ('ens_{}' subdirs should be under basedir)
-    ens_forcing_prefix: <str>
-        Prefix of ensemble forcing filenames under 'ens_{}' subdirs
-        'YYYY.nc' will be appended
-    prec_varname: <str>
-        Precip varname in the forcing netCDF files
-    dict_linear_model_param: <dict>
-        A dict of linear model parameters.
-        Keys: 'r1', 'r2', 'r3', 'r12', 'r23'
-    nproc: <int>
-        Number of processors to use for parallel ensemble
-        Default: 1
-        
+    white_noise: <np.array>
+        White noise
+        Dimension: [time, ...]
+    phi: <float>
+        Parameter in AR(1) process
+    mu: <float>
+        Mean of the AR(1) process
+        Default: 0
+    ar1_prev: <np.array> or None
+        AR(1) value right before the first time point (e.g., the last time
+        point of the previous chunk, to continue the process across chunks);
+        None for starting the process with ar1[0] = white_noise[0]
+        Dimension: [...]
+        Default: None
+
+    Returns
+    ----------
+    ar1: <np.array>
+        AR(1) process
+        Dimension: [time, ...]
+
     Require
     ----------
-    OrderedDict
-    multiprocessing
-    generate_VIC_global_file
+    scipy.signal.lfilter
     '''
 
-    # --- If nproc == 1, do a regular ensemble loop --- #
-    if nproc == 1:
-        for i in range(N):
-            # Prepare linear model parameters
-            init_state_nc = os.path.join(init_state_dir,
-                                         'state.ens{}.nc'.format(i+1))
-            out_state_basepath = os.path.join(out_state_dir,
-                                              'state.ens{}'.format(i+1))
-            out_history_fileprefix = 'history.ens{}'.format(i+1)
-            forcing_basepath = os.path.join(
-                    ens_forcing_basedir,
-                    'ens_{}'.format(i+1), ens_forcing_prefix)
-            # Run linear model
-            propagate_linear_model(
-                    start_time, end_time, lat_coord, lon_coord,
-                    model_steps_per_day, init_state_nc, out_state_basepath,
-                    out_history_dir, out_history_fileprefix,
-                    forcing_basepath, prec_varname, dict_linear_model_param)
-
-    # --- If nproc > 1, use multiprocessing --- #
-    elif nproc > 1:
-        # --- Set up multiprocessing --- #
-        pool = mp.Pool(processes=nproc)
-        # --- Loop over each ensemble member --- #
-        for i in range(N):
-            # Prepare linear model parameters
-            init_state_nc = os.path.join(init_state_dir,
-                                         'state.ens{}.nc'.format(i+1))
-            out_state_basepath = os.path.join(out_state_dir,
-                                              'state.ens{}'.format(i+1))
-            out_history_fileprefix = 'history.ens{}'.format(i+1)
-            forcing_basepath = os.path.join(
-                    ens_forcing_basedir,
-                    'ens_{}'.format(i+1), ens_forcing_prefix)
-            # Run linear model
-            pool.apply_async(propagate_linear_model,
-                             (start_time, end_time, lat_coord, lon_coord,
-                              model_steps_per_day, init_state_nc,
-                              out_state_basepath, out_history_dir,
-                              out_history_fileprefix, forcing_basepath,
-                              prec_varname, dict_linear_model_param))
-        # --- Finish multiprocessing --- #
-        pool.close()
-        pool.join()
+    # The anomaly y = ar1 - mu follows y[t] = phi * y[t-1] + white_noise[t]
+    if ar1_prev is None:
+        x = np.array(white_noise, dtype=float)
+        x[0] -= mu
+        y = lfilter([1], [1, -phi], x, axis=0)
+    else:
+        zi = phi * (np.asarray(ar1_prev, dtype=float)[np.newaxis] - mu)
+        y, _ = lfilter([1], [1, -phi], white_noise, axis=0, zi=zi)
 
+    return y + mu
 
-def perturb_soil_moisture_states(states_to_perturb_nc, L, scale_n_nloop,
-                                 out_states_nc, da_max_moist_n,
-                                 adjust_negative=True, seed=None,
-                                 no_sm3=False, prescribed_noise=None):
-    ''' Perturb all soil_moisture states
+
+def perturb_forcings(ens, orig_forcing, dict_varnames, prec_std,
+                     prec_phi, out_forcing_basedir):
+    ''' Perturb forcings for a single ensemble member
 
     Parameters
     ----------
-    states_to_perturb_nc: <str>
-        Path of VIC state netCDF file to perturb
-    L: <np.array>
-        Cholesky decomposed matrix of covariance matrix P of all states:
-                        P = L * L.T
-        Thus, L * Z (where Z is i.i.d. standard normal random variables of
-        dimension [n, n]) is multivariate normal random variables with
-        mean zero and covariance matrix P.
-        Dimension: [n, n]
-    scale_n_nloop: <np.array>
-        Standard deviation of noise to add for the whole field.
-        Dimension: [nloop, n] (where nloop = lat * lon)
-    out_states_nc: <str>
-        Path of output perturbed VIC state netCDF file
-    da_max_moist_n: <xarray.DataArray>
-        Maximum soil moisture for the whole domain and each tile
-        [unit: mm]. Soil moistures above maximum after perturbation will
-        be reset to maximum value.
-        Dimension: [lat, lon, n]
-    adjust_negative: <bool>
-        Whether or not to adjust negative soil moistures after
-        perturbation to zero.
-        Default: True (adjust negative to zero)
-    seed: <int or None>
-        Seed for random number generator; this seed will only be used locally
-        in this function and will not affect the upper-level code.
-        None for not re-assign seed in this function, but using the global seed)
-        Default: None
-    no_sm3: <bool>
-        Whether to EXCLUDE SM3 from kalman filter state vector
-        (i.e., no perturbation or update)
-        Default: False (i.e., default is to include SM3)
-    prescribed_noise: <np.array> or None
-        If not None, use pre-generated random noises as Z (before transforming
-        to be vertically/tile correlated) instead of regenerating here
-        Dim: [lat, lon, n]
-        Default: None
+    ens: <int>
+        Ensemble index; will be used in output directory name
+    orig_forcing: <class 'Forcings'>
+        Original (unperturbed) VIC forcings
+    dict_varnames: <dict>
+        A dictionary of forcing names in nc file;
+        e.g., {'PREC': 'prcp'; 'AIR_TEMP': 'tas'}
+    prec_std: <float>
+        Standard deviation of the precipitation perturbing multiplier
+    prec_phi: <float>
+        Parameter in AR(1) process for precipitation noise.
+    out_forcing_basedir: <str>
+        Base directory for output perturbed forcings;
+        Subdirs "ens_<i>" will be created, where <i> is ensemble index, 1, ..., N
+        File names will be: forc.YYYY.nc 
 
-    Returns
+    Require
     ----------
-    da_perturbation: <da.DataArray>
-        Amount of perturbation added
-        Dimension: [veg_class, snow_band, nlayer, lat, lon]
+    os
+    '''
+    
+    # Setup subdir
+    subdir = setup_output_dirs(
+                out_forcing_basedir,
+                mkdirs=['ens_{}'.format(ens)])['ens_{}'.format(ens)]
+
+    # Perturb PREC
+    ds_perturbed = orig_forcing.perturb_prec_lognormal(
+                                        varname=dict_varnames['PREC'],
+                                        std=prec_std,
+                                        phi=prec_phi)
+    # Save to nc file
+    for year, ds in ds_perturbed.groupby('time.year'):
+        to_netcdf_forcing_file_compress(
+                ds, os.path.join(subdir,
+                'force.{}.nc'.format(year)))
+
+
+def generate_ensemble_forcings(list_ens, orig_forcing_basepath, start_year,
+                               end_year, dict_varnames, prec_std, prec_phi,
+                               out_forcing_basedir, base_seed, nproc=1):
+    ''' Perturb forcings for a list of ensemble members together, one year
+        at a time (so that memory stays bounded by one year of forcings for
+        all members). The AR(1) precipitation multiplier continues across
+        years, and ensemble member <ens> uses random seed (base_seed + ens) -
+        the same perturbation as perturbing the whole period at once for
+        each member (see Forcings.perturb_prec_lognormal).
+
+    Parameters
+    ----------
+    list_ens: <list>
+        A list of ensemble indices; will be used in output directory names
+    orig_forcing_basepath: <str>
+        Original (unperturbed) forcing basepath; "YYYY.nc" will be appended
+    start_year: <int>
+        Start year
+    end_year: <int>
+        End year
+    dict_varnames: <dict>
+        A dictionary of forcing names in nc file;
+        e.g., {'PREC': 'prcp'; 'AIR_TEMP': 'tas'}
+    prec_std: <float>
+        Standard deviation of the precipitation perturbing multiplier
+    prec_phi: <float>
+        Parameter in AR(1) process for precipitation noise.
+    out_forcing_basedir: <str>
+        Base directory for output perturbed forcings;
+        Subdirs "ens_<i>" will be created, where <i> is ensemble index
+        File names will be: force.YYYY.nc
+    base_seed: <int>
+        Base random seed
+    nproc: <int>
+        Number of processors to use for writing forcing files
+        Default: 1
+
+    Require
+    ----------
+    os
+    Forcings
+    generate_ar1_process
+    EnsembleWorkerPool
+    to_netcdf_forcing_file_compress
+    '''
+
+    # --- Calculate mu and sigma for the lognormal distribution --- #
+    # (here mu and sigma are mean and std of the underlying normal dist.)
+    mu = -0.5 * np.log(np.square(prec_std)+1)
+    sigma = np.sqrt(np.log(np.square(prec_std)+1))
+    scale = sigma * np.sqrt(1 - prec_phi * prec_phi)
+
+    # --- Setup subdirs and random number generators --- #
+    list_subdir = [setup_output_dirs(
+                        out_forcing_basedir,
+                        mkdirs=['ens_{}'.format(ens)])['ens_{}'.format(ens)]
+                   for ens in list_ens]
+    list_rng = [np.random.RandomState(base_seed + ens) for ens in list_ens]
+
+    # --- Perturb and save each year --- #
+    pool = EnsembleWorkerPool(nproc)
+    ar1_prev = None
+    for year in range(start_year, end_year+1):
+        with xr.open_dataset('{}{}.nc'.format(orig_forcing_basepath, year)) as ds:
+            orig_forcing = Forcings(ds.load())
+        shape = (orig_forcing.time_len, orig_forcing.lat_len,
+                 orig_forcing.lon_len)
+        # White noise of all members [time, N, lat, lon]
+        white_noise = np.stack([rng.normal(loc=0, scale=scale, size=shape)
+                                for rng in list_rng], axis=1)
+        # AR(1) multipliers of all members
+        ar1 = generate_ar1_process(white_noise, prec_phi, mu, ar1_prev)
+        ar1_prev = ar1[-1]
+        noise = np.exp(ar1)
+        # Save perturbed forcings of all members
+        list_args = []
+        for i in range(len(list_ens)):
+            ds_perturbed = orig_forcing.ds.copy(deep=True)
+            ds_perturbed[dict_varnames['PREC']][:] *= noise[:, i, :, :]
+            list_args.append((ds_perturbed, os.path.join(
+                list_subdir[i], 'force.{}.nc'.format(year))))
+        pool.map(to_netcdf_forcing_file_compress, list_args)
+    pool.close()
+
+
+def replace_global_values(gp, replace):
+    '''given a multiline string that represents a VIC global parameter file,
+       loop through the string, replacing values with those found in the
+       replace dictionary'''
+    
+    gpl = []
+    for line in iter(gp.splitlines()):
+        line_list = line.split()
+        if line_list:
+            key = line_list[0]
+            if key in replace:
+                value = replace.pop(key)
+                val = list([str(value)])
+            else:
+                val = line_list[1:]
+            gpl.append('{0: <20} {1}\n'.format(key, ' '.join(val)))
+
+    if replace:
+        for key, val in replace.items():
+            try:
+                value = ' '.join(val)
+            except:
+                value = val
+            gpl.append('{0: <20} {1}\n'.format(key, value))
+
+    return gpl
+
+
+def perturb_soil_moisture_states_ensemble(N, states_to_perturb_dir,
+                                          L, scale_n_nloop,
+                                          out_states_dir,
+                                          da_max_moist_n,
+                                          adjust_negative=True,
+                                          nproc=1, no_sm3=False,
+                                          prescribed_noise_ensemble=None,
+                                          seed=None):
+    ''' Perturb all soil_moisture states for each ensemble member. All
+        members are perturbed together in one vectorized pass (see
+        perturb_soil_moisture_states_list)
+    
+    Parameters
+    ----------
+    N: <int>
+        Number of ensemble members
+    states_to_perturb_dir: <str>
+        Directory for VIC state files to perturb.
+        File names: state.ens<i>.nc, where <i> is ensemble index 1, ..., N
+    L: <np.array>
+        Cholesky decomposed matrix of covariance matrix P of all states:
+                        P = L * L.T
+        Thus, L * Z (where Z is i.i.d. standard normal random variables of
+        dimension [n, n]) is multivariate normal random variables with
+        mean zero and covariance matrix P.
+        Dimension: [n, n]
+    scale_n_nloop: <np.array>
+        Standard deviation of noise to add for the whole field.
+        Dimension: [nloop, n] (where nloop = lat * lon)
+    out_states_dir: <str>
+        Directory for output perturbed VIC state files;
+        File names: state.ens<i>.nc, where <i> is ensemble index 1, ..., N
+    da_max_moist_n: <xarray.DataArray>
+        Maximum soil moisture for the whole domain and each tile
+        [unit: mm]. Soil moistures above maximum after perturbation will
+        be reset to maximum value.
+        Dimension: [lat, lon, n]
+    adjust_negative: <bool>
+        Whether or not to adjust negative soil moistures after
+        perturbation to zero.
+        Default: True (adjust negative to zero)
+    nproc: <int>
+        Number of processors to use for writing perturbed state files
+        Default: 1
+    no_sm3: <bool>
+        Whether to EXCLUDE SM3 from kalman filter state vector
+        (i.e., no perturbation or update)
+        Default: False (i.e., default is to include SM3)
+    prescribed_noise_ensemble: <xr.DataArray>
+        If not None, use pre-generated random noises as Z (before transforming
+        to be vertically/tile correlated) instead of regenerating here
+        Dim: [lat, lon, n, N]
+        Default: None
+    seed: <int or None>
+        Seed for random number generator of this timestep; see
+        generate_sm_perturbation_ensemble
+        Default: None
+
+    Return
+    ----------
+    list_da_perturbation: <list>
+        A list of amount of perturbation added (a list of each ensemble member)
+        Dimension of each da: [veg_class, snow_band, nlayer, lat, lon]
+    
+    Require
+    ----------
+    os
+    perturb_soil_moisture_states_list
+    '''
+
+    list_states_to_perturb_nc = [
+        os.path.join(states_to_perturb_dir, 'state.ens{}.nc'.format(i+1))
+        for i in range(N)]
+    list_out_states_nc = [
+        os.path.join(out_states_dir, 'state.ens{}.nc'.format(i+1))
+        for i in range(N)]
+    list_da_perturbation = perturb_soil_moisture_states_list(
+        list_states_to_perturb_nc, list_out_states_nc,
+        L, scale_n_nloop, da_max_moist_n,
+        adjust_negative, seed, nproc, no_sm3,
+        prescribed_noise_ensemble)
+
+    return list_da_perturbation
+
+
+def propagate(start_time, end_time, vic_exe, vic_global_template_file,
+                       vic_model_steps_per_day, init_state_nc, out_state_basepath,
+                       out_history_dir, out_history_fileprefix,
+                       out_global_basepath, out_log_dir,
+                       forcing_basepath, mpi_proc=None, mpi_exe='mpiexec', delete_log=True):
+    ''' This function propagates (via VIC) from an initial state (or no initial state)
+        to a certain time point.
+
+    Parameters
+    ----------
+    start_time: <pandas.tslib.Timestamp>
+        Start time of this propagation run
+    end_time: <pandas.tslib.Timestamp>
+        End time of this propagation
+    vic_exe: <class 'VIC'>
+        Tonic VIC class
+    vic_global_template_file: <str>
+        Path of VIC global file template
+    vic_model_steps_per_day: <str>
+        VIC option - model steps per day
+    init_state_nc: <str>
+        Initial state netCDF file; None for no initial state
+    out_state_basepath: <str>
+        Basepath of output states; ".YYYYMMDD_SSSSS.nc" will be appended.
+        None if do not want to output state file
+    out_history_dir: <str>
+        Directory of output history files
+    out_history_fileprefix: <str>
+        History file prefix
+    out_global_basepath: <str>
+        Basepath of output global files; "YYYYMMDD-HHS_YYYYMMDD.txt" will be appended
+    out_log_dir: <str>
+        Directory for output log files
+    forcing_basepath: <str>
+        Forcing basepath. <YYYY.nc> will be appended
+    mpi_proc: <int or None>
+        Number of processors to use for VIC MPI run. None for not using MPI
+        Default: None
+    mpi_exe: <str>
+        Path for MPI exe. Only used if mpi_proc is not None
+    delete_log: <bool>
+        Whether to delete all log files in the log directory after running.
+        Default: True
+
+    Require
+    ----------
+    OrderedDict
+    generate_VIC_global_file
+    check_returncode
+    '''
+
+    # Generate VIC global param file
+    replace = OrderedDict([('FORCING1', forcing_basepath),
+                           ('OUTFILE', out_history_fileprefix)])
+    global_file = generate_VIC_global_file(
+                        global_template_path=vic_global_template_file,
+                        model_steps_per_day=vic_model_steps_per_day,
+                        start_time=start_time,
+                        end_time=end_time,
+                        init_state='#INIT_STATE' if init_state_nc is None
+                                   else 'INIT_STATE {}'.format(init_state_nc),
+                        vic_state_basepath=out_state_basepath,
+                        vic_history_file_dir=out_history_dir,
+                        replace=replace,
+                        output_global_basepath=out_global_basepath)
+    
+    # Run VIC
+    returncode = vic_exe.run(global_file, logdir=out_log_dir,
+                             **{'mpi_proc': mpi_proc, 'mpi_exe': mpi_exe})
+    check_returncode(returncode, expected=0)
+
+    # Delete log files (to save space)
+    if delete_log:
+        for f in glob.glob(os.path.join(out_log_dir, "*")):
+            os.remove(f)
+
+
+def propagate_linear_model(start_time, end_time, lat_coord, lon_coord,
+                       model_steps_per_day, init_state_nc, out_state_basepath,
+                       out_history_dir, out_history_fileprefix,
+                       forcing_basepath, prec_varname, dict_linear_model_param):
+    ''' This function propagates (via VIC) from an initial state (or no
+        initial state) to a certain time point for the whole domain.
+        The linear model assumes 3 soil layers and only allows 1 tile per
+        grid cell (i.e., nveg=1 and nsnow=1). Specifically, for each grid cell,
+        the model takes the following form:
+                    sm(t+1) = r * sm(t) + P(t)
+        where sm(t) is an array of dim [3, 1], r is a constant matrix of
+        dim [3, 3], and P(t) is input precipitation and is an array of dim
+        [3, 1].
+
+    Parameters
+    ----------
+    start_time: <pandas.tslib.Timestamp>
+        Start time of this propagation run
+    end_time: <pandas.tslib.Timestamp>
+        End time of this propagation
+    lat_coord: <list/xr.coord>
+        Latitude coordinates
+    lon_coord: <list/xr.coord>
+        Longitude coordinates
+    model_steps_per_day: <str>
+        VIC option - model steps per day
+    init_state_nc: <str>
+        Initial state netCDF file; None for no initial state
+    out_state_basepath: <str>
+        Basepath of output states; ".YYYYMMDD_SSSSS.nc" will be appended
+    out_history_dir: <str>
+        Directory of output history files
+    out_history_fileprefix: <str>
+        History file prefix
+    forcing_basepath: <str>
+        Forcing basepath. <YYYY.nc> will be appended
+    prec_varname: <str>
+        Precip varname in the forcing netCDF files
+    dict_linear_model_param: <dict>
+        A dict of linear model parameters.
+        Keys: 'r1', 'r2', 'r3', 'r12', 'r23'
+    '''
+    
+    # --- Establish linear propagation matrix r[3, 3] --- #
+    r = linear_model_matrix(dict_linear_model_param)
+
+    # --- Establish a list of time steps --- #
+    dt_hour = int(24 / model_steps_per_day)  # delta t in hour
+    times = pd.date_range(start_time, end_time, freq='{}H'.format(dt_hour))
+
+    # --- Set initial states [1, 3, nloop] --- #
+    nloop = len(lat_coord) * len(lon_coord)
+    sm0 = load_linear_model_init_state(init_state_nc, nloop)[np.newaxis, :, :]
+
+    # --- Load forcing data [1, time, nloop] --- #
+    prec = load_linear_model_prec(forcing_basepath, prec_varname, times)\
+           .reshape([1, len(times), nloop])
+
+    # --- Run the linear model --- #
+    sm = run_linear_model(r, sm0, prec)  # [1, time, 3, nloop]
+
+    # --- Save history and state files --- #
+    save_linear_model_history_state(
+        sm[0], times, end_time + pd.DateOffset(hours=dt_hour),
+        lat_coord, lon_coord,
+        os.path.join(out_history_dir,
+                     out_history_fileprefix + \
+                     '.{}-{:05d}.nc'.format(start_time.strftime('%Y-%m-%d'),
+                                            start_time.hour*3600+start_time.second)),
+        out_state_basepath)
+
+
+def linear_model_matrix(dict_linear_model_param):
+    ''' Establish the linear propagation matrix r of the linear model
+
+    Parameters
+    ----------
+    dict_linear_model_param: <dict>
+        A dict of linear model parameters.
+        Keys: 'r1', 'r2', 'r3', 'r12', 'r23'
+
+    Returns
+    ----------
+    r: <np.array>
+        Linear propagation matrix
+        Dimension: [3, 3]
+    '''
+
+    r1 = dict_linear_model_param['r1']
+    r2 = dict_linear_model_param['r2']
+    r3 = dict_linear_model_param['r3']
+    r12 = dict_linear_model_param['r12']
+    r23 = dict_linear_model_param['r23']
+    r = np.array([[r1-r12, 0, 0],
+                  [r12, r2-r23, 0],
+                  [0, r23, r3]])
+
+    return r
+
+
+def load_linear_model_init_state(init_state_nc, nloop):
+    ''' Load initial soil moisture states of the linear model
+
+    Parameters
+    ----------
+    init_state_nc: <str>
+        Initial state netCDF file; None for no initial state (all initial
+        soil moistures are set to zero)
+    nloop: <int>
+        Number of grid cells (= lat * lon)
+
+    Returns
+    ----------
+    sm0: <np.array>
+        Initial soil moisture states
+        Dimension: [3, nloop]
+    '''
+
+    if init_state_nc is None:
+        return np.zeros([3, nloop])
+    with xr.open_dataset(init_state_nc) as ds:
+        sm0 = ds['STATE_SOIL_MOISTURE'][0, 0, :, :, :].values
+    return sm0.reshape([3, nloop])
+
+
+def load_linear_model_prec(forcing_basepath, prec_varname, times):
+    ''' Load precipitation forcing of the linear model for all time steps
+        into a contiguous array
+
+    Parameters
+    ----------
+    forcing_basepath: <str>
+        Forcing basepath. <YYYY.nc> will be appended
+    prec_varname: <str>
+        Precip varname in the forcing netCDF files
+    times: <pd.DatetimeIndex>
+        Model time steps
+
+    Returns
+    ----------
+    prec: <np.array>
+        Precipitation forcing
+        Dimension: [time, lat, lon]
+    '''
+
+    list_da = []
+    for year in range(times[0].year, times[-1].year+1):
+        with xr.open_dataset(forcing_basepath + str(year) + '.nc') as ds:
+            list_da.append(ds[prec_varname].sel(
+                time=slice(times[0], times[-1])).load())
+    da_prec = xr.concat(list_da, dim='time').sel(time=times)
+
+    return np.ascontiguousarray(da_prec.values)
+
+
+def run_linear_model(r, sm0, prec):
+    ''' Run the linear model for an ensemble of whole fields:
+                    sm(t+1) = r * sm(t) + P(t)
+        where P(t) is precipitation added to the top layer.
+
+    Parameters
+    ----------
+    r: <np.array>
+        Linear propagation matrix
+        Dimension: [3, 3]
+    sm0: <np.array>
+        Initial soil moisture states
+        Dimension: [N, 3, nloop]
+    prec: <np.array>
+        Precipitation forcing
+        Dimension: [N, time, nloop]
+
+    Returns
+    ----------
+    sm: <np.array>
+        Soil moisture states at the end of each time step
+        Dimension: [N, time, 3, nloop]
+    '''
+
+    N, nt, nloop = prec.shape
+    sm = np.empty([N, nt, 3, nloop])
+    sm_prev = sm0
+    for i in range(nt):
+        np.matmul(r, sm_prev, out=sm[:, i, :, :])  # [N, 3, nloop]
+        sm[:, i, 0, :] += prec[:, i, :]
+        sm_prev = sm[:, i, :, :]
+
+    return sm
+
+
+def save_linear_model_history_state(sm, times, state_time, lat_coord, lon_coord,
+                                    out_history_nc, out_state_basepath):
+    ''' Save linear model results of one ensemble member to a history file
+        and a state file (at the end of the last time step), in the same
+        format as VIC
+
+    Parameters
+    ----------
+    sm: <np.array>
+        Soil moisture states at the end of each time step
+        Dimension: [time, 3, nloop]
+    times: <pd.DatetimeIndex>
+        Model time steps
+    state_time: <pd.datetime>
+        Time of the state file (the end of the last time step)
+    lat_coord: <list/xr.coord>
+        Latitude coordinates
+    lon_coord: <list/xr.coord>
+        Longitude coordinates
+    out_history_nc: <str>
+        Output history file path
+    out_state_basepath: <str>
+        Basepath of output states; ".YYYYMMDD_SSSSS.nc" will be appended
+    '''
+
+    sm = sm.reshape([len(times), 3, len(lat_coord), len(lon_coord)])
+
+    # --- Put simulated sm into history da and save to history file --- #
+    da_sm = xr.DataArray(sm,
+                         coords=[times, [0, 1, 2], lat_coord, lon_coord],
+                         dims=['time', 'nlayer', 'lat', 'lon'])
+    ds_hist = xr.Dataset({'OUT_SOIL_MOIST': da_sm})
+    ds_hist.to_netcdf(out_history_nc)
+
+    # --- Save state file at the end of the last time step --- #
+    sm_state = sm[-1, :, :, :].reshape([1, 1, 3, len(lat_coord),
+                                        len(lon_coord)])  # [1, 1, 3, lat, lon]
+    da_sm_state = xr.DataArray(
+            sm_state,
+            coords=[[1], [0], [0, 1, 2], lat_coord, lon_coord],
+            dims=['veg_class', 'snow_band', 'nlayer', 'lat', 'lon'])
+    ds_state = xr.Dataset({'STATE_SOIL_MOISTURE': da_sm_state})
+    ds_state.to_netcdf(
+            out_state_basepath + \
+            '.{}_{:05d}.nc'.format(state_time.strftime('%Y%m%d'),
+                                  state_time.hour*3600+state_time.second))
+
+
+def propagate_ensemble_linear_model(N, start_time, end_time, lat_coord,
+                                   lon_coord, model_steps_per_day,
+                                   init_state_dir, out_state_dir,
+                                   out_history_dir,
+                                   ens_forcing_basedir, ens_forcing_prefix,
+                                   prec_varname, dict_linear_model_param,
+                                   nproc=1, pool=None,
+                                   member_done_callback=None):
+    ''' This function propagates (via VIC) an ensemble of states to a certain time point.
+    
+    Parameters
+    ----------
+    N: <int>
+        Number of ensemble members
+    start_time: <pandas.tslib.Timestamp>
+        Start time of this propagation run
+    end_time: <pandas.tslib.Timestamp>
+        End time of this propagation
+    lat_coord: <list/xr.coord>
+        Latitude coordinates
+    lon_coord: <list/xr.coord>
+        Longitude coordinates
+    model_steps_per_day: <str>
+        VIC option - model steps per day
+    init_state_dir: <str>
+        Directory of initial states for each ensemble member
+        State file names are "state.ens<i>", where <i> is 1, 2, ..., N
+    out_state_dir: <str>
+        Directory of output states for each ensemble member
+        State file names will be "state.ens<i>.xxx.nc", where <i> is 1, 2, ..., N
+    out_history_dir: <str>
+        Directory of output history files for each ensemble member
+        History file names will be "history.ens<i>.nc", where <i> is 1, 2, ..., N
+    ens_forcing_basedir: <str>
+        Ensemble forcing basedir ('ens_{}' subdirs should be under basedir)
+    ens_forcing_prefix: <str>
+        Prefix of ensemble forcing filenames under 'ens_{}' subdirs
+        'YYYY.nc' will be appended
+    prec_varname: <str>
+        Precip varname in the forcing netCDF files
+    dict_linear_model_param: <dict>
+        A dict of linear model parameters.
+        Keys: 'r1', 'r2', 'r3', 'r12', 'r23'
+    nproc: <int>
+        Not used; all members are propagated in one batched array
+        (kept for compatibility)
+        Default: 1
+    pool: <class EnsembleWorkerPool> or None
+        Worker pool to write the output files of the members with; if None,
+        files are written in this process.
+        Default: None
+    member_done_callback: <function> or None
+        If not None, called (in this process) with the member index
+        (starting from 0) as soon as each member's output files are written
+        Default: None
+        
+    Require
+    ----------
+    EnsembleWorkerPool
+    linear_model_matrix
+    load_linear_model_init_state
+    load_linear_model_prec
+    run_linear_model
+    save_linear_model_history_state
+    '''
+
+    # --- Establish linear propagation matrix r[3, 3] --- #
+    r = linear_model_matrix(dict_linear_model_param)
+
+    # --- Establish a list of time steps --- #
+    dt_hour = int(24 / model_steps_per_day)  # delta t in hour
+    times = pd.date_range(start_time, end_time, freq='{}H'.format(dt_hour))
+    nloop = len(lat_coord) * len(lon_coord)
+
+    # --- Load initial states [N, 3, nloop] and forcings [N, time, nloop] --- #
+    sm0 = np.empty([N, 3, nloop])
+    prec = np.empty([N, len(times), nloop])
+    for i in range(N):
+        sm0[i] = load_linear_model_init_state(
+            os.path.join(init_state_dir, 'state.ens{}.nc'.format(i+1)), nloop)
+        prec[i] = load_linear_model_prec(
+            os.path.join(ens_forcing_basedir, 'ens_{}'.format(i+1),
+                         ens_forcing_prefix),
+            prec_varname, times).reshape([len(times), nloop])
+
+    # --- Run the linear model for all members at once --- #
+    sm = run_linear_model(r, sm0, prec)  # [N, time, 3, nloop]
+
+    # --- Save history and state files for each member --- #
+    state_time = end_time + pd.DateOffset(hours=dt_hour)
+    list_args = []
+    for i in range(N):
+        list_args.append((
+            sm[i], times, state_time, lat_coord, lon_coord,
+            os.path.join(out_history_dir,
+                         'history.ens{}.{}-{:05d}.nc'.format(
+                            i+1, start_time.strftime('%Y-%m-%d'),
+                            start_time.hour*3600+start_time.second)),
+            os.path.join(out_state_dir, 'state.ens{}'.format(i+1))))
+    if pool is None:
+        worker_pool = EnsembleWorkerPool(1)
+    else:
+        worker_pool = pool
+    for i, _ in worker_pool.imap_unordered(save_linear_model_history_state,
+                                           list_args):
+        if member_done_callback is not None:
+            member_done_callback(i)
+
+
+def perturb_soil_moisture_states(states_to_perturb_nc, L, scale_n_nloop,
+                                 out_states_nc, da_max_moist_n,
+                                 adjust_negative=True, seed=None,
+                                 no_sm3=False, prescribed_noise=None):
+    ''' Perturb all soil_moisture states
+
+    Parameters
+    ----------
+    states_to_perturb_nc: <str>
+        Path of VIC state netCDF file to perturb
+    L: <np.array>
+        Cholesky decomposed matrix of covariance matrix P of all states:
+                        P = L * L.T
+        Thus, L * Z (where Z is i.i.d. standard normal random variables of
+        dimension [n, n]) is multivariate normal random variables with
+        mean zero and covariance matrix P.
+        Dimension: [n, n]
+    scale_n_nloop: <np.array>
+        Standard deviation of noise to add for the whole field.
+        Dimension: [nloop, n] (where nloop = lat * lon)
+    out_states_nc: <str>
+        Path of output perturbed VIC state netCDF file
+    da_max_moist_n: <xarray.DataArray>
+        Maximum soil moisture for the whole domain and each tile
+        [unit: mm]. Soil moistures above maximum after perturbation will
+        be reset to maximum value.
+        Dimension: [lat, lon, n]
+    adjust_negative: <bool>
+        Whether or not to adjust negative soil moistures after
+        perturbation to zero.
+        Default: True (adjust negative to zero)
+    seed: <int or None>
+        Seed for random number generator; this seed will only be used locally
+        in this function and will not affect the upper-level code.
+        None for not re-assign seed in this function, but using the global seed)
+        Default: None
+    no_sm3: <bool>
+        Whether to EXCLUDE SM3 from kalman filter state vector
+        (i.e., no perturbation or update)
+        Default: False (i.e., default is to include SM3)
+    prescribed_noise: <np.array> or None
+        If not None, use pre-generated random noises as Z (before transforming
+        to be vertically/tile correlated) instead of regenerating here
+        Dim: [lat, lon, n]
+        Default: None
+
+    Returns
+    ----------
+    da_perturbation: <da.DataArray>
+        Amount of perturbation added
+        Dimension: [veg_class, snow_band, nlayer, lat, lon]
+
+    Require
+    ----------
+    os
+    class States
+    '''
+
+    # --- Load in original state file --- #
+    class_states = States(xr.open_dataset(states_to_perturb_nc))
+
+    # --- Perturb --- #
+    # Perturb
+    ds_perturbed = class_states.perturb_soil_moisture_Gaussian(
+                            L, scale_n_nloop, da_max_moist_n,
+                            adjust_negative, seed, prescribed_noise)
+    # If exclude SM3 from state vector, reset SM3 to before-perturbed states
+    if no_sm3 is True:
+        ds_perturbed['STATE_SOIL_MOISTURE'][:, :, 2, :, :] = \
+            class_states.ds['STATE_SOIL_MOISTURE'][:, :, 2, :, :]
+
+    # --- Save perturbed state file --- #
+    ds_perturbed.to_netcdf(out_states_nc,
+                           format='NETCDF4_CLASSIC')
+
+    # --- Return perturbation --- #
+    da_perturbation = (ds_perturbed - class_states.ds)['STATE_SOIL_MOISTURE']
+
+    return da_perturbation
+
+
+def perturb_soil_moisture_states_class_input(class_states, L, scale_n_nloop,
+                                 out_states_nc, da_max_moist_n,
+                                 adjust_negative=True, seed=None, no_sm3=False,
+                                 prescribed_noise=None):
+    ''' Perturb all soil_moisture states (same as funciton
+        perturb_soil_moisture_states except here inputing class_states
+        instead of an netCDF path for states to perturb)
+
+    Parameters
+    ----------
+    class_states: <class States>
+        VIC state netCDF file to perturb
+    L: <np.array>
+        Cholesky decomposed matrix of covariance matrix P of all states:
+                        P = L * L.T
+        Thus, L * Z (where Z is i.i.d. standard normal random variables of
+        dimension [n, n]) is multivariate normal random variables with
+        mean zero and covariance matrix P.
+        Dimension: [n, n]
+    scale_n_nloop: <np.array>
+        Standard deviation of noise to add for the whole field.
+        Dimension: [nloop, n] (where nloop = lat * lon)
+    out_states_nc: <str>
+        Path of output perturbed VIC state netCDF file
+    da_max_moist_n: <xarray.DataArray>
+        Maximum soil moisture for the whole domain and each tile
+        [unit: mm]. Soil moistures above maximum after perturbation will
+        be reset to maximum value.
+        Dimension: [lat, lon, n]
+    adjust_negative: <bool>
+        Whether or not to adjust negative soil moistures after
+        perturbation to zero.
+        Default: True (adjust negative to zero)
+    seed: <int or None>
+        Seed for random number generator; this seed will only be used locally
+        in this function and will not affect the upper-level code.
+        None for not re-assign seed in this function, but using the global seed)
+        Default: None
+    no_sm3: <bool>
+        Whether to EXCLUDE SM3 from kalman filter state vector (i.e., no perturbation or update)
+        Default: False (i.e., default is to include SM3)
+    prescribed_noise: <np.array> or None
+        If not None, use pre-generated random noises as Z (before transforming
+        to be vertically/tile correlated) instead of regenerating here
+        Dim: [lat, lon, n]
+        Default: None
+
+    Returns
+    ----------
+    da_perturbation: <da.DataArray>
+        Amount of perturbation added
+        Dimension: [veg_class, snow_band, nlayer, lat, lon]
+
+    Require
+    ----------
+    os
+    class States
+    '''
+
+    # --- Perturb --- #
+    # Perturb
+    ds_perturbed = class_states.perturb_soil_moisture_Gaussian(
+                            L, scale_n_nloop, da_max_moist_n,
+                            adjust_negative, seed, prescribed_noise)
+    # If exclude SM3 from state vector, reset SM3 to before-perturbed states
+    if no_sm3 is True:
+        ds_perturbed['STATE_SOIL_MOISTURE'][:, :, 2, :, :] = \
+            class_states.ds['STATE_SOIL_MOISTURE'][:, :, 2, :, :]
+
+    # --- Save perturbed state file --- #
+    to_netcdf_state_file_compress(ds_perturbed, out_states_nc)
+
+    # --- Return perturbation --- #
+    da_perturbation = (ds_perturbed - class_states.ds)['STATE_SOIL_MOISTURE']
+
+    return da_perturbation
+
+
+def concat_vic_history_files(list_history_nc):
+    ''' Concatenate short-periods of VIC history files into one; if the time period of
+        the next file overlaps that of the current file, the next-file values will be
+        used
+    
+    list_history_nc: <list>
+        A list of history files to be concatenated, in order
+    '''
+    
+    print('\tConcatenating {} files...'.format(len(list_history_nc)))
+
+    # --- Open all history files --- #
+    list_ds = []
+    for file in list_history_nc:
+        list_ds.append(xr.open_dataset(file))
+
+    # --- Loop over each history file and concatenate --- #
+    list_ds_to_concat = []  # list of ds to concat, with no overlapping periods
+    for i in range(len(list_ds[:-1])):
+        # Determine and truncate data, if needed
+        times_current = pd.to_datetime(list_ds[i]['time'].values)  # times of current ds
+        times_next = pd.to_datetime(list_ds[i+1]['time'].values)  # times of next ds
+        if times_current[-1] >= times_next[0]:  # if overlap, truncate the current ds
+            # Minus 2 seconds to avoid resolution issue
+            trunc_time_point = times_next[0] - pd.DateOffset(seconds=2) 
+            ds = list_ds[i].sel(time=slice(None, '{}T{:02d}:{:02d}:{:02d}'.format(
+                                                trunc_time_point.strftime('%Y-%m-%d'),
+                                                trunc_time_point.hour,
+                                                trunc_time_point.minute,
+                                                trunc_time_point.second)))
+        else:  # if no overlap, do not truncate
+            ds = list_ds[i]
+        # Concat to the list
+        list_ds_to_concat.append(ds)
+        
+    # Concat the last period fully to the list
+    list_ds_to_concat.append(list_ds[-1])
+   
+    # Concat all ds's
+    ds_concat = xr.concat(list_ds_to_concat, dim='time')
+    
+    return ds_concat
+
+
+def calculate_max_soil_moist_domain(global_path):
+    ''' Calculates maximum soil moisture for all grid cells and all soil layers (from soil parameters)
+    
+    Parameters
+    ----------
+    global_path: <str>
+        VIC global parameter file path; can be a template file (here it is only used to
+        extract soil parameter file info)
+        
+    Returns
+    ----------
+    da_max_moist: <xarray.DataArray>
+        Maximum soil moisture for the whole domain and each soil layer [unit: mm];
+        Dimension: [nlayer, lat, lon]
+    
+    Require
+    ----------
+    xarray
+    find_global_param_value
+    '''
+    
+     # Load soil parameter file (as defined in global file)
+    with open(global_path, 'r') as global_file:
+        global_param = global_file.read()
+    soil_nc = find_global_param_value(global_param, 'PARAMETERS')
+    ds_soil = xr.open_dataset(soil_nc, decode_cf=False)
+    
+    # Calculate maximum soil moisture for each layer
+    # Dimension: [nlayer, lat, lon]
+    da_depth = ds_soil['depth']  # [m]
+    da_bulk_density = ds_soil['bulk_density']  # [kg/m3]
+    da_soil_density = ds_soil['soil_density']  # [kg/m3]
+    da_porosity = 1 - da_bulk_density / da_soil_density
+    da_max_moist = da_depth * da_porosity * 1000  # [mm]
+
+    return da_max_moist
+
+
+def convert_max_moist_n_state(da_max_moist, nveg, nsnow):
+    ''' Converts da_max_moist of dimension [nlayer, lat, lon] to [lat, lon, n]
+        (Max moistures for each tile within a certain grid cell and layer are the same)
+
+    Parameters
+    ----------
+    da_max_moist: <xarray.DataArray>
+        Maximum soil moisture for the whole domain and each soil layer [unit: mm];
+        Dimension: [nlayer, lat, lon]
+    nveg: <int>
+        Number of veg classes
+    nsnow: <int>
+        Number of snow bands
+
+    Returns
+    ----------
+    da_max_moist_n: <xarray.DataArray>
+        Maximum soil moisture for the whole domain and each tile [unit: mm];
+        Dimension: [lat, lon, n]
+    '''
+ 
+    # Extract coordinates
+    nlayer = da_max_moist['nlayer']
+    lat = da_max_moist['lat']
+    lon = da_max_moist['lon']
+    n = len(nlayer) * nveg * nsnow
+
+    # Roll dimension to [lat, lon, nlayer]
+    max_moist = np.rollaxis(da_max_moist.values, 0, 3)  # [lat, lon, nlayer]
+
+    # Repeat data for each cell and layer for nveg*nsnow times, and convert
+    # dimension to [lat, lon, n]
+    max_moist_new = np.repeat(max_moist, nveg*nsnow).reshape([len(lat), len(lon), n])
+
+    # Put into da
+    da_max_moist_n = xr.DataArray(max_moist_new,
+                                  coords=[lat, lon, range(n)],
+                                  dims=['lat', 'lon', 'n'])
+
+    return da_max_moist_n
+
+
+def calculate_ensemble_mean_states(list_state_nc, out_state_nc):
+    ''' Calculates ensemble-mean of multiple state files; the state files are
+        read one at a time
+
+    Parameters
+    ----------
+    list_state_nc: <list>
+        A list of VIC state nc files whose mean to be calculated
+    out_state_nc: <str>
+        Path of output state netCDF file
+
+    Returns
+    ----------
+    out_state_nc: <str>
+        Path of output state netCDF file (same as input)
+
+    Require
+    ----------
+    xarray
+    class EnsembleStateReducer
+    '''
+
+    # --- Calculate ensemble mean (or median) for each state variable --- #
+    reducer = EnsembleStateReducer(len(list_state_nc))
+    for state_nc in list_state_nc:
+        with xr.open_dataset(state_nc) as ds:
+            reducer.add(ds)
+    ds_mean = reducer.result()
+
+    # Write to output netCDF file
+    ds_mean.to_netcdf(out_state_nc, format='NETCDF4_CLASSIC')
+
+    return out_state_nc
+
+
+def calculate_ensemble_mean_states_ds(list_ds):
+    ''' Calculates ensemble-mean of multiple in-memory state datasets
+
+    Parameters
+    ----------
+    list_ds: <list>
+        A list (or any iterable) of xr.Dataset's of VIC states
+
+    Returns
+    ----------
+    ds_mean: <xr.Dataset>
+        Ensemble-mean (or median) VIC states
+
+    Require
+    ----------
+    class EnsembleStateReducer
+    '''
+
+    list_ds = list(list_ds)
+    reducer = EnsembleStateReducer(len(list_ds))
+    for ds in list_ds:
+        reducer.add(ds)
+
+    return reducer.result()
+
+
+def run_vic_assigned_states(start_time, end_time, vic_exe, init_state_nc,
+                            dict_assigned_state_nc, global_template,
+                            vic_forcing_basepath, vic_model_steps_per_day,
+                            output_global_root_dir,
+                            output_vic_history_root_dir,
+                            output_vic_log_root_dir, mpi_proc=None, mpi_exe=None,
+                            delete_log=True):
+    ''' Run VIC with assigned initial states and other assigned state files during the simulation time. All VIC runs do not output state file in the end.
+    
+    Parameters
+    ----------
+    start_time: <pandas.tslib.Timestamp>
+        Start time of VIC run
+    end_time: <pandas.tslib.Timestamp>
+        End time of VIC run
+    vic_exe: <class 'VIC'>
+        VIC run class
+    init_state_nc: <str>
+        Path of initial state netCDF file; None for no initial state
+    dict_assigned_state_nc: <OrderedDict>
+        An ordered dictionary of state times and nc files after the start time;
+        Keys: state times in <pandas.tslib.Timestamp>;
+        Items: state netCDF file path in <str>
+    global_template: <str>
+        VIC global file template
+    vic_forcing_basepath: <str>
+        VIC forcing netCDF file basepath ('YYYY.nc' will be appended)
+    vic_model_steps_per_day: <int>
+        VIC model steps per day
+    output_global_root_dir: <str>
+        Directory for VIC global files
+    output_vic_history_root_dir: <str>
+        Directory for VIC output history files
+    output_vic_log_root_dir: <str>
+        Directory for VIC output log files
+    mpi_proc: <int or None>
+        Number of processors to use for VIC MPI run. None for not using MPI
+    mpi_exe: <str>
+        Path for MPI exe
+    delete_log: <bool>
+        Whether to delete all log files in the log directory after running
+        Default: True
+    
+    Returns
+    ----------
+    list_history_files_concat: <list>
+        A list of all output history file paths in order
+    
+    Require
+    ----------
+    OrderedDict
+    generate_VIC_global_file
+    check_returncode
+    '''
+    
+    list_history_files = []  # A list of resulted history file paths
+    list_history_files_concat = []  # A list of final concatenated history file paths
+    
+    # --- Run VIC from start_time to the first assigned state time --- #
+    run_start_time = start_time
+    run_end_time = list(dict_assigned_state_nc.keys())[0] - \
+                   pd.DateOffset(hours=24/vic_model_steps_per_day)
+    print('\tRunning VIC from ', run_start_time, 'to', run_end_time)
+    propagate(start_time=run_start_time, end_time=run_end_time,
+              vic_exe=vic_exe, vic_global_template_file=global_template,
+              vic_model_steps_per_day=vic_model_steps_per_day,
+              init_state_nc=init_state_nc,
+              out_state_basepath=None,
+              out_history_dir=output_vic_history_root_dir,
+              out_history_fileprefix='history',
+              out_global_basepath=os.path.join(output_global_root_dir, 'global'),
+              out_log_dir=output_vic_log_root_dir,
+              forcing_basepath=vic_forcing_basepath,
+              mpi_proc=mpi_proc,
+              mpi_exe=mpi_exe,
+              delete_log=delete_log)
+    list_history_files.append(os.path.join(
+                    output_vic_history_root_dir,
+                    'history.{}-{:05d}.nc'.format(
+                            run_start_time.strftime('%Y-%m-%d'),
+                            run_start_time.hour*3600+run_start_time.second)))
+    
+    # --- Run VIC from each assigned state time to the next (or to end_time) --- #
+    for t, time in enumerate(dict_assigned_state_nc.keys()):
+        # --- Determine last, current and next measurement time points --- #
+        current_time = time
+        if t == len(dict_assigned_state_nc)-1:  # if this is the last measurement time
+            next_time = end_time
+        else:  # if not the last measurement time
+            next_time = list(dict_assigned_state_nc.keys())[t+1] - \
+                        pd.DateOffset(hours=24/vic_model_steps_per_day)
+        # If current_time > next_time, do not propagate (we already reach the end of the simulation)
+        if current_time > next_time:
+            break
+        print('\tRunning VIC from ', current_time, 'to', next_time)
+        
+        # --- Propagate to the next time from assigned initial states --- #
+        state_nc = dict_assigned_state_nc[current_time]
+        propagate(start_time=current_time, end_time=next_time,
+                  vic_exe=vic_exe, vic_global_template_file=global_template,
+                  vic_model_steps_per_day=vic_model_steps_per_day,
+                  init_state_nc=state_nc,
+                  out_state_basepath=None,
+                  out_history_dir=output_vic_history_root_dir,
+                  out_history_fileprefix='history',
+                  out_global_basepath=os.path.join(output_global_root_dir, 'global'),
+                  out_log_dir=output_vic_log_root_dir,
+                  forcing_basepath=vic_forcing_basepath,
+                  mpi_proc=mpi_proc,
+                  mpi_exe=mpi_exe)
+        list_history_files.append(os.path.join(
+                    output_vic_history_root_dir,
+                    'history.{}-{:05d}.nc'.format(
+                            current_time.strftime('%Y-%m-%d'),
+                            current_time.hour*3600+current_time.second)))
+        # --- Concat and delete individual history files for each year --- #
+        # (If the end of EnKF run, or the end of a calendar year)
+        if (t == (len(dict_assigned_state_nc.keys()) - 1)) or \
+           (t < (len(dict_assigned_state_nc.keys()) - 1) and \
+           current_time.year != (next_time + \
+           pd.DateOffset(hours=24/vic_model_steps_per_day)).year):
+            # Determine history file year
+            year = current_time.year
+            # Concat individual history files
+            output_file=os.path.join(
+                            output_vic_history_root_dir,
+                            'history.concat.{}.nc'.format(year))
+            concat_clean_up_history_file(list_history_files,
+                                         output_file)
+            list_history_files_concat.append(output_file)
+            # Reset history file list
+            list_history_files = []
+    return list_history_files_concat
+
+
+def rmse(true, est):
+    ''' Calculates RMSE of an estimated variable compared to the truth variable
+
+    Parameters
+    ----------
+    true: <np.array>
+        A 1-D array of time series of true values
+    est: <np.array>
+        A 1-D array of time series of estimated values (must be the same length of true)
+
+    Returns
+    ----------
+    rmse: <float>
+        Root mean square error
+
+    Require
+    ----------
+    numpy
+    '''
+
+    rmse = np.sqrt(sum((est - true)**2) / len(true))
+    return rmse
+
+
+def innov_norm_var(innov, y_est_before_update, R):
+    ''' Calculates normalized variance of innovation
+    
+    Parameters
+    ----------
+    innov: <np.array>
+        A 1-D array of time series of innovation (meas - y_est_before_update),
+        averaged over all ensemble members
+    y_est_before_update: <np.array>
+        A 2-D array of y_est_before_update for all ensemble members
+        Dim: [time, N]
+    R: <float>
+        Measurement error variance
+    
+    Returns
+    ----------
+    var_norm: <float>
+        Normalized variance
+    
+    Require
+    ----------
+    numpy
+    '''
+    
+    # If all nan, return a time series of nan
+    if sum(~np.isnan(innov)) == 0:
+        return np.nan
+    
+    # Pyy = cov(y, y.transpose); divided by (N-1)
+    Pyy = np.cov(y_est_before_update).diagonal()  # [time]
+    
+    # Calculate normalized innovation time series
+    innov_norm = innov / np.sqrt(Pyy + R)
+    
+    # Calculate variance
+    var_norm = np.var(innov_norm)
+    
+    return var_norm
+
+
+def load_nc_and_concat_var_years(basepath, start_year, end_year, dict_vars):
+    ''' Loads in netCDF files end with 'YYYY.nc', and for each variable needed,
+        concat all years together and return a DataArray
+        
+        Parameters
+        ----------
+        basepath: <str>
+            Basepath of all netCDF files; 'YYYY.nc' will be appended;
+            Time dimension name in the nc files must be 'time'
+        start_year: <int>
+            First year to load
+        end_year: <int>
+            Last year to load
+        dict_vars: <dict>
+            A dict of desired variables and corresponding varname in the
+            netCDF files (e.g., {'prec': 'prcp'; 'temp': 'tair'}). The keys in
+            dict_vars will be used as keys in the output dict.
+
+        Returns
+        ----------
+        dict_da: <dict>
+            A dict of concatenated xr.DataArrays.
+            Keys: desired variables (using the same keys as in input
+                  'dict_vars')
+            Elements: <xr.DataArray>
+    '''
+
+    dict_list = {}
+    for var in dict_vars.keys():
+        dict_list[var] = []
+
+    # Loop over each year
+    for year in range(start_year, end_year+1):
+        # Load data for this year
+        ds = xr.open_dataset(basepath + '{}.nc'.format(year))
+        # Extract each variable needed and put in a list
+        for var, varname in dict_vars.items():
+            da = ds[varname]
+            # Put data of this year in a list
+            dict_list[var].append(da)
+
+    # Concat all years for all variables
+    dict_da = {}
+    for var in dict_vars.keys():
+        dict_da[var] = xr.concat(dict_list[var], dim='time')
+
+    return dict_da
+
+
+def prepare_SMART_input(cfg):
+    ''' Load and process all input datasets of a SMART run (precipitation
+        datasets, ascending and descending soil moisture and soil moisture
+        error) to SMART's dimension [npixel_active, ntime]
+
+    Parameters
+    ----------
+    cfg: <configobj>
+        SMART config ([CONTROL], [DOMAIN], [SMART_RUN], [PREC] and [SM]
+        sections are used)
+
+    Returns
+    ----------
+    dict_array_active: <dict>
+        Keys: 'prec_orig', 'prec_for_tuning_lambda', 'prec_true', 'sm_ascend',
+              'sm_descend', 'sm_error'
+        Elements: np.array with dimension [npixel_active, ntime]
+    '''
+
+    start_time = dt.datetime.strptime(cfg['SMART_RUN']['start_time'], "%Y-%m-%d-%H")
+    end_time = dt.datetime.strptime(cfg['SMART_RUN']['end_time'], "%Y-%m-%d-%H")
+    start_year = start_time.year
+    end_year = end_time.year
+
+    dict_da = {}
+
+    # --- Original prec (to be corrected) --- #
+    da_prec_orig = load_nc_and_concat_var_years(
+                        basepath=os.path.join(cfg['CONTROL']['root_dir'],
+                                              cfg['PREC']['prec_orig_nc_basepath']),
+                        start_year=start_year,
+                        end_year=end_year,
+                        dict_vars={'prec_orig': cfg['PREC']['prec_orig_varname']})\
+                      ['prec_orig'].sel(time=slice(start_time, end_time))
+    # put in dict
+    dict_da['prec_orig'] = da_prec_orig
+
+    # --- Independent prec (for lambda tuning) --- #
+    da_prec_indep = load_nc_and_concat_var_years(
+                        basepath=os.path.join(cfg['CONTROL']['root_dir'],
+                                              cfg['PREC']['prec_indep_nc_basepath']),
+                        start_year=start_year,
+                        end_year=end_year,
+                        dict_vars={'prec_indep': cfg['PREC']['prec_indep_varname']})\
+                     ['prec_indep'].sel(time=slice(start_time, end_time))
+    # put in dict
+    dict_da['prec_for_tuning_lambda'] = da_prec_indep
+
+    # --- "True" prec --- #
+    da_prec_true = load_nc_and_concat_var_years(
+                        basepath=os.path.join(cfg['CONTROL']['root_dir'],
+                                              cfg['PREC']['prec_true_nc_basepath']),
+                        start_year=start_year,
+                        end_year=end_year,
+                        dict_vars={'prec_true': cfg['PREC']['prec_true_varname']})\
+                   ['prec_true'].sel(time=slice(start_time, end_time))
+    # put in dict
+    dict_da['prec_true'] = da_prec_true
+
+    # --- Soil moisture --- #
+    # If ascending and descending products are in separate files, directly load
+    if cfg['SM']['sep_am_pm']:
+        # Ascending
+        if cfg['SM']['sm_ascend_nc'] is not None:
+            da_sm_ascend = xr.open_dataset(os.path.join(cfg['CONTROL']['root_dir'],
+                                                        cfg['SM']['sm_ascend_nc']))\
+                           [cfg['SM']['sm_ascend_varname']]
+            # put in dict
+            dict_da['sm_ascend'] = da_sm_ascend
+        else:
+            da_sm_ascend = dict_da['prec_orig'].copy(deep=True)
+            da_sm_ascend
+        # Descending
+        if cfg['SM']['sm_descend_nc'] is not None:
+            da_sm_descend = xr.open_dataset(os.path.join(cfg['CONTROL']['root_dir'],
+                                                        cfg['SM']['sm_descend_nc']))\
+                            [cfg['SM']['sm_descend_varname']]
+            # put in dict
+            dict_da['sm_descend'] = da_sm_descend
+    # If ascending and descending products are in the same file, load and then
+    # identify and separate ascending and descending
+    else:
+        # Load
+        da_sm = xr.open_dataset(os.path.join(cfg['CONTROL']['root_dir'], cfg['SM']['sm_nc']))\
+            [cfg['SM']['sm_varname']]
+        # Extract ascending and descending data
+        da_sm_ascend = da_sm.sel(
+            time=pd.to_datetime(da_sm['time'].values).hour == cfg['SM']['ascend_hour'])
+        da_sm_descend = da_sm.sel(
+            time=pd.to_datetime(da_sm['time'].values).hour == cfg['SM']['descend_hour'])
+        # Check whether the separated data has the same total lenght with the original data
+        if len(da_sm_ascend['time']) + len(da_sm_descend['time']) != len(da_sm['time']):
+            raise ValueError('Separated ascending and descending SM data does not add'
+                             'up to the total lenght of the original SM data!')
+        # Put in dict
+        dict_da['sm_ascend'] = da_sm_ascend
+        dict_da['sm_descend'] = da_sm_descend
+
+    # --- If time_step != 24: --- #
+    # 1) shift SM measurements to one-timestep earlier
+    # since SMART assumes the SM on the corresponding timesetp to be period-end;
+    # 1) Also make the SM data to have the same timestep as precipitation
+    # by filling in NAN for unobserved timesteps
+    if cfg['SMART_RUN']['time_step'] != 24:
+        for var in ['sm_ascend', 'sm_descend']:
+            da_new = dict_da['prec_orig'].copy(deep=True)
+            da_new[:] = np.nan  # [time, lat, lon]
+            # If not missing
+            if var in dict_da.keys():
+                # Shift time
+                times_new = [pd.to_datetime(t) - pd.DateOffset(hours=cfg['SMART_RUN']['time_step'])
+                             for t in dict_da[var]['time'].values]
+                # Fill in nans for unobserved timesteps
+                da_new.loc[times_new, :, :] = dict_da[var].values
+            # If missing, keep all NAN values
+            # Put into dict
+            dict_da[var] = da_new
+
+    # --- If time_step = 24, aggregate all data to daily --- #
+    if cfg['SMART_RUN']['time_step'] == 24:
+        dict_da_daily = {}
+
+        # --- Aggregate prec variables to daily (orig. units: mm/step) --- #
+        for var, da in dict_da.items():
+            # If precipitation variable
+            if var == 'prec_orig' or var == 'prec_for_tuning_lambda' or\
+            var == 'prec_true':
+                # Sum daily preciptation
+                da_daily = da.resample(time='1D').sum(dim='time')
+                # Put into dict
+                dict_da_daily[var] = da_daily
+
+        # --- Average and process soil moisture variables to daily --- #
+        for var in ['sm_ascend', 'sm_descend']:
+            # Copy the shape of the DataArray from a prec variable
+            da_sm = dict_da_daily['prec_orig'].copy()
+            da_sm[:] = np.nan
+            # If not missing
+            if var in dict_da.keys():
+                # Average to daily soil moisture
+                da = dict_da[var]
+                da_daily = da.resample(time='1D').mean(dim='time')
+                # Put into dict
+                # NOTE: (assume the "daily-mean" SM represents the SM at 00:00 on the date)
+                # (since SMART assumes the SM observation on the corresponding day with rainfall
+                # to be at the end of the day, we need to shift the SM date forward by one day)
+                da_daily = da_daily.shift(time=-1)
+                da_sm.loc[da_daily['time'], :, :] = da_daily[:]
+                dict_da_daily[var] = da_sm
+            # If missing, put in NAN
+            else:
+                # Put into dict
+                dict_da_daily[var] = da_sm
+
+    # --- Convert data to dimension [npixel_active, ntimes] --- #
+    # Load in domain file
+    ds_domain = xr.open_dataset(os.path.join(cfg['CONTROL']['root_dir'],
+                                             cfg['DOMAIN']['domain_file']))
+    da_mask = ds_domain['mask']
+
+    # Convert data to dimension [npixel_active, nday]
+    if cfg['SMART_RUN']['time_step'] == 24:
+        dict_to_convert = dict_da_daily
+    else:
+        dict_to_convert = dict_da
+    dict_array_active = da_3D_to_2D_for_SMART(dict_to_convert,
+                                              da_mask,
+                                              time_varname='time')
+
+    # --- Make soil moisture uncertainty data --- #
+    # Copy the data for shape
+    sm_error = dict_array_active['sm_ascend'].copy()  # [npixel, ntime]
+    sm_error[:] = np.nan
+
+    # If input is a numerical number, assign spatial constant R values
+    if isinstance(cfg['SM']['R'], numbers.Number):
+        std = np.sqrt(cfg['SM']['R'])
+        sm_error[:] = std
+    # If input is an xr.Dataset
+    else:
+        if cfg['SM']['R_vartype'] == 'R':
+            da_R = xr.open_dataset(
+                os.path.join(cfg['CONTROL']['root_dir'], cfg['SM']['R']))\
+                [cfg['SM']['R_varname']]
+            da_std = da_R.sqrt()
+        elif cfg['SM']['R_vartype'] == 'std':
+            da_std = xr.open_dataset(
+                os.path.join(cfg['CONTROL']['root_dir'], cfg['SM']['R']))\
+                [cfg['SM']['R_varname']]
+        # Convert 2D field to 3D temporally-constant field
+        ntime = sm_error.shape[1]
+        da_std_3D = xr.DataArray(
+            np.zeros([ntime, len(da_std['lat']), len(da_std['lon'])]),
+            coords=[range(ntime), da_std['lat'], da_std['lon']],
+            dims=['time', 'lat', 'lon'])
+        da_std_3D[:] = da_std
+        # Convert 3D da to [npixel, ntime]
+        sm_error = da_3D_to_2D_for_SMART(
+            {'sm_error': da_std_3D},
+            da_mask,
+            time_varname='time')['sm_error']
+
+    # Put in final dictionary
+    dict_array_active['sm_error'] = sm_error
+
+    return dict_array_active
+
+
+def da_3D_to_2D_for_SMART(dict_da_3D, da_mask, time_varname='time'):
+    ''' Convert data arrays with dimension [time, lat, lon] to [npixel_active, time]
+    
+    Parameters
+    ----------
+    dict_da_3D: <dict>
+        A dict of xr.DataArray's with [time, lat, lon] dimension
+        Keys: variable name
+        Elements: xr.DataArray
+    da_mask: <xr.DataArray>
+        Domain mask (>0 for active grid cells)
+    time_varname: <str>
+        Varname for time in all da's in dict_da_3D
+    
+    Return
+    ----------
+    dict_array_active: <dict>
+        Keys: variable name (same as in input)
+        Elements: np.array with dimension [npixel_active, time]
+    
+    '''
+    
+    # Extract ntime, nlat and nlon
+    da_example = dict_da_3D[list(dict_da_3D.keys())[0]]
+    ntime = len(da_example[time_varname])
+    nlat = len(da_example['lat'])
+    nlon = len(da_example['lon'])
+    
+    # Reshape domain mask
+    mask = da_mask.values
+    mask_reshape = mask.reshape(nlat*nlon)
+    
+    # Convert all da's in dict_da_3D to [npixel_active, nday]
+    dict_array_active = {}
+    # Loop over each da
+    for var, da in dict_da_3D.items():
+        # Convert to np.array and reshape to [ntime, ncell]
+        array_all_cells = da.values.reshape(ntime, nlat*nlon)
+        # Only keep active grid cells to the final dimension [ntime, npixel_active]
+        array_active = array_all_cells[:, mask_reshape>0]
+        # Transpose dimension to [npixel_active, nday]
+        array_active = np.transpose(array_active)
+        # Put in final dictionary
+        dict_array_active[var] = array_active
+    
+    return dict_array_active
+
+
+def da_2D_to_3D_from_SMART(dict_array_2D, da_mask, out_time_varname, out_time_coord):
+    ''' Convert data arrays with dimension [time, npixel_active] to [time, lat, lon]
+
+    Parameters
+    ----------
+    dict_array_2D: <dict>
+        Keys: variable name
+        Elements: np.array with dimension [time, npixel_active]
+    da_mask: <xr.DataArray>
+        Domain mask (>0 for active grid cells)
+    out_time_varname: <str>
+        Varname for time in output xr.DataArray's
+    out_time_coord: <list or other types usable for xr coords>
+        Time coordinates in output xr.DataArray's
 
-    Require
+    Return
     ----------
-    os
-    class States
+    dict_da_3D: <dict>
+        Keys: variable name (same as in input)
+        Elements: xr.DataArray with dimension [time, lat, lon]
     '''
 
-    # --- Load in original state file --- #
-    class_states = States(xr.open_dataset(states_to_perturb_nc))
+    # Extract ndays, nlat and nlon (as well as lat and lon)
+    ntime = len(out_time_coord)
+    lat = da_mask['lat']
+    lon = da_mask['lon']
+    nlat = len(lat)
+    nlon = len(lon)    
 
-    # --- Perturb --- #
-    # Perturb
-    ds_perturbed = class_states.perturb_soil_moisture_Gaussian(
-                            L, scale_n_nloop, da_max_moist_n,
-                            adjust_negative, seed, prescribed_noise)
-    # If exclude SM3 from state vector, reset SM3 to before-perturbed states
-    if no_sm3 is True:
-        ds_perturbed['STATE_SOIL_MOISTURE'][:, :, 2, :, :] = \
-            class_states.ds['STATE_SOIL_MOISTURE'][:, :, 2, :, :]
+    # Reshape domain mask and identify indices of active pixels
+    mask = da_mask.values
+    mask_reshape = mask.reshape(nlat*nlon)
+    ind_active = np.where(mask_reshape>0)[0]
+    
+    # Convert all arrays in dict_da_2D to [time, lat, lon]
+    dict_da_3D = {}
+    # Loop over each da
+    for var, array in dict_array_2D.items():
+        # Fill in inactive cells (to dimension [time, ncells])
+        array_allcells_reshape = np.empty([ntime, nlat*nlon])
+        array_allcells_reshape[:] = np.nan
+        array_allcells_reshape[:, ind_active] = array
+        # Convert to dimension [time, lat, lon]
+        array_3D = array_allcells_reshape.reshape([ntime, nlat, nlon])
+        # Put in xr.DataArray
+        da = xr.DataArray(array_3D, coords=[out_time_coord, lat, lon],
+                          dims=[out_time_varname, 'lat', 'lon'])
+        # Put in final dictionary
+        dict_da_3D[var] = da
 
-    # --- Save perturbed state file --- #
-    ds_perturbed.to_netcdf(out_states_nc,
-                           format='NETCDF4_CLASSIC')
+    return dict_da_3D
 
-    # --- Return perturbation --- #
-    da_perturbation = (ds_perturbed - class_states.ds)['STATE_SOIL_MOISTURE']
 
-    return da_perturbation
+def rescale_and_save_SMART_prec(da_prec_orig, window_size, time_step,
+                                da_prec_corr_window, start_time, out_dir, out_prefix):
+    ''' Rescale and save SMART-corrected precipitation (one ensemble member)
+    Parameters
+    ----------
+    da_prec_orig: <xr.DataArray>
+        Original precipitation
+    window_size: <int>
+        Window size in SMART (number of timesteps in a window)
+    time_step: <int>
+        SMART timestep [hour]
+    da_prec_corr_window_ens: <xr.DataArray>
+        SMART-corrected window-averaged precipitation
+    start_time: <pd.datetime>
+        Start time of simulation
+    out_dir: <str>
+        Output directory for rescaled precipitation
+    out_prefix: <str>
+        Prefix of the output prec file ("YYYY.nc" will be appended)
+    '''
+
+    # Rescale
+    da_prec_corrected = correct_prec_from_SMART(
+        da_prec_orig,
+        window_size,
+        da_prec_corr_window,
+        start_time,
+        time_step)
+    
+    # Save to file
+    ds_prec_corrected = xr.Dataset({'prec_corrected': da_prec_corrected})
+    for year, ds in ds_prec_corrected.groupby('time.year'):
+        to_netcdf_forcing_file_compress(
+            ds_force=ds,
+            out_nc=os.path.join(out_dir, '{}{}.nc'.format(out_prefix, year)))
+        
+    return da_prec_corrected
 
 
-def perturb_soil_moisture_states_class_input(class_states, L, scale_n_nloop,
-                                 out_states_nc, da_max_moist_n,
-                                 adjust_negative=True, seed=None, no_sm3=False,
-                                 prescribed_noise=None):
-    ''' Perturb all soil_moisture states (same as funciton
-        perturb_soil_moisture_states except here inputing class_states
-        instead of an netCDF path for states to perturb)
+def save_SMART_prec(start_time, end_time, time_step,
+                    da_prec_corr_window, out_dir, out_prefix):
+    ''' Save SMART-corrected precipitation when window size = 1 (one ensemble member)
 
     Parameters
     ----------
-    class_states: <class States>
-        VIC state netCDF file to perturb
-    L: <np.array>
-        Cholesky decomposed matrix of covariance matrix P of all states:
-                        P = L * L.T
-        Thus, L * Z (where Z is i.i.d. standard normal random variables of
-        dimension [n, n]) is multivariate normal random variables with
-        mean zero and covariance matrix P.
-        Dimension: [n, n]
-    scale_n_nloop: <np.array>
-        Standard deviation of noise to add for the whole field.
-        Dimension: [nloop, n] (where nloop = lat * lon)
-    out_states_nc: <str>
-        Path of output perturbed VIC state netCDF file
-    da_max_moist_n: <xarray.DataArray>
-        Maximum soil moisture for the whole domain and each tile
-        [unit: mm]. Soil moistures above maximum after perturbation will
-        be reset to maximum value.
-        Dimension: [lat, lon, n]
-    adjust_negative: <bool>
-        Whether or not to adjust negative soil moistures after
-        perturbation to zero.
-        Default: True (adjust negative to zero)
-    seed: <int or None>
-        Seed for random number generator; this seed will only be used locally
-        in this function and will not affect the upper-level code.
-        None for not re-assign seed in this function, but using the global seed)
-        Default: None
-    no_sm3: <bool>
-        Whether to EXCLUDE SM3 from kalman filter state vector (i.e., no perturbation or update)
-        Default: False (i.e., default is to include SM3)
-    prescribed_noise: <np.array> or None
-        If not None, use pre-generated random noises as Z (before transforming
-        to be vertically/tile correlated) instead of regenerating here
-        Dim: [lat, lon, n]
-        Default: None
+    start_time: <pd.datetime>
+        SMART start time
+    end_time: <pd.datetime>
+        SMART end time
+    time_step: <int>
+        SMART timestep [hour]
+    da_prec_corr_window: <xr.DataArray>
+        SMART-corrected window-averaged precipitation; this function is for
+        when window size = 1, and the 'window' dimension will be directly
+        replaced by timestamps
+    out_dir: <str>
+        Output directory for rescaled precipitation
+    out_prefix: <str>
+        Prefix of the output prec file ("YYYY.nc" will be appended)
+    '''
 
-    Returns
+    # Replace window dimension by time
+    da_prec_corr_to_save = da_prec_corr_window.rename({'window': 'time'})
+    da_prec_corr_to_save['time'] = pd.date_range(
+        start_time, end_time,
+        freq='{}H'.format(time_step))
+    ds_prec_corrected = xr.Dataset({'prec_corrected': da_prec_corr_to_save})
+    for year, ds in ds_prec_corrected.groupby('time.year'):
+        to_netcdf_forcing_file_compress(
+            ds_force=ds,
+            out_nc=os.path.join(out_dir, '{}{}.nc'.format(out_prefix, year)))
+        
+    return da_prec_corr_to_save
+
+
+def calculate_SMART_window_index(times, start_time, window_size, time_step,
+                                 nwindow):
+    ''' Map each original timestep to its SMART window
+
+    Parameters
     ----------
-    da_perturbation: <da.DataArray>
-        Amount of perturbation added
-        Dimension: [veg_class, snow_band, nlayer, lat, lon]
+    times: <list or np.array of datetime-like>
+        Timestamps of the original data
+    start_time: <dt.datetime or pd.datetime>
+        Starting time of SMART run
+    window_size: <int>
+        Number of timesteps in each window
+    time_step: <int>
+        SMART timestep [hour]
+    nwindow: <int>
+        Number of (complete) SMART windows
 
-    Require
+    Returns
     ----------
-    os
-    class States
+    ind_window: <np.array>
+        Window index of each timestep; -1 for timesteps that are not corrected
+        (in the first window or after the last complete window)
+        Dim: [time]
     '''
 
-    # --- Perturb --- #
-    # Perturb
-    ds_perturbed = class_states.perturb_soil_moisture_Gaussian(
-                            L, scale_n_nloop, da_max_moist_n,
-                            adjust_negative, seed, prescribed_noise)
-    # If exclude SM3 from state vector, reset SM3 to before-perturbed states
-    if no_sm3 is True:
-        ds_perturbed['STATE_SOIL_MOISTURE'][:, :, 2, :, :] = \
-            class_states.ds['STATE_SOIL_MOISTURE'][:, :, 2, :, :]
+    window_hours = window_size * time_step
+    hours = (pd.to_datetime(times) - pd.to_datetime(start_time)) / \
+            pd.Timedelta(hours=1)
+    ind_window = np.floor(np.asarray(hours) / window_hours).astype(int)
+    ind_window[(ind_window < 1) | (ind_window >= nwindow)] = -1
 
-    # --- Save perturbed state file --- #
-    to_netcdf_state_file_compress(ds_perturbed, out_states_nc)
+    return ind_window
 
-    # --- Return perturbation --- #
-    da_perturbation = (ds_perturbed - class_states.ds)['STATE_SOIL_MOISTURE']
 
-    return da_perturbation
+def calculate_SMART_window_sum(prec, ind_window, nwindow):
+    ''' Sum data (e.g., original precipitation) in each SMART window
 
+    Parameters
+    ----------
+    prec: <np.array>
+        Data at the original timestep; NAN is treated as zero
+        Dim: [time, ...]
+    ind_window: <np.array>
+        Window index of each timestep (-1 for no window); output of
+        calculate_SMART_window_index
+        Dim: [time]
+    nwindow: <int>
+        Number of windows
 
-def concat_vic_history_files(list_history_nc):
-    ''' Concatenate short-periods of VIC history files into one; if the time period of
-        the next file overlaps that of the current file, the next-file values will be
-        used
-    
-    list_history_nc: <list>
-        A list of history files to be concatenated, in order
+    Returns
+    ----------
+    prec_window: <np.array>
+        Sum in each window
+        Dim: [window, ...]
+    count_window: <np.array>
+        Number of timesteps in each window
+        Dim: [window]
     '''
-    
-    print('\tConcatenating {} files...'.format(len(list_history_nc)))
 
-    # --- Open all history files --- #
-    list_ds = []
-    for file in list_history_nc:
-        list_ds.append(xr.open_dataset(file))
+    ind_time = np.where(ind_window >= 0)[0]
+    # Sparse [window, time] matrix that sums timesteps into windows
+    window_matrix = csr_matrix(
+        (np.ones(len(ind_time)), (ind_window[ind_time], ind_time)),
+        shape=[nwindow, prec.shape[0]])
+    prec_window = window_matrix.dot(
+        np.nan_to_num(prec.reshape([prec.shape[0], -1]))).reshape(
+            (nwindow, ) + prec.shape[1:])
+    count_window = np.bincount(ind_window[ind_time], minlength=nwindow)
 
-    # --- Loop over each history file and concatenate --- #
-    list_ds_to_concat = []  # list of ds to concat, with no overlapping periods
-    for i in range(len(list_ds[:-1])):
-        # Determine and truncate data, if needed
-        times_current = pd.to_datetime(list_ds[i]['time'].values)  # times of current ds
-        times_next = pd.to_datetime(list_ds[i+1]['time'].values)  # times of next ds
-        if times_current[-1] >= times_next[0]:  # if overlap, truncate the current ds
-            # Minus 2 seconds to avoid resolution issue
-            trunc_time_point = times_next[0] - pd.DateOffset(seconds=2) 
-            ds = list_ds[i].sel(time=slice(None, '{}T{:02d}:{:02d}:{:02d}'.format(
-                                                trunc_time_point.strftime('%Y-%m-%d'),
-                                                trunc_time_point.hour,
-                                                trunc_time_point.minute,
-                                                trunc_time_point.second)))
-        else:  # if no overlap, do not truncate
-            ds = list_ds[i]
-        # Concat to the list
-        list_ds_to_concat.append(ds)
-        
-    # Concat the last period fully to the list
-    list_ds_to_concat.append(list_ds[-1])
-   
-    # Concat all ds's
-    ds_concat = xr.concat(list_ds_to_concat, dim='time')
-    
-    return ds_concat
+    return prec_window, count_window
 
 
-def calculate_max_soil_moist_domain(global_path):
-    ''' Calculates maximum soil moisture for all grid cells and all soil layers (from soil parameters)
-    
+def rescale_prec_by_window(prec_orig, ind_window, prec_corr_window,
+                           prec_orig_window, count_window):
+    ''' Rescale original precipitation to match corrected window sums, for all
+        windows at once
+
     Parameters
     ----------
-    global_path: <str>
-        VIC global parameter file path; can be a template file (here it is only used to
-        extract soil parameter file info)
-        
+    prec_orig: <np.array>
+        Original prec data at the original timestep
+        Dim: [time, ...]
+    ind_window: <np.array>
+        Window index of each timestep (-1 for not corrected)
+        Dim: [time]
+    prec_corr_window: <np.array>
+        Corrected prec sum in each window
+        Dim: [window, ...]
+    prec_orig_window: <np.array>
+        Original prec sum in each window (see calculate_SMART_window_sum)
+        Dim: [window, ...]
+    count_window: <np.array>
+        Number of timesteps in each window
+        Dim: [window]
+
     Returns
-    ----------
-    da_max_moist: <xarray.DataArray>
-        Maximum soil moisture for the whole domain and each soil layer [unit: mm];
-        Dimension: [nlayer, lat, lon]
-    
-    Require
-    ----------
-    xarray
-    find_global_param_value
+    ----------
+    prec_corrected: <np.array>
+        Corrected prec data at the original timestep
+        Dim: [time, ...]
     '''
-    
-     # Load soil parameter file (as defined in global file)
-    with open(global_path, 'r') as global_file:
-        global_param = global_file.read()
-    soil_nc = find_global_param_value(global_param, 'PARAMETERS')
-    ds_soil = xr.open_dataset(soil_nc, decode_cf=False)
-    
-    # Calculate maximum soil moisture for each layer
-    # Dimension: [nlayer, lat, lon]
-    da_depth = ds_soil['depth']  # [m]
-    da_bulk_density = ds_soil['bulk_density']  # [kg/m3]
-    da_soil_density = ds_soil['soil_density']  # [kg/m3]
-    da_porosity = 1 - da_bulk_density / da_soil_density
-    da_max_moist = da_depth * da_porosity * 1000  # [mm]
 
-    return da_max_moist
+    # Calculate rescaling factors for all windows
+    # Note: If prec_sum_orig is 0 for a grid cell, scale_factors will be np.inf for
+    # that grid cell
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale_factors = prec_corr_window / prec_orig_window
+        # Constant corrected prec (divided to each orig. timestep)
+        const_prec = prec_corr_window / \
+                     count_window.reshape((-1, ) + (1, ) * (prec_orig.ndim - 1))
+    # Rescale the timesteps in windows; where scale_factors == np.inf or np.nan
+    # (which indicates orig. prec are all zero for this window and this
+    # cell; np.inf indicates non-zero numerator while np.nan indicates
+    # zero numerator; np.nan at inactive grid cells as well), fill in with
+    # constant corrected prec from SMART
+    ind_time = np.where(ind_window >= 0)[0]
+    scale_factors_time = scale_factors[ind_window[ind_time]]
+    prec_corrected = np.array(prec_orig, dtype=float)
+    prec_corrected[ind_time] = np.where(
+        np.isfinite(scale_factors_time),
+        prec_corrected[ind_time] * scale_factors_time,
+        const_prec[ind_window[ind_time]])
+
+    return prec_corrected
 
 
-def convert_max_moist_n_state(da_max_moist, nveg, nsnow):
-    ''' Converts da_max_moist of dimension [nlayer, lat, lon] to [lat, lon, n]
-        (Max moistures for each tile within a certain grid cell and layer are the same)
+def correct_prec_from_SMART(da_prec_orig, window_size, da_prec_corr_window,
+                            start_time, time_step):
+    ''' Correct (i.e., rescale) original precipitation data based on outputs from
+        SMART (which is corrected prec sum in longer time windows).
+            - The first window is not corrected (orig. prec used)
+            - The last incomplete window, if exists, is not corrected (orig. prec used)
 
     Parameters
     ----------
-    da_max_moist: <xarray.DataArray>
-        Maximum soil moisture for the whole domain and each soil layer [unit: mm];
-        Dimension: [nlayer, lat, lon]
-    nveg: <int>
-        Number of veg classes
-    nsnow: <int>
-        Number of snow bands
+    da_prec_orig: <xr.DataArray>
+        Original prec data to be corrected. Original timestep, typically daily or
+        sub-daily.
+        Dims: [time, lat, lon]
+    window_size: <int>
+        Number of timesteps in each window
+    da_prec_corr_window: <xr.DataArray>
+        Corrected prec sum in each window
+        Dims: [window (index starting from 0), lat, lon]
+        NOTE: this is the output from SMART:
+                - the first window data is junk (always zeros)
+                - Only include complete windows
+    start_time: <dt.datetime or pd.datetime>
+        Starting time of the starting time of all the time series
+    time_step: <int>
+        SMART timestep [hour]
 
     Returns
     ----------
-    da_max_moist_n: <xarray.DataArray>
-        Maximum soil moisture for the whole domain and each tile [unit: mm];
-        Dimension: [lat, lon, n]
+    da_prec_corrected: <xr.DataArray>
+        Corrected prec data to be corrected. Original timestep, consistent with that
+        of input da_prec_orig
+        Dims: [time, lat, lon]
     '''
- 
-    # Extract coordinates
-    nlayer = da_max_moist['nlayer']
-    lat = da_max_moist['lat']
-    lon = da_max_moist['lon']
-    n = len(nlayer) * nveg * nsnow
 
-    # Roll dimension to [lat, lon, nlayer]
-    max_moist = np.rollaxis(da_max_moist.values, 0, 3)  # [lat, lon, nlayer]
+    # Map each orig. timestep to its window
+    nwindow = len(da_prec_corr_window['window'])
+    ind_window = calculate_SMART_window_index(
+        da_prec_orig['time'].values, start_time, window_size, time_step, nwindow)
 
-    # Repeat data for each cell and layer for nveg*nsnow times, and convert
-    # dimension to [lat, lon, n]
-    max_moist_new = np.repeat(max_moist, nveg*nsnow).reshape([len(lat), len(lon), n])
+    # Sum original prec in each window
+    prec_orig_window, count_window = calculate_SMART_window_sum(
+        da_prec_orig.values, ind_window, nwindow)
 
-    # Put into da
-    da_max_moist_n = xr.DataArray(max_moist_new,
-                                  coords=[lat, lon, range(n)],
-                                  dims=['lat', 'lon', 'n'])
+    # Rescale original prec for all windows at once (skip first window)
+    da_prec_corrected = da_prec_orig.copy(deep=True)
+    da_prec_corrected[:] = rescale_prec_by_window(
+        da_prec_orig.values, ind_window, da_prec_corr_window.values,
+        prec_orig_window, count_window)
 
-    return da_max_moist_n
+    return da_prec_corrected
 
 
-def calculate_ensemble_mean_states(list_state_nc, out_state_nc):
-    ''' Calculates ensemble-mean of multiple state files
+def load_SMART_output_prec(run_SMART_dir, var, ens=None):
+    ''' Load SMART output precipitation of one ensemble member (or the
+        deterministic corrected prec). The netCDF outputs from run_SMART are
+        used if exist; otherwise the Matlab .mat outputs are used. Only the
+        requested member is read from file.
 
     Parameters
     ----------
-    list_state_nc: <list>
-        A list of VIC state nc files whose mean to be calculated
-    out_state_nc: <str>
-        Path of output state netCDF file
+    run_SMART_dir: <str>
+        SMART output directory
+    var: <str>
+        Options:
+            'corrected': SMART-corrected window-averaged prec
+            'perturbed': perturbed prec at the original timestep
+    ens: <int> or None
+        Ensemble member index (starting from 1); None for the deterministic
+        SMART-corrected prec (var must be 'corrected')
 
     Returns
     ----------
-    out_state_nc: <str>
-        Path of output state netCDF file (same as input)
+    prec: <np.array>
+        Dim: [nwindow (or ntime for 'perturbed'), npixel_active]
+    '''
 
-    Require
+    # --- If SMART was run in Python (run_SMART.py), load the netCDF outputs --- #
+    nc = os.path.join(run_SMART_dir, 'SMART_{}_rainfall.nc'.format(var))
+    if os.path.isfile(nc):
+        if ens is None:
+            varname = 'RAIN_SMART_SMOS'
+        elif var == 'corrected':
+            varname = 'RAIN_SMART_SMOS_ENS'
+        else:
+            varname = 'RAIN_PERTURBED_ENS'
+        with xr.open_dataset(nc) as ds:
+            if ens is None:
+                prec = ds[varname].values
+            else:
+                prec = ds[varname][ens-1, :, :].values
+    # --- If SMART was run in Matlab, load the .mat outputs --- #
+    else:
+        if ens is None:
+            prec = loadmat(os.path.join(
+                run_SMART_dir, 'SMART_corrected_rainfall.mat'))['RAIN_SMART_SMOS']
+        else:
+            if var == 'corrected':
+                varname = 'RAIN_CORRECTED'
+            else:
+                varname = 'RAIN_PERTURBED'
+            prec = loadmat(os.path.join(
+                run_SMART_dir, 'SMART_{}_rainfall.ens{}.mat'.format(var, ens)))\
+                [varname]['ens{}'.format(ens)][0][0].squeeze()
+        # If npixel = 1, Matlab automatically squeezes that dimension. Here we readd this dimension
+        if len(prec.shape) == 1:
+            prec = prec.reshape([prec.shape[0], 1])
+
+    return prec
+
+
+def prepare_SMART_prec_orig_cache(da_prec_orig, window_size, time_step, nwindow,
+                                  start_time):
+    ''' Prepare the original-precipitation quantities for rescaling
+        SMART-corrected prec, which are the same for all ensemble members
+
+    Parameters
     ----------
-    xarray
-    '''
+    da_prec_orig: <xr.DataArray>
+        Original prec data to be corrected. Original timestep
+        Dims: [time, lat, lon]
+    window_size: <int>
+        Number of timesteps in each window
+    time_step: <int>
+        SMART timestep [hour]
+    nwindow: <int>
+        Number of (complete) SMART windows
+    start_time: <dt.datetime or pd.datetime>
+        Starting time of SMART run
 
-    # --- Number of files --- #
-    N = len(list_state_nc)
+    Returns
+    ----------
+    dict_prec_orig_cache: <dict>
+        'prec_orig': original prec [time, lat, lon]
+        'ind_window': window index of each timestep [time]
+        'prec_orig_window': original prec sum in each window [window, lat, lon]
+        'count_window': number of timesteps in each window [window]
+    '''
 
-    # --- Calculate ensemble mean (or median) for each state variable --- #
-    list_ds = []
-    for state_nc in list_state_nc:
-        list_ds.append(xr.open_dataset(state_nc))
-    ds_mean = list_ds[0].copy(deep=True)
-    # STATE_SOIL_MOISTURE - mean
-    ds_mean['STATE_SOIL_MOISTURE'] = (sum(list_ds) / N)['STATE_SOIL_MOISTURE']
-    # STATE_SOIL_ICE - mean
-    ds_mean['STATE_SOIL_ICE'] = (sum(list_ds) / N)['STATE_SOIL_ICE']
-    # STATE_CANOPY_WATER - mean
-    ds_mean['STATE_CANOPY_WATER'] = (sum(list_ds) / N)['STATE_CANOPY_WATER']
-    # STATE_SNOW_AGE - median, integer
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_AGE'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_AGE'][:] = np.nanmedian(ar_var, axis=0).round()
-    # STATE_SNOW_MELT_STATE - median, integer
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_MELT_STATE'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_MELT_STATE'][:] = np.nanmedian(ar_var, axis=0).round()
-    # STATE_SNOW_COVERAGE - median
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_COVERAGE'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_COVERAGE'][:] = np.nanmedian(ar_var, axis=0)
-    # STATE_SNOW_WATER_EQUIVALENT - median
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_WATER_EQUIVALENT'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_WATER_EQUIVALENT'][:] = np.nanmedian(ar_var, axis=0)
-    # STATE_SNOW_SURF_TEMP - median
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_SURF_TEMP'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_SURF_TEMP'][:] = np.nanmedian(ar_var, axis=0)
-    # STATE_SNOW_SURF_WATER - median
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_SURF_WATER'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_SURF_WATER'][:] = np.nanmedian(ar_var, axis=0)
-    # STATE_SNOW_PACK_TEMP - median
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_PACK_TEMP'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_PACK_TEMP'][:] = np.nanmedian(ar_var, axis=0)
-    # STATE_SNOW_PACK_WATER - median
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_PACK_WATER'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_PACK_WATER'][:] = np.nanmedian(ar_var, axis=0)
-    # STATE_SNOW_DENSITY - median
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_DENSITY'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_DENSITY'][:] = np.nanmedian(ar_var, axis=0)
-    # STATE_SNOW_COLD_CONTENT - median
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_COLD_CONTENT'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_COLD_CONTENT'][:] = np.nanmedian(ar_var, axis=0)
-    # STATE_SNOW_CANOPY - median
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_SNOW_CANOPY'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_SNOW_CANOPY'][:] = np.nanmedian(ar_var, axis=0)
-    # STATE_SOIL_NODE_TEMP - mean
-    ds_mean['STATE_SOIL_NODE_TEMP'] = (sum(list_ds) / N)['STATE_SOIL_NODE_TEMP']
-    # STATE_FOLIAGE_TEMPERATURE - mean
-    ds_mean['STATE_FOLIAGE_TEMPERATURE'] = (sum(list_ds) / N)['STATE_FOLIAGE_TEMPERATURE']
-    # STATE_ENERGY_LONGUNDEROUT - mean
-    ds_mean['STATE_ENERGY_LONGUNDEROUT'] = (sum(list_ds) / N)['STATE_ENERGY_LONGUNDEROUT']
-    # STATE_ENERGY_SNOW_FLUX - median
-    list_var = []
-    for ds in list_ds:
-        list_var.append(ds['STATE_ENERGY_SNOW_FLUX'].values)
-    ar_var = np.asarray(list_var)
-    ds_mean['STATE_ENERGY_SNOW_FLUX'][:] = np.nanmedian(ar_var, axis=0)
+    ind_window = calculate_SMART_window_index(
+        da_prec_orig['time'].values, start_time, window_size, time_step, nwindow)
+    prec_orig_window, count_window = calculate_SMART_window_sum(
+        da_prec_orig.values, ind_window, nwindow)
 
-    # Write to output netCDF file
-    ds_mean.to_netcdf(out_state_nc, format='NETCDF4_CLASSIC')
+    return {'prec_orig': da_prec_orig.values,
+            'ind_window': ind_window,
+            'prec_orig_window': prec_orig_window,
+            'count_window': count_window}
 
-    return out_state_nc
 
+def postprocess_SMART_member(run_SMART_dir, var, ens, times, da_mask,
+                             out_dir, out_prefix, dict_broadcast=None):
+    ''' Load one member of SMART output prec, rescale it to the original
+        timestep if needed, and save to yearly files. Each year is rescaled
+        and saved before the next, so that only one year of output is held in
+        memory.
 
-def run_vic_assigned_states(start_time, end_time, vic_exe, init_state_nc,
-                            dict_assigned_state_nc, global_template,
-                            vic_forcing_basepath, vic_model_steps_per_day,
-                            output_global_root_dir,
-                            output_vic_history_root_dir,
-                            output_vic_log_root_dir, mpi_proc=None, mpi_exe=None,
-                            delete_log=True):
-    ''' Run VIC with assigned initial states and other assigned state files during the simulation time. All VIC runs do not output state file in the end.
-    
     Parameters
     ----------
-    start_time: <pandas.tslib.Timestamp>
-        Start time of VIC run
-    end_time: <pandas.tslib.Timestamp>
-        End time of VIC run
-    vic_exe: <class 'VIC'>
-        VIC run class
-    init_state_nc: <str>
-        Path of initial state netCDF file; None for no initial state
-    dict_assigned_state_nc: <OrderedDict>
-        An ordered dictionary of state times and nc files after the start time;
-        Keys: state times in <pandas.tslib.Timestamp>;
-        Items: state netCDF file path in <str>
-    global_template: <str>
-        VIC global file template
-    vic_forcing_basepath: <str>
-        VIC forcing netCDF file basepath ('YYYY.nc' will be appended)
-    vic_model_steps_per_day: <int>
-        VIC model steps per day
-    output_global_root_dir: <str>
-        Directory for VIC global files
-    output_vic_history_root_dir: <str>
-        Directory for VIC output history files
-    output_vic_log_root_dir: <str>
-        Directory for VIC output log files
-    mpi_proc: <int or None>
-        Number of processors to use for VIC MPI run. None for not using MPI
-    mpi_exe: <str>
-        Path for MPI exe
-    delete_log: <bool>
-        Whether to delete all log files in the log directory after running
-        Default: True
-    
+    run_SMART_dir: <str>
+        SMART output directory
+    var: <str>
+        'corrected' or 'perturbed'; see load_SMART_output_prec
+    ens: <int> or None
+        Ensemble member index (starting from 1); None for the deterministic
+        SMART-corrected prec
+    times: <pd.DatetimeIndex>
+        Timestamps of the output prec (original timestep)
+    da_mask: <xr.DataArray>
+        Domain mask (>0 for active grid cells)
+    out_dir: <str>
+        Output directory
+    out_prefix: <str>
+        Prefix of the output prec file ("YYYY.nc" will be appended)
+    dict_broadcast: <dict> or None
+        Broadcast file path of each output of prepare_SMART_prec_orig_cache
+        (see EnsembleWorkerPool.broadcast), to rescale the window-averaged
+        SMART-corrected prec to the original timestep;
+        None to save the SMART output prec directly (window_size = 1, or
+        perturbed prec)
+
     Returns
     ----------
-    list_history_files_concat: <list>
-        A list of all output history file paths in order
-    
+    ens: <int> or None
+        Same as input
+
     Require
     ----------
-    OrderedDict
-    generate_VIC_global_file
-    check_returncode
+    load_SMART_output_prec
+    load_broadcast
+    rescale_prec_by_window
     '''
-    
-    list_history_files = []  # A list of resulted history file paths
-    list_history_files_concat = []  # A list of final concatenated history file paths
-    
-    # --- Run VIC from start_time to the first assigned state time --- #
-    run_start_time = start_time
-    run_end_time = list(dict_assigned_state_nc.keys())[0] - \
-                   pd.DateOffset(hours=24/vic_model_steps_per_day)
-    print('\tRunning VIC from ', run_start_time, 'to', run_end_time)
-    propagate(start_time=run_start_time, end_time=run_end_time,
-              vic_exe=vic_exe, vic_global_template_file=global_template,
-              vic_model_steps_per_day=vic_model_steps_per_day,
-              init_state_nc=init_state_nc,
-              out_state_basepath=None,
-              out_history_dir=output_vic_history_root_dir,
-              out_history_fileprefix='history',
-              out_global_basepath=os.path.join(output_global_root_dir, 'global'),
-              out_log_dir=output_vic_log_root_dir,
-              forcing_basepath=vic_forcing_basepath,
-              mpi_proc=mpi_proc,
-              mpi_exe=mpi_exe,
-              delete_log=delete_log)
-    list_history_files.append(os.path.join(
-                    output_vic_history_root_dir,
-                    'history.{}-{:05d}.nc'.format(
-                            run_start_time.strftime('%Y-%m-%d'),
-                            run_start_time.hour*3600+run_start_time.second)))
-    
-    # --- Run VIC from each assigned state time to the next (or to end_time) --- #
-    for t, time in enumerate(dict_assigned_state_nc.keys()):
-        # --- Determine last, current and next measurement time points --- #
-        current_time = time
-        if t == len(dict_assigned_state_nc)-1:  # if this is the last measurement time
-            next_time = end_time
-        else:  # if not the last measurement time
-            next_time = list(dict_assigned_state_nc.keys())[t+1] - \
-                        pd.DateOffset(hours=24/vic_model_steps_per_day)
-        # If current_time > next_time, do not propagate (we already reach the end of the simulation)
-        if current_time > next_time:
-            break
-        print('\tRunning VIC from ', current_time, 'to', next_time)
-        
-        # --- Propagate to the next time from assigned initial states --- #
-        state_nc = dict_assigned_state_nc[current_time]
-        propagate(start_time=current_time, end_time=next_time,
-                  vic_exe=vic_exe, vic_global_template_file=global_template,
-                  vic_model_steps_per_day=vic_model_steps_per_day,
-                  init_state_nc=state_nc,
-                  out_state_basepath=None,
-                  out_history_dir=output_vic_history_root_dir,
-                  out_history_fileprefix='history',
-                  out_global_basepath=os.path.join(output_global_root_dir, 'global'),
-                  out_log_dir=output_vic_log_root_dir,
-                  forcing_basepath=vic_forcing_basepath,
-                  mpi_proc=mpi_proc,
-                  mpi_exe=mpi_exe)
-        list_history_files.append(os.path.join(
-                    output_vic_history_root_dir,
-                    'history.{}-{:05d}.nc'.format(
-                            current_time.strftime('%Y-%m-%d'),
-                            current_time.hour*3600+current_time.second)))
-        # --- Concat and delete individual history files for each year --- #
-        # (If the end of EnKF run, or the end of a calendar year)
-        if (t == (len(dict_assigned_state_nc.keys()) - 1)) or \
-           (t < (len(dict_assigned_state_nc.keys()) - 1) and \
-           current_time.year != (next_time + \
-           pd.DateOffset(hours=24/vic_model_steps_per_day)).year):
-            # Determine history file year
-            year = current_time.year
-            # Concat individual history files
-            output_file=os.path.join(
-                            output_vic_history_root_dir,
-                            'history.concat.{}.nc'.format(year))
-            concat_clean_up_history_file(list_history_files,
-                                         output_file)
-            list_history_files_concat.append(output_file)
-            # Reset history file list
-            list_history_files = []
-    return list_history_files_concat
 
+    # --- Load SMART output of this member to [time, lat, lon] --- #
+    prec = load_SMART_output_prec(run_SMART_dir, var, ens)
+    prec = da_2D_to_3D_from_SMART(
+        {'prec': prec}, da_mask, out_time_varname='time',
+        out_time_coord=range(prec.shape[0]))['prec'].values
+    # --- Load shared original prec (memory-mapped) --- #
+    if dict_broadcast is not None:
+        prec_orig = load_broadcast(dict_broadcast['prec_orig'])
+        ind_window = load_broadcast(dict_broadcast['ind_window'])
+        prec_orig_window = load_broadcast(dict_broadcast['prec_orig_window'])
+        count_window = load_broadcast(dict_broadcast['count_window'])
+
+    # --- Rescale and save one year at a time --- #
+    times = pd.to_datetime(times)
+    for year in np.unique(times.year):
+        ind_time = np.where(times.year == year)[0]
+        if dict_broadcast is None:
+            prec_year = prec[ind_time]
+        else:
+            prec_year = rescale_prec_by_window(
+                prec_orig[ind_time], ind_window[ind_time], prec,
+                prec_orig_window, count_window)
+        da_prec_year = xr.DataArray(
+            prec_year, coords=[times[ind_time], da_mask['lat'], da_mask['lon']],
+            dims=['time', 'lat', 'lon'])
+        to_netcdf_forcing_file_compress(
+            ds_force=xr.Dataset({'prec_corrected': da_prec_year}),
+            out_nc=os.path.join(out_dir, '{}{}.nc'.format(out_prefix, year)))
+
+    return ens
 
-def rmse(true, est):
-    ''' Calculates RMSE of an estimated variable compared to the truth variable
+
+def calculate_SMART_DOY(ist, time_step):
+    ''' Calculate the (non-integer) day-of-year of each SMART timestep, the same
+        way as in SMART's rescale.m
 
     Parameters
     ----------
-    true: <np.array>
-        A 1-D array of time series of true values
-    est: <np.array>
-        A 1-D array of time series of estimated values (must be the same length of true)
+    ist: <int>
+        Number of timesteps
+    time_step: <int>
+        SMART timestep [hour]
 
     Returns
     ----------
-    rmse: <float>
-        Root mean square error
+    DOY: <np.array>
+        Day-of-year of each timestep, in [0, 365)
+        Dim: [ist]
+    '''
 
-    Require
+    day = np.floor(np.arange(ist) * (time_step / 24)) + 1
+    day_frac = (day + 31) * 0.002739726
+    DOY = 365 * (day_frac - np.floor(day_frac))
+
+    return DOY
+
+
+def API_short(start, API_COEFF, bb):
+    ''' Propagate the API model by one timestep (without rainfall), i.e.,
+        API_short.m of SMART with time_steps = 1
+
+    Parameters
     ----------
-    numpy
+    start: <np.array>
+        API at the previous timestep
+    API_COEFF: <np.array>
+        API coefficient at this timestep (broadcastable to start)
+    bb: <np.array>
+        API exponent (broadcastable to start)
+
+    Returns
+    ----------
+    <np.array>
+        Propagated API (before adding rainfall)
     '''
 
-    rmse = np.sqrt(sum((est - true)**2) / len(true))
-    return rmse
+    return np.sign(start) * (API_COEFF - 1) * np.abs(start)**bb + start
 
 
-def innov_norm_var(innov, y_est_before_update, R):
-    ''' Calculates normalized variance of innovation
-    
+def cdf_match_SMART(RS_sort, API_sort, sm):
+    ''' Map soil moisture retrievals to the API space by rank (CDF matching),
+        the same way as in SMART's rescale.m - each retrieval is mapped to the
+        mean of the sorted API at the positions of the tied retrievals
+
     Parameters
     ----------
-    innov: <np.array>
-        A 1-D array of time series of innovation (meas - y_est_before_update),
-        averaged over all ensemble members
-    y_est_before_update: <np.array>
-        A 2-D array of y_est_before_update for all ensemble members
-        Dim: [time, N]
-    R: <float>
-        Measurement error variance
-    
+    RS_sort: <np.array>
+        Sorted soil moisture retrievals of the matching sample
+    API_sort: <np.array>
+        Sorted API of the matching sample (same length as RS_sort)
+    sm: <np.array>
+        Soil moisture retrievals to map (all must be in RS_sort)
+
     Returns
     ----------
-    var_norm: <float>
-        Normalized variance
-    
-    Require
-    ----------
-    numpy
+    <np.array>
+        Soil moisture retrievals in the API space
     '''
-    
-    # If all nan, return a time series of nan
-    if sum(~np.isnan(innov)) == 0:
-        return np.nan
-    
-    # Pyy = cov(y, y.transpose); divided by (N-1)
-    Pyy = np.cov(y_est_before_update).diagonal()  # [time]
-    
-    # Calculate normalized innovation time series
-    innov_norm = innov / np.sqrt(Pyy + R)
-    
-    # Calculate variance
-    var_norm = np.var(innov_norm)
-    
-    return var_norm
 
+    ind_left = np.searchsorted(RS_sort, sm, side='left')
+    ind_right = np.searchsorted(RS_sort, sm, side='right')
+    API_cumsum = np.concatenate([[0], np.cumsum(API_sort)])
 
-def load_nc_and_concat_var_years(basepath, start_year, end_year, dict_vars):
-    ''' Loads in netCDF files end with 'YYYY.nc', and for each variable needed,
-        concat all years together and return a DataArray
-        
-        Parameters
-        ----------
-        basepath: <str>
-            Basepath of all netCDF files; 'YYYY.nc' will be appended;
-            Time dimension name in the nc files must be 'time'
-        start_year: <int>
-            First year to load
-        end_year: <int>
-            Last year to load
-        dict_vars: <dict>
-            A dict of desired variables and corresponding varname in the
-            netCDF files (e.g., {'prec': 'prcp'; 'temp': 'tair'}). The keys in
-            dict_vars will be used as keys in the output dict.
+    return (API_cumsum[ind_right] - API_cumsum[ind_left]) / (ind_right - ind_left)
 
-        Returns
-        ----------
-        dict_da: <dict>
-            A dict of concatenated xr.DataArrays.
-            Keys: desired variables (using the same keys as in input
-                  'dict_vars')
-            Elements: <xr.DataArray>
-    '''
 
-    dict_list = {}
-    for var in dict_vars.keys():
-        dict_list[var] = []
+def rescale_SMART(sm_observed, rain_observed, R_DQX, time_step, transform_flag,
+                  API_model_flag, API_mean, API_range, bb, lag=0.00):
+    ''' Rescale soil moisture retrievals to the API space for all pixels at once
+        (rescale.m of SMART)
 
-    # Loop over each year
-    for year in range(start_year, end_year+1):
-        # Load data for this year
-        ds = xr.open_dataset(basepath + '{}.nc'.format(year))
-        # Extract each variable needed and put in a list
-        for var, varname in dict_vars.items():
-            da = ds[varname]
-            # Put data of this year in a list
-            dict_list[var].append(da)
+    Parameters
+    ----------
+    sm_observed: <np.array>
+        Soil moisture retrievals (NAN for no retrieval)
+        Dim: [ist, npixel]
+    rain_observed: <np.array>
+        Satellite rainfall (no negative values)
+        Dim: [ist, npixel]
+    R_DQX: <np.array>
+        Soil moisture retrieval error (standard deviation)
+        Dim: [ist, npixel]
+    time_step: <int>
+        SMART timestep [hour]
+    transform_flag: <int>
+        1) CDF, 2) seasonal 1&2, 3) bias 1&2, 4) seasonal CDF,
+        5) seasonal 1&2 with seasonal variance
+    API_model_flag: <int>
+        0) static, 1) simple sine model
+    API_mean: <np.array>
+        API coefficient
+        Dim: [npixel]
+    API_range: <float>
+        Seasonal range of the API coefficient (only used if API_model_flag = 1)
+    bb: <np.array>
+        API exponent
+        Dim: [npixel]
+    lag: <float>
+        DOY lag of the seasonal API coefficient
 
-    # Concat all years for all variables
-    dict_da = {}
-    for var in dict_vars.keys():
-        dict_da[var] = xr.concat(dict_list[var], dim='time')
+    Returns
+    ----------
+    sm_observed_trans: <np.array>
+        Rescaled soil moisture (NAN for no retrieval and for the first timestep)
+        Dim: [ist, npixel]
+    R_API: <np.array>
+        Retrieval error variance in the API space
+        Dim: [ist, npixel]
+    API_COEFF: <np.array>
+        API coefficient of each timestep
+        Dim: [ist, npixel]
+    API_model: <np.array>
+        Open-loop API driven by rain_observed
+        Dim: [ist, npixel]
+    '''
 
-    return dict_da
+    ist, npixel = sm_observed.shape
+    DOY = calculate_SMART_DOY(ist, time_step)
+    # 0-based index of round(DOY) (MATLAB rounds half away from zero)
+    ind_DOY = np.floor(DOY + 0.5).astype(int) - 1
+
+    # --- API coefficient --- #
+    if API_model_flag == 0:
+        API_COEFF = np.tile(API_mean, (ist, 1))
+    elif API_model_flag == 1:
+        API_COEFF = API_mean + API_range * \
+                    np.cos(2 * np.pi * (DOY - lag) / 365)[:, np.newaxis]
+    else:
+        raise ValueError('API_model_flag = {} is not supported; only 0 and 1 '
+                         'are supported'.format(API_model_flag))
+    API_COEFF = np.clip(API_COEFF, 0, 1)
+    API_COEFF[0, :] = API_mean
+
+    # --- Open-loop API --- #
+    API_model = np.zeros([ist, npixel])
+    for k in range(1, ist):
+        API_model[k, :] = API_short(API_model[k-1, :], API_COEFF[k, :], bb) + \
+                          rain_observed[k, :]
+
+    # --- Long-term statistics --- #
+    valid = ~np.isnan(sm_observed)
+    count = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total_mean_sm_observed = np.where(valid, sm_observed, 0).sum(axis=0) / count
+        total_var_sm_observed = (np.where(valid, sm_observed - total_mean_sm_observed, 0)**2).sum(axis=0) / \
+                                (count - 1)
+        total_mean_API = np.where(valid, API_model, 0).sum(axis=0) / count
+        total_var_API = (np.where(valid, API_model - total_mean_API, 0)**2).sum(axis=0) / \
+                        (count - 1)
+        total_sd_ratio = np.sqrt(total_var_API) / np.sqrt(total_var_sm_observed)
+
+    # --- Seasonal statistics (31-day window of DOY) --- #
+    # Sum of each DOY (the first timestep is excluded)
+    valid_DOY = valid.copy()
+    valid_DOY[0, :] = False
+    sm_DOY = np.zeros([365, npixel])
+    sm2_DOY = np.zeros([365, npixel])
+    API_DOY = np.zeros([365, npixel])
+    API2_DOY = np.zeros([365, npixel])
+    count_DOY = np.zeros([365, npixel])
+    np.add.at(sm_DOY, ind_DOY, np.where(valid_DOY, sm_observed, 0))
+    np.add.at(sm2_DOY, ind_DOY, np.where(valid_DOY, sm_observed**2, 0))
+    np.add.at(API_DOY, ind_DOY, np.where(valid_DOY, API_model, 0))
+    np.add.at(API2_DOY, ind_DOY, np.where(valid_DOY, API_model**2, 0))
+    np.add.at(count_DOY, ind_DOY, valid_DOY)
+    # Sum over the circular window
+    def _window_sum(x):
+        return sum(np.roll(x, -offset, axis=0) for offset in range(-15, 16))
+    count_window = _window_sum(count_DOY)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_sm_observed = _window_sum(sm_DOY) / count_window
+        var_sm_observed = (count_window / (count_window - 1)) * \
+                          (_window_sum(sm2_DOY) / count_window - mean_sm_observed**2)
+        mean_API = _window_sum(API_DOY) / count_window
+        var_API = (count_window / (count_window - 1)) * \
+                  (_window_sum(API2_DOY) / count_window - mean_API**2)
+    # Use long-term statistics where there is no retrieval in the window
+    mean_sm_observed = np.where(count_window > 0, mean_sm_observed, total_mean_sm_observed)
+    var_sm_observed = np.where(count_window > 0, var_sm_observed, total_var_sm_observed)
+
+    # --- Retrieval error variance in the API space --- #
+    R_API = np.fmax(R_DQX**2, 0) * total_sd_ratio**2
+    R_API[0, :] = 0
+
+    # --- Rescale soil moisture --- #
+    sm_observed_trans = np.full([ist, npixel], np.nan)
+    to_rescale = valid_DOY
+    if transform_flag == 1:
+        for j in range(npixel):
+            RS_sort = np.sort(sm_observed[valid[:, j], j])
+            API_sort = np.sort(API_model[valid[:, j], j])
+            sm_observed_trans[to_rescale[:, j], j] = cdf_match_SMART(
+                RS_sort, API_sort, sm_observed[to_rescale[:, j], j])
+    elif transform_flag == 2:
+        sm_observed_trans = (sm_observed - mean_sm_observed[ind_DOY, :]) * total_sd_ratio + \
+                            mean_API[ind_DOY, :]
+    elif transform_flag == 3:
+        sm_observed_trans = (sm_observed - total_mean_sm_observed) * total_sd_ratio + \
+                            total_mean_API
+    elif transform_flag == 4:
+        # Timesteps with the same DOY share the same 91-day matching sample
+        for DOY_this in np.unique(DOY[1:]):
+            delta_DOY = np.abs(DOY - DOY_this)
+            delta_DOY[delta_DOY > 182.5] = 365 - delta_DOY[delta_DOY > 182.5]
+            in_window = delta_DOY <= 45
+            is_this_DOY = DOY == DOY_this
+            is_this_DOY[0] = False
+            for j in range(npixel):
+                ind = is_this_DOY & to_rescale[:, j]
+                if not ind.any():
+                    continue
+                subset = in_window & valid[:, j]
+                RS_sort = np.sort(sm_observed[subset, j])
+                API_sort = np.sort(API_model[subset, j])
+                sm_observed_trans[ind, j] = cdf_match_SMART(
+                    RS_sort, API_sort, sm_observed[ind, j])
+    elif transform_flag == 5:
+        var_API_k = var_API[ind_DOY, :]
+        var_sm_observed_k = var_sm_observed[ind_DOY, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sd_ratio = np.where((var_API_k > 0) & (var_sm_observed_k > 0),
+                                np.sqrt(var_API_k) / np.sqrt(var_sm_observed_k),
+                                total_sd_ratio)
+        sm_observed_trans = (sm_observed - mean_sm_observed[ind_DOY, :]) * sd_ratio + \
+                            mean_API[ind_DOY, :]
+    else:
+        raise ValueError('Unsupported transform_flag = {}'.format(transform_flag))
+    sm_observed_trans[~to_rescale] = np.nan
 
+    return sm_observed_trans, R_API, API_COEFF, API_model
+
+
+def EnKF_SMART(sm_observed, sm_observed_trans, R_API, API_COEFF, rain_observed,
+               bb, filter_flag, NUMEN, Q, P_inflation, logn_var, phi,
+               time_step, rng):
+    ''' Run the API-model EnKF (and EnKS gap-filling) of SMART for all pixels
+        and ensemble members at once; loop over time only
 
-def da_3D_to_2D_for_SMART(dict_da_3D, da_mask, time_varname='time'):
-    ''' Convert data arrays with dimension [time, lat, lon] to [npixel_active, time]
-    
     Parameters
     ----------
-    dict_da_3D: <dict>
-        A dict of xr.DataArray's with [time, lat, lon] dimension
-        Keys: variable name
-        Elements: xr.DataArray
-    da_mask: <xr.DataArray>
-        Domain mask (>0 for active grid cells)
-    time_varname: <str>
-        Varname for time in all da's in dict_da_3D
-    
-    Return
+    sm_observed: <np.array>
+        Soil moisture retrievals before rescaling (NAN for no retrieval)
+        Dim: [ist, npixel]
+    sm_observed_trans: <np.array>
+        Rescaled soil moisture retrievals
+        Dim: [ist, npixel]
+    R_API: <np.array>
+        Retrieval error variance in the API space
+        Dim: [ist, npixel]
+    API_COEFF: <np.array>
+        API coefficient
+        Dim: [ist, npixel]
+    rain_observed: <np.array>
+        Satellite rainfall
+        Dim: [ist, npixel]
+    bb: <np.array>
+        API exponent
+        Dim: [npixel]
+    filter_flag: <int>
+        2) EnKF, 6) EnKF with EnKS gap-filling
+    NUMEN: <int>
+        Number of ensemble members
+    Q: <np.array>
+        API model error variance
+        Dim: [npixel]
+    P_inflation: <float>
+        Rainfall-proportional API error variance
+    logn_var: <np.array>
+        Variance of the multiplicative rainfall perturbation
+        Dim: [npixel]
+    phi: <float>
+        Lag-1 autocorrelation of the rainfall perturbation
+    time_step: <int>
+        SMART timestep [hour]
+    rng: <np.random.Generator>
+        Random generator
+
+    Returns
     ----------
-    dict_array_active: <dict>
-        Keys: variable name (same as in input)
-        Elements: np.array with dimension [npixel_active, time]
-    
+    increment: <np.array>
+        API increment of the ensemble mean (-999 for no increment)
+        Dim: [ist, npixel]
+    increment_ens: <np.array>
+        API increment of each ensemble member
+        Dim: [ist, npixel, NUMEN]
+    innovation: <np.array>
+        Normalized innovation (-999 for no retrieval)
+        Dim: [ist, npixel]
+    rain_perturbed_ens: <np.array>
+        Perturbed rainfall
+        Dim: [ist, npixel, NUMEN]
     '''
-    
-    # Extract ntime, nlat and nlon
-    da_example = dict_da_3D[list(dict_da_3D.keys())[0]]
-    ntime = len(da_example[time_varname])
-    nlat = len(da_example['lat'])
-    nlon = len(da_example['lon'])
-    
-    # Reshape domain mask
-    mask = da_mask.values
-    mask_reshape = mask.reshape(nlat*nlon)
-    
-    # Convert all da's in dict_da_3D to [npixel_active, nday]
-    dict_array_active = {}
-    # Loop over each da
-    for var, da in dict_da_3D.items():
-        # Convert to np.array and reshape to [ntime, ncell]
-        array_all_cells = da.values.reshape(ntime, nlat*nlon)
-        # Only keep active grid cells to the final dimension [ntime, npixel_active]
-        array_active = array_all_cells[:, mask_reshape>0]
-        # Transpose dimension to [npixel_active, nday]
-        array_active = np.transpose(array_active)
-        # Put in final dictionary
-        dict_array_active[var] = array_active
-    
-    return dict_array_active
 
+    ist, npixel = sm_observed.shape
+    observed = ~np.isnan(sm_observed)
+
+    # --- Timestep of the last update for EnKS gap-filling --- #
+    if filter_flag == 6:
+        update = ~np.isnan(sm_observed_trans)
+        # Last update before each timestep (the first update if none; no
+        # gap-filling at all if no update)
+        ind_update = np.where(update, np.arange(ist)[:, np.newaxis], -1)
+        last_update = np.full([ist, npixel], -1)
+        last_update[1:, :] = np.maximum.accumulate(ind_update, axis=0)[:-1, :]
+        first_update = np.where(update.any(axis=0), update.argmax(axis=0), ist)
+        last_update = np.where(last_update < 0, first_update, last_update)
+        max_steps_to_fill = int(np.floor(10 * (24 / time_step)))
+        API_prior = np.zeros([ist, npixel, NUMEN])
+
+    # --- Initialize --- #
+    API = np.zeros([npixel, NUMEN])
+    increment = np.zeros([ist, npixel])
+    increment_ens = np.zeros([ist, npixel, NUMEN])
+    innovation = np.zeros([ist, npixel])
+    rain_perturbed_ens = np.repeat(rain_observed[:, :, np.newaxis], NUMEN, axis=2)
+
+    # --- Lognormal AR(1) rainfall multipliers --- #
+    mu = (-0.5 * np.log(logn_var + 1))[:, np.newaxis]
+    scale = (np.sqrt(np.log(logn_var + 1)) * np.sqrt(1 - phi**2))[:, np.newaxis]
+    ar1 = rng.standard_normal([npixel, NUMEN]) * scale
+    sqrt_Q = np.sqrt(Q)[:, np.newaxis]
+    bb = bb[:, np.newaxis]
+
+    # --- Loop over time --- #
+    for k in range(1, ist):
+        # Perturb rainfall
+        ar1 = mu + phi * (ar1 - mu) + rng.standard_normal([npixel, NUMEN]) * scale
+        rain_perturbed_ens[k, :, :] = np.exp(ar1) * rain_observed[k, :, np.newaxis]
+        # Propagate
+        API = API_short(API, API_COEFF[k, :, np.newaxis], bb) + \
+              rain_perturbed_ens[k, :, :] + \
+              sqrt_Q * rng.standard_normal([npixel, NUMEN]) + \
+              np.sqrt(P_inflation) * rain_observed[k, :, np.newaxis] * \
+              rng.standard_normal([npixel, NUMEN])
+        if filter_flag == 6:
+            API_prior[k, :, :] = API
+        increment[k, :] = -999
+        innovation[k, :] = -999
+        # Update pixels with a retrieval
+        pix = np.where(observed[k, :])[0]
+        if len(pix) == 0:
+            continue
+        hold_state = API[pix, :]
+        y = sm_observed_trans[k, pix]
+        R = R_API[k, pix]
+        P = np.var(hold_state, axis=1, ddof=1)
+        K = P / (P + R)
+        background = np.mean(hold_state, axis=1)
+        hold_perturbation = np.sqrt(R)[:, np.newaxis] * \
+                            rng.standard_normal([len(pix), NUMEN])
+        innovation[k, pix] = (y - background) / np.sqrt(P + R)
+        increment[k, pix] = K * (y - background)
+        increment_ens[k, pix, :] = K[:, np.newaxis] * \
+            (y[:, np.newaxis] + hold_perturbation - hold_state)
+        API[pix, :] = hold_state + increment_ens[k, pix, :]
+        # EnKS gap-filling back to the last update
+        if filter_flag == 6:
+            nfill = np.minimum(k - last_update[k, pix], max_steps_to_fill) - 1
+            anomaly_k = hold_state - background[:, np.newaxis]
+            for lag in range(1, nfill.max() + 1):
+                ind = nfill >= lag
+                m = k - lag
+                prior_m = API_prior[m, pix[ind], :]
+                CYM = np.sum(anomaly_k[ind, :] * \
+                             (prior_m - prior_m.mean(axis=1)[:, np.newaxis]),
+                             axis=1) / (NUMEN - 1)
+                K_EnKS = CYM / (P[ind] + R[ind])
+                increment[m, pix[ind]] = K_EnKS * (y[ind] - background[ind])
+                increment_ens[m, pix[ind], :] = K_EnKS[:, np.newaxis] * \
+                    (y[ind, np.newaxis] + hold_perturbation[ind, :] - hold_state[ind, :])
+
+    return increment, increment_ens, innovation, rain_perturbed_ens
+
+
+def analysis_SMART(rain_observed, sma_observed, smd_observed, R_DQX,
+                   time_step, filter_flag, transform_flag, API_model_flag,
+                   NUMEN, Q_fixed, P_inflation, logn_var, phi, API_mean, bb,
+                   API_range, if_rescale, sep_sm_orbit, rng):
+    ''' Rescale soil moisture and run the API-model EnKF (with Q tuning if
+        Q_fixed = 999) for all pixels at once (analysis.m of SMART, EnKF path)
 
-def da_2D_to_3D_from_SMART(dict_array_2D, da_mask, out_time_varname, out_time_coord):
-    ''' Convert data arrays with dimension [time, npixel_active] to [time, lat, lon]
+    Parameters
+    ----------
+    rain_observed: <np.array>
+        Satellite rainfall (no negative values)
+        Dim: [ist, npixel]
+    sma_observed, smd_observed: <np.array>
+        Ascending and descending soil moisture retrievals
+        Dim: [ist, npixel]
+    R_DQX: <np.array>
+        Soil moisture retrieval error (standard deviation)
+        Dim: [ist, npixel]
+    Other parameters: see SMART_pixels
+
+    Returns
+    ----------
+    increment, increment_ens, innovation, rain_perturbed_ens:
+        See EnKF_SMART
+    '''
+
+    ist, npixel = rain_observed.shape
+
+    # --- Rescale soil moisture retrievals --- #
+    if sep_sm_orbit == 0:
+        # Average ascending and descending retrievals on the same timestep
+        is_a = ~np.isnan(sma_observed)
+        is_d = ~np.isnan(smd_observed)
+        sm_observed = np.where(is_a & is_d, 0.5 * (smd_observed + sma_observed),
+                               np.where(is_d, smd_observed, sma_observed))
+        sm_observed_trans, R_API, API_COEFF, API_model = rescale_SMART(
+            sm_observed, rain_observed, R_DQX, time_step, transform_flag,
+            API_model_flag, API_mean, API_range, bb)
+    else:
+        if (~np.isnan(sma_observed) & ~np.isnan(smd_observed)).any():
+            raise ValueError('When sep_sm_orbit, ascending and descending products '
+                             'cannot appear on the same timestep!')
+        sma_observed_trans, R_API_a, API_COEFF_a, API_model = rescale_SMART(
+            sma_observed, rain_observed, R_DQX, time_step, transform_flag,
+            API_model_flag, API_mean, API_range, bb)
+        smd_observed_trans, R_API_d, API_COEFF_d, API_model = rescale_SMART(
+            smd_observed, rain_observed, R_DQX, time_step, transform_flag,
+            API_model_flag, API_mean, API_range, bb)
+        is_a = ~np.isnan(sma_observed)
+        is_d = ~np.isnan(smd_observed)
+        sm_observed = np.where(is_a, sma_observed, smd_observed)
+        sm_observed_trans = np.where(is_a, sma_observed_trans,
+                                     np.where(is_d, smd_observed_trans, np.nan))
+        R_API = np.where(is_a, R_API_a, np.where(is_d, R_API_d, 0))
+        API_COEFF = np.where(is_a, API_COEFF_a,
+                             np.where(is_d, API_COEFF_d, API_mean))
+    if if_rescale == 0:
+        R_API = R_DQX**2
+        sm_observed_trans = sm_observed
+
+    # --- Run EnKF, tuning Q for each pixel if Q_fixed = 999 --- #
+    no_tune = (Q_fixed != 999)
+    Q = np.full(npixel, 900. if not no_tune else Q_fixed, dtype=float)
+    logn_var = np.full(npixel, logn_var, dtype=float)
+    converge_count = np.zeros(npixel, dtype=int)
+    Q_prime = np.zeros(npixel)
+    innovation_prime = np.zeros(npixel)
+    increment = np.zeros([ist, npixel])
+    increment_ens = np.zeros([ist, npixel, NUMEN])
+    innovation = np.zeros([ist, npixel])
+    rain_perturbed_ens = np.zeros([ist, npixel, NUMEN])
+    pix = np.arange(npixel)
+    while len(pix) > 0:
+        increment[:, pix], increment_ens[:, pix, :], innovation[:, pix], \
+        rain_perturbed_ens[:, pix, :] = EnKF_SMART(
+            sm_observed[:, pix], sm_observed_trans[:, pix], R_API[:, pix],
+            API_COEFF[:, pix], rain_observed[:, pix], bb[pix],
+            filter_flag, NUMEN, Q[pix], P_inflation, logn_var[pix], phi,
+            time_step, rng)
+        if no_tune:
+            break
+        # Tune Q by the variance of normalized innovation (SMART converge_approach = 2)
+        list_pix_not_converged = []
+        for j in pix:
+            innovation_var = np.var(innovation[~np.isnan(sm_observed[:, j]), j], ddof=1)
+            if abs(innovation_var - 1) < 0.001 or converge_count[j] > 25 or np.isnan(Q[j]):
+                continue
+            converge_count[j] += 1
+            converged = (converge_count[j] >= 2 and P_inflation < 0.1 and Q[j] < 0.1
+                         and innovation_var < 1)
+            if converge_count[j] == 1:
+                Q_prime[j] = Q[j]
+                innovation_prime[j] = innovation_var
+                Q[j] = 0
+            if converge_count[j] == 2 and innovation_var < 1 and filter_flag == 2:
+                converge_count[j] = 0
+                logn_var[j] = logn_var[j] * 0.8
+                Q[j] = 2000
+            if converge_count[j] >= 2:
+                Q_hold = Q[j]
+                Q[j] = Q[j] + (-innovation_var + 1) * (Q_prime[j] - Q[j]) / \
+                       (innovation_prime[j] - innovation_var)
+                if Q[j] < 0:
+                    Q[j] = 0
+                innovation_prime[j] = innovation_var
+                Q_prime[j] = Q_hold
+            if not converged:
+                list_pix_not_converged.append(j)
+        pix = np.array(list_pix_not_converged, dtype=int)
+
+    return increment, increment_ens, innovation, rain_perturbed_ens
+
+
+def sum_SMART_window(data, window_size):
+    ''' Sum SMART data over each (complete) window along the first dimension;
+        the first window is set to zero (as in SMART) '''
+    nwindow = data.shape[0] // window_size
+    data_window = data[:nwindow*window_size].reshape(
+        (nwindow, window_size) + data.shape[1:]).sum(axis=1)
+    data_window[0] = 0
+    return data_window
+
+
+def fraction_tune_SMART(fraction, sum_rain, sum_rain_sp, increment_sum):
+    ''' RMSE of corrected rainfall (rescaled to the mean of sum_rain_sp) for
+        lambda = fraction (fraction_tune.m of SMART) '''
+    rain_corrected = sum_rain_sp + fraction * increment_sum
+    rain_corrected[rain_corrected <= 0] = 0
+    rain_corrected = rain_corrected / np.mean(rain_corrected) * np.mean(sum_rain_sp)
+    return np.sqrt(np.mean((rain_corrected - sum_rain)**2))
+
+
+def fraction_tune_corrcoef_SMART(fraction, sum_rain, sum_rain_sp, increment_sum):
+    ''' Negative correlation coefficient of corrected rainfall for
+        lambda = fraction (fraction_tune_corrcoef.m of SMART) '''
+    rain_corrected = sum_rain_sp + fraction * increment_sum
+    rain_corrected[rain_corrected <= 0] = 0
+    return - np.corrcoef(rain_corrected, sum_rain)[0, 1]
+
+
+def correction_SMART(increment_sum, increment_sum_ens, sum_rain_sp, sum_rain_indep,
+                     rain_perturbed_sum_ens, lambda_flag, lambda_tuning_target,
+                     correct_magnitude_only, correct_magnitude_only_threshold):
+    ''' Correct window-sum rainfall with the API increments for all pixels at
+        once (correction.m of SMART, EnKF path)
 
     Parameters
     ----------
-    dict_array_2D: <dict>
-        Keys: variable name
-        Elements: np.array with dimension [time, npixel_active]
-    da_mask: <xr.DataArray>
-        Domain mask (>0 for active grid cells)
-    out_time_varname: <str>
-        Varname for time in output xr.DataArray's
-    out_time_coord: <list or other types usable for xr coords>
-        Time coordinates in output xr.DataArray's
+    increment_sum: <np.array>
+        Window-sum increment (-999 for no increment)
+        Dim: [nwindow, npixel]
+    increment_sum_ens: <np.array>
+        Window-sum increment of each ensemble member
+        Dim: [nwindow, npixel, NUMEN]
+    sum_rain_sp: <np.array>
+        Window-sum satellite rainfall
+        Dim: [nwindow, npixel]
+    sum_rain_indep: <np.array>
+        Window-sum independent rainfall (negative for missing)
+        Dim: [nwindow, npixel]
+    rain_perturbed_sum_ens: <np.array>
+        Window-sum perturbed rainfall
+        Dim: [nwindow, npixel, NUMEN]
+    Other parameters: see SMART_pixels
 
-    Return
+    Returns
     ----------
-    dict_da_3D: <dict>
-        Keys: variable name (same as in input)
-        Elements: xr.DataArray with dimension [time, lat, lon]
+    sum_rain_corrected: <np.array>
+        Dim: [nwindow, npixel]
+    sum_rain_corrected_ens: <np.array>
+        Dim: [nwindow, npixel, NUMEN]
+    optimized_fraction: <np.array>
+        lambda of each pixel
+        Dim: [npixel]
     '''
 
-    # Extract ndays, nlat and nlon (as well as lat and lon)
-    ntime = len(out_time_coord)
-    lat = da_mask['lat']
-    lon = da_mask['lon']
-    nlat = len(lat)
-    nlon = len(lon)    
+    npixel = sum_rain_sp.shape[1]
+    increment_sum_hold = np.where(increment_sum < -500, 0, increment_sum)
+    increment_sum = increment_sum.copy()
+    increment_sum_ens = increment_sum_ens.copy()
+    if correct_magnitude_only == 1:
+        no_correct = sum_rain_sp <= correct_magnitude_only_threshold
+        increment_sum_hold[no_correct] = 0
+        increment_sum[no_correct] = 0
+        increment_sum_ens[no_correct] = 0
+
+    # --- Lambda --- #
+    if lambda_flag == 999:
+        if lambda_tuning_target == 'rmse':
+            func = fraction_tune_SMART
+        elif lambda_tuning_target == 'corrcoef':
+            func = fraction_tune_corrcoef_SMART
+        else:
+            raise ValueError('Unsupported lambda_tuning_target {}'.format(
+                lambda_tuning_target))
+        optimized_fraction = np.zeros(npixel)
+        for j in range(npixel):
+            ind = sum_rain_indep[:, j] >= 0
+            optimized_fraction[j] = fminbound(
+                func, 0.01, 2.00, xtol=1e-4,
+                args=(sum_rain_indep[ind, j], sum_rain_sp[ind, j],
+                      increment_sum_hold[ind, j]))
+    else:
+        optimized_fraction = np.full(npixel, lambda_flag, dtype=float)
 
-    # Reshape domain mask and identify indices of active pixels
-    mask = da_mask.values
-    mask_reshape = mask.reshape(nlat*nlon)
-    ind_active = np.where(mask_reshape>0)[0]
-    
-    # Convert all arrays in dict_da_2D to [time, lat, lon]
-    dict_da_3D = {}
-    # Loop over each da
-    for var, array in dict_array_2D.items():
-        # Fill in inactive cells (to dimension [time, ncells])
-        array_allcells_reshape = np.empty([ntime, nlat*nlon])
-        array_allcells_reshape[:] = np.nan
-        array_allcells_reshape[:, ind_active] = array
-        # Convert to dimension [time, lat, lon]
-        array_3D = array_allcells_reshape.reshape([ntime, nlat, nlon])
-        # Put in xr.DataArray
-        da = xr.DataArray(array_3D, coords=[out_time_coord, lat, lon],
-                          dims=[out_time_varname, 'lat', 'lon'])
-        # Put in final dictionary
-        dict_da_3D[var] = da
+    # --- Correct --- #
+    increment_sum[increment_sum < -500] = 0
+    sum_rain_corrected = sum_rain_sp + optimized_fraction * increment_sum
+    sum_rain_corrected_ens = rain_perturbed_sum_ens + \
+                             optimized_fraction[:, np.newaxis] * increment_sum_ens
+    sum_rain_corrected[sum_rain_corrected < 0] = 0
+    sum_rain_corrected_ens[sum_rain_corrected_ens < 0] = 0
 
-    return dict_da_3D
+    return sum_rain_corrected, sum_rain_corrected_ens, optimized_fraction
 
 
-def rescale_and_save_SMART_prec(da_prec_orig, window_size, time_step,
-                                da_prec_corr_window, start_time, out_dir, out_prefix):
-    ''' Rescale and save SMART-corrected precipitation (one ensemble member)
+def SMART_pixels(prec_orig, prec_for_tuning_lambda, prec_true, sm_ascend,
+                 sm_descend, sm_error, time_step, filter_flag, transform_flag,
+                 API_model_flag, lambda_flag, NUMEN, Q_fixed, P_inflation,
+                 logn_var, phi, window_size, API_mean, bb, API_range,
+                 if_rescale, lambda_tuning_target, correct_magnitude_only,
+                 correct_magnitude_only_threshold, sep_sm_orbit, seed=None):
+    ''' Run SMART (EnKF path, filter_flag = 2 or 6) for a set of pixels as
+        batched arrays; this is SMART.m of SMART without the pixel loop.
+
     Parameters
     ----------
-    da_prec_orig: <xr.DataArray>
-        Original precipitation
-    window_size: <int>
-        Window size in SMART (number of timesteps in a window)
+    prec_orig, prec_for_tuning_lambda, prec_true, sm_ascend, sm_descend, sm_error:
+        <np.array>
+        SMART input data (see prepare_SMART_input)
+        Dim: [npixel, ist]
     time_step: <int>
         SMART timestep [hour]
-    da_prec_corr_window_ens: <xr.DataArray>
-        SMART-corrected window-averaged precipitation
-    start_time: <pd.datetime>
-        Start time of simulation
-    out_dir: <str>
-        Output directory for rescaled precipitation
-    out_prefix: <str>
-        Prefix of the output prec file ("YYYY.nc" will be appended)
-    '''
-
-    # Rescale
-    da_prec_corrected = correct_prec_from_SMART(
-        da_prec_orig,
-        window_size,
-        da_prec_corr_window,
-        start_time,
-        time_step)
-    
-    # Save to file
-    ds_prec_corrected = xr.Dataset({'prec_corrected': da_prec_corrected})
-    for year, ds in ds_prec_corrected.groupby('time.year'):
-        to_netcdf_forcing_file_compress(
-            ds_force=ds,
-            out_nc=os.path.join(out_dir, '{}{}.nc'.format(out_prefix, year)))
-        
-    return da_prec_corrected
+    filter_flag: <int>
+        2) EnKF, 6) EnKF with EnKS gap-filling
+    transform_flag: <int>
+        1) CDF, 2) seasonal 1&2, 3) bias 1&2, 4) seasonal CDF,
+        5) seasonal 1&2 with seasonal variance
+    API_model_flag: <int>
+        0) static, 1) simple sine model
+    lambda_flag: <float>
+        999 for tuning lambda against prec_for_tuning_lambda; otherwise lambda
+    NUMEN: <int>
+        Number of ensemble members
+    Q_fixed: <float>
+        API model error variance; 999 for tuning Q for each pixel
+    P_inflation: <float>
+        Rainfall-proportional API error variance
+    logn_var: <float>
+        Variance of the multiplicative rainfall perturbation
+    phi: <float>
+        Lag-1 autocorrelation of the rainfall perturbation
+    window_size: <int>
+        Number of timesteps in a window
+    API_mean: <np.array>
+        API coefficient
+        Dim: [npixel]
+    bb: <np.array>
+        API exponent
+        Dim: [npixel]
+    API_range: <float>
+        Seasonal range of the API coefficient (only used if API_model_flag = 1)
+    if_rescale: <int>
+        1 for rescaling soil moisture to the API space; 0 for not
+    lambda_tuning_target: <str>
+        'rmse' or 'corrcoef'; only used if lambda_flag = 999
+    correct_magnitude_only: <int>
+        1 for only correcting windows with satellite rainfall above
+        correct_magnitude_only_threshold
+    correct_magnitude_only_threshold: <float>
+        Satellite rainfall threshold [mm/window]
+    sep_sm_orbit: <int>
+        1 for rescaling ascending and descending soil moisture separately
+    seed: <int or None>
+        Seed of the random generator
 
+    Returns
+    ----------
+    dict_out: <dict>
+        'RAIN_SMART_SMOS': corrected window-sum rainfall [nwindow, npixel]
+        'RAIN_SMART_SMOS_ENS': corrected window-sum rainfall ensemble
+                               [NUMEN, nwindow, npixel]
+        'INCREMENT_SUM': window-sum increment (-999 for no increment)
+                         [nwindow, npixel]
+        'RAIN_PERTURBED_ENS': perturbed rainfall at the original timestep
+                              [NUMEN, ist, npixel]
+        'innovation': normalized innovation (-999 for no retrieval) [ist, npixel]
+        'lambda': [npixel]
+    '''
 
-def save_SMART_prec(start_time, end_time, time_step,
-                    da_prec_corr_window, out_dir, out_prefix):
-    ''' Save SMART-corrected precipitation when window size = 1 (one ensemble member)
+    if filter_flag not in [2, 6]:
+        raise ValueError('Only the EnKF path of SMART (filter_flag = 2 or 6) '
+                         'is supported')
+    rng = np.random.default_rng(seed)
+
+    # --- Process input data (to [ist, npixel]) --- #
+    rain_observed = np.transpose(prec_orig).astype(float)
+    rain_observed_hold = rain_observed.copy()
+    rain_observed_hold[rain_observed_hold < 0] = -99999
+    rain_observed[rain_observed < 0] = 0
+    rain_true = np.transpose(prec_true).astype(float)
+    rain_true[rain_true < 0] = -99999
+    rain_indep = np.transpose(prec_for_tuning_lambda).astype(float)
+    rain_indep[rain_indep < 0] = -99999
+
+    # --- Calculate increments --- #
+    increment, increment_ens, innovation, rain_perturbed_ens = analysis_SMART(
+        rain_observed, np.transpose(sm_ascend), np.transpose(sm_descend),
+        np.transpose(sm_error), time_step, filter_flag, transform_flag,
+        API_model_flag, NUMEN, Q_fixed, P_inflation, logn_var, phi,
+        np.asarray(API_mean, dtype=float), np.asarray(bb, dtype=float),
+        API_range, if_rescale, sep_sm_orbit, rng)
+
+    # --- Window sums --- #
+    sum_rain = sum_SMART_window(rain_true, window_size)
+    sum_rain_sp = sum_SMART_window(rain_observed, window_size)
+    sum_rain_indep = sum_SMART_window(rain_indep, window_size)
+    sum_rain_sp_hold = sum_SMART_window(rain_observed_hold, window_size)
+    rain_perturbed_sum_ens = sum_SMART_window(rain_perturbed_ens, window_size)
+    has_increment = increment != -999
+    increment_sum = np.where(
+        sum_SMART_window(has_increment.astype(int), window_size) > 0,
+        sum_SMART_window(np.where(has_increment, increment, 0), window_size),
+        -999)
+    increment_sum[0] = -999
+    increment_sum_ens = sum_SMART_window(
+        np.where(has_increment[:, :, np.newaxis], increment_ens, 0), window_size)
+
+    # --- Correct rainfall --- #
+    sum_rain_corrected, sum_rain_corrected_ens, optimized_fraction = correction_SMART(
+        increment_sum, increment_sum_ens, sum_rain_sp, sum_rain_indep,
+        rain_perturbed_sum_ens, lambda_flag, lambda_tuning_target,
+        correct_magnitude_only, correct_magnitude_only_threshold)
+
+    # --- Rescale corrected rainfall to the mean of satellite rainfall --- #
+    # (over the windows where both true and satellite rainfall are available)
+    mask = (sum_rain >= 0) & (sum_rain_sp_hold >= 0)
+    count = mask.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hold1 = np.where(mask, sum_rain_corrected, 0).sum(axis=0) / count
+        hold2 = np.where(mask, sum_rain_sp, 0).sum(axis=0) / count
+        hold_ens = np.where(mask[:, :, np.newaxis], sum_rain_corrected_ens, 0).sum(axis=0) / \
+                   count[:, np.newaxis]
+        sum_rain_corrected = np.where(mask, sum_rain_corrected * (hold2 / hold1),
+                                      sum_rain_corrected)
+        sum_rain_corrected_ens = np.where(
+            mask[:, :, np.newaxis],
+            sum_rain_corrected_ens * (hold2[:, np.newaxis] / hold_ens),
+            sum_rain_corrected_ens)
+
+    dict_out = {'RAIN_SMART_SMOS': sum_rain_corrected,
+                'RAIN_SMART_SMOS_ENS': np.moveaxis(sum_rain_corrected_ens, 2, 0),
+                'INCREMENT_SUM': increment_sum,
+                'RAIN_PERTURBED_ENS': np.moveaxis(rain_perturbed_ens, 2, 0),
+                'innovation': innovation,
+                'lambda': optimized_fraction}
+
+    return dict_out
+
+
+def run_SMART(dict_array_active, out_dir, start_time, time_step, NUMEN,
+              window_size, API_mean, bb, nproc=1, npixel_chunk=50, seed=11,
+              **kwargs):
+    ''' Run SMART (EnKF path) for all active pixels in Python and write the
+        outputs to netCDF files. Pixels are run in chunks of npixel_chunk
+        (all pixels and ensemble members of a chunk as batched arrays); chunks
+        are run in parallel if nproc > 1, and each chunk is written as soon as
+        it finishes.
 
     Parameters
     ----------
+    dict_array_active: <dict>
+        SMART input data (see prepare_SMART_input)
+        Elements: np.array with dimension [npixel, ist]
+    out_dir: <str>
+        Output directory. Output files (same contents as the .mat outputs of
+        SMART.m):
+            SMART_corrected_rainfall.nc - RAIN_SMART_SMOS [window, pixel] and
+                                          RAIN_SMART_SMOS_ENS [N, window, pixel]
+            SMART_perturbed_rainfall.nc - RAIN_PERTURBED_ENS [N, time, pixel]
+            innovation.nc - innovation [time, pixel]
+            lambda.nc - lambda [pixel]
+            increment_sum.nc - INCREMENT_SUM [window, pixel]
     start_time: <pd.datetime>
         SMART start time
-    end_time: <pd.datetime>
-        SMART end time
     time_step: <int>
         SMART timestep [hour]
-    da_prec_corr_window: <xr.DataArray>
-        SMART-corrected window-averaged precipitation; this function is for
-        when window size = 1, and the 'window' dimension will be directly
-        replaced by timestamps
-    out_dir: <str>
-        Output directory for rescaled precipitation
-    out_prefix: <str>
-        Prefix of the output prec file ("YYYY.nc" will be appended)
-    '''
-
-    # Replace window dimension by time
-    da_prec_corr_to_save = da_prec_corr_window.rename({'window': 'time'})
-    da_prec_corr_to_save['time'] = pd.date_range(
-        start_time, end_time,
-        freq='{}H'.format(time_step))
-    ds_prec_corrected = xr.Dataset({'prec_corrected': da_prec_corr_to_save})
-    for year, ds in ds_prec_corrected.groupby('time.year'):
-        to_netcdf_forcing_file_compress(
-            ds_force=ds,
-            out_nc=os.path.join(out_dir, '{}{}.nc'.format(out_prefix, year)))
-        
-    return da_prec_corr_to_save
+    NUMEN: <int>
+        Number of ensemble members
+    window_size: <int>
+        Number of timesteps in a window
+    API_mean: <float or np.array>
+        API coefficient; a number or an array of each pixel [npixel]
+    bb: <float or np.array>
+        API exponent; a number or an array of each pixel [npixel]
+    nproc: <int>
+        Number of processors for running pixel chunks
+    npixel_chunk: <int>
+        Number of pixels in each chunk
+    seed: <int>
+        Base random seed; chunk i uses seed + i, so that the results do not
+        depend on nproc
+    **kwargs:
+        Other SMART options passed to SMART_pixels
 
+    Require
+    ----------
+    netCDF4
+    '''
 
-def correct_prec_from_SMART(da_prec_orig, window_size, da_prec_corr_window,
-                            start_time, time_step):
-    ''' Correct (i.e., rescale) original precipitation data based on outputs from
-        SMART (which is corrected prec sum in longer time windows).
-            - The first window is not corrected (orig. prec used)
-            - The last incomplete window, if exists, is not corrected (orig. prec used)
+    npixel, ist = dict_array_active['prec_orig'].shape
+    nwindow = ist // window_size
+    API_mean = np.broadcast_to(np.asarray(API_mean, dtype=float), [npixel])
+    bb = np.broadcast_to(np.asarray(bb, dtype=float), [npixel])
+    npixel_chunk = min(npixel_chunk, npixel)
+
+    # --- Create output files --- #
+    dict_nc = {}
+    for name in ['SMART_corrected_rainfall', 'SMART_perturbed_rainfall',
+                 'innovation', 'lambda', 'increment_sum']:
+        nc = netCDF4.Dataset(os.path.join(out_dir, '{}.nc'.format(name)), 'w',
+                             format='NETCDF4')
+        nc.createDimension('pixel', npixel)
+        if name in ['SMART_perturbed_rainfall', 'innovation']:
+            nc.createDimension('time', ist)
+            nc.createVariable('time', 'f8', ('time',))
+            nc['time'].units = 'hours since {}'.format(
+                pd.to_datetime(start_time).strftime('%Y-%m-%d %H:%M:%S'))
+            nc['time'][:] = np.arange(ist) * time_step
+        if name in ['SMART_corrected_rainfall', 'increment_sum']:
+            nc.createDimension('window', nwindow)
+        if name in ['SMART_corrected_rainfall', 'SMART_perturbed_rainfall']:
+            nc.createDimension('N', NUMEN)
+        dict_nc[name] = nc
+    dict_nc['SMART_corrected_rainfall'].createVariable(
+        'RAIN_SMART_SMOS', 'f8', ('window', 'pixel'))
+    # (ensemble chunked by member and pixel chunk)
+    dict_nc['SMART_corrected_rainfall'].createVariable(
+        'RAIN_SMART_SMOS_ENS', 'f8', ('N', 'window', 'pixel'),
+        zlib=True, complevel=1, chunksizes=(1, nwindow, npixel_chunk))
+    dict_nc['SMART_perturbed_rainfall'].createVariable(
+        'RAIN_PERTURBED_ENS', 'f8', ('N', 'time', 'pixel'),
+        zlib=True, complevel=1, chunksizes=(1, ist, npixel_chunk))
+    dict_nc['innovation'].createVariable('innovation', 'f8', ('time', 'pixel'))
+    dict_nc['lambda'].createVariable('lambda', 'f8', ('pixel',))
+    dict_nc['increment_sum'].createVariable('INCREMENT_SUM', 'f8', ('window', 'pixel'))
+    dict_varname_file = {'RAIN_SMART_SMOS': 'SMART_corrected_rainfall',
+                         'RAIN_SMART_SMOS_ENS': 'SMART_corrected_rainfall',
+                         'RAIN_PERTURBED_ENS': 'SMART_perturbed_rainfall',
+                         'innovation': 'innovation',
+                         'lambda': 'lambda',
+                         'INCREMENT_SUM': 'increment_sum'}
+
+    # --- Run pixel chunks and write outputs --- #
+    list_slices = [slice(i, min(i + npixel_chunk, npixel))
+                   for i in range(0, npixel, npixel_chunk)]
+    list_args = []
+    for i, pixel_slice in enumerate(list_slices):
+        dict_kwargs = {var: dict_array_active[var][pixel_slice, :]
+                       for var in ['prec_orig', 'prec_for_tuning_lambda', 'prec_true',
+                                   'sm_ascend', 'sm_descend', 'sm_error']}
+        dict_kwargs.update(kwargs)
+        dict_kwargs.update({'time_step': time_step, 'NUMEN': NUMEN,
+                            'window_size': window_size,
+                            'API_mean': API_mean[pixel_slice],
+                            'bb': bb[pixel_slice], 'seed': seed + i})
+        list_args.append((dict_kwargs, ))
+    worker_pool = EnsembleWorkerPool(nproc=nproc)
+    try:
+        for i, dict_out in worker_pool.imap_unordered(call_SMART_pixels, list_args):
+            print('\tPixels {}-{} done'.format(list_slices[i].start,
+                                               list_slices[i].stop - 1))
+            for varname, data in dict_out.items():
+                dict_nc[dict_varname_file[varname]][varname][..., list_slices[i]] = data
+    finally:
+        worker_pool.close()
+        for nc in dict_nc.values():
+            nc.close()
+
+
+def call_SMART_pixels(dict_kwargs):
+    ''' Call SMART_pixels with a dict of keyword arguments (for multiprocessing) '''
+    return SMART_pixels(**dict_kwargs)
+
+
+def read_weight_matrix(weight_nc, n_source, n_target):
+    ''' Load an xESMF-format weight file into a sparse matrix
 
     Parameters
     ----------
-    da_prec_orig: <xr.DataArray>
-        Original prec data to be corrected. Original timestep, typically daily or
-        sub-daily.
-        Dims: [time, lat, lon]
-    window_size: <int>
-        Number of timesteps in each window
-    da_prec_corr_window: <xr.DataArray>
-        Corrected prec sum in each window
-        Dims: [window (index starting from 0), lat, lon]
-        NOTE: this is the output from SMART:
-                - the first window data is junk (always zeros)
-                - Only include complete windows
-    start_time: <dt.datetime or pd.datetime>
-        Starting time of the starting time of all the time series
-    time_step: <int>
-        SMART timestep [hour]
+    weight_nc: <str>
+        Weight file in xESMF format
+    n_source: <int>
+        Number of grid cells in the source grid
+    n_target: <int>
+        Number of grid cells in the target grid
 
     Returns
     ----------
-    da_prec_corrected: <xr.DataArray>
-        Corrected prec data to be corrected. Original timestep, consistent with that
-        of input da_prec_orig
-        Dims: [time, lat, lon]
-    '''
-
-    # Identify the number of complete windows
-    nwindow = len(da_prec_corr_window['window'])
-    window_hours = window_size*time_step  # Number of hours in a window
+    A: <scipy.sparse.csr_matrix>
+        Weight matrix. Dimension: [n_target, n_source]
 
-    # Sum original prec in each window (the last window may be incomplete)
-    da_prec_orig_window = da_prec_orig.resample(
-                            dim='time',
-                            freq='{}H'.format(window_hours),
-                            how='sum')
-    da_prec_orig_window = da_prec_orig_window.rename({'time': 'window'})
+    Requires
+    ----------
+    import xESMF as xe
+    from scipy.sparse import csr_matrix
+    '''
 
-    # Loop over each window and rescale original prec (skip first window)
-    da_prec_corrected = da_prec_orig.copy(deep=True)
-    for i in range(1, nwindow):
-        # --- Select out this window period from original prec data --- #
-        window_start_time = start_time + pd.DateOffset(hours=i*window_hours)
-        window_end_time = start_time + pd.DateOffset(hours=(i+1)*window_hours-0.0001)
-        da_prec_orig_this_window = da_prec_orig.sel(
-                time=slice(window_start_time, window_end_time))
-        # --- Rescale --- #
-        # (1) Calculate rescaling factors for this windowkki;
-        prec_corr = da_prec_corr_window[i, :, :].values  # dim: [lat, lon]
-        prec_sum_orig = da_prec_orig_window[i, :, :].values  # dim: [lat, lon]
-        # Note: If prec_sum_orig is 0 for a grid cell, scale_factors will be np.inf for
-        # that grid cell
-        scale_factors = prec_corr / prec_sum_orig
-        # (2) Rescale for the orig. prec data (at orig. sub-daily or daily timestep)
-        # for this window (here array broadcast is used)
-        prec_corr_this_window = da_prec_orig_this_window.values * scale_factors
-        # (3) For grid cells where scale_factors == np.inf or scale == np.nan
-        # (which indicates orig. prec are all zero for this window and this
-        # cell; np.inf indicates non-zero numerator while np.nan indicates
-        # zero numerator; np.nan at inactive grid cells as well), fill in with
-        # constant corrected prec from SMART
-        # Index of zero-orig-prec grid cells
-        ind_inf_scale = np.where(np.isinf(scale_factors) + np.isnan(scale_factors))
-        # Constant corrected prec to fill in (divided to each orig. timestep)
-        const_prec = prec_corr / len(da_prec_orig_this_window['time'])
-        # Fill in those zero-orig-prec grid cells
-        const_prec_inf_scale = const_prec[ind_inf_scale[0], ind_inf_scale[1]]
-        prec_corr_this_window[:, ind_inf_scale[0], ind_inf_scale[1]] = const_prec_inf_scale
-        # --- Put in the final da --- #
-        da_prec_corrected.sel(time=slice(window_start_time, window_end_time))[:] = \
-                prec_corr_this_window
+    A = csr_matrix(xe.frontend.read_weights(weight_nc, n_source, n_target))
+    A.sum_duplicates()
 
-    return da_prec_corrected
+    return A
 
 
 def extract_mismatched_grid_weight_info(da_vic_domain, da_meas, weight_nc):
@@ -4311,43 +7399,32 @@ def extract_mismatched_grid_weight_info(da_vic_domain, da_meas, weight_nc):
     
     Return
     ----------
-    list_source_ind2D_weight_all: <list>
-        Length of the list: number of meas cells (n_target)
-        Each element: a list of ((2D-index), weight_target, weight_source)
-        of source cells that overlap with ONE target cell.
-        "weight_target" sums up to 1 for each TARGET grid cell;
-        "weight_source" sums up to 1 for each SOURCE grid cell in the domain
+    grid_weights: <class MismatchedGridWeights>
+        Sparse weights and per-target index table of source cells that
+        overlap with each target (meas) cell, with both "weight_target"
+        (sums up to 1 for each TARGET grid cell) and "weight_source"
+        (sums up to 1 for each SOURCE grid cell in the domain)
     
     Requires
     ----------
-    import xESMF as xe
-    find_source_ind2D_weight
+    read_weight_matrix
+    class MismatchedGridWeights
     '''
     
-    # --- Load weight array in xESMF format --- #
+    # --- Load weight matrix in xESMF format --- #
     n_source = len(da_vic_domain['lat']) * len(da_vic_domain['lon'])
     n_target = len(da_meas['lat']) * len(da_meas['lon'])
-    A = xe.frontend.read_weights(weight_nc, n_source, n_target)
-    weight_array = A.toarray()  # [n_target, n_source]
+    A = read_weight_matrix(weight_nc, n_source, n_target)  # [n_target, n_source]
     
-    # --- For each measurement grid cell, find 2D-index & weight of all contributing VIC cells
-    # each element: a list of ((2D-index), weight) of source cells
-    #               that overlap with ONE target cell
-    list_source_ind2D_weight_all = []
-    # Loop over each target (measurement) grid cell
-    for i in range(n_target):
-        # Find corresponding VIC cell
-        list_source_ind2D_weight = find_source_ind2D_weight(
-            ind_target_1D=i, weight_array=weight_array,
-            len_x_source=len(da_vic_domain['lon']))
-        list_source_ind2D_weight_all.append(list_source_ind2D_weight)
+    # --- For all measurement grid cells, build the index table of all
+    # contributing VIC cells --- #
+    grid_weights = MismatchedGridWeights(A, len_x_source=len(da_vic_domain['lon']))
     
-    return list_source_ind2D_weight_all
+    return grid_weights
 
 
 def calculate_gain_K_whole_field_mismatched_grid(da_x, da_y_est, R,
-                                                 list_source_ind2D_weight_all,
-                                                 weight_nc, da_meas):
+                                                 grid_weights):
     ''' This function calculates gain K over the whole field, when the measurement
     grid mismatches the VIC grid.
     
@@ -4363,88 +7440,158 @@ def calculate_gain_K_whole_field_mismatched_grid(da_x, da_y_est, R,
         Dimension: [lat, lon, m, N]
     R: <np.array> [lat, lon, m, m]
         Measurement error covariance matrix
-    list_source_ind2D_weight_all: <list>
+    grid_weights: <class MismatchedGridWeights>
         Typically returned by extract_mismatched_grid_weight_info().
-        list_source_ind2D_weight_all: <list>
-        Length of the list: number of meas cells (n_target)
-        Each element: a list of ((2D-index), weight) of source cells
-        that overlap with ONE target cell
-    weight_nc: <str>
-        Weight file, pre-calculated by xESMF and process_weight_file()
-    da_meas: <xr.DataArray>
-        Measurement data. Only used for extracting lat lon info.
     
     Returns
     ----------
-    list_K: <list>
-        A list of K for each meas grid cell
-        Each element of the list is a K matrix of dim [n_stacked, m]
-        (n_stacked can be different for each meas cell)
+    K_stacked: <np.array>
+        K of all meas grid cells, ragged-stacked in the order of the index
+        table of grid_weights: entries grid_weights.offsets[i]:offsets[i+1]
+        are the contributing VIC cells of meas cell i; i.e., K of meas cell i
+        (of dim [n_stacked, m] where n_stacked = n_contrib * n) is
+        K_stacked[offsets[i]:offsets[i+1]].reshape([-1, m])
+        Dim: [n_entries, n, m]
     y_est_remapped: <np.array>
         y_est remapped to the meas grid.
         Dim: [n_target, m, N]
+
+    Require
+    ----------
+    calculate_gain_K_batch
     '''
     
     # --- Extract some dimension info --- #
     # Total number of meas grid cells
-    n_target = len(list_source_ind2D_weight_all)
+    n_target = grid_weights.n_target
+    n_source = grid_weights.n_source
     # Ensemble size N
     N = len(da_x['N'])
+    n = len(da_x['n'])
+    m = len(da_y_est['m'])
 
     # --- For each meas grid cell, --- #
     # --- stack states for all contributing source cells together (x) --- #
-    # Notes: the first loop is over each meas grid cell;
-    # the second loop is over each contributing VIC cell to this meas cell;
-    # (item[0][0], item[0][1]) is the 2D-index of a source cell;
-    # Original da_x: [lat, lon, n, N]
-    # Each x_stacked in the list: [n_contrib_source_cells, n, N], then stack the first
-    # two dimensions to be [n_contrib_source_cells*n, N]
-    # Length of list: n_target
-    list_x_stacked = [
-        np.asarray(
-            [da_x.values[item[0][0], item[0][1], :, :]
-             for item in list_source_ind2D_weight_all[i]]).reshape([-1, N])
-        for i in range(n_target)]
+    # Gather states of all contributing source cells of all meas cells into
+    # one array, in the order of the index table
+    x_flat = da_x.transpose('lat', 'lon', 'n', 'N').values.reshape(
+        [n_source, n, N])
+    x_stacked = grid_weights.gather(x_flat)  # [n_entries, n, N]
     
     # --- Aggregate y_est to meas grid for the whole domain --- #
-    # remap_con needs lat lon to be the last two dims
-    da_y_est_rolled = da_y_est.transpose('m', 'N', 'lat', 'lon')
-    # Remap y_est
-    da_y_est_remapped_rolled, weight_array = remap_con(
-        reuse_weight=True, da_source=da_y_est_rolled,
-        final_weight_nc=weight_nc, da_target_domain=da_meas)
-    # Roll the y_est_remapped dimension back to original order
-    da_y_est_remapped = da_y_est_remapped_rolled.transpose('lat', 'lon', 'm', 'N')
-    # Flatten y_est_remapped into 1D index
-    y_est_remapped = da_y_est_remapped.values.reshape(
-        [-1, len(da_y_est_remapped['m']), len(da_y_est_remapped['N'])])  # [n_target, m, N]
-    
-    # --- Calculate gain K for each meas grid cell --- #
-    # A list of K for each meas grid cell
-    # Each element of the list is a K matrix of dim [n_stacked, m]
-    # (n_stacked can be different for each meas cell)
-    R_flat = R.reshape([n_target, 1, 1])
-    list_K = [calculate_gain_K(x=list_x_stacked[i], y_est=y_est_remapped[i, :, :], R=R_flat[i, :, :])
-              for i in range(n_target)]
-    
-    return list_K, y_est_remapped
-
-
-def update_states_mismatched_grid(y_est_remapped, list_K, da_meas, R, da_sm_to_update,
-                                  da_max_moist_n, list_source_ind2D_weight_all,
+    y_est_flat = da_y_est.transpose('m', 'N', 'lat', 'lon').values.reshape(
+        [m, N, n_source])
+    y_est_remapped = np.moveaxis(
+        grid_weights.remap(y_est_flat), 2, 0)  # [n_target, m, N]
+    
+    # --- Calculate gain K for all meas grid cells at once --- #
+    # Each row of K = Pxy * (Pyy+R)-1 only depends on that state and the
+    # y_est of its meas cell, so all entries are calculated in one batch
+    ind_target = grid_weights.target_ind1D  # [n_entries]
+    R_flat = R.reshape([n_target, m, m])
+    K_stacked = calculate_gain_K_batch(
+        x_stacked, y_est_remapped[ind_target], R_flat[ind_target])  # [n_entries, n, m]
+    
+    return K_stacked, y_est_remapped
+
+
+def update_soil_moisture_states_mismatched_grid_ensemble(
+        x, K_stacked, y_meas, y_est_remapped, v, max_moist, grid_weights,
+        adjust_negative=True, n_update=None):
+    ''' Updates soil moisture states of all VIC grid cells and all ensemble
+        members in one vectorized pass, when the measurement grid mismatches
+        the VIC grid. For each meas cell, delta = K * (y_meas + v - y_est) is
+        calculated for all its contributing VIC cells; delta is then
+        redistributed to VIC cells weighted by weight_source.
+        NOTE: x is updated in place
+
+    Parameters
+    ----------
+    x: <np.array>
+        Soil moisture states to update (in EnKF layout)
+        Dimension: [n_source, n, N] (where n_source = lat * lon of VIC grid)
+    K_stacked: <np.array>
+        Gain K, as returned by calculate_gain_K_whole_field_mismatched_grid()
+        Dimension: [n_entries, n, m]
+    y_meas: <np.array>
+        Measurements at current time
+        Dimension: [n_target, m]
+    y_est_remapped: <np.array>
+        Estimated measurement from before-updated states, remapped to the meas
+        grid
+        Dimension: [n_target, m, N]
+    v: <np.array>
+        Measurement perturbation
+        Dimension: [n_target, m, N]
+    max_moist: <np.array>
+        Maximum soil moisture for each tile [unit: mm]. Soil moistures above
+        maximum after update will be reset to maximum value.
+        Dimension: [n_source, n]
+    grid_weights: <class MismatchedGridWeights>
+        Typically returned by extract_mismatched_grid_weight_info().
+    adjust_negative: <bool>
+        Whether or not to adjust negative soil moistures after update
+        to zero.
+        Default: True (adjust negative to zero)
+    n_update: <int or None>
+        If not None, only update the first n_update states (e.g., to exclude
+        SM3 from update); the rest of the states are kept unchanged.
+        Default: None (update all states)
+
+    Returns
+    ----------
+    x: <np.array>
+        Updated soil moisture states (the same array as input x)
+        Dimension: [n_source, n, N]
+
+    Require
+    ----------
+    numpy
+    '''
+
+    # --- For each meas cell, calculate delta = K * (y_meas + v - y_est) --- #
+    # (for all contributing VIC cells of all meas cells at once)
+    ind_target = grid_weights.target_ind1D  # [n_entries]
+    innov = y_meas[:, :, np.newaxis] + v - y_est_remapped  # [n_target, m, N]
+    delta_stacked = np.einsum(
+        'ijl,ilk->ijk', K_stacked[:, :n_update, :],
+        innov[ind_target])  # [n_entries, n_update, N]
+    # If meas for a meas cell is NAN, update delta is zero (i.e., no update)
+    delta_stacked[np.isnan(y_meas[ind_target]).any(axis=1)] = 0
+
+    # --- Re-distribute delta to original VIC cells for the whole domain --- #
+    # Weighted-add delta to VIC cells (weight_source, adding up to 1 for
+    # each source cell)
+    delta = grid_weights.scatter(delta_stacked)  # [n_source, n_update, N]
+
+    # --- Update states - add delta to orig. states --- #
+    x_update = x[:, :n_update, :]  # view of x
+    x_update += delta
+
+    # --- Reset updated soil moistures to within [0, max] --- #
+    clip_soil_moisture_states(x_update, max_moist[:, :n_update],
+                              adjust_negative)
+
+    return x
+
+
+def update_states_mismatched_grid(y_est_remapped, K_stacked, da_meas, R, da_sm_to_update,
+                                  da_max_moist_n, grid_weights,
                                   adjust_negative=True, seed=None, no_sm3=False):
-    ''' This function updates soil moisture states over the whole field,
-    when the measurement grid mismatches the VIC grid.
+    ''' This function updates soil moisture states over the whole field
+    for a single ensemble member, when the measurement grid mismatches the
+    VIC grid.
     NOTE: this function assumes m = 1
     
     Parameters
     ----------
-    y_est_remapped: <xr.DataArray>
+    y_est_remapped: <np.array>
         Estimated measurement from pre-updated states (y = Hx);
         Dimension: [n_target, m], where n_target is the number of meas grid cells
-    list_K: <xr.DataArray>
+    K_stacked: <np.array>
         Gain K for the whole field
         Output from calculate_gain_K_whole_field_mismatched_grid()
+        Dimension: [n_entries, n, m]
     da_meas: <xr.DataArray> [lat, lon, m]
         Measurements at current time
     R: <np.array> [lat, lon, m, m]
@@ -4457,12 +7604,8 @@ def update_states_mismatched_grid(y_est_remapped, list_K, da_meas, R, da_sm_to_u
         [unit: mm]. Soil moistures above maximum after perturbation will
         be reset to maximum value.
         Dimension: [lat, lon, n]
-    list_source_ind2D_weight_all: <list>
+    grid_weights: <class MismatchedGridWeights>
         Typically returned by extract_mismatched_grid_weight_info().
-        list_source_ind2D_weight_all: <list>
-        Length of the list: number of meas cells (n_target)
-        Each element: a list of ((2D-index), weight) of source cells
-        that overlap with ONE target cell
     adjust_negative: <bool>
         Whether or not to adjust negative soil moistures after update
         to zero.
@@ -4491,104 +7634,44 @@ def update_states_mismatched_grid(y_est_remapped, list_K, da_meas, R, da_sm_to_u
     n_source = len(da_max_moist_n['lat']) * len(da_max_moist_n['lon'])
     n = len(da_max_moist_n['n'])
     
-    # --- For each meas cell, calculate delta = K * (y_meas + v - y_est) --- #
-    # Generate random measurement perturbation
-    R_flat = R.reshape([n_target])
-    if seed is None:
-        v = np.random.normal(
-                0, np.sqrt(R_flat), size=n_target).reshape([n_target, m, 1])  # [n_target, m, 1]
-    else:
-        rng = np.random.RandomState(seed)
-        v = rng.normal(
-                0, np.sqrt(R_flat), size=n_target).reshape([n_target, m, 1])  # [n_target, m, 1]
-    # Flatten the measurement data to 1D
-    meas_time_flat = da_meas.values.reshape(
-        [len(da_meas['lat'])*len(da_meas['lon']), m, 1])  # [n_target, m, 1]
-    # Calculate delta for the whole domain
-    # If there is some contributing cells, and meas for this cell is not NAN;
-    # Otherwise, update delta is zero (i.e., no update)
-    # Length of list_delta: n_target
-    # Each member of list_delta is of dim [n_stacked, 1]
-    list_delta = [np.dot(list_K[i],
-                         meas_time_flat[i, :, :] + v[i, :, :] - y_est_remapped[i, :])
-                  if (list_K[i].shape[0] > 0 and ~np.isnan(meas_time_flat[i].squeeze()))
-                  else np.zeros([list_K[i].shape[0], 1])
-                  for i in range(n_target)]
+    # --- Generate random measurement perturbation --- #
+    v = generate_meas_perturbation_ensemble(R, [seed])  # [n_target, m, 1]
     
-    # --- Re-distribute delta to original VIC cells for the whole domain --- #
-    # Initialize the VIC-cell-level delta. Dim: [n_source, n]
-    delta_vic_flat = np.zeros([n_source, n])
-    # Add up the actual delta according to weight
-    for i_target in range(n_target):
-        # Identify number of contributing cells
-        n_contrib = len(list_source_ind2D_weight_all[i_target])
-        # Unstack delta for each contributing VIC cell
-        delta_unstacked = list_delta[i_target].reshape([n_contrib, n])
-        # Loop over each contributing cell
-        for j in range(n_contrib):
-            # Identify contributing cell index and weight
-            ind_source_2D = list_source_ind2D_weight_all[i_target][j][0]
-            weight = list_source_ind2D_weight_all[i_target][j][2]  # this is weight_source,
-                                                                   # adding up to 1 for each source cell
-            # Weighted-add unstacked delta to the final delta
-            ind_source_1D = map_ind_2D_to_1D(ind_2D_lat=ind_source_2D[0],
-                                             ind_2D_lon=ind_source_2D[1],
-                                             len_x=len(da_max_moist_n['lon']))
-            delta_vic_flat[ind_source_1D, :] += delta_unstacked[j, :] * weight
-    # Reshape delta back to 2D VIC domain [lat, lon, n]
-    delta = delta_vic_flat.reshape([len(da_max_moist_n['lat']),
-                                        len(da_max_moist_n['lon']), n])
-    
-    # --- Add delta to original VIC states --- #
-    # Load before-update state file
+    # --- Update states --- #
     class_states = States(xr.Dataset({'STATE_SOIL_MOISTURE': da_sm_to_update}))
-    # Initiate DataArray for updated states
-    da_x_updated = class_states.da_EnKF.copy(deep=True)  # [lat, lon, n]
-    # Update states - add delta to orig. states
-    da_x_updated[:] += delta
-    
-    # --- Reset negative updated soil moistures to zero --- #
-    x_new = da_x_updated[:].values
-    if adjust_negative:
-        x_new[x_new<0] = 0
-
-    # --- Reset updated soil moistures above maximum to maximum --- #
-    max_moist = da_max_moist_n.values
-    x_new[(x_new>max_moist)] = max_moist[(x_new>max_moist)]
-
-    # --- Put into da --- #
-    da_x_updated[:] = x_new
+    x = update_soil_moisture_states_mismatched_grid_ensemble(
+            class_states.view.enkf(copy=True).reshape([n_source, n, 1]),
+            K_stacked,
+            da_meas.values.reshape([n_target, m]),
+            y_est_remapped.reshape([n_target, m, 1]), v,
+            da_max_moist_n.values.reshape([n_source, n]),
+            grid_weights, adjust_negative,
+            n_update=int(n/3*2) if no_sm3 is True else None)  # [n_source, n, 1]
+    da_x_updated = class_states.wrap_EnKFstates_sm(x)  # [lat, lon, n]
     
     # --- Save some diagnostic variables --- #
     da_update_increm = da_x_updated - class_states.da_EnKF
+    if no_sm3 is True:
+        da_update_increm[:, :, int(n/3*2):] = 0
     
     # --- Convert updated states to VIC states format --- #
     da_updated = class_states.convert_new_EnKFstates_sm_to_VICstates(
         da_x_updated)['STATE_SOIL_MOISTURE']
 
-    # --- If exclude SM3 from state vector, reset SM3 to before-update states --- #
-    if no_sm3 is True:
-        da_updated[:, :, 2, :, :] = \
-            class_states.ds['STATE_SOIL_MOISTURE'][:, :, 2, :, :]
-        n = len(da_update_increm['n'])
-        da_update_increm[:, :, int(n/3*2):] = 0
-
     return da_updated, da_update_increm
 
 
-def find_source_ind2D_weight(ind_target_1D, weight_array, len_x_source):
-    ''' Given a weight array in xESMF foramt ([n_target, n_source]), and the
-    1D index of ONE target grid cell, return the 2D index of all the corresponding
-    source grid cells.
+def find_source_ind2D_weight(ind_target_1D, grid_weights):
+    ''' Given the weight info of mismatched grids and the 1D index of ONE
+    target grid cell, return the 2D index of all the corresponding source
+    grid cells.
     
     Parameters
     ----------
     ind_target_1D: <int>
         Index of a target grid cell in the 1D flattened array. Index starts from 0.
-    weight_array: <np.array>
-        Weight array in xESMF format. Dimension: [n_target, n_source]
-    len_x_source: <int>
-        Length of x (lon) in the 2D domain of source.
+    grid_weights: <class MismatchedGridWeights>
+        Typically returned by extract_mismatched_grid_weight_info().
     
     Returns
     ----------
@@ -4602,20 +7685,16 @@ def find_source_ind2D_weight(ind_target_1D, weight_array, len_x_source):
     
     Requires
     ----------
-    map_coord_1D_to_2D
+    map_ind_1D_to_2D
     '''
 
-   
-    # Calculate weights normalized for each SOURCE grid cell instead
-    # (i.e., weights add up to one for each source grid cell)
-    weight_array_tmp = weight_array.copy()
-    weight_array_tmp[weight_array_tmp<0] = 0
-    weigth_source_norm = weight_array_tmp / weight_array_tmp.sum(axis=0)
- 
-    list_ind2D_weight_source = [(map_ind_1D_to_2D(ind, len_x_source),
-                                 weight_array[ind_target_1D, ind],
-                                 weigth_source_norm[ind_target_1D, ind])
-                                for ind in np.where(weight_array[ind_target_1D, :] > 0)[0]]
+    start = grid_weights.offsets[ind_target_1D]
+    end = grid_weights.offsets[ind_target_1D+1]
+    list_ind2D_weight_source = [
+        (map_ind_1D_to_2D(grid_weights.source_ind1D[k], grid_weights.len_x_source),
+         grid_weights.weight_target[k],
+         grid_weights.weight_source[k])
+        for k in range(start, end)]
     
     return list_ind2D_weight_source
 
@@ -4699,10 +7778,13 @@ def remap_con(reuse_weight, da_source, final_weight_nc, da_target_domain,
     ----------
     da_remapped: <xr.DataArray>
         Remapped data
+    weight_array: <scipy.sparse.csr_matrix>
+        Weight matrix. Dimension: [n_target, n_source]
 
     Requires
     ----------
     process_weight_file
+    read_weight_matrix
     import xesmf as xe
     '''
 
@@ -4741,11 +7823,10 @@ def remap_con(reuse_weight, da_source, final_weight_nc, da_target_domain,
     # Load final weights
     n_source = len(src_lons) * len(src_lats)
     n_target = len(target_lons) * len(target_lats)
-    A = xe.frontend.read_weights(final_weight_nc, n_source, n_target)
-    weight_array = A.toarray()  # [n_target, n_source]
+    weight_array = read_weight_matrix(final_weight_nc, n_source, n_target)  # [n_target, n_source]
     # Apply weights to remap
     array_remapped = xe.frontend.apply_weights(
-        A, da_source.values, len(target_lats), len(target_lons))
+        weight_array, da_source.values, len(target_lats), len(target_lons))
     # Track metadata
     varname = da_source.name
     extra_dims = da_source.dims[0:-2]
@@ -4757,7 +7838,8 @@ def remap_con(reuse_weight, da_source, final_weight_nc, da_target_domain,
         name=varname)
     # If weight for a target cell is negative, it means that the target cell
     # does not overlap with any valid source cell. Thus set the remapped value to NAN
-    nan_weights = (weight_array.sum(axis=1).reshape([len(target_lats), len(target_lons)]) < 0)
+    nan_weights = (np.asarray(weight_array.sum(axis=1)).reshape(
+        [len(target_lats), len(target_lons)]) < 0)
     data = da_remapped.values
     data[..., nan_weights] = np.nan
     da_remapped[:] = data
@@ -4786,21 +7868,21 @@ def edges_from_centers(centers):
     return edges
 
 
-def bias_correct_propagated_states(N, state_time, prop_before_bc_state_dir, no_sm3=False):
+def bias_correct_propagated_states(sm, no_sm3=False):
     ''' Bias-correct propagated states following Ryu et al. (2009); only
         bias-correct soil moistures of all layers (but not other state
-        variables)
+        variables). All ensemble members are bias-corrected in place in one
+        vectorized pass.
 
     Parameters
     ----------
-    N: <int>
-        Ensemble size
-    state_time: <pd.datetime>
-        State time. This is for identifying state file names.
-    prop_before_bc_state_dir: <str>
-        Directory of propagated state files for each ensemble member before
-        bias correction. State file names are "state.ens<i>.YYYYMMDD_SSSSS.nc",
-        where <i> is 1, 2, ..., N, or avg (for reference state)
+    sm: <np.array>
+        Propagated soil moisture states of all ensemble members before bias
+        correction, with the reference state as the last member (e.g., the
+        "sm" attribute of an EnsembleStateStore loaded from
+        list_ensemble_state_nc(..., bias_correct=True)). Bias-corrected in
+        place.
+        Dimension: [N+1, veg_class, snow_band, nlayer, lat, lon]
     no_sm3: <bool>
         Whether to EXCLUDE SM3 from kalman filter state vector
         (i.e., no perturbation, update or bias correction)
@@ -4808,52 +7890,31 @@ def bias_correct_propagated_states(N, state_time, prop_before_bc_state_dir, no_s
 
     Returns
     ----------
-    list_sm_bc_da: <list>
-        A list of bias-corrected soil moisture states, in the order of
-        ensemble members; also include the reference state. Each member of the
-        list is an xarray.DataArray for an ensemble member, in the structure
-        of VIC state file "STATE_SOIL_MOISTURE" variable.
-        Length: N + 1
+    sm: <np.array>
+        Bias-corrected soil moisture states of all ensemble members (the same
+        array as input sm); the reference state is unchanged
+        Dimension: [N+1, veg_class, snow_band, nlayer, lat, lon]
+    delta: <np.array>
+        Ensemble mean minus the reference state, which is subtracted from each
+        ensemble member
+        Dimension: [veg_class, snow_band, nlayer, lat, lon]
     '''
 
-    # --- Open reference state file --- #
-    ds_ref = xr.open_dataset(os.path.join(
-            prop_before_bc_state_dir,
-            'state.ensref.{}_{:05d}.nc'.format(
-                        state_time.strftime('%Y%m%d'),
-                        state_time.hour*3600+state_time.second)))
-    # --- Open ensemble state files --- #
-    list_ds = []
-    for i in range(N):
-        ds = xr.open_dataset(os.path.join(
-            prop_before_bc_state_dir,
-            'state.ens{}.{}_{:05d}.nc'.format(
-                        i+1,
-                        state_time.strftime('%Y%m%d'),
-                        state_time.hour*3600+state_time.second)))
-        list_ds.append(ds)
     # --- Calculate ensemble mean sm and delta --- #
-    list_da = []
-    for ds in list_ds:
-        list_da.append(ds['STATE_SOIL_MOISTURE'])
-    # Calculate ensemble mean sm and delta
-    da_mean = sum(list_da) / N
-    da_delta = da_mean - ds_ref['STATE_SOIL_MOISTURE']
+    N = sm.shape[0] - 1
+    ens = np.asarray(sm)[:N]  # view of the ensemble members
+    delta = ens.sum(axis=0) / N
+    delta -= sm[N]
 
-    # --- If exclude SM3 from state vector, reset da_delta to zero --- #
+    # --- If exclude SM3 from state vector, reset delta to zero --- #
     # !!! NOTE: THIS PART HAS NOT BEEN TESTED !!!
     if no_sm3 is True:
-        da_delta[:, :, 2, :, :] = 0
-        
-    # --- Bias-correct each ensemble state --- #
-    list_da_sm_bc = []
-    for i in range(N):
-        da = list_da[i]
-        da -= da_delta
-        list_da_sm_bc.append(da)
-    list_da_sm_bc.append(ds_ref['STATE_SOIL_MOISTURE'])
+        delta[:, :, 2, :, :] = 0
 
-    return list_da_sm_bc, da_delta
+    # --- Bias-correct all ensemble states --- #
+    ens -= delta
+
+    return sm, delta
 
 
 def load_propagated_states_sm(N, state_time, prop_state_dir):
@@ -4880,19 +7941,90 @@ def load_propagated_states_sm(N, state_time, prop_state_dir):
     '''
 
     list_sm_da = []
-    for i in range(N):
-        ds = xr.open_dataset(os.path.join(
-            prop_state_dir,
-            'state.ens{}.{}_{:05d}.nc'.format(
-                        i+1,
-                        state_time.strftime('%Y%m%d'),
-                        state_time.hour*3600+state_time.second)))
-        da = ds['STATE_SOIL_MOISTURE']
+    for state_nc in list_ensemble_state_nc(prop_state_dir, N, state_time=state_time):
+        with xr.open_dataset(state_nc) as ds:
+            da = ds['STATE_SOIL_MOISTURE'].load()
         list_sm_da.append(da)
 
     return list_sm_da
 
 
+def list_ensemble_state_nc(state_dir, N, bias_correct=False, state_time=None):
+    ''' Return paths of VIC state files of all ensemble members in a
+        directory.
+
+    Parameters
+    ----------
+    state_dir: <str>
+        Directory of state files
+    N: <int>
+        Ensemble size
+    bias_correct: <bool>
+        Whether to append the reference state file (for bias correction)
+        Default: False
+    state_time: <pd.datetime> or None
+        If not None, file names are "state.ens<i>.YYYYMMDD_SSSSS.nc" (VIC
+        output state files); otherwise, "state.ens<i>.nc".
+        <i> is 1, 2, ..., N, or ref (for reference state)
+        Default: None
+
+    Returns
+    ----------
+    list_state_nc: <list>
+        A list of state file paths, in the order of ensemble members
+        (reference state last, if bias_correct)
+    '''
+
+    ens = list(range(1, N+1))
+    if bias_correct:
+        ens.append('ref')
+    if state_time is None:
+        suffix = 'nc'
+    else:
+        suffix = '{}_{:05d}.nc'.format(state_time.strftime('%Y%m%d'),
+                                       state_time.hour*3600+state_time.second)
+    list_state_nc = [os.path.join(state_dir, 'state.ens{}.{}'.format(i, suffix))
+                     for i in ens]
+
+    return list_state_nc
+
+
+def list_ensemble_history_nc(history_dir, N, bias_correct, start_time):
+    ''' Return paths of VIC history files of all ensemble members of a
+        propagation period
+
+    Parameters
+    ----------
+    history_dir: <str>
+        Directory of history files
+    N: <int>
+        Ensemble size
+    bias_correct: <bool>
+        Whether to append the reference history file (for bias correction)
+    start_time: <pd.datetime>
+        Start time of the propagation period. File names are
+        "history.ens<i>.YYYY-MM-DD-SSSSS.nc", where <i> is 1, 2, ..., N,
+        or ref (for reference run)
+
+    Returns
+    ----------
+    list_history_nc: <list>
+        A list of history file paths, in the order of ensemble members
+        (reference run last, if bias_correct)
+    '''
+
+    ens = list(range(1, N+1))
+    if bias_correct:
+        ens.append('ref')
+    list_history_nc = [os.path.join(
+        history_dir, 'history.ens{}.{}-{:05d}.nc'.format(
+            i, start_time.strftime('%Y-%m-%d'),
+            start_time.hour*3600+start_time.second))
+        for i in ens]
+
+    return list_history_nc
+
+
 def save_updated_states_ensemble(N, state_dir_before_update,
                                  state_time, out_vic_state_dir,
                                  list_da_updated, bias_correct=False, nproc=1):
@@ -4924,60 +8056,35 @@ def save_updated_states_ensemble(N, state_dir_before_update,
     Require
     ----------
     numpy
+    EnsembleWorkerPool
     '''
 
-    # --- If nproc == 1, do a regular ensemble loop --- #
-    if nproc == 1:
-        if bias_correct:
-            n_ens = N + 1
-            ens = list(range(1, N+1)) + ['ref']
-        else:
-            n_ens = N
-            ens = list(range(1, N+1))
-        for i in range(n_ens):
-            # Set up parameters
-            state_nc_before_update = os.path.join(
-                    state_dir_before_update,
-                    'state.ens{}.{}_{:05d}.nc'.format(
-                            ens[i],
-                            state_time.strftime('%Y%m%d'),
-                            state_time.hour*3600+state_time.second))
-            out_vic_state_nc = os.path.join(out_vic_state_dir,
-                                            'state.ens{}.nc'.format(ens[i]))
-            # Replace updated soil moisture states and save to file
-            save_updated_states(state_nc_before_update,
-                                list_da_updated[i],
-                                out_vic_state_nc)
-    # --- If nproc > 1, use multiprocessing --- #
-    elif nproc > 1:
-        # --- Set up multiprocessing --- #
-        pool = mp.Pool(processes=nproc)
-        if bias_correct:
-            n_ens = N + 1
-            ens = list(range(1, N+1)) + ['ref']
-        else:
-            n_ens = N
-            ens = list(range(1, N+1))
-        for i in range(n_ens):
-            # Set up parameters
-            state_nc_before_update = os.path.join(
-                    state_dir_before_update,
-                    'state.ens{}.{}_{:05d}.nc'.format(
-                            ens[i],
-                            state_time.strftime('%Y%m%d'),
-                            state_time.hour*3600+state_time.second))
-            out_vic_state_nc = os.path.join(out_vic_state_dir,
-                                            'state.ens{}.nc'.format(ens[i]))
-            # Replace updated soil moisture states and save to file
-            pool.apply_async(save_updated_states,
-                             (state_nc_before_update,
-                              list_da_updated[i],
-                              out_vic_state_nc))
-        pool.close()
-        pool.join()
-
-
-def save_updated_states(state_nc_before_update, da_sm_updated, out_vic_state_nc):
+    if bias_correct:
+        ens = list(range(1, N+1)) + ['ref']
+    else:
+        ens = list(range(1, N+1))
+    list_args = []
+    for i in range(len(ens)):
+        # Set up parameters
+        state_nc_before_update = os.path.join(
+                state_dir_before_update,
+                'state.ens{}.{}_{:05d}.nc'.format(
+                        ens[i],
+                        state_time.strftime('%Y%m%d'),
+                        state_time.hour*3600+state_time.second))
+        out_vic_state_nc = os.path.join(out_vic_state_dir,
+                                        'state.ens{}.nc'.format(ens[i]))
+        list_args.append((state_nc_before_update, list_da_updated[i],
+                          out_vic_state_nc))
+
+    # --- Replace updated soil moisture states and save to file --- #
+    worker_pool = EnsembleWorkerPool(nproc)
+    worker_pool.map(save_updated_states, list_args)
+    worker_pool.close()
+
+
+def save_updated_states(state_nc_before_update, da_sm_updated, out_vic_state_nc,
+                        compress=True):
     ''' Replace soil moisture states from the before-update states with
         updated soil moistures and save to nc files, for a single file
 
@@ -4991,17 +8098,159 @@ def save_updated_states(state_nc_before_update, da_sm_updated, out_vic_state_nc)
         file STATE_SOIL_MOISTURE format.
     out_vic_state_nc: <str>
         Output state nc file path
+    compress: <bool>
+        Whether to compress the output file. Uncompressed writes are faster
+        and are meant for temporary state files that are only read by VIC.
+        Default: True
     '''
 
     # Replace updated soil moistures
-    ds = xr.open_dataset(state_nc_before_update)
+    with xr.open_dataset(state_nc_before_update) as ds:
+        ds = ds.load()
     ds['STATE_SOIL_MOISTURE'] = da_sm_updated
     # Save to netCDF file
-    to_netcdf_state_file_compress(ds, out_vic_state_nc)
+    if compress:
+        to_netcdf_state_file_compress(ds, out_vic_state_nc)
+    else:
+        ds.to_netcdf(out_vic_state_nc, format='NETCDF4')
+
+
+def load_states_time_stacked(list_state_nc, times, list_varnames):
+    ''' Load state variables from VIC state files of multiple time points into
+        one time-stacked dataset; each file is opened once and read into a
+        pre-allocated array
+
+    Parameters
+    ----------
+    list_state_nc: <list>
+        VIC state file paths, in the order of times
+    times: <pd.DatetimeIndex or list>
+        Time points of the state files
+    list_varnames: <list>
+        State variable names to load (e.g., 'STATE_SOIL_MOISTURE')
+
+    Returns
+    ----------
+    ds_states: <xr.Dataset>
+        Time-stacked state variables; dim: [time, <dims of the state variable>]
+    '''
+
+    # --- Allocate arrays using the first file as template --- #
+    with xr.open_dataset(list_state_nc[0]) as ds:
+        dict_da_template = {var: ds[var].load() for var in list_varnames}
+    dict_array = OrderedDict()
+    for var, da in dict_da_template.items():
+        dict_array[var] = np.empty((len(list_state_nc), ) + da.shape)
+
+    # --- Load each file --- #
+    for t, state_nc in enumerate(list_state_nc):
+        with xr.open_dataset(state_nc) as ds:
+            for var in list_varnames:
+                dict_array[var][t] = ds[var].values
+
+    # --- Put into a dataset --- #
+    ds_states = xr.Dataset()
+    for var, da in dict_da_template.items():
+        coords = OrderedDict([('time', pd.to_datetime(times))])
+        coords.update(da.coords)
+        ds_states[var] = xr.DataArray(dict_array[var], coords=coords,
+                                      dims=('time', ) + da.dims, attrs=da.attrs)
+
+    return ds_states
+
+
+def rescale_sm_states_by_moments(sm, tile_frac, ref_mean, ref_std, max_moist):
+    ''' Rescale tile soil moisture states at all time points at once, so that
+        the grid-cell-mean soil moisture has the reference mean and standard
+        deviation (over time) of each layer and grid cell:
+            sm_rescaled_cell = (sm_cell - mean_cell) * (ref_std / std_cell) + ref_mean
+            sm_rescaled_tile = (sm_tile - sm_cell) + sm_rescaled_cell
+        Rescaled negative soil moistures are reset to zero and above-maximum
+        ones to maximum. The output is the only full-size array allocated.
+
+    Parameters
+    ----------
+    sm: <np.array>
+        Tile soil moisture states
+        Dim: [time, veg_class, snow_band, nlayer, lat, lon]
+    tile_frac: <np.array>
+        Tile fraction
+        Dim: [veg_class, snow_band, lat, lon]
+    ref_mean: <np.array>
+        Reference mean of grid-cell soil moisture
+        Dim: [nlayer, lat, lon]
+    ref_std: <np.array>
+        Reference standard deviation of grid-cell soil moisture
+        Dim: [nlayer, lat, lon]
+    max_moist: <np.array>
+        Maximum soil moisture
+        Dim: [nlayer, lat, lon]
+
+    Returns
+    ----------
+    sm_rescaled: <np.array>
+        Rescaled tile soil moisture states
+        Dim: [time, veg_class, snow_band, nlayer, lat, lon]
+    '''
+
+    # --- Grid-cell-mean soil moisture and its statistics --- #
+    # (one time point at a time, to avoid a full-size temporary)
+    tile_frac_layer = tile_frac[:, :, np.newaxis, :, :]
+    sm_cell = np.empty((sm.shape[0], ) + sm.shape[3:])  # [time, nlayer, lat, lon]
+    for t in range(sm.shape[0]):
+        sm_cell[t] = np.nansum(sm[t] * tile_frac_layer, axis=(0, 1))
+    sm_cell_mean = np.nanmean(sm_cell, axis=0)  # [nlayer, lat, lon]
+    sm_cell_std = np.nanstd(sm_cell, axis=0)  # [nlayer, lat, lon]
+
+    # --- Rescale grid-cell mean, then each tile --- #
+    sm_rescaled_cell = (sm_cell - sm_cell_mean) * (ref_std / sm_cell_std) + \
+                       ref_mean  # [time, nlayer, lat, lon]
+    sm_rescaled = sm + (sm_rescaled_cell - sm_cell)[:, np.newaxis, np.newaxis]
+
+    # --- Reset negative and above-maximum soil moistures (in place) --- #
+    sm_rescaled[sm_rescaled < 0] = 0
+    np.copyto(sm_rescaled, np.broadcast_to(max_moist, sm_rescaled.shape),
+              where=(sm_rescaled > max_moist))
+
+    return sm_rescaled
+
+
+def save_store_member_states(state_nc_template, store_filename, i,
+                             out_vic_state_nc, compress=True):
+    ''' Save soil moisture states of one ensemble member in an
+        EnsembleStateStore file to a VIC state file (for worker processes)
+
+    Parameters
+    ----------
+    state_nc_template: <str>
+        Path for state nc file to extract state variables other than soil
+        moisture from
+    store_filename: <str>
+        Backing .npy file of an EnsembleStateStore
+    i: <int>
+        Ensemble member index (starting from 0)
+    out_vic_state_nc: <str>
+        Output state nc file path
+    compress: <bool>
+        Whether to compress the output file.
+        Default: True
+
+    Require
+    ----------
+    save_updated_states
+    '''
+
+    with xr.open_dataset(state_nc_template) as ds:
+        da_template = ds['STATE_SOIL_MOISTURE']
+        da_sm = xr.DataArray(np.array(np.load(store_filename, mmap_mode='r')[i]),
+                             coords=da_template.coords, dims=da_template.dims,
+                             attrs=da_template.attrs)
+    save_updated_states(state_nc_template, da_sm, out_vic_state_nc, compress)
 
 
 def cleanup_updated_states_ensemble(
-        N, state_dir_to_cleanup, da_tile_frac, bias_correct=False, nproc=1):
+        N, state_dir_to_cleanup, da_tile_frac, bias_correct=False, nproc=1,
+        pool=None):
     ''' Clean up updated states ensemble: calculate and save cellAvg SM and SWE states only,
         and delete the original full state files
 
@@ -5020,43 +8269,34 @@ def cleanup_updated_states_ensemble(
     nproc: <int>
         Number of processors to use for parallel ensemble
         Default: 1
+    pool: <class EnsembleWorkerPool> or None
+        Worker pool to use; if None, a pool of nproc processors is created
+        for this call only.
+        Default: None
 
     Require
     ----------
     numpy
+    EnsembleWorkerPool
     '''
 
-    # --- If nproc == 1, do a regular ensemble loop --- #
-    if nproc == 1:
-        if bias_correct:
-            n_ens = N + 1
-            ens = list(range(1, N+1)) + ['ref']
-        else:
-            n_ens = N
-            ens = list(range(1, N+1))
-        for i in range(n_ens):
-            updated_state_nc = os.path.join(state_dir_to_cleanup, 'state.ens{}.nc'.format(ens[i]))
-            out_cellAvg_state_nc = os.path.join(state_dir_to_cleanup, 'state_cellAvg.ens{}.nc'.format(ens[i]))
-            cleanup_updated_states(updated_state_nc, out_cellAvg_state_nc, da_tile_frac)
-    # --- If nproc > 1, use multiprocessing --- #
-    elif nproc > 1:
-        # --- Set up multiprocessing --- #
-        pool = mp.Pool(processes=nproc)
-        if bias_correct:
-            n_ens = N + 1
-            ens = list(range(1, N+1)) + ['ref']
-        else:
-            n_ens = N
-            ens = list(range(1, N+1))
-        for i in range(n_ens):
-            updated_state_nc = os.path.join(state_dir_to_cleanup, 'state.ens{}.nc'.format(ens[i]))
-            out_cellAvg_state_nc = os.path.join(state_dir_to_cleanup, 'state_cellAvg.ens{}.nc'.format(ens[i]))
-            pool.apply_async(cleanup_updated_states,
-                             (updated_state_nc,
-                              out_cellAvg_state_nc,
-                              da_tile_frac))
-        pool.close()
-        pool.join()
+    if bias_correct:
+        ens = list(range(1, N+1)) + ['ref']
+    else:
+        ens = list(range(1, N+1))
+    list_args = []
+    for i in range(len(ens)):
+        updated_state_nc = os.path.join(state_dir_to_cleanup, 'state.ens{}.nc'.format(ens[i]))
+        out_cellAvg_state_nc = os.path.join(state_dir_to_cleanup, 'state_cellAvg.ens{}.nc'.format(ens[i]))
+        list_args.append((updated_state_nc, out_cellAvg_state_nc, da_tile_frac))
+
+    # --- Calculate cellAvg states (errors of any member are raised here) --- #
+    if pool is None:
+        worker_pool = EnsembleWorkerPool(nproc)
+        worker_pool.map(cleanup_updated_states, list_args)
+        worker_pool.close()
+    else:
+        pool.map(cleanup_updated_states, list_args)
 
 
 def cleanup_updated_states(updated_state_nc, out_cellAvg_state_nc, da_tile_frac):
@@ -5160,43 +8400,39 @@ def regrid_spatial_prec(weight_nc, da_prec_orig, da_prec_corrected, da_mask):
     da_scale_factor = da_prec_corrected / da_prec_orig_remapped  # [time, lat, lon]
 
     # --- (2) Rescale --- #
+    # Map each source cell to its SMAP grid cell (-1 for source cells not
+    # covered by any SMAP grid cell)
+    n_target = len(da_prec_corrected['lat']) * len(da_prec_corrected['lon'])
+    n_source = len(da_prec_orig['lat']) * len(da_prec_orig['lon'])
+    weight_coo = weight_array.tocoo()
+    ind_positive = np.where(weight_coo.data > 0)[0]
+    ind_positive = ind_positive[np.argsort(weight_coo.row[ind_positive],
+                                           kind='stable')]
+    target_of_source = np.full(n_source, -1, dtype=int)
+    target_of_source[weight_coo.col[ind_positive]] = weight_coo.row[ind_positive]
+    ind_source = np.where(target_of_source >= 0)[0]
+    # Extract scale factor and corrected prec of the SMAP grid cell of each
+    # source cell
+    ntime = len(da_prec_orig['time'])
+    scale_factor = da_scale_factor.loc[
+        :, da_prec_corrected['lat'].values, da_prec_corrected['lon'].values]\
+        .values.reshape([ntime, n_target])[:, target_of_source[ind_source]]
+    prec_corrected_smap = da_prec_corrected.values.reshape(
+        [ntime, n_target])[:, target_of_source[ind_source]]
+    # Rescale original, finer-resolution precip; where scale_factor == np.inf or
+    # scale == np.nan (which indicates orig. prec are all zero for this SMAP
+    # pixel and this time; np.inf indicates non-zero numerator while np.nan
+    # indicates zero numerator; np.nan at inactive grid cells as well), fill in
+    # with constant corrected prec from SMART
+    prec_corrected_regridded = da_prec_orig.values.reshape(
+        [ntime, n_source]).astype(float)
+    prec_corrected_regridded[:, ind_source] = np.where(
+        np.isfinite(scale_factor),
+        prec_corrected_regridded[:, ind_source] * scale_factor,
+        prec_corrected_smap)
     da_prec_corrected_regridded = da_prec_orig.copy(deep=True)
-    # Loop over each SMAP grid cell
-    for i, lat in enumerate(da_prec_corrected['lat'].values):
-        for j, lon in enumerate(da_prec_corrected['lon'].values):#
-            # --- Find all underlying source cells --- #
-            ind1D_smap = map_ind_2D_to_1D(i, j, len(da_prec_corrected['lon']))
-            ind1D_source_cells = np.where(weight_array[ind1D_smap, :]>0)[0]
-            list_ind2D_source = [map_ind_1D_to_2D(ind1D, len(da_prec_orig['lon']))
-                                 for ind1D in ind1D_source_cells]  #[(lat_ind, lon_ind)]
-            list_latlon_source = [(da_prec_orig['lat'].values[ind2D[0]],
-                                   da_prec_orig['lon'].values[ind2D[1]])
-                                  for ind2D in list_ind2D_source]  # [(lat, lon)]
-            # --- Rescale --- #
-            # 1) Extract original precipitation from all underlying source cells
-            prec_orig_all_sources = np.asarray(
-                [da_prec_orig[:, ind2D[0], ind2D[1]].values
-                 for ind2D in list_ind2D_source])  # [n_source, time]
-            # 2) Extract scale factor for this SMAP pixel for all timesteps
-            scale_factor = da_scale_factor.loc[:, lat, lon].values  # [time]
-            # Rescale original, finer-resolution precip
-            prec_corrected_all_sources = \
-                scale_factor * prec_orig_all_sources  # [n_source, time]
-            # 3) For timesteps where scale_factor == np.inf or scale == np.nan
-            # (which indicates orig. prec are all zero for this SMAP pixel and this
-            # time; np.inf indicates non-zero numerator while np.nan indicates
-            # zero numerator; np.nan at inactive grid cells as well), fill in with
-            # constant corrected prec from SMART
-            # Temporal indices of such scale_factor
-            ind_inf_scale = np.where(np.isinf(scale_factor) + np.isnan(scale_factor))[0]
-            # Constant corrected precip to fill in
-            prec_corrected_to_fill = da_prec_corrected.loc[:, lat, lon].values[ind_inf_scale]
-            # Fill in
-            prec_corrected_all_sources[:, ind_inf_scale] = prec_corrected_to_fill
-            # 4) Put into the final da
-            for k, ind2D in enumerate(list_ind2D_source):
-                da_prec_corrected_regridded[:, ind2D[0], ind2D[1]] = \
-                    prec_corrected_all_sources[k, :]
+    da_prec_corrected_regridded[:] = prec_corrected_regridded.reshape(
+        da_prec_orig.shape)
 
     # --- (3) Finally, use orig prec to fill in all nan's --- #
     prec_corrected_regridded = da_prec_corrected_regridded.values
@@ -5234,15 +8470,19 @@ def process_weight_file(orig_weight_nc, output_weight_nc, n_source, n_target,
         the weight file). Can be extended to have the option of, e.g., setting a threshold
         for whether to remap for a target cell or not if the coverage is low
 
+    Returns
+    ----------
+    weight_array: <scipy.sparse.csr_matrix>
+        Processed weight matrix. Dimension: [n_target, n_source]
+
     Requres
     ----------
     from scipy.sparse import coo_matrix
-    import xesmf as xe
+    read_weight_matrix
     '''
 
     # --- Read in the original xESMF weight file --- #
-    A = xe.frontend.read_weights(orig_weight_nc, n_source, n_target)
-    weight_array = A.toarray()  # [n_target, n_source]
+    weight_array = read_weight_matrix(orig_weight_nc, n_source, n_target)  # [n_target, n_source]
 
     # --- For grid cells in the source domain that is inactive, assign weight 0 --- #
     # --- (xESMF always assumes full rectangular domain and does not consider domain shape) --- #
@@ -5252,28 +8492,43 @@ def process_weight_file(orig_weight_nc, output_weight_nc, n_source, n_target,
     source_domain_flat = da_source_domain.values.reshape([N_source_lat * N_source_lon])
     # Set weights for the masked source domain as zero
     masked_flag_flat = (source_domain_flat > -10e-15) & (source_domain_flat < 10e-15)
-    weight_array[:, masked_flag_flat] = 0
+    weight_array.data[masked_flag_flat[weight_array.indices]] = 0
+    weight_array.eliminate_zeros()
 
     # --- Adjust weights for target grid cells whose sum < 1 --- #
-    # Loop over each target grid cell
-    for i in range(n_target):
-        sum_weight = weight_array[i, :].sum()
-        # If sum of weight is 0, there is no active source cell in the target cell.
-        # Set all weights for this target cell to -1
-        if sum_weight > -10e-14 and sum_weight < 10e-14:
-            weight_array[i, :] = -1
-        # Otherwise, the sum of weight should really be 1. If the sum < 1, rescale to 1
-        elif sum_weight < (1 - 10e-10):
-            weight_array[i, :] /= sum_weight
-        elif sum_weight > (1 + 10e-10):
-            print(sum_weight)
-            raise ValueError('Error: xESMF weight sum exceeds 1. Something is wrong!')
+    sum_weight = np.asarray(weight_array.sum(axis=1)).ravel()  # [n_target]
+    if (sum_weight > (1 + 10e-10)).any():
+        print(sum_weight[sum_weight > (1 + 10e-10)])
+        raise ValueError('Error: xESMF weight sum exceeds 1. Something is wrong!')
+    # If sum of weight is 0, there is no active source cell in the target cell
+    empty_flag = (sum_weight > -10e-14) & (sum_weight < 10e-14)
+    # Otherwise, if the sum < 1, rescale to 1 (the sum of weight should really be 1)
+    scale = np.ones(n_target)
+    rescale_flag = (sum_weight < (1 - 10e-10)) & ~empty_flag
+    scale[rescale_flag] = 1 / sum_weight[rescale_flag]
+    weight_array = weight_array.multiply(scale[:, np.newaxis]).tocsr()
+    # Set all weights for target cells with no active source cell to -1
+    empty_targets = np.where(empty_flag)[0]
+    if len(empty_targets) > 0:
+        weight_array = weight_array.tocoo()
+        keep = ~np.isin(weight_array.row, empty_targets)
+        row = np.concatenate([weight_array.row[keep],
+                              np.repeat(empty_targets, n_source)])
+        col = np.concatenate([weight_array.col[keep],
+                              np.tile(np.arange(n_source), len(empty_targets))])
+        data = np.concatenate([weight_array.data[keep],
+                               -np.ones(len(empty_targets) * n_source)])
+        weight_array = coo_matrix((data, (row, col)),
+                                  shape=[n_target, n_source]).tocsr()
+    weight_array.eliminate_zeros()
+    weight_array.sort_indices()
 
     # --- Write new weights to file --- #
-    data = weight_array[weight_array!=0]
-    ind = np.where(weight_array!=0)
-    row = ind[0] + 1  # adjust index to start from 1
-    col = ind[1] + 1
+    # (in row-major order; index adjusted to start from 1)
+    weight_coo = weight_array.tocoo()
+    data = weight_coo.data
+    row = weight_coo.row + 1
+    col = weight_coo.col + 1
     ds_weight_corrected = xr.Dataset({'S': (['n_s'],  data),
                                       'col': (['n_s'],  col),
                                       'row': (['n_s'],  row)},
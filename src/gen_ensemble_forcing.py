@@ -1,13 +1,12 @@
 
-''' This script perturbs original forcing and generate and one ensemble member
+''' This script perturbs original forcing and generate one ensemble member,
+    or a range of ensemble members together
 
     Usage:
-        $ python gen_ensemble_forcing.py <config_file> <ens>
+        $ python gen_ensemble_forcing.py <config_file> <ens> [<ens_end> <nproc>]
 '''
 
 import sys
-import numpy as np
-import xarray as xr
 import os
 import pandas as pd
 from collections import OrderedDict
@@ -17,7 +16,7 @@ import matplotlib.pyplot as plt
 
 from tonic.models.vic.vic import VIC
 from tonic.io import read_config, read_configobj
-from da_utils import Forcings, perturb_forcings
+from da_utils import generate_ensemble_forcings
 
 
 # ============================================================ #
@@ -29,14 +28,23 @@ cfg = read_configobj(sys.argv[1])
 # Ensemble member index; must be an integer
 ens = int(sys.argv[2])
 
+# Optional: the last ensemble member index (all members from <ens> to
+# <ens_end> are generated together), and number of processors to use
+if len(sys.argv) > 3:
+    ens_end = int(sys.argv[3])
+    nproc = int(sys.argv[4])
+else:
+    ens_end = ens
+    nproc = 1
+
 
 # ============================================================ #
-# Set random generation seed
+# Random generation seed
 # Here the seed is modified from the base seed specified in the
 # cfg file by the ensemble index, so that each ensemble member
 # will have a different random seed realization
 # ============================================================ #
-np.random.seed(cfg['CONTROL']['seed'] + ens)
+base_seed = cfg['CONTROL']['seed']
 
 
 # ============================================================ #
@@ -57,24 +65,21 @@ output_basedir = os.path.join(cfg['CONTROL']['root_dir'],
 dict_varnames = {}
 dict_varnames['PREC'] = cfg['FORCING']['PREC']
 
-# --- Perturb forcings to generate ensemble (the whole time series is --- #
-# --- perturbed together to allow temporal autocorrelation as a whole --- #
-# Load in original forcings for all years
+# --- Perturb forcings to generate ensemble (one year at a time; the --- #
+# --- temporal autocorrelation continues across years) --- #
 start_year = start_time.year
 end_year = end_time.year
 
-list_ds = []
-for year in range(start_year, end_year+1):
-    ds = xr.open_dataset('{}{}.nc'.format(orig_forcing_basedir, year))
-    list_ds.append(ds)
-ds_all_years = xr.concat(list_ds, 'time')
-
-# Perturb and generate forcing ensemble
-class_forcings_orig = Forcings(ds_all_years)
-perturb_forcings(ens, orig_forcing=class_forcings_orig,
-                 dict_varnames=dict_varnames,
-                 prec_std=cfg['FORCING']['prec_std'],
-                 prec_phi=cfg['FORCING']['phi'],
-                 out_forcing_basedir=output_basedir)
+generate_ensemble_forcings(
+    list(range(ens, ens_end+1)),
+    orig_forcing_basepath=orig_forcing_basedir,
+    start_year=start_year,
+    end_year=end_year,
+    dict_varnames=dict_varnames,
+    prec_std=cfg['FORCING']['prec_std'],
+    prec_phi=cfg['FORCING']['phi'],
+    out_forcing_basedir=output_basedir,
+    base_seed=base_seed,
+    nproc=nproc)
 
 
@@ -28,7 +28,7 @@ from da_utils import (Forcings, setup_output_dirs, propagate,
                       concat_clean_up_history_file,
                       calculate_scale_n_whole_field,
                       calculate_cholesky_L, to_netcdf_state_file_compress,
-                      determine_tile_frac)
+                      ObservationOperator, load_states_time_stacked)
 
 # =========================================================== #
 # Load command line arguments
@@ -297,10 +297,6 @@ for t in range(len(meas_times)):
                                            'history.{}-{:05d}.nc'.format(
                                                 current_time.strftime('%Y-%m-%d'),
                                                 current_time.hour*3600+current_time.second)))
-    ds = xr.open_dataset(os.path.join(truth_subdirs['history'],
-                                           'history.{}-{:05d}.nc'.format(
-                                                current_time.strftime('%Y-%m-%d'),
-                                                current_time.hour*3600+current_time.second)))
 
 # (3) Concatenate all history files
 hist_concat_nc = os.path.join(truth_subdirs['history'],
@@ -320,29 +316,20 @@ concat_clean_up_history_file(list_history_paths,
 
 print('Simulating synthetic measurements...')
 
-# --- Load "truth" states at measurement times --- #
+# --- Load "truth" states at measurement times (time-stacked) --- #
 print('\tLoading truth states...')
-list_da_state = []
-list_da_swe = []
-for t in meas_times:
-    truth_state_nc = os.path.join(
-        truth_subdirs['states'],
-        'perturbed.state.{}_{:05d}.nc'.format(
-            t.strftime('%Y%m%d'),
-            t.hour*3600+t.second))
-    da_state = xr.open_dataset(truth_state_nc)['STATE_SOIL_MOISTURE']
-    da_swe = xr.open_dataset(truth_state_nc)['STATE_SNOW_WATER_EQUIVALENT']
-    list_da_state.append(da_state)
-    list_da_swe.append(da_swe)
-# Concatenate states of all time together
-da_truth_state_all_times = xr.concat(list_da_state, dim='time')
-da_truth_state_all_times['time'] = meas_times
-da_truth_swe_all_times = xr.concat(list_da_swe, dim='time')
-da_truth_swe_all_times['time'] = meas_times
-# Save concatenated truth states to netCDF file
-ds_truth_state_all_times = xr.Dataset(
-    {'STATE_SOIL_MOISTURE': da_truth_state_all_times,
-     'STATE_SNOW_WATER_EQUIVALENT': da_truth_swe_all_times})
+list_truth_state_nc = [
+    os.path.join(truth_subdirs['states'],
+                 'perturbed.state.{}_{:05d}.nc'.format(
+                    t.strftime('%Y%m%d'),
+                    t.hour*3600+t.second))
+    for t in meas_times]
+ds_truth_state_all_times = load_states_time_stacked(
+    list_truth_state_nc, meas_times,
+    ['STATE_SOIL_MOISTURE', 'STATE_SNOW_WATER_EQUIVALENT'])
+da_truth_state_all_times = ds_truth_state_all_times['STATE_SOIL_MOISTURE']
+da_truth_swe_all_times = ds_truth_state_all_times['STATE_SNOW_WATER_EQUIVALENT']
+# Save time-stacked truth states to netCDF file
 out_nc = os.path.join(
         truth_subdirs['states'],
         'truth_state.{}_{}.nc'.format(meas_times[0].strftime('%Y%m%d'),
@@ -350,11 +337,11 @@ out_nc = os.path.join(
 to_netcdf_state_file_compress(
     ds_truth_state_all_times, out_nc)
 # Calculate and save cell-average states to netCDF file
-da_tile_frac = determine_tile_frac(global_template)
-da_state_cellAvg = (da_truth_state_all_times * da_tile_frac).sum(
-    dim='veg_class').sum(dim='snow_band')  # [time, nlayer, lat, lon]
-da_swe_cellAvg = (da_truth_swe_all_times * da_tile_frac).sum(
-    dim='veg_class').sum(dim='snow_band')  # [time, lat, lon]
+obs_operator = ObservationOperator.from_global(global_template)
+da_state_cellAvg = obs_operator.cell_average(
+    da_truth_state_all_times)  # [time, nlayer, lat, lon]
+da_swe_cellAvg = obs_operator.cell_average(
+    da_truth_swe_all_times)  # [time, lat, lon]
 ds_state_cellAvg = xr.Dataset({'SOIL_MOISTURE': da_state_cellAvg,
                                'SWE': da_swe_cellAvg})
 out_nc = os.path.join(
@@ -7,7 +7,7 @@
         2) the timesteps after the last complete window
 
     Usage:
-        $ python postprocess_SMART.py <config_file_SMART>
+        $ python postprocess_SMART.py <config_file_SMART> nproc
 '''
 
 import numpy as np
@@ -15,21 +15,19 @@ import sys
 import pandas as pd
 import os
 import xarray as xr
-from scipy.io import loadmat
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from bokeh.plotting import figure, output_file, save
 from bokeh.io import reset_output
 import bokeh
-import multiprocessing as mp
 
 from tonic.io import read_configobj
 
 from da_utils import (load_nc_and_concat_var_years, setup_output_dirs,
-                      da_2D_to_3D_from_SMART, da_3D_to_2D_for_SMART,
-                      correct_prec_from_SMART, rmse, to_netcdf_forcing_file_compress,
-                      rescale_and_save_SMART_prec, save_SMART_prec)
+                      da_2D_to_3D_from_SMART, to_netcdf_forcing_file_compress,
+                      load_SMART_output_prec, prepare_SMART_prec_orig_cache,
+                      postprocess_SMART_member, EnsembleWorkerPool)
 
 
 # ============================================================ #
@@ -64,50 +62,14 @@ da_prec_orig = load_nc_and_concat_var_years(
                     dict_vars={'prec_orig': cfg['PREC']['prec_orig_varname']})\
                   ['prec_orig'].sel(time=slice(start_time, end_time))
 
-# --- Load corrected window-averaged prec --- #
-run_SMART_outfile = os.path.join(cfg['CONTROL']['root_dir'],
-                                 cfg['OUTPUT']['output_basedir'],
-                                 'run_SMART',
-                                 'SMART_corrected_rainfall.mat')
-run_SMART_prec_corr = loadmat(run_SMART_outfile)['RAIN_SMART_SMOS']  # [nwindow, npixel]
-
-# --- Load corrected window-averaged prec ensemble (if ensemble SMART) --- #
 filter_flag = cfg['SMART_RUN']['filter_flag']
-if filter_flag == 2 or filter_flag == 6:
-    list_run_SMART_prec_corr_ens = []
-    for i in range(cfg['SMART_RUN']['NUMEN']):
-        run_SMART_ens_outfile = os.path.join(
-            cfg['CONTROL']['root_dir'],
-            cfg['OUTPUT']['output_basedir'],
-            'run_SMART',
-            'SMART_corrected_rainfall.ens{}.mat'.format(i+1))
-        run_SMART_prec_corr_ens = loadmat(
-            run_SMART_ens_outfile)['RAIN_CORRECTED']['ens{}'.format(i+1)][0][0].squeeze()  # [nwindow, npixel]
-        # If npixel = 1, Matlab automatically squeezes that dimension. Here we readd this dimension
-        if len(run_SMART_prec_corr_ens.shape) == 1:
-            run_SMART_prec_corr_ens = run_SMART_prec_corr_ens.reshape(
-                [run_SMART_prec_corr_ens.shape[0], 1])
-        # Put in list
-        list_run_SMART_prec_corr_ens.append(run_SMART_prec_corr_ens)
+run_SMART_dir = os.path.join(cfg['CONTROL']['root_dir'],
+                             cfg['OUTPUT']['output_basedir'],
+                             'run_SMART')
+# --- Load corrected window-averaged prec --- #
+# (ensemble members are loaded one at a time when they are processed)
+run_SMART_prec_corr = load_SMART_output_prec(run_SMART_dir, 'corrected')  # [nwindow, npixel]
 
-# --- Load perturbed prec ensemble (if ensemble SMART) at original timestep --- #
-filter_flag = cfg['SMART_RUN']['filter_flag']
-if filter_flag == 2 or filter_flag == 6:
-    list_run_SMART_prec_pert_ens = []
-    for i in range(cfg['SMART_RUN']['NUMEN']):
-        perturbed_rainfall_ens_outfile = os.path.join(
-            cfg['CONTROL']['root_dir'],
-            cfg['OUTPUT']['output_basedir'],
-            'run_SMART',
-            'SMART_perturbed_rainfall.ens{}.mat'.format(i+1))
-        perturbed_rainfall_ens = loadmat(
-            perturbed_rainfall_ens_outfile)['RAIN_PERTURBED']['ens{}'.format(i+1)][0][0].squeeze()  # [nwindow, npixel]
-        # If npixel = 1, Matlab automatically squeezes that dimension. Here we readd this dimension
-        if len(perturbed_rainfall_ens.shape) == 1:
-            perturbed_rainfall_ens = perturbed_rainfall_ens.reshape(
-                [perturbed_rainfall_ens.shape[0], 1])
-        # Put in list
-        list_run_SMART_prec_pert_ens.append(run_SMART_prec_corr_ens)
 # Load in domain file
 ds_domain = xr.open_dataset(os.path.join(cfg['CONTROL']['root_dir'],
                                          cfg['DOMAIN']['domain_file']))
@@ -127,16 +89,6 @@ da_prec_corr_window = da_2D_to_3D_from_SMART(
                             da_mask=da_mask,
                             out_time_varname='window',
                             out_time_coord=range(nwindow))['prec_corr_window']
-# Process SMART prec ensemble
-if filter_flag == 2 or filter_flag == 6:
-    dict_prec_SMART_window_ens = {}
-    for i in range(cfg['SMART_RUN']['NUMEN']):
-        dict_prec_SMART_window_ens[i+1] = list_run_SMART_prec_corr_ens[i]
-    dict_da_prec_corr_window_ens = da_2D_to_3D_from_SMART(
-            dict_array_2D=dict_prec_SMART_window_ens,
-            da_mask=da_mask,
-            out_time_varname='window',
-            out_time_coord=range(nwindow))
 
 # --- Save window-averaged SMART-corrected prec --- #
 # Set up output subdir
@@ -152,118 +104,54 @@ to_netcdf_forcing_file_compress(
 
 
 # ============================================================ #
-# Save perturbed prec ensemble
-# ============================================================ #
-print('Saving perturbed precip ensemble...')
-# --- Precess perturbed prec data to da --- #
-if filter_flag == 2 or filter_flag == 6:
-    dict_prec_pert_ens = {}
-    for i in range(cfg['SMART_RUN']['NUMEN']):
-        dict_prec_pert_ens[i+1] = list_run_SMART_prec_pert_ens[i]
-    dict_da_prec_pert_ens = da_2D_to_3D_from_SMART(
-            dict_array_2D=dict_prec_pert_ens,
-            da_mask=da_mask,
-            out_time_varname='window',
-            out_time_coord=range(nwindow))
-    #  --- Save ensemble corrected precip, if applicable --- #
-    # Loop over all ensemble members
-    # --- If nproc == 1, do a regular ensemble loop --- #
-    if nproc == 1:
-        for i in range(cfg['SMART_RUN']['NUMEN']):
-            print('\tEnsemble {}'.format(i))
-            save_SMART_prec(start_time, end_time, cfg['SMART_RUN']['time_step'],
-                            dict_da_prec_pert_ens[i+1],
-                            out_dir, 'prec_perturbed.ens{}.'.format(i+1))
-    # --- If nproc > 1, use multiprocessing --- #
-    elif nproc > 1:
-        # --- Set up multiprocessing --- #
-        pool = mp.Pool(processes=nproc)
-        # --- Loop over each ensemble member --- #
-        for i in range(cfg['SMART_RUN']['NUMEN']):
-            print('\tEnsemble {}'.format(i))
-            pool.apply_async(save_SMART_prec,
-                             (start_time, end_time, cfg['SMART_RUN']['time_step'],
-                              dict_da_prec_pert_ens[i+1],
-                              out_dir, 'prec_perturbed.ens{}.'.format(i+1)))
-        # --- Finish multiprocessing --- #
-        pool.close()
-        pool.join()
-
-
-# ============================================================ #
-# Rescale orig. prec at orig. timestep based on SMART outputs
-# and save to netCDF file;
+# Rescale orig. prec at orig. timestep based on SMART outputs,
+# and save SMART-corrected (and perturbed) prec to netCDF files;
 # This rescaling step is only needed if window_size > 1
 # ============================================================ #
 print('Rescaling original prec. and saving to netCDF...')
 
-# --- If window_size == 1, skip rescaling and directly save
-print('window_size = 1, skip rescaling')
-if cfg['SMART_RUN']['window_size'] == 1:
-    # Save deterministic SMART-corrected precip
-    save_SMART_prec(start_time, end_time, cfg['SMART_RUN']['time_step'],
-                    da_prec_corr_window, out_dir, 'prec_corrected.')
-    # Save ensemble corrected precip, if applicable
-    if filter_flag == 2 or filter_flag == 6:
-        # Loop over all ensemble members
-        # --- If nproc == 1, do a regular ensemble loop --- #
-        if nproc == 1:
-            for i in range(cfg['SMART_RUN']['NUMEN']):
-                print('\tEnsemble {}'.format(i))
-                save_SMART_prec(start_time, end_time, cfg['SMART_RUN']['time_step'],
-                                dict_da_prec_corr_window_ens[i+1],
-                                out_dir, 'prec_corrected.ens{}.'.format(i+1))
-        # --- If nproc > 1, use multiprocessing --- #
-        elif nproc > 1:
-            # --- Set up multiprocessing --- #
-            pool = mp.Pool(processes=nproc)
-            # --- Loop over each ensemble member --- #
-            for i in range(cfg['SMART_RUN']['NUMEN']):
-                print('\tEnsemble {}'.format(i))
-                pool.apply_async(save_SMART_prec,
-                                 (start_time, end_time, cfg['SMART_RUN']['time_step'],
-                                  dict_da_prec_corr_window_ens[i+1],
-                                  out_dir, 'prec_corrected.ens{}.'.format(i+1)))
-            # --- Finish multiprocessing --- #
-            pool.close()
-            pool.join()
-
+# --- Set up a worker pool for all members --- #
+broadcast_dir = setup_output_dirs(out_dir, mkdirs=['broadcast'])['broadcast']
+pool = EnsembleWorkerPool(nproc, broadcast_dir)
 
-# --- If window_size > 1, rescale and save --- #
+# --- If window_size == 1, skip rescaling and directly save --- #
+if cfg['SMART_RUN']['window_size'] == 1:
+    print('window_size = 1, skip rescaling')
+    times_corrected = pd.date_range(
+        start_time, end_time,
+        freq='{}H'.format(cfg['SMART_RUN']['time_step']))
+    dict_broadcast = None
+# --- If window_size > 1, share the original-prec window sums with workers --- #
 else:
-    # --- Rescale SMART-corrected precip --- #
-    da_prec_corrected = rescale_and_save_SMART_prec(
+    times_corrected = pd.to_datetime(da_prec_orig['time'].values)
+    dict_prec_orig_cache = prepare_SMART_prec_orig_cache(
         da_prec_orig, cfg['SMART_RUN']['window_size'],
-        cfg['SMART_RUN']['time_step'],
-        da_prec_corr_window, start_time,
-        out_dir, 'prec_corrected.')
-    
-    # --- If ensemble SMART, rescale each ensemble member --- #
-    if filter_flag == 2 or filter_flag == 6:
-        # --- If nproc == 1, do a regular ensemble loop --- #
-        if nproc == 1:
-            for i in range(cfg['SMART_RUN']['NUMEN']):
-                print('Rescale and save ensemble {}...'.format(i+1))
-                rescale_and_save_SMART_prec(
-                    da_prec_orig, cfg['SMART_RUN']['window_size'],
-                    cfg['SMART_RUN']['time_step'],
-                    dict_da_prec_corr_window_ens[i+1],
-                    start_time,
-                    out_dir, 'prec_corrected.ens{}.'.format(i+1))
-        # --- If nproc > 1, use multiprocessing --- #
-        elif nproc > 1:
-            # --- Set up multiprocessing --- #
-            pool = mp.Pool(processes=nproc)
-            # --- Loop over each ensemble member --- #
-            for i in range(cfg['SMART_RUN']['NUMEN']):
-                print('Rescale and save ensemble {}...'.format(i+1))
-                pool.apply_async(rescale_and_save_SMART_prec,
-                    (da_prec_orig, cfg['SMART_RUN']['window_size'],
-                     cfg['SMART_RUN']['time_step'],
-                     dict_da_prec_corr_window_ens[i+1],
-                     start_time,
-                     out_dir, 'prec_corrected.ens{}.'.format(i+1)))
-            # --- Finish multiprocessing --- #
-            pool.close()
-            pool.join()
- 
+        cfg['SMART_RUN']['time_step'], nwindow, start_time)
+    dict_broadcast = {}
+    for name, array in dict_prec_orig_cache.items():
+        dict_broadcast[name] = pool.broadcast(name, array)
+    del dict_prec_orig_cache
+
+# --- Stream each member from SMART outputs to yearly files --- #
+# Deterministic SMART-corrected prec
+list_args = [(run_SMART_dir, 'corrected', None, times_corrected, da_mask,
+              out_dir, 'prec_corrected.', dict_broadcast)]
+# Ensemble SMART-corrected and perturbed prec, if ensemble SMART
+if filter_flag == 2 or filter_flag == 6:
+    times_perturbed = pd.date_range(
+        start_time, end_time,
+        freq='{}H'.format(cfg['SMART_RUN']['time_step']))
+    for i in range(cfg['SMART_RUN']['NUMEN']):
+        list_args.append((run_SMART_dir, 'corrected', i+1, times_corrected,
+                          da_mask, out_dir, 'prec_corrected.ens{}.'.format(i+1),
+                          dict_broadcast))
+        list_args.append((run_SMART_dir, 'perturbed', i+1, times_perturbed,
+                          da_mask, out_dir, 'prec_perturbed.ens{}.'.format(i+1),
+                          None))
+for k, ens in pool.imap_unordered(postprocess_SMART_member, list_args):
+    if ens is not None:
+        print('\tEnsemble {} {} saved'.format(ens, list_args[k][1]))
+
+# --- Finish multiprocessing --- #
+pool.close()
+os.rmdir(broadcast_dir)
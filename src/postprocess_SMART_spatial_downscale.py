@@ -113,7 +113,7 @@ n_target = len(da_prec_corrected_ensMean['lat']) * len(da_prec_corrected_ensMean
 A = xe.frontend.read_weights(
     os.path.join(cfg['CONTROL']['root_dir'], cfg['SPATIAL_DOWNSCALE']['weight_nc']),
     n_source, n_target)
-weight_array = A.toarray()  # [n_target, n_source]
+weight_array = A.tocsc()  # [n_target, n_source]
 # Check whether weight array has split source cells
 if (weight_array>0).sum(axis=0).max() != 1:
     raise ValueError('The script only takes weight file that does not split'
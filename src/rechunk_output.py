@@ -0,0 +1,43 @@
+
+''' This script converts an existing output file (e.g., a concatenated history
+    file) to another chunk layout and/or backend.
+
+    Usage:
+        $ python rechunk_output.py <in_path> <out_path> <layout> [backend] [compressor]
+
+        layout: "map" (one time step per chunk), "timeseries" (one grid cell per
+                chunk) or "balanced"
+        backend: "netcdf" or "zarr"; default is determined from out_path (Zarr if
+                 it ends with ".zarr")
+        compressor: "zlib", "zstd" (Zarr only) or "none"; default: "zlib"
+'''
+
+import sys
+
+from da_utils import rechunk_dataset
+
+
+# ============================================================ #
+# Process command line arguments
+# ============================================================ #
+in_path = sys.argv[1]
+out_path = sys.argv[2]
+layout = sys.argv[3]
+if len(sys.argv) > 4:
+    backend = sys.argv[4]
+else:
+    backend = None
+if len(sys.argv) > 5 and sys.argv[5] != 'none':
+    compressor = sys.argv[5]
+elif len(sys.argv) > 5:
+    compressor = None
+else:
+    compressor = 'zlib'
+
+
+# ============================================================ #
+# Rechunk
+# ============================================================ #
+print('Rechunking {} to {} ({} layout)...'.format(in_path, out_path, layout))
+rechunk_dataset(in_path, out_path, layout, backend=backend,
+                compressor=compressor)
@@ -27,9 +27,11 @@ from da_utils import (Forcings, setup_output_dirs, propagate,
                       concat_clean_up_history_file,
                       calculate_scale_n_whole_field,
                       calculate_cholesky_L,
-                      save_updated_states,
                       run_vic_assigned_states,
-                      determine_tile_frac)
+                      ObservationOperator, EnsembleStateStore,
+                      load_states_time_stacked,
+                      rescale_sm_states_by_moments,
+                      to_netcdf_state_file_compress)
 
 # =========================================================== #
 # Load command line arguments
@@ -97,30 +99,26 @@ lon = da_meas['lon']
 data = da_meas.values.reshape((len(time), len(lat), len(lon), 1))
 da_meas = xr.DataArray(data, coords=[time, lat, lon, [0]],
                        dims=['time', 'lat', 'lon', 'm'])
-# --- Load "truth" states --- #
+# --- Load "truth" states (time-stacked) --- #
 print('Loading orig. truth states data...')
 dict_truth_state_nc = OrderedDict()
-list_ds_truth_state = []
-list_da_truth_sm = []
 dict_rescaled_state_nc = OrderedDict()
-for t, time in enumerate(pd.to_datetime(da_meas['time'].values)):
-    print(time)
+for time in pd.to_datetime(da_meas['time'].values):
     state_time = pd.to_datetime(time)
-    truth_state_nc = os.path.join(
+    dict_truth_state_nc[state_time] = os.path.join(
         truth_subdirs['states'],
         'perturbed.state.{}_{:05d}.nc'.format(
                 time.strftime('%Y%m%d'),
                 time.hour*3600+time.second))
-    dict_truth_state_nc[state_time] = truth_state_nc
-    ds = xr.open_dataset(truth_state_nc)
-    list_ds_truth_state.append(ds)
-    list_da_truth_sm.append(ds['STATE_SOIL_MOISTURE'])
-    rescaled_state_nc = os.path.join(
+    dict_rescaled_state_nc[state_time] = os.path.join(
         truth_rescaled_subdirs['states'],
         'state.{}_{:05d}.nc'.format(
                 time.strftime('%Y%m%d'),
                 time.hour*3600+time.second))
-    dict_rescaled_state_nc[state_time] = rescaled_state_nc
+ds_truth_states = load_states_time_stacked(
+    list(dict_truth_state_nc.values()), da_meas['time'].values,
+    ['STATE_SOIL_MOISTURE', 'STATE_SNOW_WATER_EQUIVALENT'])
+da_truth_sm_concat = ds_truth_states['STATE_SOIL_MOISTURE']  # [time, veg, snow, nlayer, lat, lon]
 
 # --- Load "openloop" history file --- #
 print("Loading openloop history file...")
@@ -138,11 +136,6 @@ ds_openloop_hist = xr.open_dataset(os.path.join(
 # =========================================================== #
 print('Rescaling \"truth\" soil moisture states...')
 
-# --- Concat "truth" soil moisture states --- #
-print('\tConcatenating truth...')
-da_truth_sm_concat = xr.concat(list_da_truth_sm, dim='time')
-da_truth_sm_concat['time'] = da_meas['time']  # [time, veg, snow, nlayer, lat, lon]
-
 # --- Extract openloop soil moisture states at the same time points as measurements --- #
 # --- NOTE: history file results are timestep-beginning!! --- #
 print('\tExtracting openloop soil moistures...')
@@ -154,92 +147,46 @@ da_openloop_sm['time'] = times
 # Select out measurement time points
 da_openloop_sm = da_openloop_sm.sel(time=da_meas['time'])  # [time, nlayer, lat, lon]
 
-# --- Determine tile fraction --- #
-da_tile_frac = determine_tile_frac(os.path.join(
+# --- Build observation operator (tile fraction) --- #
+obs_operator = ObservationOperator.from_global(os.path.join(
                     cfg['CONTROL']['root_dir'],
-                    cfg['VIC']['vic_global_template']))  # [veg, snow, lat, lon]
+                    cfg['VIC']['vic_global_template']))
 
 # --- Rescale "truth" soil moisture states --- #
-print('\tRescaling for each grid-cell mean value...')
+# All time points at once:
+#   sm_rescaled_cell = (sm_truth - mean_truth) * (std_open / std_truth) + mean_open
+#   sm_rescaled_tile = (sm_tile - sm_tile_mean) + sm_rescale_cell
+# Negative and above-maximum soil moistures are reset
+print('\tRescaling for each grid cell and tile...')
 # Calculate openloop mean and variance for each layer, lat and lon
 da_openloop_sm_mean = da_openloop_sm.mean(dim='time')  # [nlayer, lat, lon]
 da_openloop_sm_std = da_openloop_sm.std(dim='time')  # [nlayer, lat, lon]
-### Rescale truth soil moisture states ###
-lat_coord = da_openloop_sm['lat']
-lon_coord = da_openloop_sm['lon']
-nlayer_coord = da_openloop_sm['nlayer']
-time_coord = da_openloop_sm['time']
-veg_coord = da_truth_sm_concat['veg_class']
-snow_coord = da_truth_sm_concat['snow_band']
-# Determine the total number of loops
-nloop = len(nlayer_coord) * len(lat_coord) * len(lon_coord)
-# Convert variables to np.array and straighten into nloop
-openloop_sm_mean = da_openloop_sm_mean.values.reshape([nloop])  # [nloop]
-openloop_sm_std = da_openloop_sm_std.values.reshape([nloop])  # [nloop]
-truth_sm = da_truth_sm_concat.values  # [time, veg, snow, nlayer, lat, lon]
-
-da_truth_sm_cell = (da_truth_sm_concat * da_tile_frac)\
-    .sum(dim='veg_class').sum(dim='snow_band')  # [time, nlayer, lat, lon]
-truth_sm_cell = da_truth_sm_cell.values.reshape([
-    len(time_coord), nloop])  # [time, nloop]
-# Calculate cell-mean truth statistics
-truth_sm_cell_mean = np.nanmean(truth_sm_cell, axis=0)  # [nloop]
-truth_sm_cell_std = np.nanstd(truth_sm_cell, axis=0)  # [nloop]
-# Calculate rescaled truth soil moisture states for grid-cell-mean values
-# --- sm_rescaled_cell = (sm_truth - mean_truth) * (std_open / std_truth) + mean_open --- #
-print('Rescaling for each grid cell...')
-sm_rescaled_cell = np.array(list(map(
-    lambda i: (truth_sm_cell[:, i] - truth_sm_cell_mean[i]) * \
-              (openloop_sm_std[i] / truth_sm_cell_std[i]) + openloop_sm_mean[i],
-    range(nloop)))).reshape(
-        [len(nlayer_coord), len(lat_coord), len(lon_coord),
-         len(time_coord)])  # [nlayer, lat, lon, time]
-sm_rescaled_cell = np.rollaxis(sm_rescaled_cell, 3, 0)  # [time, nlayer, lat, lon]
-da_sm_rescaled_cell = xr.DataArray(
-    sm_rescaled_cell,
-    coords=[time_coord, nlayer_coord, lat_coord, lon_coord],
-    dims=['time', 'nlayer', 'lat', 'lon'])
-
-# --- Rescale for each tile within each layer and grid cell --- #
-# sm_rescaled_tile = (sm_tile - sm_tile_mean) + sm_rescale_cell
-print('Rescaling for each tile...')
-da_sm_rescaled = da_truth_sm_concat - da_truth_sm_cell\
-    + da_sm_rescaled_cell  # [time, veg, snow, nlayer, lat, lon]
-
-# --- Convert back to original state shape --- #
-sm_rescaled = da_sm_rescaled.values  # [time, veg, snow, nlayer, lat, lon]
-# Put into da
-da_sm_rescaled = xr.DataArray(
-    sm_rescaled,
-    coords=[time_coord, veg_coord, snow_coord, nlayer_coord, lat_coord, lon_coord],
-    dims=['time', 'veg_class', 'snow_band', 'nlayer', 'lat', 'lon'])
-
-# --- Reset negative and above-maximum soil moistures --- #
-global_template = os.path.join(
-                    cfg['CONTROL']['root_dir'],
-                    cfg['VIC']['vic_global_template'])
 da_max_moist = calculate_max_soil_moist_domain(global_template)  # [nlayer, lat, lon]
-# Reset negative to zero
-sm = da_sm_rescaled.values
-sm[sm<0] = 0
-da_sm_rescaled[:] = sm
-# Reset above-maximum to maximum
-sm = da_sm_rescaled.values  # [time, veg, snow, nlayer, lat, lon]
-max_moist = da_max_moist.values  # [nlayer, lat, lon]
-max_moist_expanded = np.zeros([len(time_coord), len(veg_coord), len(snow_coord),
-                               len(nlayer_coord), len(lat_coord), len(lon_coord)])
-max_moist_expanded[:] = max_moist
-sm[sm>max_moist_expanded] = max_moist_expanded[sm>max_moist_expanded]
-da_sm_rescaled[:] = sm
+sm_rescaled = rescale_sm_states_by_moments(
+    da_truth_sm_concat.values, obs_operator.da_tile_frac.values,
+    da_openloop_sm_mean.values, da_openloop_sm_std.values,
+    da_max_moist.values)  # [time, veg, snow, nlayer, lat, lon]
+# Other state variables are shared with (not copied from) the orig. truth
+# states; the orig. truth soil moisture is then released
+ds_rescaled_states = ds_truth_states.assign(
+    STATE_SOIL_MOISTURE=da_truth_sm_concat.copy(data=sm_rescaled))
+del ds_truth_states, da_truth_sm_concat
 
 # --- Save rescaled states to file --- #
 print('Save rescaled states...')
-
-for state_time, state_nc in dict_truth_state_nc.items():
-    save_updated_states(
-        state_nc_before_update=state_nc,
-        da_sm_updated=da_sm_rescaled.sel(time=state_time),
-        out_vic_state_nc=dict_rescaled_state_nc[state_time])
+# Save time-stacked rescaled states to a single file
+to_netcdf_state_file_compress(
+    ds_rescaled_states,
+    os.path.join(truth_rescaled_subdirs['states'],
+                 'truth_state.{}_{}.nc'.format(
+                    pd.to_datetime(da_meas['time'].values[0]).strftime('%Y%m%d'),
+                    pd.to_datetime(da_meas['time'].values[-1]).strftime('%Y%m%d'))))
+# Export a VIC state file for each time point (to run VIC from); state
+# variables other than soil moisture are from the orig. truth states
+store = EnsembleStateStore.from_array(
+    sm_rescaled, ds_rescaled_states['STATE_SOIL_MOISTURE'][0],
+    list(dict_truth_state_nc.values()))
+store.to_nc(list(dict_rescaled_state_nc.values()), nproc=mpi_proc)
 
 
 # =========================================================== #
@@ -329,33 +276,14 @@ ds_simulated.to_netcdf(
 
 
 # =========================================================== #
-# Concatenate new truth states (cellAvg)
+# Aggregate new truth states (cellAvg)
 # =========================================================== #
-# --- Concatenate truth states (SM and SWE only, cellAvg) --- #
+# --- Aggregate truth states to cellAvg (SM and SWE only) --- #
 print('Concatenating new truth states (cellAvg)...')
-list_da_sm_cellAvg = []
-list_da_swe_cellAvg = []
-times = []
-for state_time, state_nc in dict_rescaled_state_nc.items():
-    print(state_time)
-    # Load state file, extract soil moisture & SWE only
-    ds = xr.open_dataset(state_nc)
-    da_sm = ds['STATE_SOIL_MOISTURE']
-    da_swe = ds['STATE_SNOW_WATER_EQUIVALENT']
-    # Aggregate to cellAvg
-    da_sm_cellAvg = (da_sm * da_tile_frac)\
-        .sum(dim='veg_class').sum(dim='snow_band')  # [nlayer, lat, lon]
-    da_swe_cellAvg = (da_swe * da_tile_frac)\
-        .sum(dim='veg_class').sum(dim='snow_band')  # [lat, lon]
-    # Append to lists
-    times.append(state_time)
-    list_da_sm_cellAvg.append(da_sm_cellAvg)
-    list_da_swe_cellAvg.append(da_swe_cellAvg)
-# --- Concatenate SM and SWE states --- #
-da_sm_cellAvg_alltimes = xr.concat(list_da_sm_cellAvg, dim='time')
-da_sm_cellAvg_alltimes['time'] = times
-da_swe_cellAvg_alltimes = xr.concat(list_da_swe_cellAvg, dim='time')
-da_swe_cellAvg_alltimes['time'] = times
+da_sm_cellAvg_alltimes = obs_operator.cell_average(
+    ds_rescaled_states['STATE_SOIL_MOISTURE'])  # [time, nlayer, lat, lon]
+da_swe_cellAvg_alltimes = obs_operator.cell_average(
+    ds_rescaled_states['STATE_SNOW_WATER_EQUIVALENT'])  # [time, lat, lon]
 # --- Save to file --- #
 ds_cellAvg_alltimes = xr.Dataset({
     'SOIL_MOISTURE': da_sm_cellAvg_alltimes,
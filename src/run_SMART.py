@@ -0,0 +1,86 @@
+
+''' This script runs SMART (EnKF path, filter_flag = 2 or 6) in Python for all
+    active pixels, directly from the SMART config file (no Matlab run needed).
+    Outputs are written to netCDF files in the "run_SMART" output subdir
+    (see run_SMART in da_utils).
+
+    Usage:
+        $ python run_SMART.py <config_file_SMART> nproc
+'''
+
+import sys
+import os
+import numbers
+import pandas as pd
+from scipy.io import loadmat
+
+from tonic.io import read_configobj
+
+from da_utils import setup_output_dirs, prepare_SMART_input, run_SMART
+
+
+# ============================================================ #
+# Process command line arguments
+# Read config file
+# ============================================================ #
+cfg = read_configobj(sys.argv[1])
+
+nproc = int(sys.argv[2])
+
+
+# ============================================================ #
+# Load and process input datasets to dimension [npixel_active, ntime]
+# ============================================================ #
+print('Loading input data...')
+dict_array_active = prepare_SMART_input(cfg)
+
+
+# ============================================================ #
+# Process API_mean and bb - a number or a .mat file of tuned values
+# ============================================================ #
+# Relative .mat paths are resolved against the SMART Matlab code directory,
+# same as in the Matlab run (which loads them after cd to matlab_dir)
+matlab_dir = os.path.join(cfg['CONTROL']['root_dir'],
+                          cfg['SMART_MATLAB']['matlab_dir'])
+API_mean = cfg['SMART_RUN']['API_mean']
+if not isinstance(API_mean, numbers.Number):
+    API_mean = loadmat(os.path.join(matlab_dir, API_mean))\
+               ['API_COEFF_tuned'].squeeze()
+bb = cfg['SMART_RUN']['bb']
+if not isinstance(bb, numbers.Number):
+    bb = loadmat(os.path.join(matlab_dir, bb))['bb_tuned'].squeeze()
+
+
+# ============================================================ #
+# Run SMART
+# ============================================================ #
+print('Running SMART...')
+out_dir = setup_output_dirs(os.path.join(cfg['CONTROL']['root_dir'],
+                                         cfg['OUTPUT']['output_basedir']),
+                            mkdirs=['run_SMART'])['run_SMART']
+
+run_SMART(
+    dict_array_active, out_dir,
+    start_time=pd.to_datetime(cfg['SMART_RUN']['start_time'], format='%Y-%m-%d-%H'),
+    time_step=cfg['SMART_RUN']['time_step'],
+    NUMEN=cfg['SMART_RUN']['NUMEN'],
+    window_size=cfg['SMART_RUN']['window_size'],
+    API_mean=API_mean,
+    bb=bb,
+    nproc=nproc,
+    npixel_chunk=int(cfg['SMART_RUN'].get('npixel_chunk', 50)),
+    seed=int(cfg['SMART_RUN'].get('seed', 11)),
+    filter_flag=cfg['SMART_RUN']['filter_flag'],
+    transform_flag=cfg['SMART_RUN']['transform_flag'],
+    API_model_flag=cfg['SMART_RUN']['API_model_flag'],
+    lambda_flag=cfg['SMART_RUN']['lambda_flag'],
+    Q_fixed=cfg['SMART_RUN']['Q_fixed'],
+    P_inflation=cfg['SMART_RUN']['P_inflation'],
+    logn_var=cfg['SMART_RUN']['logn_var'],
+    phi=cfg['SMART_RUN']['phi'],
+    API_range=cfg['SMART_RUN']['API_range'],
+    if_rescale=cfg['SMART_RUN']['if_rescale'],
+    lambda_tuning_target=cfg['SMART_RUN']['lambda_tuning_target'],
+    correct_magnitude_only=cfg['SMART_RUN']['correct_magnitude_only'],
+    correct_magnitude_only_threshold=cfg['SMART_RUN']['correct_magnitude_only_threshold'],
+    sep_sm_orbit=cfg['SMART_RUN']['sep_sm_orbit'])
@@ -91,6 +91,15 @@ dirs = setup_output_dirs(os.path.join(cfg['CONTROL']['root_dir'],
                                       cfg['OUTPUT']['output_EnKF_basedir']),
                          mkdirs=['global', 'history', 'states',
                                  'logs', 'plots', 'temp', 'restart_log'])
+# (Optional) Local scratch directory for the ensemble state store and the
+# temporary state files only read by VIC
+if 'output_vic_scratch_dir' in cfg['OUTPUT']:
+    output_vic_scratch_dir = setup_output_dirs(
+        os.path.join(cfg['OUTPUT']['output_vic_scratch_dir'],
+                     cfg['OUTPUT']['output_EnKF_basedir']),
+        mkdirs=['states'])['states']
+else:
+    output_vic_scratch_dir = None
 
 
 # ============================================================ #
@@ -185,16 +194,23 @@ da_max_moist = calculate_max_soil_moist_domain(
                     os.path.join(cfg['CONTROL']['root_dir'],
                                  cfg['VIC']['vic_global_template']))
 da_max_moist_n = convert_max_moist_n_state(da_max_moist, nveg, nsnow)
-# Pre-generated, spatially-correlated state perturbation noise
+# Spatially-correlated state perturbation noise - generated on demand if
+# state_perturb_random_field_phi is specified, otherwise pre-generated
 if 'state_perturb_spatial_corr' in cfg['EnKF'] and\
     cfg['EnKF']['state_perturb_spatial_corr'] is True:
     state_perturb_spatial_corr = True
-    state_perturb_random_field_dir = os.path.join(
-        cfg['CONTROL']['root_dir'],
-        cfg['EnKF']['state_perturb_random_field_dir'])
+    if 'state_perturb_random_field_phi' in cfg['EnKF']:
+        state_perturb_random_field_phi = cfg['EnKF']['state_perturb_random_field_phi']
+        state_perturb_random_field_dir = None
+    else:
+        state_perturb_random_field_phi = None
+        state_perturb_random_field_dir = os.path.join(
+            cfg['CONTROL']['root_dir'],
+            cfg['EnKF']['state_perturb_random_field_dir'])
 else:
     state_perturb_spatial_corr = False
     state_perturb_random_field_dir = None
+    state_perturb_random_field_phi = None
 
 # If linear model subsitution, no max moist limit
 if linear_model:
@@ -255,10 +271,12 @@ if not linear_model:
          debug=debug,
          save_cellAvg_state_only=save_cellAvg_state_only,
          output_temp_dir=dirs['temp'],
+         output_vic_scratch_dir=output_vic_scratch_dir,
          restart=restart,
          dict_diagnose=dict_diagnose,
          state_perturb_spatial_corr=state_perturb_spatial_corr,
-         state_perturb_random_field_dir=state_perturb_random_field_dir)
+         state_perturb_random_field_dir=state_perturb_random_field_dir,
+         state_perturb_random_field_phi=state_perturb_random_field_phi)
 else:
     dict_ens_list_history_files = EnKF_VIC(
          N=cfg['EnKF']['N'],
@@ -289,6 +307,7 @@ else:
          nproc=nproc,
          debug=debug,
          output_temp_dir=dirs['temp'],
+         output_vic_scratch_dir=output_vic_scratch_dir,
          restart=restart,
          linear_model='True',
          linear_model_prec_varname=prec_varname,
@@ -9,6 +9,7 @@ from bokeh.io import reset_output
 import bokeh
 import sys
 import multiprocessing as mp
+import hashlib
 from collections import OrderedDict
 import cartopy.feature as cfeature
 from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
@@ -16,7 +17,6 @@ import cartopy.io.shapereader as shpreader
 import xesmf as xe
 from scipy.sparse import coo_matrix
 import xesmf as xe
-import properscoring as ps
 
 from tonic.io import read_configobj
 import timeit
@@ -354,22 +354,211 @@ def to_netcdf_history_file_compress(ds_hist, out_nc):
                       encoding=dict_encode)
 
 
+def to_netcdf_timeseries_chunked(ds, out_nc, time_dim='time'):
+    ''' This function saves a ds to netCDF, with compression and the full
+        time series of one grid cell per chunk (the "timeseries" chunk
+        layout), for analyses that read one grid cell at a time.
+
+    Parameters
+    ----------
+    ds: <xr.Dataset>
+        Dataset to save; data variables with lat and lon dimensions are
+        chunked by grid cell
+    out_nc: <str>
+        Path of output netCDF file
+    time_dim: <str>
+        Time dimension name. Default: 'time'
+    '''
+
+    dict_encode = {}
+    for var in ds.data_vars:
+        # determine chunksizes
+        chunksizes = []
+        for dim in ds[var].dims:
+            if dim == 'lat' or dim == 'lon':  # for spatial dimensions, chunksize = 1
+                chunksizes.append(1)
+            else:
+                chunksizes.append(max(1, len(ds[dim])))
+        # create encoding dict
+        dict_encode[var] = {'zlib': True,
+                            'complevel': 1,
+                            'chunksizes': chunksizes}
+    ds.to_netcdf(out_nc,
+                 format='NETCDF4',
+                 encoding=dict_encode)
+
+
+def extract_truth_model_var(ds_truth, ds_model, var, depth_sm=None,
+                            model_daily=False):
+    ''' Extract a variable to evaluate from truth and model states/history.
+
+    Parameters
+    ----------
+    ds_truth: <xr.Dataset>
+        Truth states/history
+    ds_model: <xr.Dataset>
+        Model states/history (deterministic, or ensemble with "N" as the
+        ensemble dimension)
+    var: <str>
+        Variable, options:
+            sm1; sm2; sm3; totsm; swe; runoff_daily; baseflow_daily; totrunoff_daily;
+            runoff_daily_log; baseflow_daily_log; totrunoff_daily_log
+        NOTE: sm's and swe are from states; runoff's are from history file
+    depth_sm: <xr.DataArray>
+        Thickness of soil moisture
+        Only required if state_var is soil moisture
+    model_daily: <bool>
+        Whether model history is already daily (e.g., concatenated daily
+        ensemble history); if False, model history is aggregated to daily the
+        same way as truth history
+
+    Returns
+    ----------
+    da_truth: <xr.DataArray>
+    da_model: <xr.DataArray>
+    '''
+
+    def _daily(da, is_daily=False):
+        if is_daily:
+            return da
+        return da.resample('1D', dim='time', how='sum')
+
+    if var == 'sm1':
+        da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
+        da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
+    elif var == 'sm2':
+        da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
+        da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
+    elif var == 'sm3':
+        da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
+        da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
+    elif var == 'totsm':
+        da_truth = ds_truth['SOIL_MOISTURE'].sum(dim='nlayer') / depth_sm
+        da_model = ds_model['SOIL_MOISTURE'].sum(dim='nlayer') / depth_sm
+    elif var == 'swe':
+        da_truth = ds_truth['SWE']
+        da_model = ds_model['SWE']
+    elif var in ['runoff_daily', 'runoff_daily_log']:
+        da_truth = _daily(ds_truth['OUT_RUNOFF'])
+        da_model = _daily(ds_model['OUT_RUNOFF'], model_daily)
+    elif var in ['baseflow_daily', 'baseflow_daily_log']:
+        da_truth = _daily(ds_truth['OUT_BASEFLOW'])
+        da_model = _daily(ds_model['OUT_BASEFLOW'], model_daily)
+    elif var in ['totrunoff_daily', 'totrunoff_daily_log']:
+        da_truth = _daily(ds_truth['OUT_RUNOFF']) + \
+                   _daily(ds_truth['OUT_BASEFLOW'])
+        da_model = _daily(ds_model['OUT_RUNOFF'], model_daily) + \
+                   _daily(ds_model['OUT_BASEFLOW'], model_daily)
+    else:
+        raise ValueError('Unsupported variable {}!'.format(var))
+    if var.endswith('_log'):
+        da_truth = np.log(da_truth + 1)
+        da_model = np.log(da_model + 1)
+
+    return da_truth, da_model
+
+
+def calculate_metrics(out_nc, ds_truth, ds_model, var, list_metrics,
+                      depth_sm=None, model_daily=False, nproc=1, nlat_chunk=10):
+    ''' Calculates a list of metrics for one variable over all domain in a
+        single pass over the data (see calculate_ensemble_metrics).
+        All results are kept in one consolidated netCDF file, with one
+        variable per (var, metric) named "<var>_<metric>". Results are reused
+        by content hash of the input chunks, so rerunning after the inputs
+        changed recalculates (only the changed chunks).
+
+    Parameters
+    ----------
+    out_nc: <str>
+        Consolidated metrics netCDF file; created if not existing
+    ds_truth: <xr.Dataset>
+        Truth states/history
+    ds_model: <xr.Dataset>
+        Model states/history to be assessed (wrt. truth states);
+        either deterministic, or ensemble with "N" as the ensemble dimension
+        (deterministic model is treated as a one-member ensemble)
+    var: <str>
+        Variable; see extract_truth_model_var for options
+    list_metrics: <list>
+        Metrics to calculate; options: crps; bias_norm_var; nensk; rmse; pbias
+        (rmse and pbias are of the ensemble mean)
+    depth_sm: <xr.DataArray>
+        Thickness of soil moisture
+        Only required if state_var is soil moisture
+    model_daily: <bool>
+        Whether model history is already daily
+    nproc: <int>
+        Number of processors for mp; parallelized over chunks
+    nlat_chunk: <int>
+        Number of lat rows per chunk
+
+    Returns
+    ----------
+    ds_metrics: <xr.Dataset>
+        Metrics of var; each named by metric, with dimension [lat, lon]
+    '''
+
+    # --- Extract variables --- #
+    da_truth, da_model = extract_truth_model_var(
+        ds_truth, ds_model, var, depth_sm=depth_sm, model_daily=model_daily)
+    if 'N' not in da_model.dims:
+        da_model = da_model.expand_dims('N')
+
+    # --- Load cached results --- #
+    ds_all = xr.Dataset()
+    if os.path.isfile(out_nc):
+        with xr.open_dataset(out_nc) as ds:
+            ds_all = ds.load()
+        # Discard cached results if domain has changed
+        if not (np.array_equal(ds_all['lat'].values, da_truth['lat'].values) and
+                np.array_equal(ds_all['lon'].values, da_truth['lon'].values)):
+            ds_all = xr.Dataset()
+    hash_attr = 'chunk_hash_{}'.format(var)
+    list_name_var = ['{}_{}'.format(var, metric) for metric in
+                     ['crps', 'bias_norm_var', 'nensk', 'rmse', 'pbias']]
+    ds_cached = xr.Dataset(
+        OrderedDict((name[len(var)+1:], ds_all[name])
+                    for name in list_name_var if name in ds_all),
+        attrs={'chunk_hash': ds_all.attrs.get(hash_attr, '')})
+
+    # --- Calculate metrics --- #
+    ds_metrics = calculate_ensemble_metrics(
+        da_truth, da_model, nproc=nproc, nlat_chunk=nlat_chunk,
+        list_metrics=list_metrics, ds_cached=ds_cached)
+
+    # --- Update consolidated results --- #
+    hash_updated = ds_metrics.attrs['chunk_hash'] != ds_cached.attrs['chunk_hash']
+    if hash_updated or not all(metric in ds_cached for metric in list_metrics):
+        # Cached metrics of var that are now out of date are dropped
+        ds_all = xr.Dataset(
+            OrderedDict((name, ds_all[name]) for name in ds_all.data_vars
+                        if not (hash_updated and name in list_name_var)),
+            attrs=ds_all.attrs)
+        for metric in list_metrics:
+            ds_all['{}_{}'.format(var, metric)] = ds_metrics[metric]
+        ds_all.attrs[hash_attr] = ds_metrics.attrs['chunk_hash']
+        ds_all.to_netcdf(out_nc, format='NETCDF4_CLASSIC')
+
+    return ds_metrics
+
+
 def calculate_rmse(out_nc, ds_truth, ds_model,
                    var, depth_sm=None):
-    ''' A wrap funciton that calculates RMSE for all domain and save to file; if
-        result file already existed, then simply read in the file.
+    ''' A wrap funciton that calculates RMSE for all domain and save to file;
+        results are reused from the file if inputs have not changed
+        (see calculate_metrics).
     
     Parameters
     ----------
     out_nc: <str>
-        RMSE result output netCDF file
+        Consolidated metrics netCDF file
     ds_truth: <xr.Dataset>
         Truth states/history
     ds_model: <xr.Dataset>
         Model states/history whose RMSE is to be assessed (wrt. truth states)
     var: <str>
         Variable, options:
-            sm1; sm2; sm3; totsum; runoff_daily; baseflow_daily; totrunoff_daily; swe;
+            sm1; sm2; sm3; totsm; runoff_daily; baseflow_daily; totrunoff_daily; swe;
             runoff_daily_log; baseflow_daily_log; totrunoff_daily_log
         NOTE: sm's and swe are from states; runoff's are from history file
     depth_sm: <xr.DataArray>
@@ -378,95 +567,20 @@ def calculate_rmse(out_nc, ds_truth, ds_model,
     
     '''
     
-    if not os.path.isfile(out_nc):  # if RMSE is not already calculated
-        # --- Extract variables --- #
-        if var == 'sm1':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-        elif var == 'sm2':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-        elif var == 'sm3':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-        elif var == 'totsm':
-            da_truth = ds_truth['SOIL_MOISTURE'].sum(dim='nlayer') / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sum(dim='nlayer') / depth_sm
-        elif var == 'swe':
-            da_truth = ds_truth['SWE']
-            da_model = ds_model['SWE']
-        elif var == 'runoff_daily':
-            da_truth = ds_truth['OUT_RUNOFF'].resample(
-                '1D', dim='time', how='sum')
-            da_model = ds_model['OUT_RUNOFF'].resample(
-                '1D', dim='time', how='sum')
-        elif var == 'baseflow_daily':
-            da_truth = ds_truth['OUT_BASEFLOW'].resample(
-                '1D', dim='time', how='sum')
-            da_model = ds_model['OUT_BASEFLOW'].resample(
-                '1D', dim='time', how='sum')
-        elif var == 'totrunoff_daily':
-            da_truth = ds_truth['OUT_RUNOFF'].resample('1D', dim='time', how='sum') + \
-                       ds_truth['OUT_BASEFLOW'].resample('1D', dim='time', how='sum')
-            da_model = ds_model['OUT_RUNOFF'].resample('1D', dim='time', how='sum') + \
-                       ds_model['OUT_BASEFLOW'].resample('1D', dim='time', how='sum')
-        elif var == 'runoff_daily_log':
-            da_truth = np.log(ds_truth['OUT_RUNOFF'].resample(
-                '1D', dim='time', how='sum') + 1)
-            da_model = np.log(ds_model['OUT_RUNOFF'].resample(
-                '1D', dim='time', how='sum') + 1)
-        elif var == 'baseflow_daily_log':
-            da_truth = np.log(ds_truth['OUT_BASEFLOW'].resample(
-                '1D', dim='time', how='sum') + 1)
-            da_model = np.log(ds_model['OUT_BASEFLOW'].resample(
-                '1D', dim='time', how='sum') + 1)
-        elif var == 'totrunoff_daily_log':
-            da_truth = np.log(
-                ds_truth['OUT_RUNOFF'].resample('1D', dim='time', how='sum') + \
-                ds_truth['OUT_BASEFLOW'].resample('1D', dim='time', how='sum') +1)
-            da_model = np.log(
-                ds_model['OUT_RUNOFF'].resample('1D', dim='time', how='sum') + \
-                ds_model['OUT_BASEFLOW'].resample('1D', dim='time', how='sum') + 1)
-        # --- Calculate RMSE --- #
-        # Determine the total number of loops
-        lat_coord = da_truth['lat']
-        lon_coord = da_truth['lon']
-        nloop = len(lat_coord) * len(lon_coord)
-        # Reshape variables
-        truth = da_truth.values.reshape(
-            [len(da_model['time']), nloop])  # [time, nloop]
-        model = da_model.values.reshape(
-            [len(da_model['time']), nloop])  # [time, nloop]
-        # Calculate RMSE for all grid cells
-        rmse_model = np.array(list(map(
-                     lambda j: rmse(truth[:, j], model[:, j]),
-                    range(nloop))))  # [nloop]
-        # Reshape RMSE's
-        rmse_model = rmse_model.reshape(
-            [len(lat_coord), len(lon_coord)])  # [lat, lon]
-        # Put results into da's
-        da_rmse_model = xr.DataArray(
-            rmse_model, coords=[lat_coord, lon_coord],
-            dims=['lat', 'lon'])  # [mm/mm]
-        # Save RMSE to netCDF file
-        ds_rmse_model = xr.Dataset(
-            {'rmse': da_rmse_model})
-        ds_rmse_model.to_netcdf(out_nc, format='NETCDF4_CLASSIC')
-    else:  # if RMSE is already calculated
-        da_rmse_model = xr.open_dataset(out_nc)['rmse']
-    
-    return da_rmse_model
+    return calculate_metrics(out_nc, ds_truth, ds_model, var, ['rmse'],
+                             depth_sm=depth_sm)['rmse']
 
 
 def calculate_pbias(out_nc, ds_truth, ds_model,
                     var, depth_sm=None):
-    ''' A wrap funciton that calculates PBIAS for all domain and save to file; if
-        result file already existed, then simply read in the file.
+    ''' A wrap funciton that calculates PBIAS for all domain and save to file;
+        results are reused from the file if inputs have not changed
+        (see calculate_metrics).
     
     Parameters
     ----------
     out_nc: <str>
-        RMSE result output netCDF file
+        Consolidated metrics netCDF file
     ds_truth: <xr.Dataset>
         Truth states/history
     ds_model: <xr.Dataset>
@@ -481,57 +595,8 @@ def calculate_pbias(out_nc, ds_truth, ds_model,
     
     '''
     
-    if not os.path.isfile(out_nc):  # if PBIAS is not already calculated
-        # --- Extract variables --- #
-        if var == 'sm1':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-        if var == 'sm2':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-        if var == 'sm3':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-        if var == 'swe':
-            da_truth = ds_truth['SWE']
-            da_model = ds_model['SWE']
-        if var == 'runoff_daily':
-            da_truth = ds_truth['OUT_RUNOFF'].resample(
-                '1D', dim='time', how='sum')
-            da_model = ds_model['OUT_RUNOFF'].resample(
-                '1D', dim='time', how='sum')
-        if var == 'baseflow_daily':
-            da_truth = ds_truth['OUT_BASEFLOW'].resample(
-                '1D', dim='time', how='sum')
-            da_model = ds_model['OUT_BASEFLOW'].resample(
-                '1D', dim='time', how='sum')
-        if var == 'totrunoff_daily':
-            da_truth = (ds_truth['OUT_RUNOFF'] + ds_truth['OUT_BASEFLOW'])\
-                .resample('1D', dim='time', how='sum')
-            da_model = (ds_model['OUT_RUNOFF'] + ds_model['OUT_BASEFLOW'])\
-                .resample('1D', dim='time', how='sum')
-        # --- Calculate PBIAS --- #
-        # Determine the total number of loops
-        lat_coord = da_truth['lat']
-        lon_coord = da_truth['lon']
-        nloop = len(lat_coord) * len(lon_coord)
-        # Reshape variables
-        truth = da_truth.values.reshape(
-            [len(da_model['time']), nloop])  # [time, nloop]
-        model = da_model.values.reshape(
-            [len(da_model['time']), nloop])  # [time, nloop]
-        # --- Calculate PBIAS --- #
-        da_truth_mean = da_truth.mean(dim='time')
-        da_model_mean = da_model.mean(dim='time')
-        da_pbias_model = (da_model_mean - da_truth_mean) / da_truth_mean * 100
-        # Save PBIAS to netCDF file
-        ds_pbias_model = xr.Dataset(
-            {'pbias': da_pbias_model})
-        ds_pbias_model.to_netcdf(out_nc, format='NETCDF4_CLASSIC')
-    else:  # if PBIAS is already calculated
-        da_pbias_model = xr.open_dataset(out_nc)['pbias']
-    
-    return da_pbias_model
+    return calculate_metrics(out_nc, ds_truth, ds_model, var, ['pbias'],
+                             depth_sm=depth_sm)['pbias']
 
 
 def add_gridlines(axis, xlocs=[-80, -90, -100, -110, -120],
@@ -780,26 +845,30 @@ def process_weight_file(orig_weight_nc, output_weight_nc, n_source, n_target,
     return weight_array
 
 
-def calculate_crps(out_nc, ds_truth, ds_model, var, depth_sm=None):
-    ''' A wrap funciton that calculates CRPS for all domain and save to file; if
-        result file already existed, then simply read in the file.
+def calculate_crps(out_nc, ds_truth, ds_model, var, depth_sm=None, nproc=1):
+    ''' A wrap funciton that calculates CRPS for all domain and save to file;
+        results are reused from the file if inputs have not changed
+        (see calculate_metrics).
 
     Parameters
     ----------
     out_nc: <str>
-        RMSE result output netCDF file
+        Consolidated metrics netCDF file
     ds_truth: <xr.Dataset>
         Truth states/history
     ds_model: <xr.Dataset>
         Model states/history whose RMSE is to be assessed (wrt. truth states);
         This should be ensemble model results, with "N" as the ensemble dimension
+        NOTE: history should already be daily data!!
     var: <str>
         Variable, options:
-            sm1; sm2; sm3
+            sm1; sm2; sm3; runoff_daily_log; baseflow_daily_log; totrunoff_daily_log
         NOTE: sm's and swe are from states; runoff's are from history file
     depth_sm: <xr.DataArray>
         Thickness of soil moisture
         Only required if state_var is soil moisture
+    nproc: <int>
+        Number of processors for mp
         
     Returns
     ----------
@@ -807,47 +876,21 @@ def calculate_crps(out_nc, ds_truth, ds_model, var, depth_sm=None):
         CRPS for the whole domain; dimension: [lat, lon]
     '''
 
-    if not os.path.isfile(out_nc):  # if RMSE is not already calculated
-        # --- Extract variables --- #
-        if var == 'sm1':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-        elif var == 'sm2':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-        elif var == 'sm3':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-        # --- Calculate CRPS for the whole domain --- #
-        crps_domain = np.asarray(
-            [crps(da_truth.sel(lat=lat, lon=lon).values,
-                  da_model.sel(lat=lat, lon=lon).transpose('time', 'N').values)
-             for lat in da_truth['lat'].values
-             for lon in da_truth['lon'].values])
-        # --- Reshape results --- #
-        crps_domain = crps_domain.reshape([len(da_truth['lat']), len(da_truth['lon'])])
-        # --- Put results into da's --- #
-        da_crps = xr.DataArray(
-            crps_domain, coords=[da_truth['lat'], da_truth['lon']],
-            dims=['lat', 'lon'])
-        # Save RMSE to netCDF file
-        ds_crps = xr.Dataset(
-            {'crps': da_crps})
-        ds_crps.to_netcdf(out_nc, format='NETCDF4_CLASSIC')
-    else:  # if RMSE is already calculated
-        da_crps = xr.open_dataset(out_nc)['crps']
-    
-    return da_crps
+    return calculate_metrics(out_nc, ds_truth, ds_model, var, ['crps'],
+                             depth_sm=depth_sm, model_daily=True,
+                             nproc=nproc)['crps']
 
 
-def calculate_bias_ensemble_norm_var(out_nc, ds_truth, ds_model, var, depth_sm=None):
+def calculate_bias_ensemble_norm_var(out_nc, ds_truth, ds_model, var, depth_sm=None,
+                                     nproc=1):
     ''' A wrap funciton that calculates variance of ensemble-normalized bias for all domain
-    and save to file; if result file already existed, then simply read in the file.
+    and save to file; results are reused from the file if inputs have not changed
+    (see calculate_metrics).
 
     Parameters
     ----------
     out_nc: <str>
-        RMSE result output netCDF file
+        Consolidated metrics netCDF file
     ds_truth: <xr.Dataset>
         Truth states/history
     ds_model: <xr.Dataset>
@@ -860,6 +903,8 @@ def calculate_bias_ensemble_norm_var(out_nc, ds_truth, ds_model, var, depth_sm=N
     depth_sm: <xr.DataArray>
         Thickness of soil moisture
         Only required if state_var is soil moisture
+    nproc: <int>
+        Number of processors for mp
         
     Returns
     ----------
@@ -867,49 +912,20 @@ def calculate_bias_ensemble_norm_var(out_nc, ds_truth, ds_model, var, depth_sm=N
         Variance of ensemble-normalized bias for the whole domain; dimension: [lat, lon]
     '''
 
-    if not os.path.isfile(out_nc):  # if RMSE is not already calculated
-        # --- Extract variables --- #
-        if var == 'sm1':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-        elif var == 'sm2':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-        elif var == 'sm3':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-        # --- Calculate bias_norm for the whole domain --- #
-        bias_norm_var_domain = np.asarray(
-            [bias_ensemble_norm_var(
-                da_truth.sel(lat=lat, lon=lon).values,
-                da_model.sel(lat=lat, lon=lon).transpose('time', 'N').values)
-             for lat in da_truth['lat'].values
-             for lon in da_truth['lon'].values])
-        # --- Reshape results --- #
-        bias_norm_var_domain = bias_norm_var_domain.reshape(
-            [len(da_truth['lat']), len(da_truth['lon'])])
-        # --- Put results into da's --- #
-        da_bias_norm_var = xr.DataArray(
-            bias_norm_var_domain, coords=[da_truth['lat'], da_truth['lon']],
-            dims=['lat', 'lon'])
-        # Save RMSE to netCDF file
-        ds_bias_norm_var = xr.Dataset(
-            {'bias_norm_var': da_bias_norm_var})
-        ds_bias_norm_var.to_netcdf(out_nc, format='NETCDF4_CLASSIC')
-    else:  # if RMSE is already calculated
-        da_bias_norm_var = xr.open_dataset(out_nc)['bias_norm_var']
-    
-    return da_bias_norm_var
+    return calculate_metrics(out_nc, ds_truth, ds_model, var, ['bias_norm_var'],
+                             depth_sm=depth_sm, model_daily=True,
+                             nproc=nproc)['bias_norm_var']
 
 
-def calculate_nensk(out_nc, ds_truth, ds_model, var, depth_sm=None):
+def calculate_nensk(out_nc, ds_truth, ds_model, var, depth_sm=None, nproc=1):
     ''' A wrap funciton that calculates NENSK for all domain
-    and save to file; if result file already existed, then simply read in the file.
+    and save to file; results are reused from the file if inputs have not changed
+    (see calculate_metrics).
 
     Parameters
     ----------
     out_nc: <str>
-        RMSE result output netCDF file
+        Consolidated metrics netCDF file
     ds_truth: <xr.Dataset>
         Truth states/history
     ds_model: <xr.Dataset>
@@ -918,81 +934,24 @@ def calculate_nensk(out_nc, ds_truth, ds_model, var, depth_sm=None):
         NOTE: this should already be daily data!!
     var: <str>
         Variable, options:
-            sm1; sm2; sm3
+            sm1; sm2; sm3; runoff_daily; baseflow_daily; totrunoff_daily;
+            runoff_daily_log; baseflow_daily_log; totrunoff_daily_log
         NOTE: sm's and swe are from states; runoff's are from history file
     depth_sm: <xr.DataArray>
         Thickness of soil moisture
         Only required if state_var is soil moisture
+    nproc: <int>
+        Number of processors for mp
         
     Returns
     ----------
-    da_bias_norm_var: <xr.DataArray>
-        Variance of ensemble-normalized bias for the whole domain; dimension: [lat, lon]
+    da_nensk: <xr.DataArray>
+        NENSK for the whole domain; dimension: [lat, lon]
     '''
 
-    if not os.path.isfile(out_nc):  # if RMSE is not already calculated
-        # --- Extract variables --- #
-        if var == 'sm1':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-        elif var == 'sm2':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-        elif var == 'sm3':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-        elif var == 'runoff_daily':
-            da_truth = ds_truth['OUT_RUNOFF'].resample(
-                '1D', dim='time', how='sum')
-            da_model = ds_model['OUT_RUNOFF']
-        elif var == 'baseflow_daily':
-            da_truth = ds_truth['OUT_BASEFLOW'].resample(
-                '1D', dim='time', how='sum')
-            da_model = ds_model['OUT_BASEFLOW']
-        elif var == 'totrunoff_daily':
-            da_truth = \
-                ds_truth['OUT_RUNOFF'].resample('1D', dim='time', how='sum') + \
-                ds_truth['OUT_BASEFLOW'].resample('1D', dim='time', how='sum')
-            da_model = \
-                ds_model['OUT_RUNOFF'] + \
-                ds_model['OUT_BASEFLOW']
-        elif var == 'runoff_daily_log':
-            da_truth = np.log(ds_truth['OUT_RUNOFF'].resample(
-                '1D', dim='time', how='sum') + 1)
-            da_model = np.log(ds_model['OUT_RUNOFF'] + 1)
-        elif var == 'baseflow_daily_log':
-            da_truth = np.log(ds_truth['OUT_BASEFLOW'].resample(
-                '1D', dim='time', how='sum') + 1)
-            da_model = np.log(ds_model['OUT_BASEFLOW'] + 1)
-        elif var == 'totrunoff_daily_log':
-            da_truth = np.log(
-                ds_truth['OUT_RUNOFF'].resample('1D', dim='time', how='sum') + \
-                ds_truth['OUT_BASEFLOW'].resample('1D', dim='time', how='sum') +1)
-            da_model = np.log(
-                ds_model['OUT_RUNOFF'] + \
-                ds_model['OUT_BASEFLOW'] + 1)
-        # --- Calculate nensk for the whole domain --- #
-        nensk_domain = np.asarray(
-            [nensk(
-                da_truth.sel(lat=lat, lon=lon).values,
-                da_model.sel(lat=lat, lon=lon).transpose('time', 'N').values)
-             for lat in da_truth['lat'].values
-             for lon in da_truth['lon'].values])
-        # --- Reshape results --- #
-        nensk_domain = nensk_domain.reshape(
-            [len(da_truth['lat']), len(da_truth['lon'])])
-        # --- Put results into da's --- #
-        da_nensk = xr.DataArray(
-            nensk_domain, coords=[da_truth['lat'], da_truth['lon']],
-            dims=['lat', 'lon'])
-        # Save RMSE to netCDF file
-        ds_nensk = xr.Dataset(
-            {'nensk': da_nensk})
-        ds_nensk.to_netcdf(out_nc, format='NETCDF4_CLASSIC')
-    else:  # if RMSE is already calculated
-        da_nensk = xr.open_dataset(out_nc)['nensk']
-    
-    return da_nensk
+    return calculate_metrics(out_nc, ds_truth, ds_model, var, ['nensk'],
+                             depth_sm=depth_sm, model_daily=True,
+                             nproc=nproc)['nensk']
 
 
 def crps(truth, ensemble):
@@ -1010,14 +969,9 @@ def crps(truth, ensemble):
     ----------
     crps: <float>
         Time-series-mean CRPS
-        
-    Require
-    ----------
-    import properscoring as ps
     '''
     
-    array_crps = np.asarray([ps.crps_ensemble(truth[t], ensemble[t, :]) for t in range(len(truth))])
-    crps = array_crps.mean()
+    crps = crps_ensemble_sorted(truth, ensemble).mean()
     
     return crps
 
@@ -1079,3 +1033,196 @@ def nensk(truth, ensemble):
     return nensk
 
 
+def crps_ensemble_sorted(truth, ensemble):
+    ''' Calculate CRPS of ensemble forecasts against truth, using the closed form
+    over the sorted ensemble:
+            crps = mean_i(|x_i - y|) - 1/N^2 * sum_i((2i - N - 1) * x_(i))
+    where x_(i) is the i-th smallest member (i = 1, ..., N). This equals
+    properscoring.crps_ensemble, but for a whole array of forecasts at once.
+
+    Parameters
+    ----------
+    truth: <np.array>
+        Truth values; any dimension [...]
+    ensemble: <np.array>
+        Ensemble values; dimension: [..., N], where N is ensemble size and the
+        leading dimensions are the same as truth
+
+    Returns
+    ----------
+    crps: <np.array>
+        CRPS; same dimension as truth. NaN if truth or any member is NaN
+    '''
+
+    N = ensemble.shape[-1]
+    ensemble_sorted = np.sort(ensemble, axis=-1)  # [..., N]
+    weight = (2 * np.arange(1, N+1) - N - 1) / N**2  # [N]
+    crps = np.absolute(ensemble_sorted - truth[..., np.newaxis]).mean(axis=-1) - \
+           (ensemble_sorted * weight).sum(axis=-1)
+
+    return crps
+
+
+def calculate_ensemble_metrics_block(truth, ensemble, list_metrics=None):
+    ''' Calculate ensemble skill metrics for a block of grid cells at once.
+
+    Parameters
+    ----------
+    truth: <np.array>
+        Truth time series; dimension: [n, ncell]
+    ensemble: <np.array>
+        Ensemble time series; dimension: [n, ncell, N]
+    list_metrics: <list>
+        Metrics to calculate; default: all metrics, which are:
+            crps - time-mean CRPS (same as crps())
+            bias_norm_var - same as bias_ensemble_norm_var()
+            nensk - same as nensk()
+            rmse - RMSE of the ensemble mean (same as rmse())
+            pbias - percent bias of the ensemble mean, NaN skipped (same as
+                    calculate_pbias())
+
+    Returns
+    ----------
+    dict_metrics: <OrderedDict>
+        Metric name -> metric values of dimension [ncell]
+    '''
+
+    if list_metrics is None:
+        list_metrics = ['crps', 'bias_norm_var', 'nensk', 'rmse', 'pbias']
+
+    ens_mean = ensemble.mean(axis=2)  # [n, ncell]
+    mean_bias = ens_mean - truth  # [n, ncell]
+    if 'bias_norm_var' in list_metrics or 'nensk' in list_metrics:
+        ens_var = ensemble.var(axis=2)  # [n, ncell]
+
+    dict_metrics = OrderedDict()
+    for metric in list_metrics:
+        if metric == 'crps':
+            dict_metrics[metric] = crps_ensemble_sorted(truth, ensemble).mean(axis=0)
+        elif metric == 'bias_norm_var':
+            dict_metrics[metric] = (mean_bias / np.sqrt(ens_var)).var(axis=0)
+        elif metric == 'nensk':
+            dict_metrics[metric] = np.square(mean_bias).mean(axis=0) / \
+                                   ens_var.mean(axis=0)
+        elif metric == 'rmse':
+            dict_metrics[metric] = np.sqrt(
+                np.square(mean_bias).sum(axis=0) / len(truth))
+        elif metric == 'pbias':
+            truth_mean = np.nanmean(truth, axis=0)  # [ncell]
+            dict_metrics[metric] = (np.nanmean(ens_mean, axis=0) - truth_mean) / \
+                                   truth_mean * 100
+        else:
+            raise ValueError('Unsupported metric {}!'.format(metric))
+
+    return dict_metrics
+
+
+def calculate_ensemble_metrics(da_truth, da_model, nproc=1, nlat_chunk=10,
+                               list_metrics=None, ds_cached=None):
+    ''' Calculate ensemble skill metrics (see calculate_ensemble_metrics_block)
+    for the whole domain. The domain is processed in chunks of lat rows, so that
+    only one chunk of the [time, lat, lon, N] block is in memory per process.
+    Each chunk is also hashed by content, so that results of unchanged chunks
+    can be taken from a previous run (ds_cached).
+
+    Parameters
+    ----------
+    da_truth: <xr.DataArray>
+        Truth time series; dimension: [time, lat, lon] (any order)
+    da_model: <xr.DataArray>
+        Ensemble time series; dimension: [time, lat, lon, N] (any order); time
+        must be the same as da_truth
+    nproc: <int>
+        Number of processors for mp; parallelized over chunks
+    nlat_chunk: <int>
+        Number of lat rows per chunk
+    list_metrics: <list>
+        Metrics to calculate; default: all metrics
+    ds_cached: <xr.Dataset>
+        Results of a previous run of this function (with the same domain), or
+        None. Chunks whose hash matches ds_cached.attrs['chunk_hash'] are not
+        recalculated.
+
+    Returns
+    ----------
+    ds_metrics: <xr.Dataset>
+        Metrics; each with dimension [lat, lon]. The chunk hashes are stored in
+        ds_metrics.attrs['chunk_hash'] (space-separated)
+    '''
+
+    if list_metrics is None:
+        list_metrics = ['crps', 'bias_norm_var', 'nensk', 'rmse', 'pbias']
+
+    da_truth = da_truth.transpose('time', 'lat', 'lon')
+    da_model = da_model.transpose('time', 'lat', 'lon', 'N')
+    nlat = len(da_truth['lat'])
+    nlon = len(da_truth['lon'])
+    list_lat_slice = [slice(i, i+nlat_chunk) for i in range(0, nlat, nlat_chunk)]
+
+    # --- Check cached results --- #
+    list_chunk_hash_cached = []
+    if ds_cached is not None and \
+            all(metric in ds_cached for metric in list_metrics):
+        list_chunk_hash_cached = ds_cached.attrs.get('chunk_hash', '').split()
+    # Time and chunking are part of every chunk hash
+    hash_base = hashlib.sha1()
+    hash_base.update(str(nlat_chunk).encode())
+    hash_base.update(np.ascontiguousarray(da_truth['time'].values))
+    hash_base.update(np.ascontiguousarray(da_truth['lon'].values))
+
+    def _load_chunk(i):
+        truth = da_truth.isel(lat=list_lat_slice[i]).values  # [n, nlat_chunk, nlon]
+        ensemble = da_model.isel(lat=list_lat_slice[i]).values  # [n, nlat_chunk, nlon, N]
+        hash_chunk = hash_base.copy()
+        hash_chunk.update(np.ascontiguousarray(
+            da_truth['lat'].values[list_lat_slice[i]]))
+        hash_chunk.update(np.ascontiguousarray(truth))
+        hash_chunk.update(np.ascontiguousarray(ensemble))
+        return (hash_chunk.hexdigest(),
+                truth.reshape([truth.shape[0], -1]),
+                ensemble.reshape([ensemble.shape[0], -1, ensemble.shape[-1]]))
+
+    # --- Calculate metrics chunk by chunk --- #
+    # Load nproc chunks at a time to bound memory
+    list_dict_metrics = []
+    list_chunk_hash = []
+    if nproc > 1:
+        pool = mp.Pool(processes=nproc)
+    for i_start in range(0, len(list_lat_slice), nproc):
+        list_args = []
+        list_i_calc = []
+        for i in range(i_start, min(i_start+nproc, len(list_lat_slice))):
+            hash_chunk, truth, ensemble = _load_chunk(i)
+            list_chunk_hash.append(hash_chunk)
+            if i < len(list_chunk_hash_cached) and \
+                    list_chunk_hash_cached[i] == hash_chunk:
+                list_dict_metrics.append(OrderedDict(
+                    (metric, ds_cached[metric].isel(
+                        lat=list_lat_slice[i]).values.ravel())
+                    for metric in list_metrics))
+            else:
+                list_dict_metrics.append(None)
+                list_i_calc.append(i)
+                list_args.append((truth, ensemble, list_metrics))
+        if nproc > 1:
+            results = pool.starmap(calculate_ensemble_metrics_block, list_args)
+        else:
+            results = [calculate_ensemble_metrics_block(*args) for args in list_args]
+        for i, dict_metrics in zip(list_i_calc, results):
+            list_dict_metrics[i] = dict_metrics
+    if nproc > 1:
+        pool.close()
+        pool.join()
+
+    # --- Put results into ds --- #
+    ds_metrics = xr.Dataset()
+    for metric in list_metrics:
+        metric_domain = np.concatenate(
+            [dict_metrics[metric] for dict_metrics in list_dict_metrics])
+        ds_metrics[metric] = xr.DataArray(
+            metric_domain.reshape([nlat, nlon]),
+            coords=[da_truth['lat'], da_truth['lon']],
+            dims=['lat', 'lon'])
+    ds_metrics.attrs['chunk_hash'] = ' '.join(list_chunk_hash)
+
+    return ds_metrics
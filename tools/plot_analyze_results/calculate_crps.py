@@ -3,99 +3,12 @@ import sys
 import os
 import warnings
 warnings.filterwarnings('ignore')
-import numpy as np
 import pandas as pd
-import multiprocessing as mp
 import xarray as xr
 
 from tonic.io import read_configobj
-from analysis_utils import crps, setup_output_dirs, get_soil_depth
-
-
-def calculate_crps(out_nc, ds_truth, ds_model, var, depth_sm=None, nproc=1):
-    ''' A wrap funciton that calculates CRPS for all domain and save to file; if
-        result file already existed, then simply read in the file.
-
-    Parameters
-    ----------
-    out_nc: <str>
-        RMSE result output netCDF file
-    ds_truth: <xr.Dataset>
-        Truth states/history
-    ds_model: <xr.Dataset>
-        Model states/history whose RMSE is to be assessed (wrt. truth states);
-        This should be ensemble model results, with "N" as the ensemble dimension
-    var: <str>
-        Variable, options:
-            sm1; sm2; sm3; runoff_daily_log; baseflow_daily_log; totrunoff_daily_log
-        NOTE: sm's and swe are from states; runoff's are from history file
-    depth_sm: <xr.DataArray>
-        Thickness of soil moisture
-        Only required if state_var is soil moisture
-    nproc: <int>
-        Number of processors for mp
-
-    Returns
-    ----------
-    da_crps: <xr.DataArray>
-        CRPS for the whole domain; dimension: [lat, lon]
-    '''
-
-    if not os.path.isfile(out_nc):  # if RMSE is not already calculated
-        # --- Extract variables --- #
-        if var == 'sm1':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=0) / depth_sm
-        elif var == 'sm2':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=1) / depth_sm
-        elif var == 'sm3':
-            da_truth = ds_truth['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-            da_model = ds_model['SOIL_MOISTURE'].sel(nlayer=2) / depth_sm
-        elif var == 'runoff_daily_log':
-            da_truth = np.log(ds_truth['OUT_RUNOFF'].resample(
-                '1D', dim='time', how='sum') + 1)
-            da_model = np.log(ds_model['OUT_RUNOFF'] + 1)
-        elif var == 'baseflow_daily_log':
-            da_truth = np.log(ds_truth['OUT_BASEFLOW'].resample(
-                '1D', dim='time', how='sum') + 1)
-            da_model = np.log(ds_model['OUT_BASEFLOW'] + 1)
-        elif var == 'totrunoff_daily_log':
-            da_truth = np.log(
-                ds_truth['OUT_RUNOFF'].resample('1D', dim='time', how='sum') + \
-                ds_truth['OUT_BASEFLOW'].resample('1D', dim='time', how='sum') +1)
-            da_model = np.log(
-                ds_model['OUT_RUNOFF'] + \
-                ds_model['OUT_BASEFLOW'] + 1)
-
-        # --- Calculate CRPS for the whole domain --- #
-        results = {}
-        pool = mp.Pool(processes=nproc)
-        for lat in da_truth['lat'].values:
-            for lon in da_truth['lon'].values:
-                results[(lat, lon)] = pool.apply_async(
-                    crps, (da_truth.sel(lat=lat, lon=lon).values,
-                           da_model.sel(lat=lat, lon=lon).transpose('time', 'N').values))
-        pool.close()
-        pool.join()
-        # --- Get return values --- #
-        crps_domain = np.zeros([len(da_truth['lat']), len(da_truth['lon'])])
-        crps_domain[:] = np.nan
-        da_crps = xr.DataArray(
-            crps_domain, coords=[da_truth['lat'], da_truth['lon']],
-            dims=['lat', 'lon'])
-        for i, result in results.items():
-            lat = i[0]
-            lon = i[1]
-            da_crps.loc[lat, lon] = result.get()
-        # Save CRPS to netCDF file
-        ds_crps = xr.Dataset(
-            {'crps': da_crps})
-        ds_crps.to_netcdf(out_nc, format='NETCDF4_CLASSIC')
-    else:  # if RMSE is already calculated
-        da_crps = xr.open_dataset(out_nc)['crps']
-
-    return da_crps
+from analysis_utils import calculate_crps, setup_output_dirs, get_soil_depth, \
+                           to_netcdf_timeseries_chunked
 
 
 # ========================================================== #
@@ -220,7 +133,9 @@ if var == 'sm1' or var == 'sm2' or var == 'sm3':
                     i+1)))
             list_ds_allEns.append(ds)
         ds_EnKF_states_allEns = xr.concat(list_ds_allEns, dim='N')
-        ds_EnKF_states_allEns.to_netcdf(out_nc)
+        # (saved with the full time series in each chunk, as CRPS is calculated
+        # over chunks of lat rows with all time steps and ensemble members)
+        to_netcdf_timeseries_chunked(ds_EnKF_states_allEns, out_nc)
     # --- EnKF ens-mean updated states --- #
     out_nc = os.path.join(
         EnKF_result_basedir,
@@ -260,7 +175,9 @@ else:
     da_baseflow_daily_allEns = xr.concat(list_da_baseflow_allEns, dim='N')
     ds_hist_daily_allEns = xr.Dataset({'OUT_RUNOFF': da_runoff_daily_allEns,
                                        'OUT_BASEFLOW': da_baseflow_daily_allEns})
-    ds_hist_daily_allEns.to_netcdf(out_nc)
+    # (saved with the full time series in each chunk, as CRPS is calculated
+    # over chunks of lat rows with all time steps and ensemble members)
+    to_netcdf_timeseries_chunked(ds_hist_daily_allEns, out_nc)
 # --- EnKF mean --- #
 out_nc = os.path.join(
     EnKF_result_basedir, 'history', 'EnKF_ensemble_concat',
@@ -10,6 +10,7 @@ import shutil
 import scipy.linalg as la
 import glob
 import h5py
+import netCDF4
 from scipy.stats import rankdata
 import cartopy.crs as ccrs
 import cartopy.io.shapereader as shpreader
@@ -156,7 +157,7 @@ def extract_smap_static_info(filename, orbit="AM"):
     return lat, lon
 
 
-def extract_smap_sm(filename, orbit):
+def extract_smap_sm(filename, orbit, row_slice=slice(None), col_slice=slice(None)):
     ''' This function extracts soil moisture values [cm3/cm3] from a raw SMAP L3 HDF5 file.
     
     Parameters
@@ -165,31 +166,127 @@ def extract_smap_sm(filename, orbit):
         File path of a SMAP L3 HDF5 file
     orbit: <str>
         "AM" or "PM"
+    row_slice: <slice>
+        Rows (lat) of the global grid to read; default: all
+    col_slice: <slice>
+        Columns (lon) of the global grid to read; default: all
     
     Reterns
     -------
     sm: <numpy.array>
         A 2-D soil moisture data of the whole domain (with np.nan for missing value)
+    retireval_qual_flag: <numpy.array>
+        A 2-D retrieval quality flag of the whole domain
     '''
     
     with h5py.File(filename, 'r') as f:
-        # Extract soil moisture data
+        # Extract soil moisture data (only the hyperslab needed is read)
         if orbit == "AM":
-            sm = f['Soil_Moisture_Retrieval_Data_AM']['soil_moisture'].value
+            sm = f['Soil_Moisture_Retrieval_Data_AM']['soil_moisture'][row_slice, col_slice]
             missing_value = f['Soil_Moisture_Retrieval_Data_AM']['soil_moisture'].attrs['_FillValue']
-            retireval_qual_flag = f['Soil_Moisture_Retrieval_Data_AM']['retrieval_qual_flag'].value
+            retireval_qual_flag = f['Soil_Moisture_Retrieval_Data_AM']['retrieval_qual_flag'][row_slice, col_slice]
         else:
-            sm = f['Soil_Moisture_Retrieval_Data_PM']['soil_moisture_pm'].value
+            sm = f['Soil_Moisture_Retrieval_Data_PM']['soil_moisture_pm'][row_slice, col_slice]
             missing_value = f['Soil_Moisture_Retrieval_Data_PM']['soil_moisture_pm'].attrs['_FillValue']
-            retireval_qual_flag = f['Soil_Moisture_Retrieval_Data_PM']['retrieval_qual_flag_pm'].value
+            retireval_qual_flag = f['Soil_Moisture_Retrieval_Data_PM']['retrieval_qual_flag_pm'][row_slice, col_slice]
         # Mask missing points
         sm[sm==missing_value] = np.nan
         
     return sm, retireval_qual_flag
 
 
-def extract_smap_multiple_days(filename, start_date, end_date, da_smap_domain=None):
-    ''' This function imports a chunk of days of SMAP L3 data and put in a xr.DataArray, skipping missing dates
+def calculate_smap_domain_slices(lat, lon, da_smap_domain):
+    ''' Calculates the row and column slices of the global SMAP grid that cover
+        a SMAP domain.
+
+    Parameters
+    ----------
+    lat: <numpy.array>
+        Latitudes of the global SMAP grid (descending order; from
+        extract_smap_static_info)
+    lon: <numpy.array>
+        Longitudes of the global SMAP grid (ascending order)
+    da_smap_domain: <xr.DataArray>
+        SMAP domain to extract. None for the global domain
+
+    Returns
+    ----------
+    row_slice: <slice>
+        Rows (lat) to read
+    col_slice: <slice>
+        Columns (lon) to read
+    '''
+
+    if da_smap_domain is None:
+        return slice(None), slice(None)
+
+    domain_lat_range = [da_smap_domain['lat'].values[0],
+                        da_smap_domain['lat'].values[-1]]
+    domain_lon_range = [da_smap_domain['lon'].values[0],
+                        da_smap_domain['lon'].values[-1]]
+    rows, = np.where((lat <= domain_lat_range[0]+0.05) &
+                     (lat >= domain_lat_range[1]-0.05))
+    cols, = np.where((lon >= domain_lon_range[0]-0.05) &
+                     (lon <= domain_lon_range[1]+0.05))
+
+    return slice(rows[0], rows[-1]+1), slice(cols[0], cols[-1]+1)
+
+
+def extract_smap_one_day(filename, date, row_slice, col_slice):
+    ''' This function loads AM and PM SMAP L3 data of one day for a domain.
+
+    Parameters
+    ----------
+    filename: <str>
+        Template file path of SMAP L3 HDF5 files (see extract_smap_multiple_days)
+    date: <pd.Timestamp>
+        Date to load
+    row_slice: <slice>
+        Rows (lat) of the global grid to read
+    col_slice: <slice>
+        Columns (lon) of the global grid to read
+
+    Returns
+    ----------
+    sm: <numpy.array>
+        Soil moisture; dimension: [2 (AM, PM), lat, lon]; np.nan if an orbit
+        cannot be loaded
+    flag: <numpy.array>
+        Retrieval quality flag; dimension: [2 (AM, PM), lat, lon]; np.nan if an
+        orbit cannot be loaded
+    loaded: <numpy.array>
+        Whether each orbit is loaded; dimension: [2 (AM, PM)]
+    '''
+
+    date_str = date.strftime("%Y%m%d")  # date in YYYYMMMDD
+    sm = None
+    flag = None
+    loaded = np.zeros(2, dtype=bool)
+    for i, orbit in enumerate(['AM', 'PM']):
+        try:
+            sm_orbit, flag_orbit = extract_smap_sm(
+                glob.glob(filename.format(date_str))[0], orbit,
+                row_slice=row_slice, col_slice=col_slice)
+        except:
+            print("Warning: cannot load {} data for {}. Assign missing value for this time.".format(
+                orbit, date_str))
+            continue
+        if sm is None:
+            sm = np.full([2] + list(sm_orbit.shape), np.nan)
+            flag = np.full([2] + list(sm_orbit.shape), np.nan)
+        sm[i, :, :] = sm_orbit
+        flag[i, :, :] = flag_orbit
+        loaded[i] = True
+
+    return sm, flag, loaded
+
+
+def extract_smap_multiple_days(filename, start_date, end_date, da_smap_domain=None,
+                               nproc=1, out_nc=None):
+    ''' This function imports a chunk of days of SMAP L3 data and put in a xr.DataArray, skipping missing dates.
+        Only the domain hyperslab is read from each file; days are loaded in
+        parallel. If out_nc is specified, data are streamed into an on-disk cube
+        (see ingest_smap_days), skipping days already in it.
 
     Parameters
     ----------
@@ -204,10 +301,31 @@ def extract_smap_multiple_days(filename, start_date, end_date, da_smap_domain=No
         e.g.: "20150430"
     da_smap_domain: <xr.DataArray>
         SMAP domain to extract. None for keeping the global domain
+    nproc: <int>
+        Number of processors for mp (over days)
+    out_nc: <str>
+        On-disk SMAP cube netCDF file; None for loading in memory only
+
+    Returns
+    ----------
+    da: <xr.DataArray>
+        SMAP soil moisture; dimension: [time, lat, lon]
+    da_flag: <xr.DataArray>
+        SMAP retrieval quality flag; dimension: [time, lat, lon]
     '''
 
+    if out_nc is not None:
+        ingest_smap_days(filename, start_date, end_date, out_nc,
+                         da_smap_domain=da_smap_domain, nproc=nproc)
+        with xr.open_dataset(out_nc) as ds:
+            ds = ds.sel(time=slice(pd.to_datetime(start_date),
+                                   pd.to_datetime(end_date) + pd.DateOffset(hours=18))).load()
+        return ds['soil_moisture'], ds['retrieval_qual_flag']
+
     # Extract static info
     lat, lon = extract_smap_static_info(glob.glob(filename.format(start_date))[0])
+    # Domain hyperslab to read
+    row_slice, col_slice = calculate_smap_domain_slices(lat, lon, da_smap_domain)
 
     # Process time period
     dates = pd.date_range(start_date, end_date)  # dates only
@@ -215,84 +333,131 @@ def extract_smap_multiple_days(filename, start_date, end_date, da_smap_domain=No
                           "{}-{:02d}".format(end_date, 18),
                           freq='12H')  # AM and PM measurement times
 
-    # Initialize a DataArray for the entire global domain
-    da_global = xr.DataArray(np.empty([len(lat), len(lon)]),
-                             coords=[lat, lon], dims=['lat', 'lon'])
-
     # Initialize domain da
-    if da_smap_domain is None:  # if there is no domain file, extract the entire global domain
-        da = xr.DataArray(np.empty([len(times), len(lat), len(lon)]),
-                          coords=[times, lat, lon], dims=['time', 'lat', 'lon'])
-    if da_smap_domain is not None:  # if there is a domain file, extract domain only
-        da = xr.DataArray(np.empty([len(times), len(da_smap_domain['lat']),
-                                    len(da_smap_domain['lon'])]),
-                          coords=[times, da_smap_domain['lat'], da_smap_domain['lon']],
-                          dims=['time', 'lat', 'lon'])
+    da = xr.DataArray(np.empty([len(times), len(lat[row_slice]), len(lon[col_slice])]),
+                      coords=[times, lat[row_slice], lon[col_slice]],
+                      dims=['time', 'lat', 'lon'])
     da[:] = np.nan
     da_flag = da.copy(deep=True)
 
     # Load data for each day
-    if da_smap_domain is not None:
-        domain_lat_range = [da_smap_domain['lat'].values[0],
-                            da_smap_domain['lat'].values[-1]]
-        domain_lon_range = [da_smap_domain['lon'].values[0],
-                            da_smap_domain['lon'].values[-1]]
-    for date in dates:
-        print('Loading {}'.format(date))
-        date_str = date.strftime("%Y%m%d")  # date in YYYYMMMDD
-        # --- Load AM data for this day --- #
-        try:
-            sm_am, retireval_qual_flag_am = extract_smap_sm(glob.glob(filename.format(date_str))[0], "AM")
-            # Clip domain
-            if da_smap_domain is not None:
-                # Retrieval data
-                da_global[:, :] = sm_am
-                da_domain_data = da_global.sel(
-                    lat=slice(domain_lat_range[0]+0.05, domain_lat_range[1]-0.05),
-                    lon=slice(domain_lon_range[0]-0.05, domain_lon_range[1]+0.05))
-                sm_am = da_domain_data.values.copy()
-                # Retrieval flag
-                da_global[:, :] = retireval_qual_flag_am
-                da_domain_data = da_global.sel(
-                    lat=slice(domain_lat_range[0]+0.05, domain_lat_range[1]-0.05),
-                    lon=slice(domain_lon_range[0]-0.05, domain_lon_range[1]+0.05))
-                retireval_qual_flag_am = da_domain_data.values.copy()
-                
-        except:
-            print("Warning: cannot load AM data for {}. Assign missing value for this time.".format(date_str))
-            continue
-        # Put in the final da
-        time = date + pd.DateOffset(hours=6)
-        da.loc[time, :, :] = sm_am
-        da_flag.loc[time, :, :] = retireval_qual_flag_am
-        # --- Load PM data for this day --- #
-        try:
-            sm_pm, retrieval_qual_flag_pm = extract_smap_sm(glob.glob(filename.format(date_str))[0], "PM")
-            # Clip domain
-            if da_smap_domain is not None:
-                # Retrieval data
-                da_global[:, :] = sm_pm
-                da_domain_data = da_global.sel(
-                    lat=slice(domain_lat_range[0]+0.05, domain_lat_range[1]-0.05),
-                    lon=slice(domain_lon_range[0]-0.05, domain_lon_range[1]+0.05))
-                sm_pm = da_domain_data.values.copy()
-                # Retrieval flag
-                da_global[:, :] = retrieval_qual_flag_pm
-                da_domain_data = da_global.sel(
-                    lat=slice(domain_lat_range[0]+0.05, domain_lat_range[1]-0.05),
-                    lon=slice(domain_lon_range[0]-0.05, domain_lon_range[1]+0.05))
-                retrieval_qual_flag_pm = da_domain_data.values.copy()
-        except:
-            print("Warning: cannot load PM data for {}. Assign missing value for this time.".format(date_str))
-            continue
-        # Put in da
-        time = date + pd.DateOffset(hours=18)
-        da.loc[time, :, :] = sm_pm
-        da_flag.loc[time, :, :] = retrieval_qual_flag_pm
+    pool = mp.Pool(processes=nproc)
+    results = [pool.apply_async(extract_smap_one_day,
+                                (filename, date, row_slice, col_slice))
+               for date in dates]
+    pool.close()
+    for i, result in enumerate(results):
+        print('Loading {}'.format(dates[i]))
+        sm, flag, loaded = result.get()
+        if loaded.any():
+            da[2*i:2*i+2, :, :] = sm
+            da_flag[2*i:2*i+2, :, :] = flag
+    pool.join()
 
     return da, da_flag
 
 
+def ingest_smap_days(filename, start_date, end_date, out_nc, da_smap_domain=None,
+                     nproc=1):
+    ''' This function ingests days of SMAP L3 data of a domain into an on-disk
+        netCDF cube, with the retrieval quality flags alongside. Days are loaded
+        in parallel and written to the cube as they finish. Orbits already
+        loaded into the cube are skipped, so rerunning with a later end_date only
+        reads the new files (and the files that were missing before).
+
+    Parameters
+    ----------
+    filename: <str>
+        Template file path of SMAP L3 HDF5 files (see extract_smap_multiple_days)
+    start_date: <str>
+        Start time of the period, in "YYYYMMDD" format. If out_nc already exists,
+        must not be earlier than its start
+    end_date: <str>
+        End time of the period, in "YYYYMMDD" format.
+    out_nc: <str>
+        SMAP cube netCDF file; created if not existing. Variables:
+            soil_moisture, retrieval_qual_flag - [time, lat, lon]
+            loaded - [time]; 1 for orbits loaded from SMAP files
+    da_smap_domain: <xr.DataArray>
+        SMAP domain to extract. None for keeping the global domain
+    nproc: <int>
+        Number of processors for mp (over days)
+
+    Require
+    ----------
+    netCDF4
+    '''
+
+    dates = pd.date_range(start_date, end_date)  # dates only
+
+    # --- Create the cube if not existing --- #
+    if not os.path.isfile(out_nc):
+        # Extract static info from the first available file
+        list_files = [f for date in dates
+                      for f in glob.glob(filename.format(date.strftime('%Y%m%d')))]
+        lat, lon = extract_smap_static_info(list_files[0])
+        row_slice, col_slice = calculate_smap_domain_slices(lat, lon, da_smap_domain)
+        nc = netCDF4.Dataset(out_nc, 'w', format='NETCDF4')
+        nc.createDimension('time', None)
+        nc.createDimension('lat', len(lat[row_slice]))
+        nc.createDimension('lon', len(lon[col_slice]))
+        nc.createVariable('time', 'f8', ('time',))
+        nc['time'].units = 'hours since {}'.format(dates[0].strftime('%Y-%m-%d %H:%M:%S'))
+        nc['time'].calendar = 'proleptic_gregorian'
+        nc.createVariable('lat', 'f8', ('lat',))[:] = lat[row_slice]
+        nc.createVariable('lon', 'f8', ('lon',))[:] = lon[col_slice]
+        # (chunked by month of AM & PM times, for time series reads)
+        chunksizes = (62, len(lat[row_slice]), len(lon[col_slice]))
+        for varname in ['soil_moisture', 'retrieval_qual_flag']:
+            nc.createVariable(varname, 'f8', ('time', 'lat', 'lon'),
+                              zlib=True, complevel=1, chunksizes=chunksizes,
+                              fill_value=np.nan)
+        nc.createVariable('loaded', 'i1', ('time',))
+        nc.row_start = int(row_slice.start or 0)
+        nc.col_start = int(col_slice.start or 0)
+    else:
+        nc = netCDF4.Dataset(out_nc, 'a')
+
+    # --- Extend time axis to end_date --- #
+    time_start = pd.to_datetime(nc['time'].units.split('since ')[1])
+    ind_start = (dates[0] - time_start).days * 2
+    if ind_start < 0:
+        nc.close()
+        raise ValueError('start_date is earlier than the start of {}!'.format(out_nc))
+    ntime = (dates[-1] - time_start).days * 2 + 2
+    ntime_old = len(nc['time'])
+    if ntime > ntime_old:
+        nc['time'][ntime_old:ntime] = 6 + 12 * np.arange(ntime_old, ntime)
+        nc['loaded'][ntime_old:ntime] = 0
+
+    # --- Load days not yet loaded --- #
+    row_slice = slice(nc.row_start, nc.row_start + len(nc.dimensions['lat']))
+    col_slice = slice(nc.col_start, nc.col_start + len(nc.dimensions['lon']))
+    loaded_cube = nc['loaded'][ind_start:ntime].reshape([-1, 2])  # [day, AM/PM]
+    dates_to_load = [date for i, date in enumerate(dates)
+                     if not loaded_cube[i].all()]
+    pool = mp.Pool(processes=nproc)
+    results = [pool.apply_async(extract_smap_one_day,
+                                (filename, date, row_slice, col_slice))
+               for date in dates_to_load]
+    pool.close()
+    # Write each day into the cube as it finishes (in date order)
+    for date, result in zip(dates_to_load, results):
+        print('Loading {}'.format(date))
+        sm, flag, loaded = result.get()
+        if not loaded.any():
+            continue
+        # (only overwrite orbits that are loaded)
+        for i in np.where(loaded)[0]:
+            ind = (date - time_start).days * 2 + i
+            nc['soil_moisture'][ind, :, :] = sm[i]
+            nc['retrieval_qual_flag'][ind, :, :] = flag[i]
+            nc['loaded'][ind] = 1
+        nc.sync()
+    pool.join()
+    nc.close()
+
+
 def edges_from_centers(centers):
     ''' Return an array of grid edge values from grid center values
     Parameters
@@ -610,6 +775,7 @@ def rescale_SMAP_domain(da_smap, da_reference, smap_times_am, smap_times_pm,
 
 def rescale_domain(da_input, da_reference, method):
     ''' Rescales an input domain of time series to be in the same regime of a reference domain.
+    All grid cells are rescaled at once (see rescale_array).
     Currently ignores all NANs in da_reference.
 
     Parameters
@@ -617,9 +783,12 @@ def rescale_domain(da_input, da_reference, method):
     da_input: <xr.DataArray>
         Input data. Dimension: [time, lat, lon]
     da_reference: <xr.DataArray>
-        Refererence data. Dimension: [time, lat, lon]. Can be different length from da_input.
+        Refererence data. Dimension: [time, lat, lon]. Must be at the same time
+        points as da_input.
     method: <str>
         Options: "moment_2nd" - matching mean and standard deviation
+                 "moment_2nd_season" - see rescale_ts
+                 "cdf" - see rescale_ts
 
     Returns
     ----------
@@ -627,30 +796,16 @@ def rescale_domain(da_input, da_reference, method):
         Rescaled data
     '''
 
-    # Rescale input data for each grid cell
+    # Rescale input data for all grid cells
     ncells = len(da_input['lat']) * len(da_input['lon'])
-    da_input_flat = da_input.values.reshape([-1, ncells]) # [time, lat*lon]
-    da_reference_flat = da_reference.values.reshape([-1, ncells])  # [time, lat*lon]
-    list_data_rescaled_flat = np.asarray(
-        [rescale_ts(pd.Series(da_input_flat[:, i], index=da_input['time'].values),
-                    pd.Series(da_reference_flat[:, i], index=da_reference['time'].values),
-                    method=method)
-         for i in range(ncells)])  # [lat*lon, time]
-    # Extract flattened scaled data, std_input and std_reference
-    data_rescaled_flat = np.asarray([item[0] for item in list_data_rescaled_flat])
-    std_input_rescaled_flat = np.asarray([item[1] for item in list_data_rescaled_flat])
-    std_reference_rescaled_flat = np.asarray([item[2] for item in list_data_rescaled_flat])
-    # Reshape
-    data_rescaled = data_rescaled_flat.reshape(
-        [len(da_input['lat']), len(da_input['lon']), -1])  # [lat, lon, time]
-    data_rescaled = np.rollaxis(data_rescaled, 2, 0)  # [time, lat, lon]
-    std_input_rescaled = std_input_rescaled_flat.reshape(
-        [len(da_input['lat']), len(da_input['lon'])])  # [lat, lon]
-    std_reference_rescaled = std_reference_rescaled_flat.reshape(
-        [len(da_input['lat']), len(da_input['lon'])])  # [lat, lon]
+    data_input_flat = da_input.values.reshape([-1, ncells]) # [time, lat*lon]
+    data_reference_flat = da_reference.values.reshape([-1, ncells])  # [time, lat*lon]
+    data_rescaled_flat, std_input, std_reference = rescale_array(
+        data_input_flat, data_reference_flat, da_input['time'].values,
+        method=method)  # [time, lat*lon]
     # Put back into da
     da_rescaled = da_input.copy()
-    da_rescaled[:] = data_rescaled
+    da_rescaled[:] = data_rescaled_flat.reshape(da_input.shape)  # [time, lat, lon]
 
     return da_rescaled
 
@@ -664,13 +819,14 @@ def rescale_ts(ts_input, ts_reference, method):
     ts_input: <pd.Series>
         Input time series
     ts_reference: <pd.Series>
-        Reference time series
+        Reference time series (at the same time points as ts_input)
     method: <str>
         Options: "moment_2nd" - matching mean and standard deviation
                  "moment_2nd_season" - matching mean and standard deviation; mean is
                      sampled using  31-day window of year; standard deviation is kept
                      constant temporally (following SMART paper 2011)
-                 "cdf" - cdf matching. Will return None for ts_std_input and ts_std_reference
+                 "cdf" - cdf matching, with ECDF's sampled using 31-day window of year.
+                     Will return None for std_input and std_reference
 
     Returns
     ----------
@@ -682,52 +838,225 @@ def rescale_ts(ts_input, ts_reference, method):
         Reference standard deviation
     '''
 
+    data_rescaled, std_input, std_reference = rescale_array(
+        ts_input.values.reshape([-1, 1]),
+        ts_reference.values.reshape([-1, 1]),
+        ts_input.index,
+        method=method)
+    ts_rescaled = pd.Series(data_rescaled[:, 0], index=ts_input.index)
+    if std_input is not None:
+        std_input = std_input[0]
+        std_reference = std_reference[0]
+
+    return ts_rescaled, std_input, std_reference
+
+
+def rescale_array(data_input, data_reference, times, method):
+    ''' Rescales input time series of multiple grid cells to be in the same regime
+    of reference time series, for all grid cells at once.
+    Currently ignores all NANs in data_reference.
+
+    Parameters
+    ----------
+    data_input: <np.array>
+        Input data. Dimension: [time, ncell]
+    data_reference: <np.array>
+        Reference data at the same time points. Dimension: [time, ncell]
+    times: <np.array or pd.DatetimeIndex>
+        Time points of data_input
+    method: <str>
+        Options: see rescale_ts
+
+    Returns
+    ----------
+    data_rescaled: <np.array>
+        Rescaled data. Dimension: [time, ncell]
+    std_input: <np.array>
+        Input standard deviation. Dimension: [ncell]. None for "cdf"
+    std_reference: <np.array>
+        Reference standard deviation. Dimension: [ncell]. None for "cdf"
+    '''
+
     # Use consistent time points in the reference data vs. in the input data
-    ts_reference[np.isnan(ts_input)] = np.nan
-    
+    data_reference = data_reference.copy()
+    data_reference[np.isnan(data_input)] = np.nan
+
     if method == "moment_2nd":
-        mean_reference = np.nanmean(ts_reference)
-        std_reference = np.nanstd(ts_reference, ddof=0)
-        mean_input = np.nanmean(ts_input)
-        std_input = np.nanstd(ts_input, ddof=0)
-        ts_rescaled = mean_reference + (ts_input - mean_input) / std_input * std_reference
-        # Construct time series of ts_std_input and ts_std_reference to return
-        ts_std_input = pd.Series(np.ones(len(ts_input))*std_input, index=ts_input.index)
-        ts_std_reference = pd.Series(np.ones(len(ts_reference))*std_reference, index=ts_reference.index)
+        mean_reference = np.nanmean(data_reference, axis=0)
+        std_reference = np.nanstd(data_reference, axis=0, ddof=0)
+        mean_input = np.nanmean(data_input, axis=0)
+        std_input = np.nanstd(data_input, axis=0, ddof=0)
+        data_rescaled = mean_reference + (data_input - mean_input) / std_input * std_reference
 
     elif method == "moment_2nd_season":
-        std_reference = np.nanstd(ts_reference, ddof=0)
-        std_input = np.nanstd(ts_input, ddof=0)
-        # Calculate window-mean for both reference and input series
-        # Dict key: (month, day); value: mean value from the ts
-        dict_window_mean_reference = calculate_seasonal_window_mean(ts_reference)
-        dict_window_mean_input = calculate_seasonal_window_mean(ts_input)
-        # Construct time series of "mean_reference" and "mean_input"
-        # (mean_reference ts is constructed at the input data timestep)
-        list_mean_reference = [dict_window_mean_reference[(t.month, t.day)]
-                               for t in ts_input.index]
-        ts_mean_reference = pd.Series(list_mean_reference, index=ts_input.index)
-        list_mean_input = [dict_window_mean_input[(t.month, t.day)]
-                               for t in ts_input.index]
-        ts_mean_input = pd.Series(list_mean_input, index=ts_input.index)
-        # Rescale input ts
-        ts_rescaled = ts_mean_reference + (ts_input - ts_mean_input) / std_input * std_reference
+        std_reference = np.nanstd(data_reference, axis=0, ddof=0)
+        std_input = np.nanstd(data_input, axis=0, ddof=0)
+        # Calculate window-mean for both reference and input data
+        # (dimension: [366, ncell]; index: day of leap year)
+        window_mean_reference, _ = calculate_seasonal_window_mean_std_array(
+            data_reference, times)
+        window_mean_input, _ = calculate_seasonal_window_mean_std_array(
+            data_input, times)
+        # Rescale input data (window-mean sampled at the input data timestep)
+        dayofyear = calculate_dayofyear_leap(times)
+        data_rescaled = window_mean_reference[dayofyear] + \
+            (data_input - window_mean_input[dayofyear]) / std_input * std_reference
 
     elif method == "cdf":
-        dict_window_data_input = extract_seasonal_window_data(ts_input)
-        dict_window_data_reference = extract_seasonal_window_data(ts_reference)
-        array_rescaled = np.array(
-            [scipy.stats.mstats.mquantiles(
-                dict_window_data_reference[(t.month, t.day)],
-                calculate_ecdf_percentile(ts_input[t], dict_window_data_input[(t.month, t.day)]),
-                alphap=0, betap=0)
-             if ~np.isnan(ts_input[t]) else np.nan
-             for t in ts_input.index ])
-        ts_rescaled = pd.Series(array_rescaled, ts_input.index)
-        ts_std_input = None
-        ts_std_reference = None
+        data_rescaled = cdf_match_seasonal_window_array(
+            data_input, data_reference, times)
+        std_input = None
+        std_reference = None
 
-    return ts_rescaled, std_input, std_reference
+    else:
+        raise ValueError('Unsupported rescaling method {}!'.format(method))
+
+    return data_rescaled, std_input, std_reference
+
+
+def calculate_dayofyear_leap(times):
+    ''' Calculates day of year of time points on a leap-year calendar, so that the
+        same (month, day) always maps to the same index.
+
+    Parameters
+    ----------
+    times: <np.array or pd.DatetimeIndex>
+        Time points
+
+    Returns
+    ----------
+    dayofyear: <np.array>
+        Day of year index; 0 for Jan 1, 59 for Feb 29, 365 for Dec 31
+    '''
+
+    times = pd.DatetimeIndex(times)
+    dayofyear = np.asarray(times.dayofyear) - 1
+    # Days after Feb 28 in non-leap years are shifted by one (skipping Feb 29)
+    dayofyear[(~np.asarray(times.is_leap_year)) &
+              (np.asarray(times.month) > 2)] += 1
+
+    return dayofyear
+
+
+def calculate_seasonal_window_mean_std_array(data, times, half_window=15, ddof=1):
+    ''' Calculates seasonal window mean and std values of time series of multiple
+        grid cells (mean/std value of 31-day-window of all years, for each day of
+        year), for all grid cells at once.
+        Data are binned by day of year on a leap-year calendar; window sums are
+        then cumulative-sum differences over the circular day-of-year axis.
+
+    Parameters
+    ----------
+    data: <np.array>
+        Time series; NANs are ignored. Dimension: [time, ncell]
+    times: <np.array or pd.DatetimeIndex>
+        Time points of data
+    half_window: <int>
+        Half window length [day]; default: 15 (i.e., 31-day window)
+    ddof: <int>
+        Delta degrees of freedom of std; default: 1 (same as pd.Series.std())
+
+    Returns
+    ----------
+    window_mean: <np.array>
+        Window-mean values. Dimension: [366, ncell]; index: day of year on a
+        leap-year calendar (see calculate_dayofyear_leap)
+    window_std: <np.array>
+        Window-std values. Dimension: [366, ncell]
+    '''
+
+    dayofyear = calculate_dayofyear_leap(times)
+    valid = ~np.isnan(data)
+    # Subtract overall mean before summing squares, for numerical precision
+    center = np.nanmean(data, axis=0)  # [ncell]
+    center[np.isnan(center)] = 0
+    anomaly = np.where(valid, data - center, 0)
+
+    # --- Sum over each day of year --- #
+    count_doy = np.zeros([366] + list(data.shape[1:]))
+    sum_doy = np.zeros([366] + list(data.shape[1:]))
+    sumsq_doy = np.zeros([366] + list(data.shape[1:]))
+    np.add.at(count_doy, dayofyear, valid)
+    np.add.at(sum_doy, dayofyear, anomaly)
+    np.add.at(sumsq_doy, dayofyear, np.square(anomaly))
+
+    # --- Sum over the circular window centered around each day of year --- #
+    def _window_sum(x):
+        x = np.concatenate([x[-half_window:], x, x[:half_window]])
+        cumsum = np.concatenate([np.zeros([1] + list(x.shape[1:])),
+                                 np.cumsum(x, axis=0)])
+        return cumsum[2*half_window+1:] - cumsum[:-(2*half_window+1)]
+
+    count = np.round(_window_sum(count_doy))
+    sum_window = _window_sum(sum_doy)
+    sumsq_window = _window_sum(sumsq_doy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_anomaly = sum_window / count
+        window_mean = mean_anomaly + center
+        var = (sumsq_window - count * np.square(mean_anomaly)) / (count - ddof)
+        var[count <= ddof] = np.nan
+        window_std = np.sqrt(np.maximum(var, 0))
+
+    return window_mean, window_std
+
+
+def cdf_match_seasonal_window_array(data_input, data_reference, times,
+                                    half_window=15):
+    ''' CDF-matches input time series to reference time series, for multiple grid
+        cells at once. ECDF's are sampled using 31-day window of year of all
+        years; percentile of each input value is from the input ECDF (Weibull
+        plotting position, see calculate_ecdf_percentile), which is then mapped to
+        the reference ECDF (same as
+        scipy.stats.mstats.mquantiles(..., alphap=0, betap=0)).
+
+    Parameters
+    ----------
+    data_input: <np.array>
+        Input data. Dimension: [time, ncell]
+    data_reference: <np.array>
+        Reference data at the same time points; NANs are ignored.
+        Dimension: [time, ncell]
+    times: <np.array or pd.DatetimeIndex>
+        Time points of data_input
+    half_window: <int>
+        Half window length [day]; default: 15 (i.e., 31-day window)
+
+    Returns
+    ----------
+    data_rescaled: <np.array>
+        Rescaled data. Dimension: [time, ncell]
+    '''
+
+    dayofyear = calculate_dayofyear_leap(times)
+    data_rescaled = np.full(data_input.shape, np.nan)
+
+    for d in np.unique(dayofyear):
+        # --- Extract sorted window data of all years (NANs sorted to the end) --- #
+        in_window = np.isin(
+            dayofyear, (d + np.arange(-half_window, half_window+1)) % 366)
+        window_input = np.sort(data_input[in_window], axis=0)  # [nwindow, ncell]
+        window_reference = np.sort(data_reference[in_window], axis=0)  # [nwindow, ncell]
+        n_input = (~np.isnan(window_input)).sum(axis=0)  # [ncell]
+        n_reference = (~np.isnan(window_reference)).sum(axis=0)  # [ncell]
+        # --- Percentile of input data of this day of year --- #
+        ind_time = np.where(dayofyear == d)[0]
+        value = data_input[ind_time]  # [nt, ncell]
+        rank = (window_input[np.newaxis, :, :] < value[:, np.newaxis, :]).sum(axis=1) + 1
+        percentile = rank / (n_input + 1)  # [nt, ncell]
+        # --- Quantile of the reference ECDF --- #
+        aleph = (n_reference + 1) * percentile
+        k = np.floor(np.clip(aleph, 1, np.maximum(n_reference - 1, 1))).astype(int)
+        gamma = np.clip(aleph - k, 0, 1)
+        k = np.minimum(k, len(window_reference) - 1)
+        quantile = (1 - gamma) * np.take_along_axis(window_reference, k - 1, axis=0) + \
+                   gamma * np.take_along_axis(window_reference, k, axis=0)
+        # One reference data point - quantile is that point; no data - NAN
+        quantile = np.where(n_reference == 1, window_reference[0], quantile)
+        quantile[:, n_reference == 0] = np.nan
+        quantile[np.isnan(value)] = np.nan
+        data_rescaled[ind_time] = quantile
+
+    return data_rescaled
 
 
 def calculate_seasonal_window_mean(ts):
@@ -746,27 +1075,11 @@ def calculate_seasonal_window_mean(ts):
         key: (month, day); value: mean value from the ts
     '''
 
-    # Extract all indices for each (month, day) of a full year
+    window_mean, _ = calculate_seasonal_window_mean_std_array(
+        ts.values.reshape([-1, 1]), ts.index)
     d_fullyear = pd.date_range('20160101', '20161231')
-    dayofyear_fullyear = [(d.month, d.day) for d in d_fullyear]
-    list_dayofyear_index = [(ts.index.month==d[0]) & (ts.index.day==d[1]) for d in dayofyear_fullyear]
-    keys = dayofyear_fullyear
-    values = list_dayofyear_index
-    dict_dayofyear_index = dict(zip(keys, values))
-
-    # Calculate window-mean value for each (month, day)
-    dict_window_mean = {}  # key: (month, day); value: mean value from the ts
-    for d in d_fullyear:
-        # Identify (month, day)s in a 31-day window centered around the current day
-        d_window = pd.date_range(d.date() - pd.DateOffset(days=15),
-                                 d.date() + pd.DateOffset(days=15))
-        dayofyear_window = [(d.month, d.day) for d in d_window]
-        # Extract all data points in the window of all years
-        ts_window = pd.concat([ts.loc[dict_dayofyear_index[d]]
-                               for d in dayofyear_window])
-        # Calculate window mean value
-        mean_ts = ts_window.mean()
-        dict_window_mean[(d.month, d.day)] = mean_ts
+    dict_window_mean = dict(
+        ((d.month, d.day), window_mean[i, 0]) for i, d in enumerate(d_fullyear))
 
     return dict_window_mean
 
@@ -927,30 +1240,13 @@ def calculate_seasonal_window_mean_std(ts):
         key: (month, day); value: std value from the ts
     '''
 
-    # Extract all indices for each (month, day) of a full year
+    window_mean, window_std = calculate_seasonal_window_mean_std_array(
+        ts.values.reshape([-1, 1]), ts.index)
     d_fullyear = pd.date_range('20160101', '20161231')
-    dayofyear_fullyear = [(d.month, d.day) for d in d_fullyear]
-    list_dayofyear_index = [(ts.index.month==d[0]) & (ts.index.day==d[1]) for d in dayofyear_fullyear]
-    keys = dayofyear_fullyear
-    values = list_dayofyear_index
-    dict_dayofyear_index = dict(zip(keys, values))
-
-    # Calculate window mean and std values for each (month, day)
-    dict_window_mean = {}  # key: (month, day); value: mean value from the ts
-    dict_window_std = {}  # key: (month, day); value: std value from the ts
-    for d in d_fullyear:
-        # Identify (month, day)s in a 31-day window centered around the current day
-        d_window = pd.date_range(d.date() - pd.DateOffset(days=15),
-                                 d.date() + pd.DateOffset(days=15))
-        dayofyear_window = [(d.month, d.day) for d in d_window]
-        # Extract all data points in the window of all years
-        ts_window = pd.concat([ts.loc[dict_dayofyear_index[d]]
-                               for d in dayofyear_window])
-        # Calculate window mean and std values
-        mean_ts = ts_window.mean()
-        std_ts = ts_window.std()
-        dict_window_mean[(d.month, d.day)] = mean_ts
-        dict_window_std[(d.month, d.day)] = std_ts
+    dict_window_mean = dict(
+        ((d.month, d.day), window_mean[i, 0]) for i, d in enumerate(d_fullyear))
+    dict_window_std = dict(
+        ((d.month, d.day), window_std[i, 0]) for i, d in enumerate(d_fullyear))
 
     return dict_window_mean, dict_window_std
 
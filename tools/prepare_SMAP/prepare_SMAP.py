@@ -130,10 +130,13 @@ if cfg['INPUT']['smap_exist'] is True:
 # If SMAP data not processed, before, load and process
 else:
     # --- Load SMAP data --- #
+    # (ingested into an on-disk cube; days already in the cube are not reloaded)
     da_smap, da_flag = extract_smap_multiple_days(
         os.path.join(cfg['INPUT']['smap_dir'], 'SMAP_L3_SM_P_{}_*.h5'),
         start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'),
-        da_smap_domain=da_smap_domain)
+        da_smap_domain=da_smap_domain,
+        nproc=int(cfg['INPUT'].get('nproc', 1)),
+        out_nc=os.path.join(output_subdir_data_unscaled, 'soil_moisture_ingested.nc'))
     # --- Convert SMAP time to VIC-forcing-data time zone --- #
     # --- Shift SMAP data to the VIC-forcing-data time zone --- #
     # Shift SMAP time
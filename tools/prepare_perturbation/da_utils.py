@@ -121,3 +121,157 @@ def edges_from_centers(centers):
 
     return edges
 
+
+def calculate_exponential_circulant_eigenvalues(nlat, nlon, phi, max_pad=8):
+    ''' Calculates the eigenvalues of the circulant embedding of an exponential,
+        unit-variance spatial covariance on a regular [lat, lon] grid, for
+        generating spatially correlated random fields by FFT.
+
+    Parameters
+    ----------
+    nlat: <int>
+        Number of grid cells in lat
+    nlon: <int>
+        Number of grid cells in lon
+    phi: <float>
+        Range parameter of the exponential covariance, cov(h) = exp(-h/phi),
+        where h is the distance in number of grid cells (same as phi in
+        geoR::grf with unit grid spacing)
+    max_pad: <int>
+        Maximum size of the embedding grid, in multiples of the domain size.
+        The embedding grid is enlarged (from 2x) until the embedding is
+        non-negative definite; if still not at max_pad (large phi relative to
+        the domain), the remaining (small) negative eigenvalues are set to
+        zero, which slightly approximates the covariance.
+        Default: 8
+
+    Returns
+    ----------
+    eigenvalues: <np.array>
+        Eigenvalues of the embedding covariance
+        Dim: [nlat_embed, nlon_embed]
+
+    Require
+    ----------
+    numpy
+    '''
+
+    pad = 2
+    while True:
+        # --- Wrapped distances on the embedding torus --- #
+        nlat_embed = pad * nlat
+        nlon_embed = pad * nlon
+        dlat = np.minimum(np.arange(nlat_embed), nlat_embed - np.arange(nlat_embed))
+        dlon = np.minimum(np.arange(nlon_embed), nlon_embed - np.arange(nlon_embed))
+        h = np.sqrt(dlat[:, np.newaxis]**2 + dlon[np.newaxis, :]**2)
+        # --- Eigenvalues of the circulant covariance --- #
+        eigenvalues = np.real(np.fft.fft2(np.exp(-h / phi)))
+        if eigenvalues.min() >= -1e-8 * eigenvalues.max() or pad * 2 > max_pad:
+            break
+        pad *= 2
+
+    return np.maximum(eigenvalues, 0)
+
+
+def generate_spatial_random_fields(nlat, nlon, phi, nfield, seed=None,
+                                   eigenvalues=None, nfield_batch=16):
+    ''' Generates independent, zero-mean, unit-variance 2D random fields with
+        exponential spatial correlation (circulant embedding). Each FFT gives
+        two independent fields (real and imaginary parts).
+
+    Parameters
+    ----------
+    nlat: <int>
+        Number of grid cells in lat
+    nlon: <int>
+        Number of grid cells in lon
+    phi: <float>
+        Range parameter of the exponential covariance [number of grid cells]
+    nfield: <int>
+        Number of fields to generate
+    seed: <int or None>
+        Seed for the random number generator; None for drawing a fresh seed
+        from OS entropy.
+        Default: None
+    eigenvalues: <np.array> or None
+        Pre-calculated output of calculate_exponential_circulant_eigenvalues
+        for the same nlat, nlon and phi; None for calculating here.
+        Default: None
+    nfield_batch: <int>
+        Number of fields generated in each FFT batch (limits memory use)
+        Default: 16
+
+    Returns
+    ----------
+    fields: <np.array>
+        Dim: [nfield, lat, lon]
+
+    Require
+    ----------
+    numpy
+    calculate_exponential_circulant_eigenvalues
+    '''
+
+    if eigenvalues is None:
+        eigenvalues = calculate_exponential_circulant_eigenvalues(nlat, nlon, phi)
+    sqrt_eigenvalues = np.sqrt(eigenvalues / eigenvalues.size)
+
+    rng = np.random.default_rng(seed)
+    fields = np.empty([nfield, nlat, nlon])
+    for i in range(0, nfield, nfield_batch):
+        nfield_this = min(nfield_batch, nfield - i)
+        nfft = (nfield_this + 1) // 2
+        # --- Complex white noise on the embedding grid --- #
+        w = rng.standard_normal((2, nfft) + eigenvalues.shape)
+        y = np.fft.fft2(sqrt_eigenvalues * (w[0] + 1j * w[1]))
+        # --- Real and imaginary parts are independent fields --- #
+        y = np.concatenate([y.real[:, :nlat, :nlon], y.imag[:, :nlat, :nlon]])
+        fields[i:i+nfield_this] = y[:nfield_this]
+
+    return fields
+
+
+def generate_state_perturb_random_fields(lat, lon, n, N, phi, seed=None,
+                                         eigenvalues=None):
+    ''' Generates zero-mean, unit-variance, spatially correlated (but
+        tile/layer-uncorrelated) random fields for state perturbation of one
+        timestep. Same format as the "vert_uncorr.<time>.nc" files read by
+        EnKF_VIC.
+
+    Parameters
+    ----------
+    lat: <np.array>
+        Lat coordinates of the VIC domain
+    lon: <np.array>
+        Lon coordinates of the VIC domain
+    n: <int>
+        Number of states in each grid cell (nlayer * nveg * nsnow)
+    N: <int>
+        Number of ensemble members
+    phi: <float>
+        Range parameter of the exponential covariance [number of grid cells]
+    seed: <int or None>
+        Seed for the random number generator of this timestep
+        Default: None
+    eigenvalues: <np.array> or None
+        Pre-calculated output of calculate_exponential_circulant_eigenvalues
+        Default: None
+
+    Returns
+    ----------
+    da_noise: <xr.DataArray>
+        Dim: [lat, lon, n, N]
+
+    Require
+    ----------
+    generate_spatial_random_fields
+    '''
+
+    fields = generate_spatial_random_fields(
+        len(lat), len(lon), phi, n*N, seed, eigenvalues)  # [n*N, lat, lon]
+    noise = np.moveaxis(fields.reshape([n, N, len(lat), len(lon)]),
+                        [0, 1], [2, 3])  # [lat, lon, n, N]
+    da_noise = xr.DataArray(noise, coords=[lat, lon, range(n), range(N)],
+                            dims=['lat', 'lon', 'n', 'N'], name='noise')
+
+    return da_noise
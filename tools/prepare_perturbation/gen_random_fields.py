@@ -0,0 +1,57 @@
+
+# Generate zero-mean, unit-variance spatially correlated random fields
+# (exponential covariance, circulant embedding) for state perturbation,
+# and save one "vert_uncorr.<time>.nc" file for each timestep.
+# NOTE: EnKF_VIC can also generate the same fields on demand (set
+# state_perturb_random_field_phi in the [EnKF] section of the DA config file),
+# in which case this step is not needed.
+
+import pandas as pd
+import xarray as xr
+import os
+
+from da_utils import (calculate_exponential_circulant_eigenvalues,
+                      generate_state_perturb_random_fields)
+
+# ===================================================== #
+# Parameters
+# ===================================================== #
+# Inputs
+da_domain = xr.open_dataset(
+    '/pool0/data/yixinmao/data_assim/param/vic/ArkRed/ArkRed.domain.nc')['mask']
+times = pd.date_range('2015-03-31-00', '2018-01-01-00', freq='12H')
+nlayer = 3
+nveg = 12
+nsnow = 1
+phi = 12  # [number of VIC grid cells]
+N = 32
+seed = 234  # the seed of the i-th timestep is seed + i
+
+# Outputs
+output_dir = ('/pool0/data/yixinmao/data_assim/tools/prepare_perturbation/'
+              'output/random_fields_nc/phi12.N32')
+
+
+# ===================================================== #
+# Generate random fields and save
+# ===================================================== #
+n = nlayer * nveg * nsnow
+
+# The circulant embedding is the same for all timesteps
+eigenvalues = calculate_exponential_circulant_eigenvalues(
+    len(da_domain['lat']), len(da_domain['lon']), phi)
+
+for i, t in enumerate(times):
+    print(i)
+
+    # Generate fields - zero-mean, unit-variance, vertically uncorrelated
+    da_noise = generate_state_perturb_random_fields(
+        da_domain['lat'].values, da_domain['lon'].values, n, N, phi,
+        seed=seed+i, eigenvalues=eigenvalues)  # [lat, lon, n, N]
+
+    # Save array to file
+    ds_noise = xr.Dataset({'noise': da_noise})
+    ds_noise.to_netcdf(os.path.join(
+        output_dir,
+        'vert_uncorr.{}.nc'.format(t.strftime("%Y%m%d-%H-%M-%S"))))
+